@@ -0,0 +1,390 @@
+import argparse
+import gzip
+import json
+import os
+import sys
+
+import numpy as np
+import pysam
+import tables
+
+
+# default seed for random number generator, so that the same
+# data are generated each time unless a seed is specified
+SEED_DEFAULT = 0
+
+# number of fragments that are generated and written at once
+BATCH_SIZE_DEFAULT = 500000
+
+# names of files written to the output directory
+PARAMS_FILENAME = "params.json"
+BAM_FILENAME = "reads.bam"
+SNP_DIR = "snps"
+SNP_TAB_FILENAME = "snp_tab.h5"
+SNP_INDEX_FILENAME = "snp_index.h5"
+HAPLOTYPE_FILENAME = "haplotypes.h5"
+
+# base for each nucleotide code (0-3)
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(
+        description="Generates a synthetic data set for benchmarking "
+        "the mapping scripts: a sorted, indexed BAM file of reads from "
+        "random chromosome sequences, and the SNPs on those "
+        "chromosomes in both the text and HDF5 input formats. Reads "
+        "are named <chrom>_<number>, so that the chromosome of a read "
+        "can be recovered from its name.")
+
+    parser.add_argument("out_dir",
+                        help="directory to write data set to")
+
+    parser.add_argument("--n_reads", type=int, default=100000,
+                        help="number of reads to generate. For "
+                        "paired-end data each read of a pair counts "
+                        "as one read (default=100000)")
+
+    parser.add_argument("--paired_end", action="store_true",
+                        default=False,
+                        help="generate paired-end reads")
+
+    parser.add_argument("--read_len", type=int, default=100,
+                        help="length of reads (default=100)")
+
+    parser.add_argument("--n_chrom", type=int, default=2,
+                        help="number of chromosomes (default=2)")
+
+    parser.add_argument("--chrom_len", type=int, default=10000000,
+                        help="length of each chromosome (default=10000000)")
+
+    parser.add_argument("--snp_density", type=float, default=1.0,
+                        help="number of SNPs per kb (default=1.0)")
+
+    parser.add_argument("--n_samples", type=int, default=2,
+                        help="number of samples in haplotype file. "
+                        "Reads are generated from the haplotypes of the "
+                        "first sample (default=2)")
+
+    parser.add_argument("--insert_size_mean", type=float, default=250.0,
+                        help="mean insert size of read pairs (default=250)")
+
+    parser.add_argument("--insert_size_sd", type=float, default=50.0,
+                        help="standard deviation of insert size of "
+                        "read pairs (default=50)")
+
+    parser.add_argument("--dup_rate", type=float, default=0.05,
+                        help="fraction of reads (or read pairs) that "
+                        "duplicate the position of another read "
+                        "(default=0.05)")
+
+    parser.add_argument("--seed", type=int, default=SEED_DEFAULT,
+                        help="seed for random number generator. The "
+                        "same seed and options always give the same "
+                        "data (default=%d)" % SEED_DEFAULT)
+
+    parser.add_argument("--batch_size", type=int,
+                        default=BATCH_SIZE_DEFAULT,
+                        help="number of reads or read pairs to generate "
+                        "at once. Larger batches are faster but use "
+                        "more memory (default=%d)" % BATCH_SIZE_DEFAULT)
+
+    options = parser.parse_args()
+
+    if options.n_reads < 1:
+        parser.error("--n_reads must be at least 1")
+    if options.read_len < 1:
+        parser.error("--read_len must be at least 1")
+    if options.n_chrom < 1:
+        parser.error("--n_chrom must be at least 1")
+    if options.chrom_len < 2 * options.read_len or \
+       (options.paired_end and options.chrom_len < 2 * (options.insert_size_mean +
+                                                        4 * options.insert_size_sd)):
+        parser.error("--chrom_len is too short for the read length "
+                     "and insert size")
+    if options.snp_density < 0 or options.snp_density > 1000:
+        parser.error("--snp_density must be between 0 and 1000")
+    if options.n_samples < 1:
+        parser.error("--n_samples must be at least 1")
+    if options.dup_rate < 0 or options.dup_rate >= 1:
+        parser.error("--dup_rate must be at least 0 and less than 1")
+    if options.batch_size < 1:
+        parser.error("--batch_size must be at least 1")
+
+    return options
+
+
+
+class ChromSNPs(object):
+    """SNPs on a chromosome. pos are 1-based positions, ref and
+    alt are nucleotide codes (0-3), and haplotypes is a matrix with a
+    row for each SNP and a column for each haplotype"""
+    def __init__(self, pos, ref, alt, haplotypes):
+        self.pos = pos
+        self.ref = ref
+        self.alt = alt
+        self.haplotypes = haplotypes
+
+
+
+def make_snps(rng, genome, snp_density, n_samples):
+    """places SNPs at random positions on a chromosome, with a random
+    alternate allele and random haplotypes for each sample"""
+    n_snp = int(round(genome.shape[0] * snp_density / 1000.0))
+    pos = np.sort(rng.choice(genome.shape[0], size=n_snp,
+                             replace=False)).astype(np.int64) + 1
+    ref = genome[pos - 1]
+    alt = (ref + rng.integers(1, 4, size=n_snp, dtype=np.uint8)) % 4
+    haplotypes = rng.integers(2, size=(n_snp, 2 * n_samples), dtype=np.int8)
+
+    return ChromSNPs(pos, ref, alt, haplotypes)
+
+
+
+def make_hap_seqs(genome, snps):
+    """returns a 2D array of nucleotide codes with the sequence of
+    each haplotype of the first sample"""
+    hap_seqs = np.vstack([genome, genome])
+    for i in range(2):
+        hap_seqs[i, snps.pos - 1] = np.where(snps.haplotypes[:, i] == 1,
+                                             snps.alt, snps.ref)
+    return hap_seqs
+
+
+
+def gen_fragments(rng, n_frag, options, chrom_len):
+    """generates random fragments, returning arrays with the 0-based
+    start, length, and haplotype of each fragment, and whether each
+    fragment is flipped (reverse strand for single-end reads, or
+    left read is read2 for paired-end reads)"""
+    if options.paired_end:
+        frag_len = np.rint(rng.normal(options.insert_size_mean,
+                                      options.insert_size_sd, size=n_frag))
+        frag_len = np.clip(frag_len, options.read_len,
+                           chrom_len).astype(np.int64)
+    else:
+        frag_len = np.full(n_frag, options.read_len, dtype=np.int64)
+
+    start = rng.integers(0, chrom_len - frag_len + 1)
+
+    # some fragments are duplicates of others in the batch
+    is_dup = rng.random(n_frag) < options.dup_rate
+    src = rng.integers(n_frag, size=np.count_nonzero(is_dup))
+    start[is_dup] = start[src]
+    frag_len[is_dup] = frag_len[src]
+
+    hap = rng.integers(2, size=n_frag)
+    is_flipped = rng.random(n_frag) < 0.5
+
+    return start, frag_len, hap, is_flipped
+
+
+
+def get_read_seqs(hap_seqs, hap, start, read_len):
+    """returns a list of read sequence strings"""
+    offsets = np.arange(read_len)
+    codes = hap_seqs[hap[:, None], start[:, None] + offsets]
+    seqs = np.ascontiguousarray(BASES[codes]).view("S%d" % read_len)
+    return seqs[:, 0].astype("U").tolist()
+
+
+
+def write_sam_batch(f, chrom_name, names, start, frag_len, hap, is_flipped,
+                    hap_seqs, options):
+    """writes a batch of reads as SAM records"""
+    read_len = options.read_len
+    qual = "I" * read_len
+    cigar = "%dM" % read_len
+
+    if not options.paired_end:
+        flags = np.where(is_flipped, 16, 0).tolist()
+        record_fmt = "%%s\t%%d\t%s\t%%d\t60\t%s\t*\t0\t0\t%%s\t%s\n" % \
+            (chrom_name, cigar, qual)
+        f.write("".join(map(record_fmt.__mod__,
+                            zip(names, flags, (start + 1).tolist(),
+                                get_read_seqs(hap_seqs, hap, start,
+                                              read_len)))))
+        return
+
+    # left read is on forward strand and right read is on reverse
+    # strand. Left read is read1 unless fragment is flipped
+    right_start = start + frag_len - read_len
+    left_flags = np.where(is_flipped, 163, 99).tolist()
+    right_flags = np.where(is_flipped, 83, 147).tolist()
+
+    record_fmt = "%%s\t%%d\t%s\t%%d\t60\t%s\t=\t%%d\t%%d\t%%s\t%s\n" % \
+        (chrom_name, cigar, qual)
+    f.write("".join(map(record_fmt.__mod__,
+                        zip(names, left_flags, (start + 1).tolist(),
+                            (right_start + 1).tolist(), frag_len.tolist(),
+                            get_read_seqs(hap_seqs, hap, start, read_len)))))
+    f.write("".join(map(record_fmt.__mod__,
+                        zip(names, right_flags, (right_start + 1).tolist(),
+                            (start + 1).tolist(), (-frag_len).tolist(),
+                            get_read_seqs(hap_seqs, hap, right_start,
+                                          read_len)))))
+
+
+
+def write_snp_file(filename, snps):
+    """writes SNPs in the text input format"""
+    f = gzip.open(filename, "wt")
+    f.write("".join(map("%d %s %s\n".__mod__,
+                        zip(snps.pos.tolist(),
+                            BASES[snps.ref].view("S1").astype("U").tolist(),
+                            BASES[snps.alt].view("S1").astype("U").tolist()))))
+    f.close()
+
+
+
+class SNPTab(tables.IsDescription):
+    name = tables.StringCol(16)
+    pos = tables.Int64Col()
+    allele1 = tables.StringCol(100)
+    allele2 = tables.StringCol(100)
+
+
+class SamplesTab(tables.IsDescription):
+    name = tables.StringCol(64)
+
+
+
+def write_h5_files(out_dir, chrom_names, chrom_lens, chrom_snps, samples):
+    """writes SNPs in the HDF5 input format (like snp2h5 does)"""
+    snp_tab_h5 = tables.open_file(os.path.join(out_dir, SNP_TAB_FILENAME),
+                                  "w")
+    snp_index_h5 = tables.open_file(os.path.join(out_dir,
+                                                 SNP_INDEX_FILENAME), "w")
+    hap_h5 = tables.open_file(os.path.join(out_dir, HAPLOTYPE_FILENAME), "w")
+    zlib_filter = tables.Filters(complevel=1, complib="zlib")
+
+    for chrom_name, chrom_len, snps in zip(chrom_names, chrom_lens,
+                                           chrom_snps):
+        n_snp = snps.pos.shape[0]
+
+        table = snp_tab_h5.create_table(snp_tab_h5.root, chrom_name, SNPTab)
+        rows = np.zeros(n_snp, dtype=table.dtype)
+        rows["name"] = np.char.add(b"snp", np.arange(n_snp).astype("S"))
+        rows["pos"] = snps.pos
+        rows["allele1"] = BASES[snps.ref].view("S1")
+        rows["allele2"] = BASES[snps.alt].view("S1")
+        table.append(rows)
+        table.flush()
+
+        snp_index = np.full(chrom_len, -1, dtype=np.int32)
+        snp_index[snps.pos - 1] = np.arange(n_snp, dtype=np.int32)
+        carray = snp_index_h5.create_carray(snp_index_h5.root, chrom_name,
+                                            tables.Int32Atom(dflt=0),
+                                            snp_index.shape,
+                                            filters=zlib_filter)
+        carray[:] = snp_index
+
+        carray = hap_h5.create_carray(hap_h5.root, chrom_name,
+                                      tables.Int8Atom(dflt=0),
+                                      snps.haplotypes.shape,
+                                      filters=zlib_filter)
+        carray[:] = snps.haplotypes
+
+        # all haplotypes are phased
+        carray = hap_h5.create_carray(hap_h5.root, "phase_%s" % chrom_name,
+                                      tables.Int8Atom(dflt=0),
+                                      (n_snp, len(samples)),
+                                      filters=zlib_filter)
+        carray[:] = np.ones((n_snp, len(samples)), dtype=np.int8)
+
+        for h5f in (snp_tab_h5, snp_index_h5, hap_h5):
+            table = h5f.create_table(h5f.root, "samples_%s" % chrom_name,
+                                     SamplesTab)
+            rows = np.zeros(len(samples), dtype=table.dtype)
+            rows["name"] = samples
+            table.append(rows)
+            table.flush()
+
+    for h5f in (snp_tab_h5, snp_index_h5, hap_h5):
+        h5f.close()
+
+
+
+def get_n_frags(n_frag, n_chrom):
+    """divides n_frag fragments evenly between chromosomes"""
+    return [n_frag // n_chrom + (1 if i < n_frag % n_chrom else 0)
+            for i in range(n_chrom)]
+
+
+
+def main():
+    options = parse_options()
+
+    rng = np.random.default_rng(options.seed)
+
+    if not os.path.exists(options.out_dir):
+        os.makedirs(options.out_dir)
+    snp_dir = os.path.join(options.out_dir, SNP_DIR)
+    if not os.path.exists(snp_dir):
+        os.makedirs(snp_dir)
+
+    chrom_names = ["chr%d" % (i + 1) for i in range(options.n_chrom)]
+    chrom_lens = [options.chrom_len] * options.n_chrom
+    samples = ["sample%d" % (i + 1) for i in range(options.n_samples)]
+
+    if options.paired_end:
+        n_frag = options.n_reads // 2
+    else:
+        n_frag = options.n_reads
+
+    bam_filename = os.path.join(options.out_dir, BAM_FILENAME)
+    sam_filename = bam_filename + ".unsorted.sam.gz"
+    sam_f = gzip.open(sam_filename, "wt", compresslevel=1)
+    sam_f.write("@HD\tVN:1.0\tSO:unsorted\n")
+    for chrom_name, chrom_len in zip(chrom_names, chrom_lens):
+        sam_f.write("@SQ\tSN:%s\tLN:%d\n" % (chrom_name, chrom_len))
+
+    chrom_snps = []
+    for chrom_name, chrom_len, chrom_n_frag in \
+            zip(chrom_names, chrom_lens, get_n_frags(n_frag, options.n_chrom)):
+        sys.stderr.write("%s: generating sequence and SNPs\n" % chrom_name)
+        genome = rng.integers(4, size=chrom_len, dtype=np.uint8)
+        snps = make_snps(rng, genome, options.snp_density, options.n_samples)
+        chrom_snps.append(snps)
+        write_snp_file(os.path.join(snp_dir, "%s.snps.txt.gz" % chrom_name),
+                       snps)
+        hap_seqs = make_hap_seqs(genome, snps)
+        del genome
+
+        n_done = 0
+        while n_done < chrom_n_frag:
+            n_batch = min(options.batch_size, chrom_n_frag - n_done)
+            start, frag_len, hap, is_flipped = \
+                gen_fragments(rng, n_batch, options, chrom_len)
+            names = ["%s_%d" % (chrom_name, i)
+                     for i in range(n_done, n_done + n_batch)]
+            write_sam_batch(sam_f, chrom_name, names, start, frag_len, hap,
+                            is_flipped, hap_seqs, options)
+            n_done += n_batch
+            sys.stderr.write("%s: %d fragments\n" % (chrom_name, n_done))
+
+    sam_f.close()
+
+    sys.stderr.write("writing HDF5 SNP files\n")
+    write_h5_files(options.out_dir, chrom_names, chrom_lens, chrom_snps,
+                   samples)
+
+    sys.stderr.write("sorting and indexing %s\n" % bam_filename)
+    pysam.sort("-o", bam_filename, sam_filename)
+    pysam.index(bam_filename)
+    os.remove(sam_filename)
+
+    params = dict(vars(options))
+    params["chrom_names"] = chrom_names
+    params["chrom_lens"] = chrom_lens
+    params["n_snps"] = [int(snps.pos.shape[0]) for snps in chrom_snps]
+    params["n_reads"] = n_frag * 2 if options.paired_end else n_frag
+    params["samples"] = samples
+    with open(os.path.join(options.out_dir, PARAMS_FILENAME), "w") as f:
+        json.dump(params, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,550 @@
+import argparse
+import gzip
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pysam
+import tables
+
+# the mapping scripts are in the parent directory
+MAPPING_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, MAPPING_DIR)
+
+import snptable
+import find_intersecting_snps
+import filter_remapped_reads
+import rmdup
+import get_as_counts
+import util
+
+import make_bench_data
+
+
+# stages that can be benchmarked, in the order they are run
+STAGE_NAMES = ["snptable_read_file", "snptable_read_h5",
+               "get_overlapping_snps", "filter_reads",
+               "filter_remapped_reads", "rmdup", "get_as_counts"]
+
+# fraction of remapped reads that the fake mapper places at the
+# wrong position, so that filter_remapped_reads discards some reads
+REMAP_WRONG_RATE_DEFAULT = 0.05
+
+# number of fastq records converted to SAM records at once by the
+# fake mapper
+REMAP_BATCH_SIZE = 100000
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(
+        description="Times the stages of the mapping pipeline on a "
+        "data set made by make_bench_data.py, and writes the time, "
+        "throughput and peak memory use of each stage to a JSON file "
+        "so that runs can be compared across commits. Each stage runs "
+        "in a new process, so that its peak memory use is measured "
+        "separately. Peak memory use is reported for the process that "
+        "runs each stage and for the largest of its worker processes "
+        "(with --threads), rather than summed over workers.")
+
+    parser.add_argument("data_dir",
+                        help="directory containing data set written by "
+                        "make_bench_data.py")
+
+    parser.add_argument("--output", required=True,
+                        help="JSON file to write results to")
+
+    parser.add_argument("--stages", default=",".join(STAGE_NAMES),
+                        help="comma-delimited list of stages to run "
+                        "(default=%s)" % ",".join(STAGE_NAMES))
+
+    parser.add_argument("--work_dir", default=None,
+                        help="directory to write output files of stages "
+                        "to (default=<data_dir>/bench_work)")
+
+    parser.add_argument("--threads", type=int, default=1,
+                        help="number of worker processes used by stages "
+                        "that support them (default=1)")
+
+    parser.add_argument("--h5", action="store_true", default=False,
+                        help="read SNPs from the HDF5 files rather than "
+                        "the text files in the filter_reads and "
+                        "get_as_counts stages")
+
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="number of times to run each stage. The "
+                        "fastest run is used when comparing to a "
+                        "baseline (default=1)")
+
+    parser.add_argument("--label", default=None,
+                        help="label to record with results, for example "
+                        "the name of a branch")
+
+    parser.add_argument("--baseline", default=None,
+                        help="JSON file from an earlier run to compare "
+                        "results to")
+
+    options = parser.parse_args()
+
+    options.stages = options.stages.split(",")
+    for stage_name in options.stages:
+        if stage_name not in STAGE_NAMES:
+            parser.error("unknown stage '%s', expected one of: %s" %
+                         (stage_name, ", ".join(STAGE_NAMES)))
+
+    if options.threads < 1:
+        parser.error("--threads must be at least 1")
+    if options.repeat < 1:
+        parser.error("--repeat must be at least 1")
+
+    if options.work_dir is None:
+        options.work_dir = os.path.join(options.data_dir, "bench_work")
+
+    return options
+
+
+
+def get_git_commit():
+    """returns the commit of the mapping scripts, or None if it
+    cannot be determined"""
+    try:
+        out = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                      cwd=MAPPING_DIR,
+                                      stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode().strip()
+
+
+
+def read_params(data_dir):
+    """reads the parameters of a data set and adds the paths of its
+    files to them"""
+    with open(os.path.join(data_dir, make_bench_data.PARAMS_FILENAME)) as f:
+        data = json.load(f)
+
+    data["bam"] = os.path.join(data_dir, make_bench_data.BAM_FILENAME)
+    data["snp_dir"] = os.path.join(data_dir, make_bench_data.SNP_DIR)
+    data["snp_tab"] = os.path.join(data_dir,
+                                   make_bench_data.SNP_TAB_FILENAME)
+    data["snp_index"] = os.path.join(data_dir,
+                                     make_bench_data.SNP_INDEX_FILENAME)
+    data["haplotype"] = os.path.join(data_dir,
+                                     make_bench_data.HAPLOTYPE_FILENAME)
+    return data
+
+
+
+def get_snp_args(data, config):
+    """returns keyword arguments giving the SNP input files for
+    find_intersecting_snps.main and get_as_counts.main"""
+    if config["h5"]:
+        return {"snp_tab_filename" : data["snp_tab"],
+                "snp_index_filename" : data["snp_index"],
+                "haplotype_filename" : data["haplotype"]}
+    return {"snp_dir" : data["snp_dir"]}
+
+
+
+def get_filter_reads_prefix(work_dir):
+    """returns prefix of the output files of the filter_reads stage"""
+    return os.path.join(work_dir, "filter_reads",
+                        make_bench_data.BAM_FILENAME[:-len(".bam")])
+
+
+
+#
+# Each benchmark function runs one stage and returns a tuple of
+# (number of items processed, name of items, seconds). The seconds
+# only cover the work being benchmarked, which for some stages
+# excludes reading the input.
+#
+
+def bench_snptable_read_file(data, work_dir, config):
+    """reads the text SNP file of each chromosome"""
+    n_snp = 0
+    start = time.perf_counter()
+    for chrom_name in data["chrom_names"]:
+        snp_tab = snptable.SNPTable()
+        snp_tab.read_file(os.path.join(data["snp_dir"],
+                                       "%s.snps.txt.gz" % chrom_name))
+        n_snp += snp_tab.n_snp
+    return n_snp, "snps", time.perf_counter() - start
+
+
+
+def bench_snptable_read_h5(data, work_dir, config):
+    """reads the SNPs of each chromosome from the HDF5 files"""
+    n_snp = 0
+    start = time.perf_counter()
+    snp_tab_h5 = tables.open_file(data["snp_tab"], "r")
+    snp_index_h5 = tables.open_file(data["snp_index"], "r")
+    hap_h5 = tables.open_file(data["haplotype"], "r")
+    for chrom_name in data["chrom_names"]:
+        snp_tab = snptable.SNPTable()
+        snp_tab.read_h5(snp_tab_h5, snp_index_h5, hap_h5, chrom_name)
+        n_snp += snp_tab.n_snp
+    for h5f in (snp_tab_h5, snp_index_h5, hap_h5):
+        h5f.close()
+    return n_snp, "snps", time.perf_counter() - start
+
+
+
+def bench_get_overlapping_snps(data, work_dir, config):
+    """looks up the SNPs overlapping every read, in blocks of reads
+    as filter_reads does. Reading SNPs and reads is not timed."""
+    bam = pysam.Samfile(data["bam"], "rb")
+    n_read = 0
+    seconds = 0.0
+    for chrom_name in data["chrom_names"]:
+        snp_tab = snptable.SNPTable()
+        snp_tab.read_file(os.path.join(data["snp_dir"],
+                                       "%s.snps.txt.gz" % chrom_name))
+        for block in snptable.iter_read_blocks(bam.fetch(chrom_name)):
+            start = time.perf_counter()
+            snp_tab.get_overlapping_snps_reads(block)
+            seconds += time.perf_counter() - start
+            n_read += len(block)
+    bam.close()
+    return n_read, "reads", seconds
+
+
+
+def bench_filter_reads(data, work_dir, config):
+    """runs find_intersecting_snps.py"""
+    start = time.perf_counter()
+    find_intersecting_snps.main(data["bam"],
+                                is_paired_end=data["paired_end"],
+                                is_sorted=True,
+                                output_dir=os.path.join(work_dir,
+                                                        "filter_reads"),
+                                threads=config["threads"],
+                                **get_snp_args(data, config))
+    return data["n_reads"], "reads", time.perf_counter() - start
+
+
+
+def bench_filter_remapped_reads(data, work_dir, config):
+    """runs filter_remapped_reads.py on the reads written by the
+    filter_reads stage, after they have been remapped by
+    make_remap_bam"""
+    prefix = get_filter_reads_prefix(work_dir)
+    remap_bam = prefix + ".remapped.bam"
+    bam = pysam.Samfile(remap_bam, "rb")
+    n_read = sum(1 for read in bam)
+    bam.close()
+
+    start = time.perf_counter()
+    filter_remapped_reads.main(prefix + ".to.remap.bam", remap_bam,
+                               prefix + ".remap.keep.bam",
+                               threads=config["threads"])
+    return n_read, "remapped reads", time.perf_counter() - start
+
+
+
+def bench_rmdup(data, work_dir, config):
+    """runs rmdup.py (which uses rmdup_pe.py for paired-end reads)"""
+    start = time.perf_counter()
+    rmdup.main(data["bam"], os.path.join(work_dir, "rmdup.bam"),
+               paired_end=data["paired_end"], threads=config["threads"])
+    return data["n_reads"], "reads", time.perf_counter() - start
+
+
+
+def bench_get_as_counts(data, work_dir, config):
+    """runs get_as_counts.py"""
+    start = time.perf_counter()
+    get_as_counts.main(data["bam"],
+                       output_filename=os.path.join(work_dir,
+                                                    "as_counts.txt"),
+                       threads=config["threads"],
+                       **get_snp_args(data, config))
+    return data["n_reads"], "reads", time.perf_counter() - start
+
+
+
+BENCH_FUNCTIONS = {"snptable_read_file" : bench_snptable_read_file,
+                   "snptable_read_h5" : bench_snptable_read_h5,
+                   "get_overlapping_snps" : bench_get_overlapping_snps,
+                   "filter_reads" : bench_filter_reads,
+                   "filter_remapped_reads" : bench_filter_remapped_reads,
+                   "rmdup" : bench_rmdup,
+                   "get_as_counts" : bench_get_as_counts}
+
+
+
+def iter_fastq(filename):
+    """yields lists of up to REMAP_BATCH_SIZE (name, seq, qual) tuples
+    from a gzipped fastq file"""
+    f = gzip.open(filename, "rt")
+    while True:
+        lines = list(itertools.islice(f, 4 * REMAP_BATCH_SIZE))
+        if not lines:
+            break
+        yield [(lines[i][1:].rstrip("\n"), lines[i+1].rstrip("\n"),
+                lines[i+3].rstrip("\n")) for i in range(0, len(lines), 4)]
+    f.close()
+
+
+
+def make_remap_bam(prefix, wrong_rate=REMAP_WRONG_RATE_DEFAULT, seed=0):
+    """Stands in for remapping the fastq files written by
+    find_intersecting_snps.py. Each read is placed at the position
+    given in its name (which is where it came from), except for a
+    fraction wrong_rate of reads, which are placed one base away.
+    The reads are sorted by coordinate and written to 
+    <prefix>.remapped.bam, as the remapped reads are in the pipeline
+    (see README.md)."""
+    rng = np.random.default_rng(seed)
+    comp = str.maketrans("ACGTN", "TGCAN")
+
+    template = pysam.Samfile(prefix + ".to.remap.bam", "rb")
+    sam_filename = prefix + ".remapped.sam"
+    sam_f = open(sam_filename, "w")
+    sam_f.write(str(template.header))
+    template.close()
+
+    if os.path.exists(prefix + ".remap.fq1.gz"):
+        for batch1, batch2 in zip(iter_fastq(prefix + ".remap.fq1.gz"),
+                                  iter_fastq(prefix + ".remap.fq2.gz")):
+            lines = []
+            shift = (rng.random(len(batch1)) < wrong_rate).tolist()
+            for (name, seq1, qual1), (_, seq2, qual2), s in \
+                    zip(batch1, batch2, shift):
+                orig_name, coord_str, num, total = \
+                    filter_remapped_reads.parse_remap_name(name)
+                chrom_name = orig_name.rsplit("_", 1)[0]
+                pos1, pos2 = [int(x) for x in coord_str.split("-")]
+                pos1 += s
+                tlen = pos2 + len(seq2) - pos1
+                lines.append("%s\t99\t%s\t%d\t60\t%dM\t=\t%d\t%d\t%s\t%s\n"
+                             "%s\t147\t%s\t%d\t60\t%dM\t=\t%d\t%d\t%s\t%s\n" %
+                             (name, chrom_name, pos1, len(seq1), pos2, tlen,
+                              seq1, qual1,
+                              name, chrom_name, pos2, len(seq2), pos1, -tlen,
+                              seq2.translate(comp)[::-1], qual2))
+            sam_f.write("".join(lines))
+    else:
+        for batch in iter_fastq(prefix + ".remap.fq.gz"):
+            lines = []
+            shift = (rng.random(len(batch)) < wrong_rate).tolist()
+            for (name, seq, qual), s in zip(batch, shift):
+                orig_name, coord_str, num, total = \
+                    filter_remapped_reads.parse_remap_name(name)
+                chrom_name = orig_name.rsplit("_", 1)[0]
+                lines.append("%s\t0\t%s\t%d\t60\t%dM\t*\t0\t0\t%s\t%s\n" %
+                             (name, chrom_name, int(coord_str) + s, len(seq),
+                              seq, qual))
+            sam_f.write("".join(lines))
+
+    sam_f.close()
+
+    sorted_bam = util.sort_bam(sam_filename, prefix + ".remapped")
+    os.rename(sorted_bam, prefix + ".remapped.bam")
+    os.remove(sam_filename)
+
+
+
+def prepare_remap(args):
+    """Worker process function that writes the input files of the
+    filter_remapped_reads stage, running find_intersecting_snps.py
+    first if the filter_reads stage has not been run"""
+    data, work_dir, config, log_filename = args
+    redirect_stderr(log_filename)
+
+    prefix = get_filter_reads_prefix(work_dir)
+    if not os.path.exists(prefix + ".to.remap.bam"):
+        bench_filter_reads(data, work_dir, config)
+    make_remap_bam(prefix, seed=data["seed"])
+
+
+
+def redirect_stderr(log_filename):
+    """sends output to stderr (including from C libraries) to a log
+    file, so that messages from the mapping scripts do not clutter
+    the benchmark output"""
+    log_f = open(log_filename, "w")
+    os.dup2(log_f.fileno(), sys.stderr.fileno())
+    log_f.close()
+
+
+
+def run_stage(args):
+    """Worker process function that runs one stage and returns a
+    dictionary with its timing and peak memory use. peak_rss_mb is the
+    peak of the process that runs the stage, and worker_peak_rss_mb is
+    the peak of the largest single worker process that it started 
+    (0 if it did not start any). They are not summed over workers."""
+    stage_name, data, work_dir, config, log_filename = args
+    redirect_stderr(log_filename)
+
+    start_rss = util.get_peak_rss_mb()
+    start = time.perf_counter()
+    n_items, unit, seconds = BENCH_FUNCTIONS[stage_name](data, work_dir,
+                                                         config)
+    wall_seconds = time.perf_counter() - start
+    sys.stderr.flush()
+
+    return {"stage" : stage_name,
+            "items" : n_items,
+            "unit" : unit,
+            "seconds" : seconds,
+            "wall_seconds" : wall_seconds,
+            "items_per_second" : n_items / seconds if seconds > 0 else None,
+            "start_rss_mb" : start_rss,
+            "peak_rss_mb" : util.get_peak_rss_mb(),
+            "worker_peak_rss_mb" : util.get_peak_rss_mb(children=True)}
+
+
+
+def run_worker(func, args, conn):
+    """target of worker processes, which sends the result of
+    func(args) back through conn"""
+    conn.send(func(args))
+    conn.close()
+
+
+
+def run_in_new_process(func, args, log_filename):
+    """runs func(args) in a new process, so that the peak memory use
+    that it measures only includes its own work. The process is not
+    a daemon (unlike Pool workers), so that stages can start their
+    own worker processes. log_filename is the file that the process
+    writes its messages to, which is named if it fails."""
+    ctx = multiprocessing.get_context("spawn")
+    recv_conn, send_conn = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=run_worker, args=(func, args, send_conn))
+    proc.start()
+    send_conn.close()
+    try:
+        result = recv_conn.recv()
+    except EOFError:
+        result = None
+    proc.join()
+
+    if proc.exitcode != 0:
+        raise RuntimeError("%s failed in worker process, see log file "
+                           "%s" % (func.__name__, log_filename))
+    return result
+
+
+
+def get_best_runs(results):
+    """returns a dictionary with the fastest run of each stage"""
+    best = {}
+    for run in results["runs"]:
+        stage_name = run["stage"]
+        if stage_name not in best or run["seconds"] < best[stage_name]["seconds"]:
+            best[stage_name] = run
+    return best
+
+
+
+def write_summary(out_f, results, baseline=None):
+    best = get_best_runs(results)
+    if baseline:
+        baseline_best = get_best_runs(baseline)
+    else:
+        baseline_best = {}
+
+    # PEAK.MB is the peak memory of the process that runs each stage,
+    # and WORKER.MB is that of its largest worker process (if any)
+    out_f.write("%-22s %10s %14s %10s %10s" % ("STAGE", "SECONDS",
+                                                "ITEMS/SEC", "PEAK.MB",
+                                                "WORKER.MB"))
+    if baseline_best:
+        out_f.write(" %10s %10s" % ("SPEEDUP", "MEM.RATIO"))
+    out_f.write("\n")
+
+    for stage_name in STAGE_NAMES:
+        if stage_name not in best:
+            continue
+        run = best[stage_name]
+        out_f.write("%-22s %10.2f %14.0f %10.1f %10.1f" %
+                    (stage_name, run["seconds"], run["items_per_second"] or 0,
+                     run["peak_rss_mb"], run.get("worker_peak_rss_mb", 0)))
+        old_run = baseline_best.get(stage_name)
+        if old_run:
+            out_f.write(" %10.2f %10.2f" %
+                        (old_run["seconds"] / run["seconds"],
+                         run["peak_rss_mb"] / old_run["peak_rss_mb"]))
+        out_f.write("\n")
+
+
+
+def main():
+    options = parse_options()
+
+    data = read_params(options.data_dir)
+    config = {"threads" : options.threads,
+              "h5" : options.h5}
+
+    for dir_name in (options.work_dir,
+                     os.path.dirname(get_filter_reads_prefix(options.work_dir))):
+        if not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+
+    results = {"label" : options.label,
+               "commit" : get_git_commit(),
+               "date" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "host" : platform.node(),
+               "platform" : platform.platform(),
+               "cpu_count" : os.cpu_count(),
+               "python_version" : platform.python_version(),
+               "numpy_version" : np.__version__,
+               "pysam_version" : pysam.__version__,
+               "pytables_version" : tables.__version__,
+               "threads" : options.threads,
+               "h5" : options.h5,
+               "data" : data,
+               "runs" : []}
+
+    for stage_name in STAGE_NAMES:
+        if stage_name not in options.stages:
+            continue
+
+        if stage_name == "filter_remapped_reads":
+            sys.stderr.write("preparing remapped reads\n")
+            log_filename = os.path.join(options.work_dir,
+                                        "prepare_remap.log")
+            run_in_new_process(prepare_remap,
+                               (data, options.work_dir, config,
+                                log_filename),
+                               log_filename)
+
+        for i in range(options.repeat):
+            sys.stderr.write("running %s\n" % stage_name)
+            log_filename = os.path.join(options.work_dir,
+                                        "%s.%d.log" % (stage_name, i))
+            run = run_in_new_process(run_stage,
+                                     (stage_name, data, options.work_dir,
+                                      config, log_filename),
+                                     log_filename)
+            run["repeat"] = i
+            results["runs"].append(run)
+            sys.stderr.write("  %.2f seconds, %.1f MB peak RSS, %.1f MB "
+                             "peak RSS of largest worker\n" %
+                             (run["seconds"], run["peak_rss_mb"],
+                              run["worker_peak_rss_mb"]))
+
+    with open(options.output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+    else:
+        baseline = None
+
+    write_summary(sys.stdout, results, baseline)
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+#!/bin/bash
+#
+# Benchmarks the mapping scripts on single-end and paired-end data
+# sets with 10^5, 10^6 and 10^7 reads. Data sets are generated the
+# first time this is run. Results are written to
+# $OUT_DIR/<label>.<se|pe>.<n_reads>.json, and are compared to the
+# results of the baseline label, if given.
+#
+# usage: run_benchmarks.sh <label> [<baseline label>]
+#
+
+DATA_DIR=${DATA_DIR:-$HOME/wasp_bench/data}
+OUT_DIR=${OUT_DIR:-$HOME/wasp_bench/results}
+THREADS=${THREADS:-1}
+
+LABEL=$1
+BASELINE=$2
+
+if [ -z "$LABEL" ]; then
+    echo "usage: run_benchmarks.sh <label> [<baseline label>]" >&2
+    exit 2
+fi
+
+mkdir -p $OUT_DIR
+
+for N_READS in 100000 1000000 10000000; do
+    for MODE in se pe; do
+        DATA=$DATA_DIR/$MODE.$N_READS
+
+        if [ ! -e $DATA/params.json ]; then
+            if [ $MODE == "pe" ]; then
+                PE_OPT="--paired_end"
+            else
+                PE_OPT=""
+            fi
+            python make_bench_data.py $PE_OPT --n_reads $N_READS $DATA
+        fi
+
+        BASELINE_OPT=""
+        if [ -n "$BASELINE" ]; then
+            BASELINE_OPT="--baseline $OUT_DIR/$BASELINE.$MODE.$N_READS.json"
+        fi
+
+        echo "$MODE $N_READS"
+        python run_benchmarks.py --label $LABEL --threads $THREADS \
+               --output $OUT_DIR/$LABEL.$MODE.$N_READS.json \
+               $BASELINE_OPT $DATA
+    done
+done
@@ -1,9 +1,41 @@
 
 import argparse
 import sys
+import os
+import pickle
+import tempfile
+import time
 
+import numpy as np
 import pysam
 
+import util
+
+
+# default maximum memory used by samtools sort, per thread
+SORT_MEM_DEFAULT = util.SORT_MEM_DEFAULT
+
+# pysam version needed to sort by read name in ASCII order (sort -N,
+# which was added in samtools 1.17)
+MIN_PYSAM_VER_NAME_SORT = "0.21.0"
+
+# status of a remapped read (see check_remapped_read)
+REMAP_CORRECT = 0
+REMAP_WRONG = 1
+REMAP_SKIP = 2
+
+# number of reads that are read before bookkeeping arrays are updated
+REMAP_BLOCK_SIZE = 100000
+
+# number of distinct CIGARs above which the exact number is not tracked
+MAX_CIGARS = 3
+
+# constants used to hash read names (the seed and prime are from the
+# 64-bit FNV hash, and the shift mixes high bits into the low bits
+# that are used to choose slots)
+HASH_SEED = np.uint64(14695981039346656037)
+HASH_PRIME = np.uint64(1099511628211)
+HASH_SHIFT = np.uint64(29)
 
 
 def parse_options():
@@ -41,7 +73,78 @@ def parse_options():
     parser.add_argument("keep_bam", help="output BAM file to write "
                         "filtered set of reads to")
 
-    return parser.parse_args()
+    parser.add_argument("--merge_join", action="store_true",
+                        default=False,
+                        help="Stream both input BAM files in order of "
+                        "read name and filter the reads for each original "
+                        "read name as they are read, rather than holding "
+                        "the names of all remapped reads in memory. Input "
+                        "files that are not already sorted by read name "
+                        "(in ASCII order, as by samtools sort -N) are "
+                        "sorted first, using temporary files in the "
+                        "directory of keep_bam (this requires pysam "
+                        "%s or later). Reads are written to "
+                        "keep_bam in order of read name (with '.' "
+                        "appended, which is the order of the remapped "
+                        "read names)." % MIN_PYSAM_VER_NAME_SORT)
+
+    parser.add_argument("--sort_mem", default=SORT_MEM_DEFAULT,
+                        help="Maximum memory used by samtools sort (per "
+                        "thread) when input files are sorted for "
+                        "--merge_join or --threads (default=%s)" %
+                        SORT_MEM_DEFAULT)
+
+    parser.add_argument("--threads", type=int, default=1,
+                        help="Number of worker processes to use "
+                        "(default=1). If greater than 1, to_remap_bam is "
+                        "sorted by coordinate (as is remap_bam, if its "
+                        "header does not say that it is sorted) and both "
+                        "files are indexed, using temporary files in the "
+                        "directory of keep_bam. Workers then read the "
+                        "remapped reads on each chromosome, and then check "
+                        "the reads to remap on each chromosome, writing "
+                        "the reads that are kept to shard files that are "
+                        "concatenated into keep_bam. Sorting uses THREADS "
+                        "threads but is otherwise done by the main "
+                        "process, and the speedup is limited by the "
+                        "largest chromosome. Reads are written in order "
+                        "of chromosome and position (with the reads of "
+                        "each pair together) rather than in the order of "
+                        "to_remap_bam. Remapped reads only count as "
+                        "mapping to the correct location if they are on "
+                        "the same chromosome as the original read, and "
+                        "reads whose remapped versions were all on other "
+                        "chromosomes are counted as 'not present' rather "
+                        "than 'bad'. Otherwise the same reads are kept as "
+                        "with one process. Cannot be used with "
+                        "--merge_join.")
+
+    parser.add_argument("--metrics", default=None, metavar="METRICS_FILE",
+                        help="Write metrics to this file, including the "
+                        "time spent reading remapped reads and writing "
+                        "kept reads (for each chromosome, with --threads), "
+                        "numbers of reads, reads per second, the largest "
+                        "numbers of read names and cached reads, and peak "
+                        "memory use. The file is written in TSV format if "
+                        "its name ends with .tsv, and in JSON format "
+                        "otherwise.")
+
+    parser.add_argument("--progress", type=float, default=0,
+                        metavar="SECONDS",
+                        help="Write a progress line to stderr at most "
+                        "every SECONDS seconds (default=0, no progress "
+                        "lines).")
+
+    options = parser.parse_args()
+
+    if options.threads < 1:
+        parser.error("--threads must be >= 1")
+    if options.progress < 0:
+        parser.error("--progress must be >= 0")
+    if options.threads > 1 and options.merge_join:
+        parser.error("--threads cannot be used with --merge_join")
+
+    return options
 
 
 class ReadStats:
@@ -69,6 +172,13 @@ class ReadStats:
         self.cigar_missing = 0
         
 
+    def add(self, other):
+        """adds counts from another ReadStats object to this one
+        (e.g. to combine counts from separate worker processes)"""
+        for attr, val in vars(other).items():
+            setattr(self, attr, getattr(self, attr) + val)
+
+            
     def write(self):
         sys.stderr.write("keep reads: %d\n" % self.keep)
         sys.stderr.write("bad reads: %d\n" % self.bad)
@@ -79,230 +189,1005 @@ class ReadStats:
         sys.stderr.write("  mate pair missing: {}\n".format(self.pair_missing))
 
 
-def filter_reads(remap_bam):
-    # dictionary to keep track of how many times a given read is observed
-    read_counts = {}
+def parse_remap_name(qname):
+    """parses name of remapped read, which should contain:
+       1 - the original name of the read
+       2 - the coordinate that it should map to
+       3 - the number of the read
+       4 - the total number of reads being remapped
+    Returns tuple of (orig_name, coord_str, num, total)"""
+    words = qname.split(".")
+    if len(words) < 4:
+        raise ValueError("expected read names to be formatted "
+                         "like <orig_name>.<coordinate>."
+                         "<read_number>.<total_read_number> but got "
+                         "%s" % qname)
+
+    # token separator '.' can potentially occur in
+    # original read name, so if more than 4 tokens,
+    # assume first tokens make up original read name
+    orig_name = ".".join(words[0:len(words)-3])
+    coord_str, num_str, total_str = words[len(words)-3:]
+
+    return orig_name, coord_str, int(num_str), int(total_str)
+
+
+
+def check_remapped_read(read, coord_str):
+    """Checks whether a (primary) remapped read mapped back to the
+    coordinate(s) in coord_str. Returns REMAP_CORRECT or REMAP_WRONG, 
+    or REMAP_SKIP for the right end of a read pair (only the left 
+    end is checked)."""
+    if '-' in coord_str:
+        # paired end read, coordinate gives expected positions for each end
+        c1, c2 = coord_str.split("-")
+
+        if not read.is_paired:
+            return REMAP_WRONG
+        if not read.is_proper_pair:
+            return REMAP_WRONG
+
+        pos1 = int(c1)
+        pos2 = int(c2)
+
+        # only use left end of reads, but check that right end is in
+        # correct location
+        if read.pos < read.next_reference_start or (read.pos == read.next_reference_start and read.is_read1 and not read.is_read2):
+            if pos1 == read.pos+1 and pos2 == read.next_reference_start+1:
+                # both reads mapped to correct location
+                return REMAP_CORRECT
+        else:
+            # this is right end of read
+            return REMAP_SKIP
+    else:
+        # single end read
+        pos = int(coord_str)
+
+        if pos == read.pos+1:
+            # read maps to correct location
+            return REMAP_CORRECT
+
+    return REMAP_WRONG
+
+
 
-    # names of reads that should be kept
-    keep_reads = set([])
-    bad_reads = set([])
+class ReadNameTable(object):
+    """Open-addressing hash table that maps read names to dense 
+    integer ids (0, 1, 2, ...). Slots hold 64-bit hashes of names
+    in NumPy arrays rather than Python strings, and the names 
+    themselves are kept (indexed by id) in a fixed-width NumPy bytes 
+    array, which uses much less memory than a dict when there are
+    millions of names. Names are looked up an array at a time. When
+    a hash matches, the stored name is compared as well, so names
+    with the same hash are given different ids."""
+
+    def __init__(self, capacity=1024):
+        # keys are hashes of names, with 0 indicating an empty slot
+        self.keys = np.zeros(capacity, dtype=np.uint64)
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        # names indexed by id (widened when longer names are added)
+        self.id_names = np.zeros(capacity // 2, dtype="S1")
+        self.n_name = 0
+
+        
+    def hash_names(self, names):
+        """returns array of (non-zero) 64-bit hashes of names, which
+        are a NumPy bytes array. Names are hashed 8 bytes at a time."""
+        width = -(-names.dtype.itemsize // 8) * 8
+        words = names.astype("S%d" % width).view(np.uint64)
+        words = words.reshape(names.shape[0], width // 8)
+        hashes = np.full(names.shape[0], HASH_SEED, dtype=np.uint64)
+        for i in range(words.shape[1]):
+            # names are padded with zero bytes, and words that are all
+            # padding are not hashed, so that a name has the same hash
+            # in arrays of any width
+            word = words[:, i]
+            mixed = (hashes ^ word) * HASH_PRIME
+            mixed ^= mixed >> HASH_SHIFT
+            hashes = np.where(word != 0, mixed, hashes)
+        hashes[hashes == 0] = 1
+        return hashes
+
+
+    def unique_names(self, names):
+        """returns unique hashes, unique names (as a NumPy bytes array) 
+        and the index of each of names in the unique arrays"""
+        name_array = np.array(names, dtype="S")
+        keys, inverse = np.unique(self.hash_names(name_array),
+                                  return_inverse=True)
+        inverse = inverse.ravel()
+        uniq_names = np.zeros(keys.shape[0], dtype=name_array.dtype)
+        uniq_names[inverse] = name_array
+
+        if not np.array_equal(uniq_names[inverse], name_array):
+            # different names in this block have the same hash,
+            # so find unique names by comparing the names themselves
+            uniq_names, inverse = np.unique(name_array, return_inverse=True)
+            inverse = inverse.ravel()
+            keys = self.hash_names(uniq_names)
+
+        return keys, uniq_names, inverse
 
-    # a dictionary of lists for each read
-    # each list contains two sets of CIGAR strings, one for each pair
-    cigar_strings = {}
     
-    for read in remap_bam:        
-        # parse name of read, which should contain:
-        # 1 - the original name of the read
-        # 2 - the coordinate that it should map to
-        # 3 - the number of the read
-        # 4 - the total number of reads being remapped
-        words = read.qname.split(".")
-        if len(words) < 4:
-            raise ValueError("expected read names to be formatted "
-                             "like <orig_name>.<coordinate>."
-                             "<read_number>.<total_read_number> but got "
-                             "%s" % read.qname)
-
-        # token separator '.' can potentially occur in
-        # original read name, so if more than 4 tokens,
-        # assume first tokens make up original read name
-        orig_name = ".".join(words[0:len(words)-3])
-        coord_str, num_str, total_str = words[len(words)-3:]
-        num = int(num_str)
-        total = int(total_str)
+    def find_keys(self, keys, names):
+        """returns ids of keys with names, or -1 for names that are
+        not present"""
+        mask = np.uint64(self.keys.shape[0] - 1)
+        pos = keys & mask
+        result = np.full(keys.shape[0], -1, dtype=np.int64)
+        todo = np.arange(keys.shape[0])
+
+        while todo.shape[0] > 0:
+            slot_keys = self.keys[pos[todo]]
+            slot_ids = self.ids[pos[todo]]
+            is_match = slot_keys == keys[todo]
+            # a matching hash is only a match if names are the same
+            is_match[is_match] = (self.id_names[slot_ids[is_match]] ==
+                                  names[todo[is_match]])
+            result[todo[is_match]] = slot_ids[is_match]
+
+            # keep probing (linearly) until name or empty slot is found
+            todo = todo[~(is_match | (slot_keys == 0))]
+            pos[todo] = (pos[todo] + np.uint64(1)) & mask
+
+        return result
+
+    
+    def insert_keys(self, keys, ids):
+        """inserts keys of names that are not already present with ids"""
+        mask = np.uint64(self.keys.shape[0] - 1)
+        pos = keys & mask
+        todo = np.arange(keys.shape[0])
+
+        while todo.shape[0] > 0:
+            is_empty = self.keys[pos[todo]] == 0
+            cand = todo[is_empty]
+            
+            # if several keys are at same empty slot, only
+            # first one is put in it
+            _, first = np.unique(pos[cand], return_index=True)
+            placed = cand[first]
+            self.keys[pos[placed]] = keys[placed]
+            self.ids[pos[placed]] = ids[placed]
 
+            todo = np.setdiff1d(todo, placed, assume_unique=True)
+            pos[todo] = (pos[todo] + np.uint64(1)) & mask
+
+            
+    def resize(self, capacity):
+        """changes number of slots in table, re-inserting all keys"""
+        is_used = self.keys != 0
+        keys = self.keys[is_used]
+        ids = self.ids[is_used]
+        self.keys = np.zeros(capacity, dtype=np.uint64)
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.insert_keys(keys, ids)
+
+
+    def add_names(self, names, ids):
+        """stores names with ids, growing and widening id_names 
+        as needed"""
+        size = self.id_names.shape[0]
+        while int(ids.max()) >= size:
+            size *= 2
+        itemsize = max(self.id_names.dtype.itemsize, names.dtype.itemsize)
+        if size > self.id_names.shape[0] or \
+           itemsize > self.id_names.dtype.itemsize:
+            id_names = np.zeros(size, dtype="S%d" % itemsize)
+            id_names[:self.n_name] = self.id_names[:self.n_name]
+            self.id_names = id_names
+        self.id_names[ids] = names
+
+        
+    def lookup(self, names, add=False):
+        """Returns array with ids of names. Names that are not 
+        present are added with new ids if add is True, otherwise 
+        their ids are -1."""
+        if len(names) == 0:
+            return np.zeros(0, dtype=np.int64)
+        keys, uniq_names, inverse = self.unique_names(names)
+        ids = self.find_keys(keys, uniq_names)
+
+        if add:
+            is_new = ids == -1
+            n_new = int(np.sum(is_new))
+
+            if n_new > 0:
+                # keep table at most half full
+                capacity = self.keys.shape[0]
+                while (self.n_name + n_new) * 2 > capacity:
+                    capacity *= 2
+                if capacity > self.keys.shape[0]:
+                    self.resize(capacity)
+
+                ids[is_new] = np.arange(self.n_name, self.n_name + n_new)
+                self.add_names(uniq_names[is_new], ids[is_new])
+                self.insert_keys(keys[is_new], ids[is_new])
+                self.n_name += n_new
+
+        return ids[inverse]
+
+
+
+class RemapCounts(object):
+    """Bookkeeping for remapped reads. Information about each original
+    read is stored in parallel NumPy arrays, indexed by the id that
+    its name is given by a ReadNameTable, and CIGAR strings are stored 
+    as integer ids (which index cigar_strings)."""
+
+    def __init__(self):
+        self.names = ReadNameTable()
+        self.size = 0
+
+        # expected total number of remapped versions of each read
+        self.total = np.zeros(0, dtype=np.uint32)
+        # number of versions that remapped to correct location
+        self.count = np.zeros(0, dtype=np.uint32)
+        # whether one or more versions did not remap correctly
+        self.is_bad = np.zeros(0, dtype=bool)
+        # ids of first two distinct CIGARs of remapped versions
+        self.cigars = np.zeros((0, 2), dtype=np.int32)
+        # number of distinct CIGARs (up to MAX_CIGARS)
+        self.n_cigar = np.zeros(0, dtype=np.uint8)
+
+        self.cigar_ids = {}
+        self.cigar_strings = []
+
+
+    def get_cigar_id(self, cigar_string):
+        """returns id of CIGAR string, giving it a new id if it does
+        not have one"""
+        cigar_id = self.cigar_ids.get(cigar_string)
+        if cigar_id is None:
+            cigar_id = len(self.cigar_strings)
+            self.cigar_ids[cigar_string] = cigar_id
+            self.cigar_strings.append(cigar_string)
+        return cigar_id
+
+    
+    def resize(self, size):
+        """grows arrays so that they can hold at least size reads"""
+        if size <= self.size:
+            return
+        size = max(size, self.size * 2)
+        n_add = size - self.size
+        self.total = np.concatenate([self.total,
+                                     np.zeros(n_add, dtype=np.uint32)])
+        self.count = np.concatenate([self.count,
+                                     np.zeros(n_add, dtype=np.uint32)])
+        self.is_bad = np.concatenate([self.is_bad,
+                                      np.zeros(n_add, dtype=bool)])
+        self.cigars = np.concatenate([self.cigars,
+                                      np.full((n_add, 2), -1, dtype=np.int32)])
+        self.n_cigar = np.concatenate([self.n_cigar,
+                                       np.zeros(n_add, dtype=np.uint8)])
+        self.size = size
+
+        
+    def add_cigars(self, ids, cigar_ids):
+        """records that reads with ids had CIGARs with cigar_ids"""
+        # remove duplicates and CIGARs that were already seen
+        order = np.lexsort((cigar_ids, ids))
+        ids = ids[order]
+        cigar_ids = cigar_ids[order]
+        is_dup = np.zeros(ids.shape[0], dtype=bool)
+        is_dup[1:] = (ids[1:] == ids[:-1]) & (cigar_ids[1:] == cigar_ids[:-1])
+        is_new = ~is_dup & (self.cigars[ids, 0] != cigar_ids) & \
+                 (self.cigars[ids, 1] != cigar_ids)
+        ids = ids[is_new]
+        cigar_ids = cigar_ids[is_new]
+
+        # put new CIGARs into next free slots for each read
+        uniq_ids, first, n_new = np.unique(ids, return_index=True,
+                                           return_counts=True)
+        rank = np.arange(ids.shape[0]) - np.repeat(first, n_new)
+        slot = self.n_cigar[ids].astype(np.int64) + rank
+        for i in range(2):
+            is_slot = slot == i
+            self.cigars[ids[is_slot], i] = cigar_ids[is_slot]
+
+        self.n_cigar[uniq_ids] = np.minimum(self.n_cigar[uniq_ids] + n_new,
+                                            MAX_CIGARS)
+
+        
+    def add_reads(self, names, status, total, cigar_ids):
+        """Updates counts for a block of remapped reads. names are
+        the original read names, status is REMAP_CORRECT, REMAP_WRONG or
+        REMAP_SKIP for each read, total is the number of versions of
+        each read and cigar_ids are the ids of their CIGARs (-1 for 
+        reads whose CIGAR should not be recorded)."""
+        if len(names) == 0:
+            return
+        ids = self.names.lookup(names, add=True)
+        self.resize(self.names.n_name)
+
+        status = np.array(status, dtype=np.uint8)
+        total = np.array(total, dtype=np.uint32)
+        cigar_ids = np.array(cigar_ids, dtype=np.int32)
+
+        self.is_bad[ids[status == REMAP_WRONG]] = True
+
+        is_correct = status == REMAP_CORRECT
+        self.total[ids[is_correct]] = total[is_correct]
+        np.add.at(self.count, ids[is_correct], 1)
+
+        has_cigar = cigar_ids >= 0
+        self.add_cigars(ids[has_cigar], cigar_ids[has_cigar])
+
+
+    def get_keep(self):
+        """returns boolean array indicating which reads had all of
+        their versions remap to the correct location"""
+        n = self.names.n_name
+        count = self.count[:n]
+        total = self.total[:n]
+        is_keep = (count > 0) & (count >= total)
+
+        is_extra = is_keep & (count >= 2 * total)
+        if np.any(is_extra):
+            raise ValueError("saw %d reads more times than expected in "
+                             "input file" % np.sum(is_extra))
+        return is_keep
+
+    
+    def get_cigar_strings(self, read_id):
+        """returns tuple of distinct CIGAR strings for read. If there
+        were more than two then the tuple contains None for the 
+        CIGARs that were not recorded."""
+        n = int(self.n_cigar[read_id])
+        cigars = [self.cigar_strings[c] for c in self.cigars[read_id, :min(n, 2)]]
+        return tuple(cigars) + (None,) * (n - len(cigars))
+
+
+
+def filter_reads(remap_bam, metrics=None):
+    """reads remapped reads and returns a RemapCounts object
+    that records which reads remapped correctly and their CIGARs. 
+    If metrics is provided, read counts and the number of read names
+    are recorded in this util.Metrics object."""
+    remap_counts = RemapCounts()
+
+    if metrics is None:
+        metrics = util.Metrics()
+
+    names = []
+    status = []
+    total = []
+    cigar_ids = []
+    
+    for read in remap_bam:
+        orig_name, coord_str, num, read_total = parse_remap_name(read.qname)
+
+        names.append(orig_name)
+        total.append(read_total)
 
         # only keep primary alignments and discard 'secondary'
         # and 'supplementary' alignments
         if read.is_secondary or read.is_supplementary:
-            bad_reads.add(orig_name)
-            continue
-        
-        # add the cigars for this read
-
-        # pysam used to give back read1 and read2 flagged consistently,
-        # however something now seems broken with the flags. Not sure if
-        # this reflects a change in pysam HTSeqLib or elsewhere. Regardless
-        # to make WASP robust to this issue, no longer tracking whether a
-        # CIGAR corresponds to read1 or read2. This could
-        # potentially result in a mapping bias for a very small number of reads
-        # (i.e. if read1 and read2 remap to same location with new CIGARs,
-        # but the new read1 CIGAR happens to match the old read2 CIGAR and
-        # vice-versa, but number is likely to be miniscule.
-
-        if(orig_name in cigar_strings):
-            cigar_strings[orig_name].add(read.cigarstring)
+            status.append(REMAP_WRONG)
+            cigar_ids.append(-1)
         else:
-            cigar_strings[orig_name] = set([read.cigarstring])
+            # add the cigars for this read
 
-        correct_map = False
-        
-        if '-' in coord_str:
-            # paired end read, coordinate gives expected positions for each end
-            c1, c2 = coord_str.split("-")
-
-            if not read.is_paired:
-                bad_reads.add(orig_name)
-                continue
-            if not read.is_proper_pair:
-                bad_reads.add(orig_name)
-                continue
-            
-            pos1 = int(c1)
-            pos2 = int(c2)
-            if pos1 < pos2:
-                left_pos = pos1
-                right_pos = pos2
-            else:
-                left_pos = pos2
-                right_pos = pos1
-                
-            # only use left end of reads, but check that right end is in
-            # correct location
-            if read.pos < read.next_reference_start or (read.pos == read.next_reference_start and read.is_read1 and not read.is_read2):
-                if pos1 == read.pos+1 and pos2 == read.next_reference_start+1:
-                    # both reads mapped to correct location
-                    correct_map = True
-            else:
-                # this is right end of read
-                continue
-        else:
-            # single end read
-            pos = int(coord_str)
+            # pysam used to give back read1 and read2 flagged consistently,
+            # however something now seems broken with the flags. Not sure if
+            # this reflects a change in pysam HTSeqLib or elsewhere. Regardless
+            # to make WASP robust to this issue, no longer tracking whether a
+            # CIGAR corresponds to read1 or read2. This could
+            # potentially result in a mapping bias for a very small number of reads
+            # (i.e. if read1 and read2 remap to same location with new CIGARs,
+            # but the new read1 CIGAR happens to match the old read2 CIGAR and
+            # vice-versa, but number is likely to be miniscule.
+            cigar_ids.append(remap_counts.get_cigar_id(read.cigarstring))
+            status.append(check_remapped_read(read, coord_str))
 
-            if pos == read.pos+1:
-                # read maps to correct location
-                correct_map = True
+        if len(names) >= REMAP_BLOCK_SIZE:
+            remap_counts.add_reads(names, status, total, cigar_ids)
+            metrics.count("remapped_reads", len(names))
+            metrics.set_max("read_names", remap_counts.names.n_name)
+            metrics.progress()
+            names = []
+            status = []
+            total = []
+            cigar_ids = []
 
-        if correct_map:
-            if orig_name in read_counts:
-                read_counts[orig_name] += 1
-            else:
-                read_counts[orig_name] = 1
+    remap_counts.add_reads(names, status, total, cigar_ids)
+    metrics.count("remapped_reads", len(names))
+    metrics.set_max("read_names", remap_counts.names.n_name)
+
+    return remap_counts
 
-            if read_counts[orig_name] == total:
-                # all alternative versions of this read
-                # mapped to correct location
-                if orig_name in keep_reads:
-                    raise ValueError("saw read %s more times than "
-                                     "expected in input file" % orig_name)
-                keep_reads.add(orig_name)
 
-                # remove read from counts to save mem
-                del read_counts[orig_name]
+
+def write_pair(r1, r2, cigs, keep_bam, stats):
+    """checks that the CIGAR strings of a read pair match the CIGARs
+    of the remapped reads (cigs) and writes the pair to keep_bam 
+    if they do"""
+    #
+    # check that the CIGAR strings match up
+    # for both reads.
+    # NOTE: 2/8/2021 Code used to assume that read1 and read2 stayed defined as
+    # read1 and read2 following re-alignment. Observed that read1 and read2 sometimes
+    # switch. Changed code to allow for this possibility.
+    if len(cigs) == 1:
+        # both reads had same CIGAR in original mapping
+        if (r1.cigarstring == r2.cigarstring) and \
+           (r1.cigarstring in cigs):
+            # Both R1 and R2 cigar strings are the same
+            # and match CIGAR from original mapping
+            stats.keep += 2
+            keep_bam.write(r1)
+            keep_bam.write(r2)
         else:
-            # read maps to different location
-            bad_reads.add(orig_name)
+            stats.cigar_mismatch += 1
+            stats.discard += 1
+    elif len(cigs) == 2:
+        # both reads had different CIGAR in original mapping
+        if (r1.cigarstring != r2.cigarstring) and \
+           (r1.cigarstring in cigs) and \
+           (r2.cigarstring in cigs):
+            # verified CIGARs are different and 
+            # were both present in original mapping
+            stats.keep += 2
+            keep_bam.write(r1)
+            keep_bam.write(r2)
+        else:
+            stats.cigar_mismatch += 1
+            stats.discard += 1
+    else:
+        # There were no CIGARs or >2 CIGARs in original mapping
+        # This is unexpected and we don't handle this case.
+        stats.cigar_missing += 1
+        stats.discard += 1
 
-    #sys.stderr.write("keep_reads: %d, bad_reads: %d\n" % (len(keep_reads), len(bad_reads)))
-    #sys.stderr.write("%d reads did not have all versions map\n" % (len(read_counts)))
-            
-    return keep_reads, bad_reads, cigar_strings
 
 
-def write_reads(to_remap_bam, keep_bam, keep_reads, bad_reads, cigar_strings):
-    """writes reads but also checks cigar strings"""
+def write_single(read, cigs, keep_bam, stats):
+    """checks that the CIGAR string of a single-end read matches the
+    CIGAR of the remapped reads (cigs) and writes the read to 
+    keep_bam if it does"""
+    if (len(cigs) != 1):
+        # currently don't handle missing/multiple CIGARs
+        stats.cigar_missing += 1
+        stats.discard += 1
+    else:
+        if (read.cigarstring in cigs):
+            keep_bam.write(read)
+            stats.keep += 1
+        else:
+            stats.cigar_mismatch += 1
+            stats.discard += 1
 
-    stats = ReadStats()
-    
-    read_pair_cache = {}
+            
+            
+def write_reads_block(reads, keep_bam, remap_counts, is_keep,
+                      read_pair_cache, stats):
+    """checks a block of reads from to_remap_bam against remap_counts
+    and writes those that should be kept to keep_bam"""
+    ids = remap_counts.names.lookup([read.qname for read in reads])
 
-    for read in to_remap_bam:
-        if read.qname in bad_reads:
+    for read, read_id in zip(reads, ids):
+        if read_id == -1:
+            # read was not labeled as 'keep' or 'bad' in original file
+            stats.not_present += 1
+        elif remap_counts.is_bad[read_id]:
             stats.bad += 1
-        elif read.qname in keep_reads:
+        elif is_keep[read_id]:
             if read.is_paired:
                 # cache reads until you see their pair
                 # then, write both of them to file together
                 if read.qname in read_pair_cache:
-                    #
-                    # check that the CIGAR strings match up
-                    # for both reads.
-                    # NOTE: 2/8/2021 Code used to assume that read1 and read2 stayed defined as
-                    # read1 and read2 following re-alignment. Observed that read1 and read2 sometimes
-                    # switch. Changed code to allow for this possibility.
                     r1 = read_pair_cache[read.qname]
                     r2 = read
 
                     # remove read from cache
                     del read_pair_cache[read.qname]
 
-                    cigs = cigar_strings[read.qname]
-
-
-                    if len(cigs) == 1:
-                        # both reads had same CIGAR in original mapping
-                        if (r1.cigarstring == r2.cigarstring) and \
-                           (r1.cigarstring in cigs):
-                            # Both R1 and R2 cigar strings are the same
-                            # and match CIGAR from original mapping
-                            stats.keep += 2
-                            keep_bam.write(r1)
-                            keep_bam.write(r2)
-                        else:
-                            stats.cigar_mismatch += 1
-                            stats.discard += 1
-                    elif len(cigs) == 2:
-                        # both reads had different CIGAR in original mapping
-                        if (r1.cigarstring != r2.cigarstring) and \
-                           (r1.cigarstring in cigs) and \
-                           (r2.cigarstring in cigs):
-                            # verified CIGARs are different and 
-                            # were both present in original mapping
-                            stats.keep += 2
-                            keep_bam.write(r1)
-                            keep_bam.write(r2)
-                        else:
-                            stats.cigar_mismatch += 1
-                            stats.discard += 1
-                    else:
-                        # There were no CIGARs or >2 CIGARs in original mapping
-                        # This is unexpected and we don't handle this case.
-                        stats.cigar_missing += 1
-                        stats.discard += 1
-                        
+                    write_pair(r1, r2,
+                               remap_counts.get_cigar_strings(read_id),
+                               keep_bam, stats)
                 else:
                     # cache this read
                     read_pair_cache[read.qname] = read
             else:
                 # single-end read
-                if (len(cigar_strings[read.qname]) != 1):
-                    # currently don't handle missing/multiple CIGARs
-                    stats.cigar_missing += 1
-                    stats.discard += 1
-                else:
-                    if (read.cigarstring in cigar_strings[read.qname]):
-                        keep_bam.write(read)
-                        stats.keep += 1
-                    else:
-                        stats.cigar_mismatch += 1
-                        stats.discard += 1
+                write_single(read, remap_counts.get_cigar_strings(read_id),
+                             keep_bam, stats)
         else:
             # read was not labeled as 'keep' or 'bad' in original file
             stats.not_present += 1
+            
+
+        
+def write_reads(to_remap_bam, keep_bam, remap_counts, metrics=None):
+    """writes reads but also checks cigar strings. If metrics is 
+    provided, read counts and the size of the read pair cache are 
+    recorded in this util.Metrics object. Returns a ReadStats object."""
+
+    stats = ReadStats()
+
+    if metrics is None:
+        metrics = util.Metrics()
+    
+    read_pair_cache = {}
+    is_keep = remap_counts.get_keep()
+
+    reads = []
+    for read in to_remap_bam:
+        reads.append(read)
+        if len(reads) >= REMAP_BLOCK_SIZE:
+            write_reads_block(reads, keep_bam, remap_counts, is_keep,
+                              read_pair_cache, stats)
+            metrics.count("reads", len(reads))
+            metrics.set_max("read_pair_cache", len(read_pair_cache))
+            metrics.progress()
+            reads = []
+    write_reads_block(reads, keep_bam, remap_counts, is_keep,
+                      read_pair_cache, stats)
+    metrics.count("reads", len(reads))
+    metrics.set_max("read_pair_cache", len(read_pair_cache))
 
     # any reads remaining in the cache have been discarded
     stats.pair_missing += len(read_pair_cache)
     stats.discard += len(read_pair_cache)
     
+    return stats
 
-    stats.write()
-    
+
+
+def filter_chrom_shard(args):
+    """Worker process function that reads the remapped reads on one
+    chromosome (or the unplaced reads, if chrom_name is '*') from the
+    indexed remap_bam, and writes the RemapCounts object that records
+    them to counts_filename. Returns a NumPy bytes array with the names
+    of the reads that had a version that did not remap correctly, and
+    a util.Metrics object."""
+    remap_bam_path, index_filename, chrom_name, counts_filename, \
+        progress_interval = args
+
+    metrics = util.Metrics(progress_interval)
+    metrics.start_chrom(chrom_name)
+
+    start_time = time.perf_counter()
+    remap_bam = pysam.Samfile(remap_bam_path, index_filename=index_filename)
+    remap_counts = filter_reads(remap_bam.fetch(chrom_name), metrics=metrics)
+    remap_bam.close()
+    metrics.add_time("read_remapped", time.perf_counter() - start_time)
+
+    with open(counts_filename, "wb") as f:
+        pickle.dump(remap_counts, f, pickle.HIGHEST_PROTOCOL)
+
+    n = remap_counts.names.n_name
+    bad_names = remap_counts.names.id_names[:n][remap_counts.is_bad[:n]]
+
+    metrics.finish()
+
+    return bad_names, metrics
+
+
+
+def write_chrom_shard(args):
+    """Worker process function that checks the reads to remap on one
+    chromosome (or the unplaced reads, if chrom_name is '*') from the
+    indexed to_remap_bam against the RemapCounts in counts_filename
+    (None if no remapped reads were on the chromosome), and writes the
+    reads to keep to shard_filename. Reads with names in the
+    bad_names_filename array had a version that did not remap correctly
+    (possibly on another chromosome) and are not kept. Returns a
+    ReadStats object and a util.Metrics object."""
+    to_remap_bam_path, index_filename, template_path, chrom_name, \
+        counts_filename, bad_names_filename, shard_filename, \
+        progress_interval = args
+
+    metrics = util.Metrics(progress_interval)
+    metrics.start_chrom(chrom_name)
+
+    if counts_filename:
+        with open(counts_filename, "rb") as f:
+            remap_counts = pickle.load(f)
+    else:
+        remap_counts = RemapCounts()
+
+    ids = remap_counts.names.lookup(np.load(bad_names_filename))
+    remap_counts.is_bad[ids[ids >= 0]] = True
+
+    start_time = time.perf_counter()
+    to_remap_bam = pysam.Samfile(to_remap_bam_path,
+                                 index_filename=index_filename)
+    template_bam = pysam.Samfile(template_path)
+    keep_bam = pysam.Samfile(shard_filename, "wb", template=template_bam)
+    template_bam.close()
+    stats = write_reads(to_remap_bam.fetch(chrom_name), keep_bam,
+                        remap_counts, metrics=metrics)
+    keep_bam.close()
+    to_remap_bam.close()
+    metrics.add_time("write_keep", time.perf_counter() - start_time)
+
+    metrics.finish()
+
+    return stats, metrics
+
+
+
+def get_fetch_chroms(bam):
+    """returns a list of (name, n_read) for the chromosomes of the
+    indexed pysam AlignmentFile bam that have reads, with '*' for
+    unplaced reads if there are any"""
+    chroms = [(name, n_read) for tid, name, n_read
+              in util.get_indexed_chroms(bam)]
+    if bam.nocoordinate > 0:
+        chroms.append(("*", bam.nocoordinate))
+    return chroms
+
+
+
+def write_reads_parallel(to_remap_bam_path, remap_bam_path, keep_bam_path,
+                         threads, sort_mem=SORT_MEM_DEFAULT, metrics=None):
+    """Filters reads using a pool of worker processes, in two rounds
+    of one job per chromosome, and writes the reads that are kept to
+    keep_bam_path. The input BAM files are sorted by coordinate (if
+    needed) and indexed, so that each worker reads only its own
+    chromosome. The remapped reads are counted in the first round,
+    and the names of reads that did not remap correctly on any
+    chromosome are passed to the second round, which checks the reads
+    to remap and writes the reads that are kept to a shard file for
+    each chromosome. The shards are concatenated without being decoded.
+    Temporary files are written to a directory next to keep_bam_path,
+    which is removed at the end. Returns a ReadStats object. If metrics
+    is provided, the metrics recorded by the workers are added to this
+    util.Metrics object."""
+    if metrics is None:
+        metrics = util.Metrics()
+
+    tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(keep_bam_path) +
+                               ".tmp",
+                               dir=os.path.dirname(keep_bam_path) or ".")
+
+    with util.removing_files([tmp_dir]):
+        start_time = time.perf_counter()
+        # the reads to remap are grouped by chromosome, but pairs are
+        # not in order of position, so they are always sorted
+        to_remap_sorted = util.sort_bam(to_remap_bam_path,
+                                        "%s/to_remap" % tmp_dir,
+                                        threads=threads, sort_mem=sort_mem)
+        to_remap_index = util.get_bam_index(to_remap_sorted,
+                                            to_remap_sorted + ".bai",
+                                            threads=threads)
+        remap_sorted, remap_index = \
+            util.get_sorted_bam(remap_bam_path, "%s/remap" % tmp_dir,
+                                threads=threads, sort_mem=sort_mem)
+        metrics.add_time("sort_index", time.perf_counter() - start_time)
+
+        remap_bam = pysam.Samfile(remap_sorted, index_filename=remap_index)
+        remap_chroms = get_fetch_chroms(remap_bam)
+        remap_bam.close()
+
+        counts_filenames = {}
+        args = []
+        for i, (chrom_name, n_read) in enumerate(remap_chroms):
+            counts_filenames[chrom_name] = \
+                util.get_shard_filename("%s/counts" % tmp_dir, i, ".pkl")
+            args.append((remap_sorted, remap_index, chrom_name,
+                         counts_filenames[chrom_name],
+                         metrics.progress_interval))
+
+        bad_names = [np.zeros(0, dtype="S1")]
+        for chrom_bad_names, chrom_metrics in \
+            util.run_chrom_workers(filter_chrom_shard, args, threads,
+                                   sizes=[n for c, n in remap_chroms]):
+            bad_names.append(chrom_bad_names)
+            metrics.add(chrom_metrics)
+
+        bad_names_filename = "%s/bad_names.npy" % tmp_dir
+        np.save(bad_names_filename, np.unique(np.concatenate(bad_names)))
+
+        to_remap_bam = pysam.Samfile(to_remap_sorted,
+                                     index_filename=to_remap_index)
+        to_remap_chroms = get_fetch_chroms(to_remap_bam)
+        to_remap_bam.close()
+
+        shard_filenames = []
+        args = []
+        for i, (chrom_name, n_read) in enumerate(to_remap_chroms):
+            shard_filenames.append(
+                util.get_shard_filename("%s/keep" % tmp_dir, i, ".bam"))
+            args.append((to_remap_sorted, to_remap_index, to_remap_bam_path,
+                         chrom_name, counts_filenames.get(chrom_name),
+                         bad_names_filename, shard_filenames[-1],
+                         metrics.progress_interval))
+
+        stats = ReadStats()
+        for chrom_stats, chrom_metrics in \
+            util.run_chrom_workers(write_chrom_shard, args, threads,
+                                   sizes=[n for c, n in to_remap_chroms]):
+            stats.add(chrom_stats)
+            metrics.add(chrom_metrics)
+
+        start_time = time.perf_counter()
+        if shard_filenames:
+            pysam.cat("-o", keep_bam_path, *shard_filenames)
+        else:
+            to_remap_bam = pysam.Samfile(to_remap_bam_path)
+            pysam.Samfile(keep_bam_path, "wb", template=to_remap_bam).close()
+            to_remap_bam.close()
+        metrics.add_time("merge_shards", time.perf_counter() - start_time)
+
+    return stats
+
+
+
+def get_name_key(name):
+    """returns key that original read names are ordered by in the 
+    merge join. Remapped reads are sorted by their full names 
+    (<orig_name>.<coordinate>...), so the groups of remapped reads for
+    each original name are in order of orig_name + '.' rather than 
+    orig_name (e.g. r1-2.100.1.1 sorts before r1.100.1.2 because '-' 
+    comes before '.')."""
+    return name + "."
+
+
+
+def iter_remap_groups(remap_bam):
+    """Iterates over a remapped BAM file that is sorted by read name, 
+    and yields a tuple of (orig_name, is_keep, is_bad, cigar_strings)
+    for each original read name, after all of the remapped reads with 
+    that name have been read. Groups are yielded in order of 
+    get_name_key(orig_name). Only the reads for one original name are
+    held in memory at a time."""
+    cur_name = None
+    count = 0
+    is_keep = False
+    is_bad = False
+    cigar_strings = set()
+
+    for read in remap_bam:
+        orig_name, coord_str, num, total = parse_remap_name(read.qname)
+
+        if orig_name != cur_name:
+            if cur_name is not None:
+                if get_name_key(orig_name) < get_name_key(cur_name):
+                    raise ValueError("remapped reads are not sorted by "
+                                     "original read name: %s appears "
+                                     "after %s" % (orig_name, cur_name))
+                yield cur_name, is_keep, is_bad, cigar_strings
+            cur_name = orig_name
+            count = 0
+            is_keep = False
+            is_bad = False
+            cigar_strings = set()
+
+        # only keep primary alignments and discard 'secondary'
+        # and 'supplementary' alignments
+        if read.is_secondary or read.is_supplementary:
+            is_bad = True
+            continue
+
+        # add the cigars for this read (see filter_reads)
+        cigar_strings.add(read.cigarstring)
+
+        status = check_remapped_read(read, coord_str)
+
+        if status == REMAP_SKIP:
+            continue
+
+        if status == REMAP_CORRECT:
+            count += 1
+            if count == total:
+                # all alternative versions of this read
+                # mapped to correct location
+                if is_keep:
+                    raise ValueError("saw read %s more times than "
+                                     "expected in input file" % orig_name)
+                is_keep = True
+                count = 0
+        else:
+            # read maps to different location
+            is_bad = True
+
+    if cur_name is not None:
+        yield cur_name, is_keep, is_bad, cigar_strings
+
+
+
+def iter_read_groups(to_remap_bam):
+    """Iterates over a BAM file that is sorted by read name, and yields
+    a tuple of (name, reads) for each read name, in order of 
+    get_name_key(name) (the order of the groups from 
+    iter_remap_groups). The two orders differ only when a read name 
+    is the start of other read names, followed by a character that 
+    comes before '.', so reads are held back only for names like 
+    this (e.g. r1 is yielded after r1-2 and r1-3)."""
+    # names that are held back, each of which is the start of the next
+    held = []
+    prev_name = None
+    reads = []
+
+    def add_group(name, reads):
+        # groups that cannot come after this name are yielded
+        # (longest first) and this name is held back in case later
+        # names start with it
+        while held:
+            held_name = held[-1][0]
+            if name.startswith(held_name) and \
+               name[len(held_name)] < ".":
+                break
+            yield held.pop()
+        held.append((name, reads))
+
+    for read in to_remap_bam:
+        if read.qname != prev_name:
+            if prev_name is not None:
+                if read.qname < prev_name:
+                    raise ValueError("reads to remap are not sorted by "
+                                     "read name: %s appears after %s" %
+                                     (read.qname, prev_name))
+                yield from add_group(prev_name, reads)
+            prev_name = read.qname
+            reads = []
+        reads.append(read)
+
+    if prev_name is not None:
+        yield from add_group(prev_name, reads)
+    while held:
+        yield held.pop()
+
+        
+
+def write_reads_merge_join(to_remap_bam, keep_bam, remap_bam, metrics=None):
+    """Like filter_reads followed by write_reads, but streams both
+    input BAM files, which must be sorted by read name, and merges
+    the remapped reads for each original read name with the original
+    reads on the fly, so that memory use does not grow with the 
+    number of reads. Reads are written in order of 
+    get_name_key(read name). If metrics is provided, read counts are
+    recorded in this util.Metrics object. Returns a ReadStats object."""
+    stats = ReadStats()
+
+    if metrics is None:
+        metrics = util.Metrics()
+    read_count = 0
+
+    remap_groups = iter_remap_groups(remap_bam)
+    group = next(remap_groups, None)
+
+    for name, reads in iter_read_groups(to_remap_bam):
+        read_count += len(reads)
+        if read_count >= util.METRICS_READ_INTERVAL:
+            metrics.count("reads", read_count)
+            metrics.progress()
+            read_count = 0
+
+        # skip remapped reads that have no original read
+        name_key = get_name_key(name)
+        while group is not None and get_name_key(group[0]) < name_key:
+            group = next(remap_groups, None)
+
+        if group is None or group[0] != name:
+            # reads were not labeled as 'keep' or 'bad' in original file
+            stats.not_present += len(reads)
+            continue
+
+        orig_name, is_keep, is_bad, cigar_strings = group
+        
+        if is_bad:
+            stats.bad += len(reads)
+        elif is_keep:
+            read_pair_cache = {}
+            for read in reads:
+                if read.is_paired:
+                    # cache reads until you see their pair
+                    # then, write both of them to file together
+                    if read.qname in read_pair_cache:
+                        r1 = read_pair_cache.pop(read.qname)
+                        write_pair(r1, read, cigar_strings, keep_bam, stats)
+                    else:
+                        read_pair_cache[read.qname] = read
+                else:
+                    write_single(read, cigar_strings, keep_bam, stats)
+
+            # reads for this name that were not paired are discarded
+            stats.pair_missing += len(read_pair_cache)
+            stats.discard += len(read_pair_cache)
+        else:
+            stats.not_present += len(reads)
+
+    metrics.count("reads", read_count)
+
+    return stats
 
     
-def main(to_remap_bam_path, remap_bam_path, keep_bam_path):
-    to_remap_bam = pysam.Samfile(to_remap_bam_path)
-    remap_bam = pysam.Samfile(remap_bam_path)
-    keep_bam = pysam.Samfile(keep_bam_path, "wb", template=to_remap_bam)
 
-    keep_reads, bad_reads, cigar_strings = filter_reads(remap_bam)
+def is_name_sorted(bam):
+    """returns True if header of BAM file says that it is sorted
+    by read name in ASCII order"""
+    hd = bam.header.to_dict().get("HD", {})
+    return (hd.get("SO") == "queryname" and
+            hd.get("SS") == "queryname:lexicographical")
+
+
+
+def open_name_sorted(bam_path, tmp_prefix, sort_mem=SORT_MEM_DEFAULT):
+    """Opens bam_path, first sorting it by read name (in ASCII order)
+    if it is not already. Returns tuple of (bam, sorted_path). If a
+    sorted copy was made sorted_path is its path (which should be 
+    removed when done), otherwise it is None."""
+    bam = pysam.Samfile(bam_path)
+    if is_name_sorted(bam):
+        return bam, None
+    bam.close()
+
+    util.check_pysam_version(MIN_PYSAM_VER_NAME_SORT)
+    sorted_path = tmp_prefix + ".namesort.bam"
+    sys.stderr.write("sorting %s by read name\n" % bam_path)
+    pysam.sort("-N", "--no-PG", "-m", sort_mem, "-T", tmp_prefix,
+               "-o", sorted_path, bam_path)
+    
+    return pysam.Samfile(sorted_path), sorted_path
     
-    write_reads(to_remap_bam, keep_bam, keep_reads, bad_reads, cigar_strings)
+    
+    
+def main(to_remap_bam_path, remap_bam_path, keep_bam_path,
+         merge_join=False, sort_mem=SORT_MEM_DEFAULT, threads=1,
+         metrics_filename=None, progress_interval=0):
+    metrics = util.Metrics(progress_interval)
+
+    if merge_join:
+        metrics.start_chrom(util.METRICS_NO_CHROM)
+        tmp_prefix = "%s.tmp%d" % (keep_bam_path, os.getpid())
+
+        # sorted copies are removed at the end, including when
+        # sorting or filtering fails part way through
+        with util.removing_files([tmp_prefix + ".to_remap.namesort.bam",
+                                  tmp_prefix + ".remap.namesort.bam"]):
+            start_time = time.perf_counter()
+            to_remap_bam, to_remap_sorted = \
+                open_name_sorted(to_remap_bam_path, tmp_prefix + ".to_remap",
+                                 sort_mem=sort_mem)
+            remap_bam, remap_sorted = \
+                open_name_sorted(remap_bam_path, tmp_prefix + ".remap",
+                                 sort_mem=sort_mem)
+            metrics.add_time("name_sort", time.perf_counter() - start_time)
+            keep_bam = pysam.Samfile(keep_bam_path, "wb",
+                                     template=to_remap_bam)
+
+            start_time = time.perf_counter()
+            stats = write_reads_merge_join(to_remap_bam, keep_bam, remap_bam,
+                                           metrics=metrics)
+            metrics.add_time("merge_join", time.perf_counter() - start_time)
+            stats.write()
+
+            for bam in (to_remap_bam, remap_bam, keep_bam):
+                bam.close()
+    elif threads > 1:
+        stats = write_reads_parallel(to_remap_bam_path, remap_bam_path,
+                                     keep_bam_path, threads,
+                                     sort_mem=sort_mem, metrics=metrics)
+        stats.write()
+    else:
+        metrics.start_chrom(util.METRICS_NO_CHROM)
+        to_remap_bam = pysam.Samfile(to_remap_bam_path)
+        keep_bam = pysam.Samfile(keep_bam_path, "wb", template=to_remap_bam)
+        remap_bam = pysam.Samfile(remap_bam_path)
+
+        start_time = time.perf_counter()
+        remap_counts = filter_reads(remap_bam, metrics=metrics)
+        metrics.add_time("read_remapped", time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        stats = write_reads(to_remap_bam, keep_bam, remap_counts,
+                            metrics=metrics)
+        metrics.add_time("write_keep", time.perf_counter() - start_time)
+        stats.write()
+
+    if metrics_filename:
+        metrics.finish()
+        metrics.write(metrics_filename)
         
 
 
 if __name__ == "__main__":
     options = parse_options()
-    main(options.to_remap_bam, options.remap_bam, options.keep_bam)
-
+    main(options.to_remap_bam, options.remap_bam, options.keep_bam,
+         merge_join=options.merge_join, sort_mem=options.sort_mem,
+         threads=options.threads, metrics_filename=options.metrics,
+         progress_interval=options.progress)
@@ -1,9 +1,14 @@
 import sys
 import os
 import gzip
+import copy
 import argparse
+import collections
+import contextlib
+import concurrent.futures
+import zlib
 import numpy as np
-from itertools import product, groupby
+from itertools import product
 
 # sys.path.append("/coaf3b65459446be3/inputs/wasp-refs/WASP/mapping")
 # sys.path.append("WASP-master/mapping")
@@ -18,12 +23,23 @@ import tables
 # packages for the other scripts: 
 import subprocess
 import operator 
+import shutil
+import hashlib
+import json
+import resource
+import time
 
 MAX_SEQS_DEFAULT = 64
 MAX_SNPS_DEFAULT = 6
+HAP_CACHE_SIZE_DEFAULT = 10000
 
 # for util.py
 DNA_COMP = None
+GZIP_BLOCK_SIZE = 4 * 1024 * 1024
+GZIP_LEVEL_DEFAULT = 6
+METRICS_READ_INTERVAL = 10000
+METRICS_NO_CHROM = "*"
+SORT_MEM_DEFAULT = "768M"
 # for snptable.py 
 NUCLEOTIDES = {b'A', b'C', b'T', b'G'}
 SNP_UNDEF = -1
@@ -56,45 +72,168 @@ def revcomp(seq_str):
     return comp(seq_str)[::-1]
 
         
-def sort_bam(input_bam, output_prefix):
-    """Calls samtools sort on input_bam filename and writes to
-    output_bam. Takes into account that the command line arguments 
-    for samtools sort have changed between versions."""
+def sort_bam(input_bam, output_prefix, threads=1, sort_mem=SORT_MEM_DEFAULT):
+    """Sorts input_bam by coordinate and writes it to output_prefix +
+    '.sort.bam', returning the name of the sorted file. Sorting is done
+    by pysam.sort, which is a merge sort that uses the given number of
+    threads, and writes temporary files (next to the output file) when
+    it uses more than sort_mem memory per thread."""
+    import pysam
 
     output_bam = output_prefix + ".sort.bam"
-    
-    # first try new way of using samtools sort
-    failed = False
-    cmd = "samtools sort -o " + output_bam + " " + input_bam
-    sys.stderr.write("running command: %s\n" % cmd)
-    try:
-        subprocess.check_call(cmd, shell=True)
-    except Exception as e:
-        sys.stderr.write("samtools sort command failed:\n%s\n" %
-                         str(e))
-        failed = True
+
+    sys.stderr.write("sorting %s with %d threads\n" % (input_bam, threads))
+    pysam.sort("-@", str(threads - 1), "-m", sort_mem,
+               "-T", output_prefix + ".sort.tmp",
+               "-o", output_bam, input_bam)
+
     if not os.path.exists(output_bam):
-        sys.stderr.write("output file %s does not exist\n" % output_bam)
-        failed = True
-        
-    if failed:
-        # OLD way of calling samtools (changed in newer versions)
-        sys.stderr.write("samtools sort command failed, trying old samtools "
-                         "syntax\n")
-        
-        cmd = "samtools sort " + input_bam + " " + output_prefix
-        sys.stderr.write("running command: %s\n" % cmd)
+        raise IOError("Failed to create sorted BAM file '%s'" % output_bam)
 
-        try:
-            subprocess.check_call(cmd, shell=True)
-        except Exception as e:
-            sys.stderr.write("samtools sort command failed:\n%s\n" %
-                             str(e))
-            exit(1)
-        
-        if not os.path.exists(paths.sorted_output_bam):
-            raise IOError("Failed to create sorted BAM file '%s'" %
-                          paths.sorted_output_bam)
+    return output_bam
+
+
+
+def get_bam_index(bam_filename, index_filename, threads=1):
+    """Returns the name of an up-to-date index of bam_filename. An
+    existing index next to bam_filename (.bai or .csi) is only used if
+    it is newer than bam_filename, because a stale index makes fetch()
+    silently return the wrong reads. Otherwise bam_filename is indexed
+    and the index is written to index_filename, rather than next to
+    bam_filename, which may be in a directory that is not writable.
+    The BAM file should be opened with pysam.AlignmentFile(bam_filename,
+    index_filename=...) to use the returned index."""
+    import pysam
+
+    bam_mtime = os.path.getmtime(bam_filename)
+    bam_root = os.path.splitext(bam_filename)[0]
+    for filename in (bam_filename + ".bai", bam_root + ".bai",
+                     bam_filename + ".csi", bam_root + ".csi"):
+        if os.path.exists(filename):
+            if os.path.getmtime(filename) >= bam_mtime:
+                return filename
+            sys.stderr.write("WARNING: index %s is older than %s, "
+                             "not using it\n" % (filename, bam_filename))
+
+    sys.stderr.write("indexing %s\n" % bam_filename)
+    pysam.index("-@", str(threads - 1), bam_filename, index_filename)
+
+    return index_filename
+
+
+
+def get_sorted_bam(input_bam, output_prefix, is_sorted=False, threads=1,
+                   sort_mem=SORT_MEM_DEFAULT):
+    """Returns the names of a coordinate-sorted BAM file with the reads
+    from input_bam and of its index. If input_bam is a BAM file whose
+    header (@HD SO field) says that it is sorted by coordinate, it is
+    used as it is. Otherwise it is sorted with sort_bam. If is_sorted
+    is True, input_bam is assumed to be sorted unless its header gives
+    a different sort order. The index is found or created by
+    get_bam_index, and a new index of input_bam is written to
+    output_prefix + '.input.bai'."""
+    import pysam
+
+    bam = pysam.AlignmentFile(input_bam)
+    sort_order = bam.header.to_dict().get("HD", {}).get("SO")
+    is_bam = bam.is_bam
+    bam.close()
+
+    if is_bam and (sort_order == "coordinate" or
+                   (is_sorted and sort_order in (None, "unknown"))):
+        sorted_bam = input_bam
+    else:
+        if is_sorted:
+            sys.stderr.write("WARNING: header of %s gives sort order '%s', "
+                             "sorting it by coordinate\n" %
+                             (input_bam, sort_order))
+        sorted_bam = sort_bam(input_bam, output_prefix, threads=threads,
+                              sort_mem=sort_mem)
+
+    if sorted_bam == input_bam:
+        index_filename = output_prefix + ".input.bai"
+    else:
+        index_filename = sorted_bam + ".bai"
+    index_filename = get_bam_index(sorted_bam, index_filename,
+                                   threads=threads)
+
+    return sorted_bam, index_filename
+
+
+
+def get_indexed_chroms(bam):
+    """returns a list of (tid, name, n_read) tuples for the chromosomes
+    of the indexed pysam AlignmentFile bam that have reads, in the
+    order of the BAM header"""
+    return sorted((bam.get_tid(x.contig), x.contig, x.total)
+                  for x in bam.get_index_statistics() if x.total > 0)
+
+
+
+def get_shard_filename(filename, index, suffix=""):
+    """returns the name of a 'shard' file that a worker process writes
+    output to, which is later merged into filename"""
+    return "%s.shard%d%s" % (filename, index, suffix)
+
+
+
+def remove_files(filenames):
+    """removes the files and directories in filenames that exist"""
+    import shutil
+
+    for filename in filenames:
+        if os.path.isdir(filename):
+            shutil.rmtree(filename)
+        elif os.path.exists(filename):
+            os.remove(filename)
+
+
+
+@contextlib.contextmanager
+def removing_files(filenames):
+    """Context manager that removes the files (and directories) in the
+    list filenames when the block is left, including when an exception
+    is raised, so that shards and temporary files are not left behind
+    by a failed run. Names can be added to the list inside the block."""
+    try:
+        yield filenames
+    finally:
+        remove_files(filenames)
+
+
+
+def run_chrom_job(args):
+    """runs a job in a worker process, returning its index and result"""
+    func, i, job_args = args
+    return i, func(job_args)
+
+
+
+def run_chrom_workers(func, job_args, threads, sizes=None):
+    """Calls func on each of job_args (typically one per chromosome) in
+    a pool of threads worker processes, and returns the results in the
+    order of job_args. If sizes are given, the largest jobs are started
+    first so that big chromosomes do not hold up the end of the run.
+    Workers are started with spawn rather than fork, so that they do
+    not inherit HDF5 library state or open files from this process."""
+    import multiprocessing
+
+    order = list(range(len(job_args)))
+    if sizes is not None:
+        order.sort(key=lambda i: sizes[i], reverse=True)
+
+    sys.stderr.write("processing %d chromosomes with %d worker "
+                     "processes\n" % (len(job_args), threads))
+
+    results = [None] * len(job_args)
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(threads) as pool:
+        for i, result in pool.imap_unordered(
+                run_chrom_job, [(func, i, job_args[i]) for i in order],
+                chunksize=1):
+            results[i] = result
+
+    return results
 
 
 
@@ -114,6 +253,332 @@ def is_gzipped(filename):
     return (byte1 == b'\x1f') and (byte2== b'\x8b')
 
 
+class ParallelGzipWriter(object):
+    """File-like object that writes text to a gzip file, compressing
+    blocks of text in parallel using a pool of threads (zlib releases
+    the GIL while it compresses). Each block is written as a separate
+    gzip member, which is still a valid gzip file that can be read by 
+    gzip / zcat. Blocks are written in the order they were filled, so 
+    the output does not depend on the number of threads."""
+
+    def __init__(self, filename, threads=2, level=GZIP_LEVEL_DEFAULT,
+                 block_size=GZIP_BLOCK_SIZE):
+        self.f = open(filename, "wb")
+        self.level = level
+        self.block_size = block_size
+        self.buf = []
+        self.buf_len = 0
+        self.pool = concurrent.futures.ThreadPoolExecutor(threads)
+        # compressed blocks that have not been written yet; the
+        # number is limited to bound memory usage
+        self.pending = collections.deque()
+        self.max_pending = threads * 2
+        self.n_block = 0
+
+
+    def compress_block(self, data):
+        """returns data compressed as a single gzip member"""
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+
+        
+    def write_pending(self, max_pending):
+        """writes compressed blocks until at most max_pending 
+        are left"""
+        while len(self.pending) > max_pending:
+            self.f.write(self.pending.popleft().result())
+
+            
+    def flush_block(self):
+        """submits the buffered text to be compressed"""
+        if self.buf_len == 0:
+            return
+        data = "".join(self.buf).encode("utf-8")
+        self.buf = []
+        self.buf_len = 0
+        self.pending.append(self.pool.submit(self.compress_block, data))
+        self.n_block += 1
+        self.write_pending(self.max_pending)
+        
+
+    def write(self, text):
+        self.buf.append(text)
+        self.buf_len += len(text)
+        if self.buf_len >= self.block_size:
+            self.flush_block()
+
+
+    def close(self):
+        self.flush_block()
+        self.write_pending(0)
+        if self.n_block == 0:
+            # write an empty gzip member, so that file is valid gzip
+            self.f.write(self.compress_block(b""))
+        self.pool.shutdown()
+        self.f.close()
+
+        
+
+def open_gzip_writer(filename, threads=1, level=GZIP_LEVEL_DEFAULT):
+    """Opens filename for writing gzipped text. If threads > 1,
+    blocks of text are compressed in parallel by a ParallelGzipWriter"""
+    if threads > 1:
+        return ParallelGzipWriter(filename, threads=threads, level=level)
+    return gzip.open(filename, "wt", compresslevel=level)
+
+
+
+def get_peak_rss_mb(children=False):
+    """returns the peak resident set size of this process in MB. If
+    children is True, returns the peak resident set size of the
+    largest single child process that has finished (not the sum over
+    child processes) instead."""
+    if children:
+        who = resource.RUSAGE_CHILDREN
+    else:
+        who = resource.RUSAGE_SELF
+    rss = resource.getrusage(who).ru_maxrss
+    if sys.platform == "darwin":
+        # ru_maxrss is in bytes on macOS, and in kB elsewhere
+        return rss / (1024.0 * 1024.0)
+    return rss / 1024.0
+
+
+
+class Metrics(object):
+    """Records the wall time spent on each chromosome (or other unit
+    of work) and in each phase of processing, counts of reads and other
+    items, the largest sizes of caches, and peak memory use, so that
+    they can be written to a JSON or TSV metrics file. If
+    progress_interval is greater than 0, progress() writes a line to
+    stderr at most once every progress_interval seconds."""
+
+    def __init__(self, progress_interval=0):
+        self.progress_interval = progress_interval
+        self.start_time = time.perf_counter()
+        self.last_progress = self.start_time
+        self.wall_seconds = 0.0
+        self.peak_rss_mb = 0.0
+
+        # current chromosome, and time that it was started
+        self.chrom = METRICS_NO_CHROM
+        self.chrom_start = None
+
+        # chromosomes in the order they were started
+        self.chroms = []
+
+        # seconds spent on each chromosome
+        self.chrom_seconds = {}
+
+        # seconds spent in each phase, counts, and maximum values,
+        # as dictionaries keyed on chromosome
+        self.phase_seconds = {}
+        self.counts = {}
+        self.max_values = {}
+
+        # last running totals given to update_count
+        self.totals = {}
+
+
+    def start_chrom(self, chrom_name):
+        """ends the current chromosome and starts timing chrom_name"""
+        self.end_chrom()
+        self.chrom = chrom_name
+        if chrom_name not in self.chrom_seconds:
+            self.chroms.append(chrom_name)
+            self.chrom_seconds[chrom_name] = 0.0
+        self.chrom_start = time.perf_counter()
+
+
+    def end_chrom(self):
+        """stops timing the current chromosome"""
+        if self.chrom_start is not None:
+            self.chrom_seconds[self.chrom] += time.perf_counter() - \
+                self.chrom_start
+            self.chrom_start = None
+        self.chrom = METRICS_NO_CHROM
+        self.peak_rss_mb = max(self.peak_rss_mb, get_peak_rss_mb())
+
+
+    def add_time(self, phase, seconds):
+        """adds seconds to the time spent in phase on the current
+        chromosome"""
+        phases = self.phase_seconds.setdefault(self.chrom, {})
+        phases[phase] = phases.get(phase, 0.0) + seconds
+
+
+    def count(self, name, n=1):
+        """adds n to a count for the current chromosome"""
+        counts = self.counts.setdefault(self.chrom, {})
+        counts[name] = counts.get(name, 0) + n
+
+
+    def update_count(self, name, total):
+        """updates a count from a running total that is kept elsewhere
+        (e.g. by a cache), adding the increase since the last update
+        to the current chromosome"""
+        n = total - self.totals.get(name, 0)
+        self.totals[name] = total
+        if n:
+            self.count(name, n)
+
+
+    def set_max(self, name, value):
+        """records value if it is the largest seen for name on the
+        current chromosome"""
+        if value > self.max_values.get(self.chrom, {}).get(name, 0):
+            self.max_values.setdefault(self.chrom, {})[name] = value
+
+
+    def progress(self):
+        """writes a progress line if progress_interval seconds have
+        passed since the last one"""
+        if self.progress_interval <= 0:
+            return
+        now = time.perf_counter()
+        if now - self.last_progress < self.progress_interval:
+            return
+        self.last_progress = now
+
+        n_read = self.counts.get(self.chrom, {}).get("reads", 0)
+        if self.chrom_start is not None and now > self.chrom_start:
+            read_rate = n_read / (now - self.chrom_start)
+        else:
+            read_rate = 0.0
+        sys.stderr.write("progress: %s: %d reads (%.0f reads/sec), "
+                         "%.1f seconds elapsed, peak RSS %.1f MB\n" %
+                         (self.chrom, n_read, read_rate,
+                          now - self.start_time, get_peak_rss_mb()))
+
+
+    def add(self, other):
+        """adds the metrics from another Metrics object to this one
+        (e.g. to combine metrics from separate worker processes)"""
+        for chrom_name in other.chroms:
+            if chrom_name not in self.chrom_seconds:
+                self.chroms.append(chrom_name)
+                self.chrom_seconds[chrom_name] = 0.0
+            self.chrom_seconds[chrom_name] += other.chrom_seconds[chrom_name]
+
+        for chrom_name, phases in other.phase_seconds.items():
+            self_phases = self.phase_seconds.setdefault(chrom_name, {})
+            for phase, seconds in phases.items():
+                self_phases[phase] = self_phases.get(phase, 0.0) + seconds
+
+        for chrom_name, counts in other.counts.items():
+            self_counts = self.counts.setdefault(chrom_name, {})
+            for name, n in counts.items():
+                self_counts[name] = self_counts.get(name, 0) + n
+
+        for chrom_name, max_values in other.max_values.items():
+            self_max_values = self.max_values.setdefault(chrom_name, {})
+            for name, value in max_values.items():
+                self_max_values[name] = max(self_max_values.get(name, 0),
+                                            value)
+
+        self.peak_rss_mb = max(self.peak_rss_mb, other.peak_rss_mb)
+
+
+    def finish(self):
+        """stops timing, and records total wall time and peak memory"""
+        self.end_chrom()
+        self.wall_seconds = time.perf_counter() - self.start_time
+
+
+    def get_summary(self, seconds, phases, counts, max_values):
+        if seconds > 0 and "reads" in counts:
+            read_rate = counts["reads"] / seconds
+        else:
+            read_rate = None
+
+        # fraction of cache lookups that were hits, from counts
+        # named <cache>_hits and <cache>_misses
+        hit_rates = {}
+        for name in counts:
+            if name.endswith("_hits") or name.endswith("_misses"):
+                cache_name = name.rsplit("_", 1)[0]
+                n_hit = counts.get(cache_name + "_hits", 0)
+                n_miss = counts.get(cache_name + "_misses", 0)
+                hit_rates[cache_name] = float(n_hit) / (n_hit + n_miss)
+
+        return {"seconds" : seconds,
+                "reads_per_second" : read_rate,
+                "phases" : dict(phases),
+                "counts" : dict(counts),
+                "max" : dict(max_values),
+                "hit_rates" : hit_rates}
+
+
+    def to_dict(self):
+        """returns the metrics as a dictionary, with a summary for
+        each chromosome and a summary of all chromosomes"""
+        chroms = list(self.chroms)
+        for chrom_name in list(self.phase_seconds) + list(self.counts) + \
+                list(self.max_values):
+            # work that was not on a chromosome
+            if chrom_name not in chroms:
+                chroms.append(chrom_name)
+
+        chrom_summaries = []
+        total_phases = {}
+        total_counts = {}
+        total_max_values = {}
+        for chrom_name in chroms:
+            summary = self.get_summary(self.chrom_seconds.get(chrom_name, 0.0),
+                                       self.phase_seconds.get(chrom_name, {}),
+                                       self.counts.get(chrom_name, {}),
+                                       self.max_values.get(chrom_name, {}))
+            summary["chrom"] = chrom_name
+            chrom_summaries.append(summary)
+
+            # combine metrics for all chromosomes
+            for phase, seconds in summary["phases"].items():
+                total_phases[phase] = total_phases.get(phase, 0.0) + seconds
+            for name, n in summary["counts"].items():
+                total_counts[name] = total_counts.get(name, 0) + n
+            for name, value in summary["max"].items():
+                total_max_values[name] = max(total_max_values.get(name, 0),
+                                             value)
+
+        total_summary = self.get_summary(self.wall_seconds, total_phases,
+                                         total_counts, total_max_values)
+
+        return {"command" : " ".join(sys.argv),
+                "wall_seconds" : self.wall_seconds,
+                "peak_rss_mb" : self.peak_rss_mb,
+                "total" : total_summary,
+                "chromosomes" : chrom_summaries}
+
+
+    def write(self, filename):
+        """writes the metrics to filename, in TSV format if the name
+        ends with .tsv and in JSON format otherwise"""
+        metrics = self.to_dict()
+
+        f = open(filename, "w")
+        if not filename.endswith(".tsv"):
+            json.dump(metrics, f, indent=2, sort_keys=True)
+            f.write("\n")
+            f.close()
+            return
+
+        # write one metric per line, in long format
+        f.write("CHROM\tMETRIC\tVALUE\n")
+        f.write("total\twall_seconds\t%g\n" % metrics["wall_seconds"])
+        f.write("total\tpeak_rss_mb\t%g\n" % metrics["peak_rss_mb"])
+        metrics["total"]["chrom"] = "total"
+        for summary in metrics["chromosomes"] + [metrics["total"]]:
+            rows = [("seconds", summary["seconds"])]
+            if summary["reads_per_second"] is not None:
+                rows.append(("reads_per_second", summary["reads_per_second"]))
+            for key in ("phases", "counts", "max", "hit_rates"):
+                rows.extend(("%s.%s" % (key, name), value) for name, value
+                            in sorted(summary[key].items()))
+            for name, value in rows:
+                f.write("%s\t%s\t%g\n" % (summary["chrom"], name, value))
+        f.close()
+
+
 
 def check_pysam_version(min_pysam_ver="0.8.4"):
     """Checks that the imported version of pysam is greater than
@@ -171,8 +636,42 @@ def check_python_version():
 ######################## START OF SNPTABLE.PY ########################
 
 NUCLEOTIDES = {b'A', b'C', b'T', b'G'}
+NUCLEOTIDE_ARRAY = np.array(sorted(NUCLEOTIDES), dtype="|S1")
 SNP_UNDEF = -1
 
+# kinds of variants in SNP table (see SNPTable.classify_variants)
+VARIANT_SNP = 0        # single-nucleotide polymorphism
+VARIANT_INDEL_1BP = 1  # 1bp insertion or deletion
+VARIANT_INDEL = 2      # longer indel (or other multi-base variant)
+VARIANT_MALFORMED = 3  # alleles with unexpected characters
+
+# types of index used to lookup SNPs by position (see SNPTable)
+SNP_INDEX_AUTO = "auto"
+SNP_INDEX_DENSE = "dense"
+SNP_INDEX_SPARSE = "sparse"
+SNP_INDEX_TYPES = [SNP_INDEX_AUTO, SNP_INDEX_DENSE, SNP_INDEX_SPARSE]
+
+# when index type is 'auto', a sparse index is used for chromosomes
+# with fewer SNPs than this per base. A sparse index uses 12 bytes per
+# SNP vs 4 bytes per base for a dense index, and lookups are faster
+# unless nearly every position has a SNP
+SPARSE_INDEX_MAX_DENSITY = 0.3
+
+# number of positions to read from HDF5 SNP index at once when
+# converting it to a sparse index
+SPARSE_INDEX_CHUNK_SIZE = 1000000
+
+# approximate number of bytes of haplotype matrix to read from HDF5
+# file at once when filtering SNPs by sample
+HAP_CHUNK_BYTES = 64*1024*1024
+
+# version of SNP cache format, this should be incremented whenever
+# the format changes or the way that SNP tables are built changes
+SNP_CACHE_VERSION = 1
+
+# number of reads to look up overlapping SNPs for at once
+READ_BLOCK_SIZE = 10000
+
 
 # codes for CIGAR string
 BAM_CMATCH     = 0   # M - match/mismatch to ref M
@@ -185,8 +684,80 @@ BAM_CPAD       = 6   # P - padding (silent deletion from padded reference)
 BAM_CEQUAL     = 7   # = - sequence match
 BAM_CDIFF      = 8   # X - sequence mismatch
 
+# lookup tables, indexed by CIGAR code, indicating whether an
+# operation consumes bases of the read / genome and whether it
+# aligns read bases to genome bases
+CIGAR_CONSUMES_READ = np.array([1, 1, 0, 0, 1, 0, 0, 1, 1], dtype=bool)
+CIGAR_CONSUMES_GENOME = np.array([1, 0, 1, 1, 0, 0, 0, 1, 1], dtype=bool)
+CIGAR_IS_MATCH = np.array([1, 0, 0, 0, 0, 0, 0, 1, 1], dtype=bool)
+
+
+def get_cigar_arrays(reads):
+    """Returns arrays describing the alignment of each of the provided
+    reads, in the form expected by SNPTable.get_overlapping_snps_batch():
+    [1] start position of each read in genome (0-based, like read.pos),
+    [2] CIGAR operation codes of all reads (concatenated),
+    [3] CIGAR operation lengths of all reads (concatenated),
+    [4] number of CIGAR operations for each read,
+    [5] query length of each read"""
+    n_read = len(reads)
+    read_starts = np.empty(n_read, dtype=np.int64)
+    n_cigar = np.empty(n_read, dtype=np.int64)
+    query_lens = np.empty(n_read, dtype=np.int64)
+    cigar_list = []
+
+    for i in range(n_read):
+        read = reads[i]
+        cigar = read.cigartuples
+        if cigar is None:
+            cigar = []
+        read_starts[i] = read.reference_start
+        n_cigar[i] = len(cigar)
+        query_lens[i] = read.query_length
+        cigar_list.extend(cigar)
+
+    if len(cigar_list) > 0:
+        cigar_array = np.array(cigar_list, dtype=np.int64)
+        cigar_ops = cigar_array[:, 0]
+        cigar_lens = cigar_array[:, 1]
+    else:
+        cigar_ops = np.array([], dtype=np.int64)
+        cigar_lens = np.array([], dtype=np.int64)
+
+    return read_starts, cigar_ops, cigar_lens, n_cigar, query_lens
+
+
+
+def iter_read_blocks(reads, block_size=READ_BLOCK_SIZE):
+    """Groups reads from an iterator into lists of up to block_size
+    consecutive reads that are all on the same chromosome, so that
+    overlapping SNPs can be looked up for a whole block at once"""
+    block = []
+    cur_tid = None
+    for read in reads:
+        if block and ((read.tid != cur_tid) or (len(block) >= block_size)):
+            yield block
+            block = []
+        cur_tid = read.tid
+        block.append(read)
+    if block:
+        yield block
+
+
+
 class SNPTable(object):
-    def __init__(self):
+    def __init__(self, index_type=SNP_INDEX_DENSE):
+        """index_type is one of SNP_INDEX_TYPES and specifies how SNPs
+        are looked up by position. A dense index uses an array with
+        an element for every position on the chromosome. A sparse index
+        only stores the positions of SNPs and uses much less memory.
+        With SNP_INDEX_AUTO the type of index is chosen for each
+        chromosome based on the density of SNPs."""
+        if index_type not in SNP_INDEX_TYPES:
+            raise ValueError("unknown SNP index type '%s', expected "
+                             "one of %s" % (index_type,
+                                            ", ".join(SNP_INDEX_TYPES)))
+        self.index_type = index_type
         self.clear()
 
     def clear(self):
@@ -198,9 +769,20 @@ class SNPTable(object):
         # snp_index array will be 0 and 1 (and can be used to lookup
         # info for the SNP in snp_pos, snp_allele1, snp_allele2 arrays)
         self.snp_index = np.array([], dtype=np.int32)
+        # when a sparse index is used, snp_index is empty and instead
+        # sparse_pos contains the sorted (0-based) positions of SNPs and
+        # sparse_idx contains the corresponding indices into
+        # snp_pos, snp_allele1, etc. For the example above sparse_pos
+        # would be [1233, 1454] and sparse_idx would be [0, 1]
+        self.is_sparse = False
+        self.index_len = 0
+        self.sparse_pos = np.array([], dtype=np.int64)
+        self.sparse_idx = np.array([], dtype=np.int32)
         self.snp_pos = np.array([], dtype=np.int32)
         self.snp_allele1 = np.array([], dtype="|S10")
         self.snp_allele2 = np.array([], dtype="|S10")
+        # kind of each variant (VARIANT_SNP, VARIANT_INDEL, etc.)
+        self.variant_kind = np.array([], dtype=np.uint8)
         self.haplotypes = None
         self.phase = None
         self.n_snp = 0
@@ -209,8 +791,15 @@ class SNPTable(object):
 
 
     def read_h5(self, snp_tab_h5, snp_index_h5, hap_h5, chrom_name,
-                samples=None):
-        """read in SNPs and indels from HDF5 input files"""
+                samples=None, cache=None):
+        """read in SNPs and indels from HDF5 input files. If an
+        SNPCache is provided, SNPs are read from the cache if they
+        are present in it, and are otherwise added to it"""
+        h5_filenames = [snp_tab_h5.filename, snp_index_h5.filename,
+                        hap_h5.filename]
+        if cache and cache.load(self, chrom_name, h5_filenames, samples,
+                                hap_h5=hap_h5):
+            return
 
         node_name = "/%s" % chrom_name
         phase_node_name = "/phase_%s" % chrom_name
@@ -232,9 +821,9 @@ class SNPTable(object):
                 self.clear()
                 return
 
-        # get numpy array of SNP idices
-        node = snp_index_h5.get_node(node_name)
-        self.snp_index = node[:]
+        # SNP index is read after SNPs, once we know how many
+        # there are
+        index_node = snp_index_h5.get_node(node_name)
 
         # get numpy array of SNP positions
         node = snp_tab_h5.get_node(node_name)
@@ -246,6 +835,8 @@ class SNPTable(object):
         self.haplotypes = hap_h5.get_node(node_name)
         if phase_node_name in hap_h5:
             self.phase = hap_h5.get_node(phase_node_name)
+        else:
+            self.phase = None
         
         if samples:
             # reduce set of SNPs and indels to ones that are
@@ -263,25 +854,18 @@ class SNPTable(object):
                 self.clear()
                 return
                 
-            hap_idx = np.empty(samp_idx.shape[0]*2, dtype=np.int)
+            hap_idx = np.empty(samp_idx.shape[0]*2, dtype=int)
             hap_idx[0::2] = samp_idx*2
             hap_idx[1::2] = samp_idx*2 + 1
-            haps = self.haplotypes[:, hap_idx]
-            if self.phase:
-                phase = self.phase[:, samp_idx]
 
-            # count number of ref and non-ref alleles,
-            # ignoring undefined (-1s)
-            nonref_count = np.apply_along_axis(np.sum, 1, haps == 1)
-            ref_count = np.apply_along_axis(np.sum, 1, haps == 0)
-            total_count = nonref_count + ref_count
-            is_polymorphic = (ref_count > 0) & (ref_count < total_count)
+            is_polymorphic, haps, phase = \
+                self.filter_polymorphic(samp_idx, hap_idx)
 
             # reduce to set of polymorphic positions
             sys.stderr.write("reducing %d SNPs on chromosome "
                              "%s to %d positions that are polymorphic in "
                              "sample of %d individuals\n" %
-                             (haps.shape[0], chrom_name, 
+                             (self.n_snp, chrom_name, 
                               np.sum(is_polymorphic), len(samples)))
 
             # make filtered and ordered samples for this chromosome
@@ -290,18 +874,29 @@ class SNPTable(object):
                                   key=operator.itemgetter(1))
             self.samples = [x[0] for x in sorted_samps]
             
-            self.haplotypes = haps[is_polymorphic,]
-            if self.phase:
-                self.phase = phase[is_polymorphic,]
+            self.haplotypes = haps
+            self.phase = phase
             self.snp_pos = self.snp_pos[is_polymorphic]
             self.snp_allele1 = self.snp_allele1[is_polymorphic]
             self.snp_allele2 = self.snp_allele2[is_polymorphic]
             self.n_snp = self.snp_pos.shape[0]
 
             # regenerate index to point to reduced set of polymorphic SNPs
-            self.snp_index[:] = -1                
-            self.snp_index[self.snp_pos-1] = np.arange(self.n_snp,
-                                                       dtype=np.int32)
+            self.make_index(index_node.shape[0])
+        elif self.use_sparse_index(index_node.shape[0]):
+            self.read_h5_sparse_index(index_node)
+        else:
+            # get numpy array of SNP idices
+            self.is_sparse = False
+            self.snp_index = index_node[:]
+            self.index_len = self.snp_index.shape[0]
+                
+        self.variant_kind = self.classify_variants(chrom_name)
+
+        if cache:
+            cache.save(self, chrom_name, h5_filenames, samples,
+                       hap_node_name=node_name,
+                       phase_node_name=phase_node_name)
                 
 
     
@@ -372,8 +967,115 @@ class SNPTable(object):
                              "%s: %s\n" %
                              (chrom_name, ",".join(not_seen_samples)))
         
-        return samp_idx_dict, np.array(samp_idx, dtype=np.int)
+        return samp_idx_dict, np.array(samp_idx, dtype=int)
+
+        
+
+    def filter_polymorphic(self, samp_idx, hap_idx):
+        """Finds SNPs that are polymorphic in the samples with the
+        provided indices (samp_idx) and haplotype columns (hap_idx).
+        The haplotype (and phase) matrices are read from the HDF5
+        file in chunks of rows, so that the full matrix is never held
+        in memory. Returns a boolean array indicating which SNPs are
+        polymorphic and the haplotype and phase matrices for only
+        those SNPs and samples (phase is None if there is no phase
+        information)."""
+        n_row = self.haplotypes.shape[0]
+        n_col = max(self.haplotypes.shape[1], 1)
+        chunk_size = max(HAP_CHUNK_BYTES // n_col, 1)
+
+        is_polymorphic = np.zeros(n_row, dtype=bool)
+        hap_chunks = []
+        phase_chunks = []
+
+        for start in range(0, n_row, chunk_size):
+            end = min(start + chunk_size, n_row)
+            haps = self.haplotypes[start:end][:, hap_idx]
+
+            # count number of ref and non-ref alleles,
+            # ignoring undefined (-1s)
+            nonref_count = np.count_nonzero(haps == 1, axis=1)
+            ref_count = np.count_nonzero(haps == 0, axis=1)
+            total_count = nonref_count + ref_count
+            is_poly = (ref_count > 0) & (ref_count < total_count)
+            is_polymorphic[start:end] = is_poly
+
+            hap_chunks.append(haps[is_poly])
+            if self.phase is not None:
+                phase = self.phase[start:end][:, samp_idx]
+                phase_chunks.append(phase[is_poly])
+
+        if hap_chunks:
+            haps = np.concatenate(hap_chunks)
+        else:
+            haps = np.empty((0, hap_idx.shape[0]),
+                            dtype=self.haplotypes.dtype)
+
+        if self.phase is None:
+            phase = None
+        elif phase_chunks:
+            phase = np.concatenate(phase_chunks)
+        else:
+            phase = np.empty((0, samp_idx.shape[0]), dtype=self.phase.dtype)
+
+        return is_polymorphic, haps, phase
+        
 
+    def use_sparse_index(self, chrom_len):
+        """returns True if a sparse index should be used for the
+        current set of SNPs on a chromosome of length chrom_len"""
+        if self.index_type == SNP_INDEX_AUTO:
+            return self.n_snp < SPARSE_INDEX_MAX_DENSITY * chrom_len
+        return self.index_type == SNP_INDEX_SPARSE
+    
+    
+    def make_index(self, index_len):
+        """Makes index (dense or sparse) that is used to lookup SNPs 
+        by their position on the chromosome. index_len is the length 
+        of the dense index (i.e. the maximum SNP position). Where there
+        are multiple SNPs at the same position, the index points to 
+        the last one."""
+        self.index_len = index_len
+        if self.use_sparse_index(index_len):
+            self.is_sparse = True
+            self.snp_index = np.array([], dtype=np.int32)
+
+            order = np.argsort(self.snp_pos, kind="stable")
+            pos = self.snp_pos[order].astype(np.int64) - 1
+            is_last = np.ones(pos.shape[0], dtype=bool)
+            is_last[:-1] = pos[1:] != pos[:-1]
+            self.sparse_pos = pos[is_last]
+            self.sparse_idx = order[is_last].astype(np.int32)
+        else:
+            self.is_sparse = False
+            self.snp_index = np.empty(index_len, dtype=np.int32)
+            self.snp_index[:] = SNP_UNDEF
+            self.snp_index[self.snp_pos-1] = np.arange(self.n_snp,
+                                                       dtype=np.int32)
+
+            
+    def read_h5_sparse_index(self, index_node):
+        """Makes sparse index from dense SNP index stored in HDF5 file,
+        reading a chunk of positions at a time so that the whole dense
+        index is never held in memory"""
+        self.is_sparse = True
+        self.index_len = index_node.shape[0]
+        self.snp_index = np.array([], dtype=np.int32)
+        
+        pos_list = []
+        idx_list = []
+        for start in range(0, index_node.shape[0], SPARSE_INDEX_CHUNK_SIZE):
+            chunk = index_node[start:start+SPARSE_INDEX_CHUNK_SIZE]
+            offsets = np.where(chunk != SNP_UNDEF)[0]
+            pos_list.append(offsets.astype(np.int64) + start)
+            idx_list.append(chunk[offsets].astype(np.int32))
+
+        if pos_list:
+            self.sparse_pos = np.concatenate(pos_list)
+            self.sparse_idx = np.concatenate(idx_list)
+        else:
+            self.sparse_pos = np.array([], dtype=np.int64)
+            self.sparse_idx = np.array([], dtype=np.int32)
         
 
     def is_snp(self, allele1, allele2):
@@ -398,12 +1100,59 @@ class SNPTable(object):
         return False
         
 
+    def classify_variants(self, name):
+        """Classifies every variant in the table as a SNP, 1bp indel,
+        longer indel or malformed variant (with unexpected characters
+        in its alleles), like is_snp but for all variants at
+        once. Returns an array of VARIANT_* codes. A single warning is
+        written for malformed variants, which are treated like indels
+        when reads are checked for overlapping SNPs. name is the
+        chromosome or file that the variants were read from."""
+        len1 = np.char.str_len(self.snp_allele1)
+        len2 = np.char.str_len(self.snp_allele2)
+        is_single = (len1 == 1) & (len2 == 1)
+        is_nuc = (np.isin(self.snp_allele1, NUCLEOTIDE_ARRAY) &
+                  np.isin(self.snp_allele2, NUCLEOTIDE_ARRAY))
+
+        # deleted allele may be represented with '-' character
+        is_del1 = (self.snp_allele1 == b"-")
+        is_del2 = (self.snp_allele2 == b"-")
+        len1[is_del1] = 0
+        len2[is_del2] = 0
+        
+        is_snp = is_single & is_nuc
+        is_malformed = (is_single & ~is_nuc & ~is_del1 & ~is_del2) | \
+                       ((len1 == 0) & (len2 == 0))
+        is_indel_1bp = ~is_snp & ~is_malformed & (np.abs(len1 - len2) == 1)
+
+        variant_kind = np.full(self.snp_pos.shape[0], VARIANT_INDEL,
+                               dtype=np.uint8)
+        variant_kind[is_snp] = VARIANT_SNP
+        variant_kind[is_indel_1bp] = VARIANT_INDEL_1BP
+        variant_kind[is_malformed] = VARIANT_MALFORMED
+
+        n_malformed = np.sum(is_malformed)
+        if n_malformed > 0:
+            i = np.where(is_malformed)[0][0]
+            sys.stderr.write("WARNING: %d variants in %s have unexpected "
+                             "characters in alleles (e.g. %s/%s at "
+                             "position %d), treating them as indels\n" %
+                             (n_malformed, name, self.snp_allele1[i],
+                              self.snp_allele2[i], self.snp_pos[i]))
+        
+        return variant_kind
+
 
         
-    def read_file(self, filename):
-        """read in SNPs and indels from text input file"""
+    def read_file(self, filename, cache=None):
+        """read in SNPs and indels from text input file. If an
+        SNPCache is provided, SNPs are read from the cache if they
+        are present in it, and are otherwise added to it"""
+        if cache and cache.load(self, filename, [filename]):
+            return
+        
         try:
-            if util.is_gzipped(filename):
+            if is_gzipped(filename):
                 f = gzip.open(filename, "rt")
             else:
                 f = open(filename, "rt")
@@ -453,18 +1202,181 @@ class SNPTable(object):
         self.snp_allele2 = np.array(snp_allele2_list, dtype="|S10")
         del snp_allele2_list
 
+        self.n_snp = self.snp_pos.shape[0]
+
         # make another array that makes it easy to lookup SNPs by their position
         # on the chromosome
-        self.snp_index = np.empty(max_pos, dtype=np.int32)
-        self.snp_index[:] = SNP_UNDEF
-        self.snp_index[self.snp_pos-1] = np.arange(self.snp_pos.shape[0])
-
-        self.n_snp = self.snp_pos.shape[0]
+        self.make_index(max_pos)
+        self.variant_kind = self.classify_variants(filename)
 
         # currently haplotypes can only be read from HDF5 file
         self.haplotypes = None
 
+        if cache:
+            cache.save(self, filename, [filename])
+
     
+    def get_snps_in_intervals(self, starts, lengths):
+        """Finds SNPs and indels that overlap a set of genomic intervals.
+        starts are the (0-based) start positions of the intervals and
+        lengths are their lengths. Returns three arrays with an element
+        for each overlapping SNP / indel: [1] index of the interval
+        it overlaps, [2] offset of the SNP / indel from the start of the
+        interval, [3] index of the SNP / indel. Overlaps are ordered by
+        interval and then by offset."""
+
+        if self.is_sparse:
+            # find range of SNPs that falls within each interval
+            first = np.searchsorted(self.sparse_pos, starts, side="left")
+            last = np.searchsorted(self.sparse_pos, starts + lengths,
+                                   side="left")
+            n_hit = last - first
+
+            interval_idx = np.repeat(np.arange(starts.shape[0]), n_hit)
+            interval_first = np.cumsum(n_hit) - n_hit
+            k = (np.arange(interval_idx.shape[0]) -
+                 interval_first[interval_idx] + first[interval_idx])
+            offsets = self.sparse_pos[k] - starts[interval_idx]
+
+            return interval_idx, offsets, self.sparse_idx[k]
+
+        # clip intervals to end of index, as there are no SNPs past the end
+        ends = np.minimum(starts + lengths, self.snp_index.shape[0])
+        n_pos = np.maximum(ends - starts, 0)
+
+        # expand intervals to get every genomic position that they cover
+        interval_idx = np.repeat(np.arange(starts.shape[0]), n_pos)
+        interval_first = np.cumsum(n_pos) - n_pos
+        offsets = (np.arange(interval_idx.shape[0]) -
+                   interval_first[interval_idx])
+        s_idx = self.snp_index[starts[interval_idx] + offsets]
+
+        is_hit = (s_idx != SNP_UNDEF)
+
+        return interval_idx[is_hit], offsets[is_hit], s_idx[is_hit]
+
+
+    def get_overlapping_snps_batch(self, read_starts, cigar_ops, cigar_lens,
+                                   n_cigar, query_lens):
+        """Finds the SNPs and indels that overlap a block of reads.
+        The reads are described by arrays (see get_cigar_arrays()):
+        read_starts - start positions of reads in genome (0-based)
+        cigar_ops - CIGAR operation codes for all reads, concatenated
+        cigar_lens - CIGAR operation lengths for all reads, concatenated
+        n_cigar - number of CIGAR operations for each read
+        query_lens - length of each read sequence
+
+        Returns six arrays:
+        [1] offsets into [2] and [3] for each read (of length n_read+1),
+        [2] indices of SNPs that reads overlap,
+        [3] positions in reads that overlap SNPs,
+        [4] offsets into [5] and [6] for each read (of length n_read+1),
+        [5] indices of indels that reads overlap,
+        [6] positions in reads that overlap indels.
+        The SNPs overlapping read i are snp_idx[snp_offsets[i]:snp_offsets[i+1]].
+        First base of read is position 1."""
+        read_starts = np.asarray(read_starts, dtype=np.int64)
+        cigar_ops = np.asarray(cigar_ops, dtype=np.int64)
+        cigar_lens = np.asarray(cigar_lens, dtype=np.int64)
+        n_cigar = np.asarray(n_cigar, dtype=np.int64)
+        query_lens = np.asarray(query_lens, dtype=np.int64)
+        n_read = read_starts.shape[0]
+
+        is_unknown = (cigar_ops < BAM_CMATCH) | (cigar_ops > BAM_CDIFF)
+        if np.any(is_unknown):
+            raise ValueError("unknown CIGAR code %d" %
+                             cigar_ops[is_unknown][0])
+
+        # index of read that each CIGAR operation belongs to, and
+        # index of first CIGAR operation for each read
+        op_read = np.repeat(np.arange(n_read), n_cigar)
+        read_first_op = (np.cumsum(n_cigar) - n_cigar)[op_read]
+
+        # number of bases of read and genome consumed by each operation
+        read_len = np.where(CIGAR_CONSUMES_READ[cigar_ops], cigar_lens, 0)
+        genome_len = np.where(CIGAR_CONSUMES_GENOME[cigar_ops], cigar_lens, 0)
+
+        # number of read / genome bases consumed before each operation
+        # (within its read)
+        read_cum = np.cumsum(read_len) - read_len
+        read_offset = read_cum - read_cum[read_first_op]
+        genome_cum = np.cumsum(genome_len) - genome_len
+        genome_offset = genome_cum - genome_cum[read_first_op]
+
+        total_read_len = np.bincount(op_read, weights=read_len,
+                                     minlength=n_read).astype(np.int64)
+        is_bad_len = total_read_len != query_lens
+        if np.any(is_bad_len):
+            i = np.where(is_bad_len)[0][0]
+            raise ValueError("length of read segments in CIGAR %d "
+                             "does not add up to query length (%d)" %
+                             (total_read_len[i], query_lens[i]))
+
+        # Look for SNPs and indels in match / mismatch segments and
+        # for indels in deleted segments. Read segments that are
+        # inserted or soft-clipped do not exist in the reference and
+        # skipped segments (e.g. introns) are ignored
+        is_del = (cigar_ops == BAM_CDEL)
+        is_lookup = CIGAR_IS_MATCH[cigar_ops] | is_del
+        seg_read = op_read[is_lookup]
+        seg_del = is_del[is_lookup]
+        seg_read_offset = read_offset[is_lookup]
+        seg_starts = read_starts[seg_read] + genome_offset[is_lookup]
+
+        seg_idx, offsets, s_idx = \
+            self.get_snps_in_intervals(seg_starts, cigar_lens[is_lookup])
+
+        hit_read = seg_read[seg_idx]
+        hit_del = seg_del[seg_idx]
+        # for deletions, position in read is where we last left off
+        # in read sequence
+        read_pos = np.where(hit_del, seg_read_offset[seg_idx],
+                            seg_read_offset[seg_idx] + offsets + 1)
+
+        is_snp = (self.variant_kind[s_idx] == VARIANT_SNP)
+        # SNPs in deleted segments are ignored
+        is_snp_hit = is_snp & ~hit_del
+        is_indel_hit = ~is_snp
+
+        snp_offsets = np.zeros(n_read+1, dtype=np.int64)
+        snp_offsets[1:] = np.cumsum(np.bincount(hit_read[is_snp_hit],
+                                                minlength=n_read))
+        indel_offsets = np.zeros(n_read+1, dtype=np.int64)
+        indel_offsets[1:] = np.cumsum(np.bincount(hit_read[is_indel_hit],
+                                                  minlength=n_read))
+
+        return (snp_offsets, s_idx[is_snp_hit], read_pos[is_snp_hit],
+                indel_offsets, s_idx[is_indel_hit], read_pos[is_indel_hit])
+
+
+    def get_overlapping_snps_reads(self, reads):
+        """Like get_overlapping_snps but looks up SNPs and indels
+        for a list of reads at once, which is much faster than
+        calling get_overlapping_snps for each read. Returns a list
+        containing a tuple of four lists for each read (in the form
+        returned by get_overlapping_snps)."""
+        snp_offsets, snp_idx, snp_read_pos, \
+            indel_offsets, indel_idx, indel_read_pos = \
+            self.get_overlapping_snps_batch(*get_cigar_arrays(reads))
+
+        snp_offsets = snp_offsets.tolist()
+        snp_idx = snp_idx.tolist()
+        snp_read_pos = snp_read_pos.tolist()
+        indel_offsets = indel_offsets.tolist()
+        indel_idx = indel_idx.tolist()
+        indel_read_pos = indel_read_pos.tolist()
+
+        overlaps = []
+        for i in range(len(reads)):
+            s_start, s_end = snp_offsets[i], snp_offsets[i+1]
+            i_start, i_end = indel_offsets[i], indel_offsets[i+1]
+            overlaps.append((snp_idx[s_start:s_end],
+                             snp_read_pos[s_start:s_end],
+                             indel_idx[i_start:i_end],
+                             indel_read_pos[i_start:i_end]))
+        return overlaps
+
+
     def get_overlapping_snps(self, read):
         """Returns several lists: 
         [1] indices of SNPs that this read overlaps,
@@ -472,154 +1384,212 @@ class SNPTable(object):
         [3] indices for indels that read overlaps, 
         [4] positions in read sequence that overlap indels. 
         First base of read is position 1."""
+        snp_offsets, snp_idx, snp_read_pos, \
+            indel_offsets, indel_idx, indel_read_pos = \
+            self.get_overlapping_snps_batch(*get_cigar_arrays([read]))
         
-        # read.cigar is a list of tuples. Each tuple has two entries. The first
-        # entry specifies the character in the cigar and the second entry
-        # specifies the length of that character. The values are
-        # M       BAM_CMATCH      0
-        # I       BAM_CINS        1
-        # D       BAM_CDEL        2
-        # N       BAM_CREF_SKIP   3
-        # S       BAM_CSOFT_CLIP  4
-        # H       BAM_CHARD_CLIP  5
-        # P       BAM_CPAD        6
-        # =       BAM_CEQUAL      7
-        # X       BAM_CDIFF       8
-        # E.g. (0, 5) means 5 matches, and (4, 2) means a soft clip of 2bp
-        read_start = 0
-        read_end = 0
-        genome_start = read.pos
-        genome_end = read.pos
-
-        # index into combined SNP/indel table for overlapping SNPs
-        snp_idx = []
-        # positions in read of overlapping SNPs
-        snp_read_pos = []
-        # index into combined SNP/indel table for overlapping indels
-        indel_idx = []
-        # positions in read of overlapping SNPs
-        indel_read_pos = []
-        
-        for cigar in read.cigar:
-            op = cigar[0] # CIGAR 'operation'
-            op_len  = cigar[1] # length of operation
-            
-            if (op == BAM_CMATCH) or (op == BAM_CEQUAL) or (op == BAM_CDIFF):
-                # match or mismatch to reference
-                read_start = read_end + 1
-                read_end = read_start + op_len - 1
-                genome_start = genome_end + 1
-                genome_end = genome_start + op_len - 1
-
-                # check for SNP in this genome segment
-                s = genome_start - 1
-                e = min(genome_end, self.snp_index.shape[0])
-                s_idx = self.snp_index[s:e]
-                offsets = np.where(s_idx != SNP_UNDEF)[0]
-                
-                if offsets.shape[0] > 0:
-                    # there are overlapping SNPs and/or indels
-                    
-                    for offset in offsets:
-                        read_pos = offset + read_start
-                        
-                        allele1 = self.snp_allele1[s_idx[offset]]
-                        allele2 = self.snp_allele2[s_idx[offset]]
-                        if self.is_snp(allele1, allele2):
-                            snp_idx.append(s_idx[offset])
-                            snp_read_pos.append(read_pos)
-                        else:
-                            indel_idx.append(s_idx[offset])
-                            indel_read_pos.append(read_pos)
-
-            elif op == BAM_CINS:
-                # insert in read relative to reference
-                read_start = read_end + 1
-                read_end = read_start + op_len - 1
-
-                # Genome sequence does not advance, no possibility
-                # for read to overlap SNP, since these bases do
-                # not exist in reference.
-                # INDELs here should be picked up
-                # by one of flanking match segments
-
-            elif op == BAM_CDEL:
-                # deletion in read relative to reference
-                genome_start = genome_end + 1
-                genome_end   = genome_start + op_len - 1
-
-                # Read sequence does not advance, no possibility
-                # for read to overlap SNP, since these bases do
-                # not exist in read
-
-                # in most cases deletion should be picked up
-                # by flanking match segment, but there could be
-                # nested indels
-
-                s = genome_start - 1
-                e = min(genome_end, self.snp_index.shape[0])
-                
-                # check for INDEL in this genome segment
-                s_idx = self.snp_index[s:e]
-                offsets = np.where(s_idx != SNP_UNDEF)[0]
-                
-                if offsets.shape[0] > 0:
-                    # there are overlapping SNPs and/or indels
-                    for offset in offsets:
-                        read_pos = offset + read_start
-                        allele1 = self.snp_allele1[s_idx[offset]]
-                        allele2 = self.snp_allele2[s_idx[offset]]
-                        if self.is_snp(allele1, allele2):
-                            # ignore SNP
-                            pass
-                        else:
-                            indel_idx.append(s_idx[offset])
-                            # position in read is where we last left off
-                            # in read sequence
-                            indel_read_pos.append(read_end)
-            elif op == BAM_CREF_SKIP:
-                # section of skipped reference, such as intron
-                genome_end = genome_end + op_len
-                genome_start = genome_end
-
-                # do nothing with SNPs/indels in this region
-                # since they are skipped
-                
-            elif op == BAM_CSOFT_CLIP:
-                # this part of read skipped
-                read_start = read_end + 1
-                read_end = read_start + op_len - 1
-
-                # This is like insert, but at end of the read.
-                # Sequence was not considered in alignment.
-                # Usually this is because bases at end of read
-                # were low quality. One option would be to 
-                # pretend soft-clipped part of read was aligned
-                # like match/mismatch and to consider SNPs in this
-                # region. We have decided to not consider SNPs 
-                # because this part of read is not actually aligned.
-
-            elif op == BAM_CHARD_CLIP:
-                # these bases not included in read or genome
-                pass
+        return (snp_idx.tolist(), snp_read_pos.tolist(),
+                indel_idx.tolist(), indel_read_pos.tolist())
+
+
+
+class SNPCache(object):
+    """Stores per-chromosome SNP tables in a cache directory, so that
+    later runs with the same SNP files do not need to parse them
+    again. Each table is stored as a directory of .npy files, which
+    are memory-mapped when they are read back. Tables are keyed by
+    the real path, size and modification time of each input SNP file
+    and the list of samples used to filter the SNPs, so a cached table
+    is not used after an input file is replaced or modified. If
+    checksum is True, input files are identified by an MD5 checksum of
+    their contents instead, which reads every byte of the files but
+    also detects changes that keep the same size and modification
+    time."""
+
+    def __init__(self, cache_dir, checksum=False):
+        self.cache_dir = cache_dir
+        self.checksum = checksum
+        # keys of input files, by filename, so that each file
+        # is only checked once
+        self.file_keys = {}
+
+
+    def get_checksum(self, filename):
+        """returns MD5 checksum of contents of file"""
+        md5 = hashlib.md5()
+        f = open(filename, "rb")
+        while True:
+            block = f.read(1024*1024)
+            if not block:
+                break
+            md5.update(block)
+        f.close()
+        return md5.hexdigest()
 
-            elif op == BAM_CPAD:
-                # like an insert, likely only used in multiple-sequence
-                # alignment where inserts may be of different lengths
-                # in different seqs
-                read_start += read_end + 1
-                read_end = read_start + op_len - 1
 
+    def get_file_key(self, filename):
+        """returns string that identifies the version of an input 
+        file: its real path, size and modification time (in ns), or 
+        the checksum of its contents if self.checksum is True"""
+        if filename not in self.file_keys:
+            if self.checksum:
+                key = "md5:%s" % self.get_checksum(filename)
             else:
-                raise ValueError("unknown CIGAR code %d" % op)
+                st = os.stat(filename)
+                key = "stat:%s:%d:%d" % (os.path.realpath(filename),
+                                         st.st_size, st.st_mtime_ns)
+            self.file_keys[filename] = key
 
-        if read_end != len(read.seq):
-            raise ValueError("length of read segments in CIGAR %d "
-                             "does not add up to query length (%d)" %
-                             (read_end, len(read.seq)))
-        
+        return self.file_keys[filename]
+
+    
+    def get_key(self, filenames, samples=None):
+        """returns key for SNP table read from provided input files
+        and filtered using provided list of samples"""
+        md5 = hashlib.md5()
+        md5.update(("version:%d\n" % SNP_CACHE_VERSION).encode())
+        for filename in filenames:
+            md5.update(("file:%s\n" % self.get_file_key(filename)).encode())
+        if samples:
+            for samp in samples:
+                md5.update(("sample:%s\n" % samp).encode())
+        return md5.hexdigest()
+
+    
+    def get_path(self, chrom_name, filenames, samples=None):
+        """returns path to cache directory for SNP table, or None if
+        one of the input files cannot be read"""
+        try:
+            key = self.get_key(filenames, samples)
+        except IOError:
+            return None
+
+        # text SNP files are identified by filename rather than
+        # chromosome name
+        name = os.path.basename(chrom_name)
+        return os.path.join(self.cache_dir, "v%d" % SNP_CACHE_VERSION,
+                            key, name)
+    
+
+    def load(self, snp_tab, chrom_name, filenames, samples=None, hap_h5=None):
+        """Reads SNP table from cache into snp_tab. Returns True if
+        table was in the cache and False otherwise. hap_h5 is used
+        to get haplotypes that were not filtered by sample, which are
+        not stored in the cache."""
+        path = self.get_path(chrom_name, filenames, samples)
+        if path is None or not os.path.exists(path):
+            return False
+
+        f = open(os.path.join(path, "info.json"), "rt")
+        info = json.load(f)
+        f.close()
+
+        if info['version'] != SNP_CACHE_VERSION:
+            return False
+
+        sys.stderr.write("reading SNPs from cache '%s'\n" % path)
+
+        def load_array(name):
+            return np.load(os.path.join(path, name + ".npy"),
+                           mmap_mode='r')
+
+        snp_tab.clear()
+        snp_tab.snp_pos = load_array("snp_pos")
+        snp_tab.snp_allele1 = load_array("snp_allele1")
+        snp_tab.snp_allele2 = load_array("snp_allele2")
+        snp_tab.variant_kind = load_array("variant_kind")
+        snp_tab.n_snp = snp_tab.snp_pos.shape[0]
+        snp_tab.samples = info['samples']
+
+        # index is always stored in sparse form, but is converted to
+        # a dense index if that is what is wanted
+        snp_tab.index_len = info['index_len']
+        sparse_pos = load_array("sparse_pos")
+        sparse_idx = load_array("sparse_idx")
+        if snp_tab.use_sparse_index(snp_tab.index_len):
+            snp_tab.is_sparse = True
+            snp_tab.sparse_pos = sparse_pos
+            snp_tab.sparse_idx = sparse_idx
+        else:
+            snp_tab.is_sparse = False
+            snp_tab.snp_index = np.empty(snp_tab.index_len, dtype=np.int32)
+            snp_tab.snp_index[:] = SNP_UNDEF
+            snp_tab.snp_index[sparse_pos] = sparse_idx
+
+        if info['has_haplotypes']:
+            snp_tab.haplotypes = load_array("haplotypes")
+            if info['has_phase']:
+                snp_tab.phase = load_array("phase")
+        elif hap_h5 and info['hap_node_name']:
+            snp_tab.haplotypes = hap_h5.get_node(info['hap_node_name'])
+            if info['phase_node_name'] in hap_h5:
+                snp_tab.phase = hap_h5.get_node(info['phase_node_name'])
+
+        return True
+
+    
+    def save(self, snp_tab, chrom_name, filenames, samples=None,
+             hap_node_name=None, phase_node_name=None):
+        """Writes SNP table to the cache. Haplotypes are only stored if
+        they have been filtered by sample (and are therefore not an 
+        HDF5 node), otherwise the name of the HDF5 haplotype node is
+        stored so that they can be retrieved from the HDF5 file."""
+        path = self.get_path(chrom_name, filenames, samples)
+        if path is None or os.path.exists(path):
+            return
+
+        if snp_tab.is_sparse:
+            sparse_pos = snp_tab.sparse_pos
+            sparse_idx = snp_tab.sparse_idx
+        else:
+            sparse_pos = np.where(snp_tab.snp_index != SNP_UNDEF)[0]
+            sparse_idx = snp_tab.snp_index[sparse_pos].astype(np.int32)
+
+        has_haplotypes = isinstance(snp_tab.haplotypes, np.ndarray)
+        has_phase = has_haplotypes and isinstance(snp_tab.phase, np.ndarray)
         
-        return snp_idx, snp_read_pos, indel_idx, indel_read_pos
+        info = {'version' : SNP_CACHE_VERSION,
+                'chrom' : chrom_name,
+                'filenames' : filenames,
+                'samples' : list(snp_tab.samples),
+                'n_snp' : int(snp_tab.n_snp),
+                'index_len' : int(snp_tab.index_len),
+                'has_haplotypes' : has_haplotypes,
+                'has_phase' : has_phase,
+                'hap_node_name' : None if has_haplotypes else hap_node_name,
+                'phase_node_name' : None if has_haplotypes else phase_node_name}
+
+        # write to temporary directory first and then rename it, so
+        # that other processes never see an incomplete table
+        tmp_path = "%s.tmp%d" % (path, os.getpid())
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        arrays = [("snp_pos", snp_tab.snp_pos),
+                  ("snp_allele1", snp_tab.snp_allele1),
+                  ("snp_allele2", snp_tab.snp_allele2),
+                  ("variant_kind", snp_tab.variant_kind),
+                  ("sparse_pos", sparse_pos.astype(np.int64)),
+                  ("sparse_idx", sparse_idx)]
+        if has_haplotypes:
+            arrays.append(("haplotypes", snp_tab.haplotypes))
+        if has_phase:
+            arrays.append(("phase", snp_tab.phase))
+
+        for name, array in arrays:
+            np.save(os.path.join(tmp_path, name + ".npy"), array)
+
+        f = open(os.path.join(tmp_path, "info.json"), "wt")
+        json.dump(info, f, indent=2)
+        f.close()
+
+        try:
+            os.rename(tmp_path, path)
+            sys.stderr.write("wrote SNPs to cache '%s'\n" % path)
+        except OSError:
+            # another process wrote this table first
+            shutil.rmtree(tmp_path)
 
 ######################## END OF SNPTABLE.PY ########################
 
@@ -632,19 +1602,29 @@ class DataFiles(object):
     def __init__(self, bam_filename, is_sorted, is_paired,
                  output_dir=None, snp_dir=None,
                  snp_tab_filename=None, snp_index_filename=None,
-                 haplotype_filename=None, samples=None):
+                 haplotype_filename=None, samples=None,
+                 open_files=True, compress_threads=1,
+                 compress_level=GZIP_LEVEL_DEFAULT, sort_threads=1,
+                 sort_mem=SORT_MEM_DEFAULT):
         # flag indicating whether reads are paired-end
         self.is_paired = is_paired
+
+        # number of threads used to compress each output file
+        # and gzip compression level of output fastq files
+        self.compress_threads = compress_threads
+        self.compress_level = compress_level
         
         # prefix for output files
         self.prefix = None
 
         # name of input BAM filename
         self.bam_filename = bam_filename        
-        # name of sorted input bam_filename
+        # name of sorted and indexed input bam_filename
         # (new file is created if input file is not
         #  already sorted)
         self.bam_sort_filename = None
+        # name of index of bam_sort_filename
+        self.bam_index_filename = None
         # pysam file handle for input BAM
         self.input_bam = None
 
@@ -673,14 +1653,10 @@ class DataFiles(object):
         self.snp_index_filename = snp_index_filename
         self.haplotype_filename = haplotype_filename
 
-        if self.snp_tab_filename:
-            self.snp_tab_h5 = tables.open_file(snp_tab_filename, "r")
-            self.snp_index_h5 = tables.open_file(snp_index_filename, "r")
-            self.hap_h5 = tables.open_file(haplotype_filename, "r")
-        else:
-            self.snp_tab_h5 = None
-            self.snp_index_h5 = None
-            self.hap_h5 = None
+        # pytables file handles for HDF5 files
+        self.snp_tab_h5 = None
+        self.snp_index_h5 = None
+        self.hap_h5 = None
 
             
         # separate input directory and bam filename
@@ -712,46 +1688,111 @@ class DataFiles(object):
         # on command line rather than appending name to prefix
         sys.stderr.write("prefix: %s\n" % self.prefix)
         
-        if not is_sorted:
-            sort_bam(self.bam_filename, self.prefix)
-            self.bam_sort_filename = self.prefix + ".sort.bam"
-        else:
-            self.bam_sort_filename = self.bam_filename
+        self.bam_sort_filename, self.bam_index_filename = \
+            get_sorted_bam(self.bam_filename, self.prefix,
+                           is_sorted=is_sorted, threads=sort_threads,
+                           sort_mem=sort_mem)
 
-        self.keep_filename = self.prefix + ".keep.bam"
-        self.remap_filename = self.prefix + ".to.remap.bam"
+        self.set_output_filenames()
 
         sys.stderr.write("reading reads from:\n  %s\n" %
                          self.bam_sort_filename)
         
         sys.stderr.write("writing output files to:\n")
-
-        
         if self.is_paired:
-            self.fastq1_filename = self.prefix + ".remap.fq1.gz"
-            self.fastq2_filename = self.prefix + ".remap.fq2.gz"
-            self.fastq1 = gzip.open(self.fastq1_filename, "wt")
-            self.fastq2 = gzip.open(self.fastq2_filename, "wt")
-            self.fastq_single_filename = self.prefix + ".remap.single.fq.gz"
-            self.fastq_single = gzip.open(self.fastq_single_filename, "wt")
             sys.stderr.write("  %s\n  %s\n  %s\n" %
                              (self.fastq1_filename,
                               self.fastq2_filename,
                               self.fastq_single_filename))
-            
         else:
-            self.fastq_single_filename = self.prefix + ".remap.fq.gz"
-            self.fastq_single = gzip.open(self.fastq_single_filename, "wt")
             sys.stderr.write("  %s\n" % (self.fastq_single_filename))
-
-        self.input_bam = pysam.Samfile(self.bam_sort_filename, "r")
-        self.keep_bam = pysam.Samfile(self.keep_filename, "w",
-                                      template=self.input_bam)
-        self.remap_bam = pysam.Samfile(self.remap_filename, "w",
-                                       template=self.input_bam)
         sys.stderr.write("  %s\n  %s\n" % (self.keep_filename,
                                            self.remap_filename))
 
+        if open_files:
+            self.open_files()
+
+
+    def set_output_filenames(self):
+        """sets names of output files using current prefix"""
+        self.keep_filename = self.prefix + ".keep.bam"
+        self.remap_filename = self.prefix + ".to.remap.bam"
+
+        if self.is_paired:
+            self.fastq1_filename = self.prefix + ".remap.fq1.gz"
+            self.fastq2_filename = self.prefix + ".remap.fq2.gz"
+            self.fastq_single_filename = self.prefix + ".remap.single.fq.gz"
+        else:
+            self.fastq_single_filename = self.prefix + ".remap.fq.gz"
+
+            
+    def open_files(self):
+        """opens input SNP and BAM files and creates output files"""
+        if self.snp_tab_filename:
+            self.snp_tab_h5 = tables.open_file(self.snp_tab_filename, "r")
+            self.snp_index_h5 = tables.open_file(self.snp_index_filename, "r")
+            self.hap_h5 = tables.open_file(self.haplotype_filename, "r")
+
+        if self.is_paired:
+            self.fastq1 = self.open_fastq(self.fastq1_filename)
+            self.fastq2 = self.open_fastq(self.fastq2_filename)
+        self.fastq_single = self.open_fastq(self.fastq_single_filename)
+
+        self.input_bam = self.open_input_bam()
+        self.keep_bam = self.open_output_bam(self.keep_filename,
+                                             self.input_bam)
+        self.remap_bam = self.open_output_bam(self.remap_filename,
+                                              self.input_bam)
+
+
+    def open_input_bam(self):
+        """opens sorted input BAM file with its index"""
+        return pysam.Samfile(self.bam_sort_filename, "r",
+                             index_filename=self.bam_index_filename)
+
+
+    def open_fastq(self, filename):
+        """opens gzipped output fastq file"""
+        return open_gzip_writer(filename, threads=self.compress_threads,
+                                level=self.compress_level)
+
+    
+    def open_output_bam(self, filename, template):
+        """opens output BAM file (BGZF-compressed unless compression
+        level is 0) with header from template"""
+        if self.compress_level == 0:
+            mode = "wb0"
+        else:
+            mode = "wb"
+        return pysam.Samfile(filename, mode, template=template,
+                             threads=self.compress_threads)
+
+
+    def open_shard(self, tid):
+        """Returns a copy of this object with all files opened, that
+        writes output for the chromosome with index tid to separate
+        'shard' files. Used by worker processes, which must
+        open their own filehandles."""
+        shard = copy.copy(self)
+        shard.prefix = "%s.shard%d" % (self.prefix, tid)
+        shard.set_output_filenames()
+        shard.open_files()
+        return shard
+
+
+    def shard_filenames(self, tid):
+        """Returns list of (shard_filename, output_filename) tuples
+        for the chromosome with index tid"""
+        shard = copy.copy(self)
+        shard.prefix = "%s.shard%d" % (self.prefix, tid)
+        shard.set_output_filenames()
+
+        attrs = ["keep_filename", "remap_filename", "fastq_single_filename"]
+        if self.is_paired:
+            attrs.extend(["fastq1_filename", "fastq2_filename"])
+
+        return [(getattr(shard, attr), getattr(self, attr)) for attr in attrs]
+
 
     
         
@@ -821,8 +1862,20 @@ class ReadStats(object):
         self.remap_single = 0
         # number of read pairs kept
         self.remap_pair = 0
+
+        # number of lookups of unique haplotypes for a set of SNPs
+        # that were / were not already in the haplotype cache
+        self.hap_cache_hits = 0
+        self.hap_cache_misses = 0
         
 
+    def add(self, other):
+        """adds counts from another ReadStats object to this one
+        (e.g. to combine counts from separate worker processes)"""
+        for attr, val in vars(other).items():
+            setattr(self, attr, getattr(self, attr) + val)
+
+        
     def write(self, file_handle):
         sys.stderr.write("DISCARD reads:\n"
                          "  unmapped: %d\n"
@@ -861,6 +1914,9 @@ class ReadStats(object):
         file_handle.write("read SNP ref matches: %d\n" % self.ref_count)
         file_handle.write("read SNP alt matches: %d\n" % self.alt_count)
         file_handle.write("read SNP mismatches: %d\n" % self.other_count)
+        file_handle.write("haplotype cache hits: %d\n" % self.hap_cache_hits)
+        file_handle.write("haplotype cache misses: %d\n" %
+                          self.hap_cache_misses)
         
         total = self.ref_count + self.alt_count + self.other_count
         if total > 0:
@@ -897,8 +1953,13 @@ def parse_options():
                         dest='is_sorted', 
                         default=False,
                         help=('Indicates that the input BAM file'
-                              ' is coordinate-sorted (default '
-                              'is False).'))
+                              ' is coordinate-sorted, even if its '
+                              'header does not give a sort order '
+                              '(default is False). Input BAM files '
+                              'whose headers say that they are sorted '
+                              'by coordinate are not sorted again, '
+                              'and are indexed if they do not have '
+                              'an index.'))
     
     parser.add_argument("--max_seqs", type=int, default=MAX_SEQS_DEFAULT,
                         help="The maximum number of sequences with different "
@@ -968,6 +2029,92 @@ def parse_options():
                         "file is provided.",
                         metavar="SAMPLES")
                         
+    parser.add_argument("--threads", type=int, default=1,
+                        help="Number of worker processes to use "
+                        "(default=1). If greater than 1, chromosomes are "
+                        "processed in parallel and each worker writes "
+                        "its own output files, which are merged "
+                        "once all chromosomes are done. Reads are "
+                        "retrieved by chromosome using the BAM index. "
+                        "An index that is older than the BAM file is "
+                        "not used, and a new index is written to the "
+                        "output directory.")
+
+    parser.add_argument("--compress_threads", type=int, default=1,
+                        help="Number of threads used to compress each "
+                        "output BAM and fastq file (default=1). With "
+                        "--threads, each worker process uses this many "
+                        "threads for each of its files.")
+
+    parser.add_argument("--compress_level", type=int,
+                        default=GZIP_LEVEL_DEFAULT,
+                        choices=range(10), metavar="{0-9}",
+                        help="gzip compression level of output fastq "
+                        "files, from 0 (no compression) to 9 (best "
+                        "compression) (default=%d). If 0, output BAM "
+                        "files are also written uncompressed, otherwise "
+                        "they are written with the default BAM compression "
+                        "level." % GZIP_LEVEL_DEFAULT)
+
+    parser.add_argument("--sort_mem", default=SORT_MEM_DEFAULT,
+                        help="Maximum memory used per thread when the "
+                        "input BAM file is sorted (default=%s). Sorting "
+                        "uses --threads threads, and writes temporary "
+                        "files to the output directory when more memory "
+                        "is needed." % SORT_MEM_DEFAULT)
+
+    parser.add_argument("--snp_index_type", default=SNP_INDEX_AUTO,
+                        choices=SNP_INDEX_TYPES,
+                        help="Type of index used to lookup SNPs by "
+                        "position (default=%s). A dense index has an "
+                        "entry for every base of a chromosome, while a "
+                        "sparse index only stores SNP positions and needs "
+                        "much less memory. With 'auto' a sparse index is "
+                        "used unless a chromosome has very dense SNPs."
+                        % SNP_INDEX_AUTO)
+
+    parser.add_argument("--snp_cache_dir", default=None,
+                        metavar="SNP_CACHE_DIR",
+                        help="Directory to cache SNP tables in. SNP "
+                        "tables for each chromosome are written to this "
+                        "directory after they are first read, and are "
+                        "read from it (much faster) in later runs with "
+                        "the same SNP files and --samples. The cache "
+                        "directory is created if it does not exist.")
+
+    parser.add_argument("--snp_cache_checksum", action="store_true",
+                        default=False,
+                        help="Identify SNP files in the --snp_cache_dir "
+                        "cache by an MD5 checksum of their contents, "
+                        "rather than by their path, size and "
+                        "modification time. This reads all of the SNP "
+                        "files on every run, but detects changes that "
+                        "keep the same size and modification time.")
+
+    parser.add_argument("--hap_cache_size", type=int,
+                        default=HAP_CACHE_SIZE_DEFAULT,
+                        help="Maximum number of sets of overlapping SNPs "
+                        "to cache unique haplotypes for on each "
+                        "chromosome (default=%d). Reads that overlap the "
+                        "same set of SNPs reuse the cached haplotypes. "
+                        "Set to 0 to disable the cache." %
+                        HAP_CACHE_SIZE_DEFAULT)
+
+    parser.add_argument("--metrics", default=None, metavar="METRICS_FILE",
+                        help="Write metrics to this file, including the "
+                        "time spent on each chromosome and in each phase "
+                        "(SNP loading, overlap lookup, read generation "
+                        "and fastq writing), reads per second, cache "
+                        "sizes, haplotype cache hits and peak memory use. "
+                        "The file is written in TSV format if its name "
+                        "ends with .tsv, and in JSON format otherwise.")
+
+    parser.add_argument("--progress", type=float, default=0,
+                        metavar="SECONDS",
+                        help="Write a progress line to stderr at most "
+                        "every SECONDS seconds (default=0, no progress "
+                        "lines).")
+
     parser.add_argument("bam_filename", action='store',
                         help="Coordinate-sorted input BAM file "
                         "containing mapped reads.")
@@ -975,6 +2122,18 @@ def parse_options():
         
     options = parser.parse_args()
 
+    if options.threads < 1:
+        parser.error("--threads must be >= 1")
+
+    if options.hap_cache_size < 0:
+        parser.error("--hap_cache_size must be >= 0")
+
+    if options.compress_threads < 1:
+        parser.error("--compress_threads must be >= 1")
+
+    if options.progress < 0:
+        parser.error("--progress must be >= 0")
+
     if options.snp_dir:
         if(options.snp_tab or options.snp_index or options.haplotype):
             parser.error("expected --snp_dir OR (--snp_tab, --snp_index and "
@@ -1019,11 +2178,18 @@ def write_read(read, snp_tab, snp_idx, read_pos):
         
 
 
-def count_ref_alt_matches(read, read_stats, snp_tab, snp_idx, read_pos):
+def count_ref_alt_matches(read, read_stats, snp_tab, snp_idx, read_pos,
+                          skip_snps=()):
+    """Counts matches of read to the alleles of the SNPs it overlaps.
+    SNPs with indices in skip_snps (e.g. SNPs that are counted from
+    the other read of a pair) are not counted."""
     ref_alleles = snp_tab.snp_allele1[snp_idx]
     alt_alleles = snp_tab.snp_allele2[snp_idx]
     
     for i in range(len(snp_idx)):
+        if snp_idx[i] in skip_snps:
+            continue
+
         ref = ref_alleles[i].decode("utf-8")
         alt = alt_alleles[i].decode("utf-8")
         
@@ -1038,6 +2204,35 @@ def count_ref_alt_matches(read, read_stats, snp_tab, snp_idx, read_pos):
             read_stats.other_count += 1
             
 
+def get_mate_overlap_skips(read1, snp_idx1, read_pos1,
+                           read2, snp_idx2, read_pos2):
+    """Returns two sets, with the indices of the SNPs that should not
+    be counted for read1 and read2, so that SNPs overlapped by both
+    reads of a pair are only counted once. The base with the higher
+    base quality is counted (or the base from read1 if they have the
+    same quality)."""
+    skip1 = set()
+    skip2 = set()
+
+    shared = set(snp_idx1).intersection(snp_idx2)
+    if not shared:
+        return skip1, skip2
+
+    qual1 = read1.query_qualities
+    qual2 = read2.query_qualities
+    pos1 = dict(zip(snp_idx1, read_pos1))
+    pos2 = dict(zip(snp_idx2, read_pos2))
+
+    for s_idx in shared:
+        if qual1 is not None and qual2 is not None and \
+           qual2[pos2[s_idx]-1] > qual1[pos1[s_idx]-1]:
+            skip1.add(s_idx)
+        else:
+            skip2.add(s_idx)
+
+    return skip1, skip2
+
+
 def get_unique_haplotypes(haplotypes, phasing, snp_idx):
     """
     returns list of vectors of unique haplotypes for this set of SNPs
@@ -1090,9 +2285,131 @@ def get_unique_haplotypes(haplotypes, phasing, snp_idx):
     return haps[idx,:]
 
 
+
+class HaplotypeCache(object):
+    """Least-recently-used cache of the unique haplotypes returned
+    by get_unique_haplotypes(), keyed by the tuple of SNP indices.
+    Many reads overlap the same set of SNPs, so this avoids
+    recomputing the haplotypes for every read. SNP indices refer to
+    the SNP table of the current chromosome, so the cache must be
+    cleared when the next chromosome is started."""
+
+    def __init__(self, max_size=HAP_CACHE_SIZE_DEFAULT):
+        self.max_size = max_size
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+
+    def clear(self):
+        """removes all haplotypes from the cache (but does not
+        reset the hit / miss counts)"""
+        self.cache.clear()
+
+        
+    def get_unique_haplotypes(self, haplotypes, phasing, snp_idx):
+        """returns unique haplotypes for this set of SNPs, from the
+        cache if possible (see get_unique_haplotypes)"""
+        key = tuple(snp_idx)
+
+        haps = self.cache.get(key)
+        if haps is not None:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return haps
+
+        self.misses += 1
+        haps = get_unique_haplotypes(haplotypes, phasing, snp_idx)
+
+        if self.max_size > 0:
+            self.cache[key] = haps
+            if len(self.cache) > self.max_size:
+                # remove least recently used haplotypes
+                self.cache.popitem(last=False)
+
+        return haps
+    
+    
             
+def seq_to_array(seq):
+    """converts a read sequence string to a numpy array of uint8 
+    character codes"""
+    return np.frombuffer(seq.encode("ascii"), dtype=np.uint8)
+
+
+def array_to_seq(seq_array):
+    """converts a numpy array of uint8 character codes back to a
+    read sequence string"""
+    return seq_array.tobytes().decode("ascii")
+
+
+def get_allele_codes(alleles):
+    """returns a numpy array of uint8 character codes for a np array
+    of single-base alleles. Raises a ValueError if any of the
+    alleles is not a single base"""
+    alleles = np.asarray(alleles, dtype=np.bytes_)
+    if np.any(np.char.str_len(alleles) != 1):
+        raise ValueError("expected single-base alleles but got: %s"
+                         % repr(alleles))
+    return alleles.astype("S1").view(np.uint8)
+
+
+def get_row_keys(seqs):
+    """returns a 1D array with a single element for each row of a 
+    2D uint8 array (which must have at least one column), so that
+    rows can be compared or sorted at once"""
+    seqs = np.ascontiguousarray(seqs)
+
+    # create view of data that joins all elements of each row
+    # into single void datatype
+    return seqs.view(np.dtype((np.void, seqs.dtype.itemsize *
+                               seqs.shape[1]))).ravel()
+
+
+def unique_seqs(seqs):
+    """returns the unique rows of a 2D uint8 array of read
+    sequences (or alleles), sorted"""
+    if seqs.shape[0] < 2:
+        return seqs
+    _, idx = np.unique(get_row_keys(seqs), return_index=True)
+    
+    return seqs[idx]
+
+
+def add_seq(seqs, seq):
+    """adds a sequence (string) to a 2D uint8 array of unique
+    read sequences, if it is not already present"""
+    seq_array = seq_to_array(seq)
+    if seqs.shape[0] == 0:
+        return seq_array.reshape(1, -1)
+    return unique_seqs(np.vstack([seqs, seq_array]))
+
+
+def discard_seq(seqs, seq):
+    """removes a sequence (string) from a 2D uint8 array of read
+    sequences, if it is present"""
+    if seqs.shape[0] == 0:
+        return seqs
+    seq_array = seq_to_array(seq)
+    return seqs[np.any(seqs != seq_array, axis=1)]
+
+    
+def substitute_alleles(read_array, read_pos, alleles):
+    """Returns a 2D uint8 array of reads (one row per row of alleles)
+    made by substituting the alleles into read_array. alleles is a 2D 
+    uint8 array of character codes with a column for each position in 
+    read_pos (1-based positions in the read). Duplicate reads are 
+    removed."""
+    # remove duplicates from the (much smaller) allele array
+    # before making the reads
+    alleles = unique_seqs(alleles)
+    new_seqs = np.repeat(read_array.reshape(1, -1), alleles.shape[0], axis=0)
+    new_seqs[:, np.asarray(read_pos, dtype=np.int64) - 1] = alleles
+    return new_seqs
+
+
 def generate_haplo_reads(read_seq, snp_idx, read_pos, ref_alleles, alt_alleles,
-                         haplo_tab, phase_tab):
+                         haplo_tab, phase_tab, hap_cache=None):
     """
       read_seq - a string representing the the sequence of the read in question
       snp_index - a list of indices of SNPs that this read overlaps
@@ -1102,69 +2419,31 @@ def generate_haplo_reads(read_seq, snp_idx, read_pos, ref_alleles, alt_alleles,
       alt_alleles - a np array of alternate alleles with
                     indices corresponding to snp_index
       haplo_tab - a pytables node with haplotypes from haplotype.h5
+      hap_cache - a HaplotypeCache to retrieve unique haplotypes from
+
+    Returns a 2D uint8 array with a row for each unique read 
+    sequence (see array_to_seq). 
     """
-    haps = get_unique_haplotypes(haplo_tab, phase_tab, snp_idx)
+    if hap_cache is not None:
+        haps = hap_cache.get_unique_haplotypes(haplo_tab, phase_tab, snp_idx)
+    else:
+        haps = get_unique_haplotypes(haplo_tab, phase_tab, snp_idx)
 
     # sys.stderr.write("UNIQUE haplotypes: %s\n"
     #                  "read_pos: %s\n"
     #                 % (repr(haps), read_pos))
-    
-    read_len = len(read_seq)
-
-    new_read_list = set()
-
-    # loop over haplotypes
-    for hap in haps:
-        new_read = []
-        cur_pos = 1
-
-        missing_data = False
-
-        # loop over the SNPs to get alleles that make up this haplotype
-        for i in range(len(hap)):
-            if read_pos[i] > cur_pos:
-                # add segment of read
-                new_read.append(read_seq[cur_pos-1:read_pos[i]-1])
-            # add segment for appropriate allele
-            if hap[i] == 0:
-                # reference allele
-                new_read.append(ref_alleles[i].decode("utf-8"))
-            elif hap[i] == 1:
-                # alternate allele
-                new_read.append(alt_alleles[i].decode("utf-8"))
-            else:
-                # haplotype has unknown genotype so skip it...
-                missing_data = True
-                break
-            
 
-            cur_pos = read_pos[i] + 1
+    read_array = seq_to_array(read_seq)
+    ref_codes = get_allele_codes(ref_alleles)
+    alt_codes = get_allele_codes(alt_alleles)
 
+    # skip haplotypes that have unknown genotypes
+    haps = haps[np.all((haps == 0) | (haps == 1), axis=1)]
 
-        if read_len >= cur_pos:
-            # add final segment
-            new_read.append(read_seq[cur_pos-1:read_len])
-            
-        if not missing_data:
-            new_seq = "".join(new_read)
-
-            # sanity check: read should be same length as original
-            if len(new_seq) != read_len:
-                raise ValueError("Expected read len to be %d but "
-                                 "got %d.\n"
-                                 "ref_alleles: %s\n"
-                                 "alt_alleles: %s\n"
-                                 "read_pos: %s\n"
-                                 "snp_idx: %s\n"
-                                 "haps: %s\n" 
-                                 % (read_len, len(new_seq),
-                                    repr(ref_alleles), repr(alt_alleles),
-                                    repr(read_pos), repr(snp_idx),
-                                    repr(haps)))
-
-            new_read_list.add("".join(new_seq))
-
-    return new_read_list
+    # substitute the ref / alt alleles of every haplotype at once
+    alleles = np.where(haps == 0, ref_codes, alt_codes).astype(np.uint8)
+
+    return substitute_alleles(read_array, read_pos, alleles)
 
     
 
@@ -1172,27 +2451,31 @@ def generate_haplo_reads(read_seq, snp_idx, read_pos, ref_alleles, alt_alleles,
 def generate_reads(read_seq, read_pos, ref_alleles, alt_alleles):
     """Generate set of reads with all possible combinations
     of alleles (i.e. 2^n combinations where n is the number of snps overlapping
-    the reads)
+    the reads). The original read is included. Returns a 2D uint8
+    array with a row for each unique read sequence.
     """
-    reads = [read_seq]
-    # iterate through all snp locations
-    for i in range(len(read_pos)):
-        idx = read_pos[i]-1
-        # for each read we've already created...
-        for j in range(len(reads)):
-            read = reads[j]
-            # create a new version of this read with both reference
-            # and alternative versions of the allele at this index
-            reads.append(
-              read[:idx] + ref_alleles[i].decode("utf-8") + read[idx+1:]
-            )
-            reads.append(
-              read[:idx] + alt_alleles[i].decode("utf-8") + read[idx+1:]
-            )
-    return set(reads)
+    read_array = seq_to_array(read_seq)
+    n_snp = len(read_pos)
+    if n_snp == 0:
+        return read_array.reshape(1, -1)
+
+    # possible alleles at each SNP: the base in the original read,
+    # the reference allele and the alternate allele
+    choices = np.empty((n_snp, 3), dtype=np.uint8)
+    choices[:, 0] = read_array[np.asarray(read_pos, dtype=np.int64) - 1]
+    choices[:, 1] = get_allele_codes(ref_alleles)
+    choices[:, 2] = get_allele_codes(alt_alleles)
+
+    # every combination of choices, one row per combination
+    combos = np.indices((3,) * n_snp).reshape(n_snp, -1).T
+    alleles = choices[np.arange(n_snp), combos]
+
+    return substitute_alleles(read_array, read_pos, alleles)
 
 
 def write_fastq(fastq_file, orig_read, new_seqs):
+    """writes new_seqs (a 2D uint8 array of read sequences) to 
+    fastq_file, with names and qualities from orig_read"""
     n_seq = len(new_seqs)
     i = 1
     for new_seq in new_seqs:
@@ -1204,17 +2487,20 @@ def write_fastq(fastq_file, orig_read, new_seqs):
         name = "%s.%d.%d.%d" % (orig_read.qname, orig_read.pos+1, i, n_seq)
                                        
         fastq_file.write("@%s\n%s\n+%s\n%s\n" %
-                         (name, new_seq, name, orig_read.qual))
+                         (name, array_to_seq(new_seq), name, orig_read.qual))
 
         i += 1
 
         
 def write_pair_fastq(fastq_file1, fastq_file2, orig_read1, orig_read2,
                      new_pairs):
-
-    n_pair = len(new_pairs)
+    """writes new_pairs (a tuple of two 2D uint8 arrays of read 
+    sequences, with a row for each pair) to fastq_file1 and 
+    fastq_file2, with names and qualities from orig_read1 and 
+    orig_read2"""
+    n_pair = len(new_pairs[0])
     i = 1
-    for pair in new_pairs:
+    for seq1, seq2 in zip(new_pairs[0], new_pairs[1]):
         # give each fastq record a new name giving:
         # 1 - the original name of the read
         # 2 - the coordinates the two ends of the pair should map to
@@ -1227,9 +2513,9 @@ def write_pair_fastq(fastq_file1, fastq_file2, orig_read1, orig_read2,
         name = "%s.%s.%d.%d" % (orig_read1.qname, pos_str, i, n_pair)
         
         fastq_file1.write("@%s\n%s\n+%s\n%s\n" %
-                          (name, pair[0], name, orig_read1.qual))
+                          (name, array_to_seq(seq1), name, orig_read1.qual))
 
-        rev_seq = revcomp(pair[1])
+        rev_seq = revcomp(array_to_seq(seq2))
         fastq_file2.write("@%s\n%s\n+%s\n%s\n" %
                           (name, rev_seq, name, orig_read2.qual))
 
@@ -1239,29 +2525,77 @@ def write_pair_fastq(fastq_file1, fastq_file2, orig_read1, orig_read2,
 
         
     
+def get_block_overlaps(snp_tab, reads):
+    """Looks up the SNPs and indels overlapping a block of reads
+    from the same chromosome in a single batch. Returns a list
+    with an entry for each read, in the form returned by
+    SNPTable.get_overlapping_snps(), or None for reads that
+    will not be processed (e.g. unmapped or secondary alignments)."""
+    overlaps = [None] * len(reads)
+    read_idx = [i for i, read in enumerate(reads)
+                if not (read.is_unmapped or read.is_secondary or
+                        read.is_supplementary)]
+    try:
+        block_overlaps = snp_tab.get_overlapping_snps_reads(
+            [reads[i] for i in read_idx])
+    except ValueError:
+        # a read has an invalid CIGAR string, look SNPs up one read
+        # at a time instead, so that an error is only raised if the
+        # invalid read is actually processed
+        return overlaps
+
+    for i, read_overlaps in zip(read_idx, block_overlaps):
+        overlaps[i] = read_overlaps
+
+    return overlaps
+
+    
+
 def filter_reads(files, max_seqs=MAX_SEQS_DEFAULT, max_snps=MAX_SNPS_DEFAULT,
-                 samples=None):
+                 samples=None, chrom=None, snp_index_type=SNP_INDEX_AUTO,
+                 snp_cache=None, hap_cache_size=HAP_CACHE_SIZE_DEFAULT,
+                 metrics=None):
+    """Reads through input BAM, writing reads to keep / remap output files
+    and returns a ReadStats object. If chrom is provided, only
+    reads from that chromosome are retrieved (using the BAM index).
+    snp_index_type is the type of index used to lookup SNPs
+    (see SNPTable). If snp_cache is provided, SNP tables are read
+    from / written to this SNPCache. hap_cache_size is the maximum
+    number of sets of unique haplotypes to cache per chromosome.
+    If metrics is provided, timings and counts are recorded in
+    this Metrics object."""
     cur_chrom = None
     cur_tid = None
     seen_chrom = set([])
 
-    snp_tab = SNPTable()
+    snp_tab = SNPTable(index_type=snp_index_type)
+    hap_cache = HaplotypeCache(hap_cache_size)
     read_stats = ReadStats()
     read_pair_cache = {}
     cache_size = 0
-    read_count = 0
-    
-    for read in files.input_bam:
-        read_count += 1
-        # if (read_count % 100000) == 0:
-        #     sys.stderr.write("\nread_count: %d\n" % read_count)
-        #     sys.stderr.write("cache_size: %d\n" % cache_size)
+
+    if metrics is None:
+        metrics = Metrics()
+
+    if chrom is None:
+        reads = files.input_bam
+    else:
+        reads = files.input_bam.fetch(chrom)
+
+    # reads are processed in blocks from the same chromosome so that
+    # overlapping SNPs can be looked up for many reads at once
+    for block in iter_read_blocks(reads):
+        read = block[0]
 
         # TODO: need to change this to use new pysam API calls
         # but need to check pysam version for backward compatibility
         if read.tid == -1:
-            # unmapped read
-            read_stats.discard_unmapped += 1
+            # unmapped reads
+            if cur_tid != -1:
+                metrics.start_chrom(METRICS_NO_CHROM)
+                cur_tid = -1
+            metrics.count("reads", len(block))
+            read_stats.discard_unmapped += len(block)
             continue
         
         if (cur_tid is None) or (read.tid != cur_tid):
@@ -1275,7 +2609,8 @@ def filter_reads(files, max_seqs=MAX_SEQS_DEFAULT, max_snps=MAX_SNPS_DEFAULT,
                 read_stats.discard_missing_pair += len(read_pair_cache)
             read_pair_cache = {}
             cache_size = 0
-            read_count = 0
+            # haplotype cache is indexed by SNPs on this chromosome
+            hap_cache.clear()
             
             if cur_chrom in seen_chrom:
                 # sanity check that input bam file is sorted
@@ -1284,6 +2619,8 @@ def filter_reads(files, max_seqs=MAX_SEQS_DEFAULT, max_snps=MAX_SNPS_DEFAULT,
             seen_chrom.add(cur_chrom)
             cur_tid = read.tid
             sys.stderr.write("starting chromosome %s\n" % cur_chrom)
+            metrics.start_chrom(cur_chrom)
+            start_time = time.perf_counter()
 
             # use HDF5 files if they are provided, otherwise use text
             # files from SNP dir
@@ -1291,104 +2628,251 @@ def filter_reads(files, max_seqs=MAX_SEQS_DEFAULT, max_snps=MAX_SNPS_DEFAULT,
                 sys.stderr.write("reading SNPs from file '%s'\n" %
                                  files.snp_tab_h5.filename)
                 snp_tab.read_h5(files.snp_tab_h5, files.snp_index_h5,
-                                files.hap_h5, cur_chrom, samples)
+                                files.hap_h5, cur_chrom, samples,
+                                cache=snp_cache)
             else:
                 snp_filename = "%s/%s.snps.txt.gz" % (files.snp_dir, cur_chrom)
                 sys.stderr.write("reading SNPs from file '%s'\n" % snp_filename)
-                snp_tab.read_file(snp_filename)
+                snp_tab.read_file(snp_filename, cache=snp_cache)
+            metrics.add_time("snp_load", time.perf_counter() - start_time)
             
             sys.stderr.write("processing reads\n")
 
-        if read.is_secondary:
-            # this is a secondary alignment (i.e. read was aligned more than
-            # once and this has align score that <= best score)
-            read_stats.discard_secondary += 1
-            continue
-
-        if read.is_supplementary:
-            # this is a supplementary alignment (ie chimeric and not the representative alignment)
-            read_stats.discard_supplementary += 1
-            continue
-
-        if read.is_paired:
-            if read.mate_is_unmapped:
-                # other side of pair not mapped
-                # we could process as single... but these not likely
-                # useful so discard
-                # process_single_read(read, read_stats, files,
-                #                     snp_tab, max_seqs, max_snps)
-                read_stats.discard_mate_unmapped += 1
-            elif(read.next_reference_name == cur_chrom or
-                 read.next_reference_name == "="):
-                # other pair mapped to same chrom
-
-                # sys.stderr.write("flag: %s" % read.flag)
-                if not read.is_proper_pair:
-                    # sys.stderr.write(' => improper\n')
-                    read_stats.discard_improper_pair += 1
-                    continue
-                # sys.stderr.write(' => proper\n')
-
-                if read.qname in read_pair_cache:
-                    # we already saw prev pair, retrieve from cache
-                    read1 = read_pair_cache[read.qname]
-                    read2 = read
-                    del read_pair_cache[read.qname]
-                    cache_size -= 1
-
-                    if read2.next_reference_start != read1.reference_start:
-                        sys.stderr.write("WARNING: read pair positions "
-                                         "do not match for pair %s\n" %
-                                         read.qname)
+        metrics.count("reads", len(block))
+        start_time = time.perf_counter()
+        block_overlaps = get_block_overlaps(snp_tab, block)
+        metrics.add_time("overlap_lookup", time.perf_counter() - start_time)
+
+        for read, overlaps in zip(block, block_overlaps):
+            if read.is_secondary:
+                # this is a secondary alignment (i.e. read was aligned more than
+                # once and this has align score that <= best score)
+                read_stats.discard_secondary += 1
+                continue
+
+            if read.is_supplementary:
+                # this is a supplementary alignment (ie chimeric and not the representative alignment)
+                read_stats.discard_supplementary += 1
+                continue
+
+            if read.is_paired:
+                if read.mate_is_unmapped:
+                    # other side of pair not mapped
+                    # we could process as single... but these not likely
+                    # useful so discard
+                    # process_single_read(read, read_stats, files,
+                    #                     snp_tab, max_seqs, max_snps)
+                    read_stats.discard_mate_unmapped += 1
+                elif(read.next_reference_name == cur_chrom or
+                     read.next_reference_name == "="):
+                    # other pair mapped to same chrom
+
+                    # sys.stderr.write("flag: %s" % read.flag)
+                    if not read.is_proper_pair:
+                        # sys.stderr.write(' => improper\n')
+                        read_stats.discard_improper_pair += 1
+                        continue
+                    # sys.stderr.write(' => proper\n')
+
+                    if read.qname in read_pair_cache:
+                        # we already saw prev pair, retrieve from cache
+                        read1, overlaps1 = read_pair_cache[read.qname]
+                        read2 = read
+                        del read_pair_cache[read.qname]
+                        cache_size -= 1
+
+                        if read2.next_reference_start != read1.reference_start:
+                            sys.stderr.write("WARNING: read pair positions "
+                                             "do not match for pair %s\n" %
+                                             read.qname)
+                        else:
+                            process_paired_read(read1, read2, read_stats,
+                                                files, snp_tab, max_seqs,
+                                                max_snps, overlaps1=overlaps1,
+                                                overlaps2=overlaps,
+                                                hap_cache=hap_cache,
+                                                metrics=metrics)
                     else:
-                        process_paired_read(read1, read2, read_stats,
-                                            files, snp_tab, max_seqs,
-                                            max_snps)
-                else:
-                    # we need to wait for next pair
-                    read_pair_cache[read.qname] = read
+                        # we need to wait for next pair
+                        read_pair_cache[read.qname] = (read, overlaps)
 
-                    cache_size += 1
+                        cache_size += 1
 
                     
+                else:
+                    # other side of pair mapped to different
+                    # chromosome, discard this read
+                    read_stats.discard_different_chromosome += 1
+
             else:
-                # other side of pair mapped to different
-                # chromosome, discard this read
-                read_stats.discard_different_chromosome += 1
+                process_single_read(read, read_stats, files, snp_tab,
+                                    max_seqs, max_snps, overlaps=overlaps,
+                                    hap_cache=hap_cache, metrics=metrics)
 
-        else:
-            process_single_read(read, read_stats, files, snp_tab,
-                                max_seqs, max_snps)
+        metrics.set_max("read_pair_cache", len(read_pair_cache))
+        metrics.update_count("hap_cache_hits", hap_cache.hits)
+        metrics.update_count("hap_cache_misses", hap_cache.misses)
+        metrics.progress()
+
+    metrics.end_chrom()
 
     if len(read_pair_cache) != 0:
         sys.stderr.write("WARNING: failed to find pairs for %d "
                          "reads on this chromosome\n" %
                          len(read_pair_cache))
         read_stats.discard_missing_pair += len(read_pair_cache)
+
+    read_stats.hap_cache_hits = hap_cache.hits
+    read_stats.hap_cache_misses = hap_cache.misses
     
-    read_stats.write(sys.stderr)
+    return read_stats
+
+
+
+def filter_reads_shard(args):
+    """Worker process function that filters the reads from a single
+    chromosome, writing them to the shard output files for that chromosome.
+    Returns a ReadStats object and a Metrics object."""
+    files, tid, chrom, max_seqs, max_snps, samples, \
+        snp_index_type, snp_cache, hap_cache_size, progress_interval = args
+
+    # each worker needs its own file handles, including its
+    # own SNP table (which is read by filter_reads)
+    metrics = Metrics(progress_interval)
+    shard = files.open_shard(tid)
+    read_stats = filter_reads(shard, max_seqs=max_seqs, max_snps=max_snps,
+                              samples=samples, chrom=chrom,
+                              snp_index_type=snp_index_type,
+                              snp_cache=snp_cache,
+                              hap_cache_size=hap_cache_size,
+                              metrics=metrics)
+    shard.close()
+    metrics.finish()
 
+    return read_stats, metrics
 
-def slice_read(read, indices):
-    """slice a read by an array of indices"""
-    return "".join(np.array(list(read))[indices])
+
+
+def merge_shards(files, tids):
+    """Merges the shard output files written by worker processes for
+    the chromosomes with indices tids into the final output files, in order
+    of tids."""
+
+    # get shard filenames for each output file
+    shard_filenames = {}
+    for tid in tids:
+        for shard_filename, out_filename in files.shard_filenames(tid):
+            if out_filename in shard_filenames:
+                shard_filenames[out_filename].append(shard_filename)
+            else:
+                shard_filenames[out_filename] = [shard_filename]
+
+    for out_filename in (files.keep_filename, files.remap_filename):
+        if out_filename not in shard_filenames:
+            # no chromosomes were processed, write BAM with only a header
+            template = files.open_input_bam()
+            files.open_output_bam(out_filename, template).close()
+            template.close()
+            continue
+
+        # BAM shards all have the same header, so their compressed
+        # blocks can be concatenated without decompressing them
+        pysam.cat("-o", out_filename, *shard_filenames[out_filename])
+
+    # gzipped fastqs can be concatenated directly, because a
+    # file containing multiple gzip members is also a valid gzip file
+    fastq_filenames = [files.fastq_single_filename]
+    if files.is_paired:
+        fastq_filenames.extend([files.fastq1_filename, files.fastq2_filename])
+
+    for out_filename in fastq_filenames:
+        if out_filename not in shard_filenames:
+            # no chromosomes were processed, write empty gzip file
+            files.open_fastq(out_filename).close()
+            continue
+        
+        with open(out_filename, "wb") as out_f:
+            for shard_filename in shard_filenames.get(out_filename, []):
+                with open(shard_filename, "rb") as f:
+                    shutil.copyfileobj(f, out_f)
+            
+
+
+def filter_reads_parallel(files, threads, max_seqs=MAX_SEQS_DEFAULT,
+                          max_snps=MAX_SNPS_DEFAULT, samples=None,
+                          snp_index_type=SNP_INDEX_AUTO, snp_cache=None,
+                          hap_cache_size=HAP_CACHE_SIZE_DEFAULT,
+                          metrics=None):
+    """Filters reads using a pool of worker processes, each of which
+    processes one chromosome at a time. Shard outputs are then merged 
+    in the order that chromosomes appear in the BAM header, so that
+    the output files are the same as when the reads are filtered by
+    a single process. Returns a ReadStats object. If metrics is
+    provided, the metrics recorded by the workers are added to
+    this Metrics object."""
+    # input BAM was indexed when DataFiles was created
+    input_bam = files.open_input_bam()
+
+    read_stats = ReadStats()
+
+    if metrics is None:
+        metrics = Metrics()
+
+    # reads without coordinates are not returned by fetch()
+    read_stats.discard_unmapped += input_bam.nocoordinate
+    if input_bam.nocoordinate > 0:
+        metrics.count("reads", input_bam.nocoordinate)
+
+    chroms = get_indexed_chroms(input_bam)
+    input_bam.close()
+
+    if snp_cache and files.snp_tab_filename:
+        # get keys of HDF5 files once, rather than in every
+        # worker (which reads them if checksums are used)
+        snp_cache.get_key([files.snp_tab_filename,
+                           files.snp_index_filename,
+                           files.haplotype_filename], samples)
+
+    shard_args = [(files, tid, chrom, max_seqs, max_snps, samples,
+                   snp_index_type, snp_cache, hap_cache_size,
+                   metrics.progress_interval)
+                  for tid, chrom, n_read in chroms]
+    tids = [x[0] for x in chroms]
+
+    shard_filenames = [shard_filename for tid in tids
+                       for shard_filename, out_filename
+                       in files.shard_filenames(tid)]
+    with removing_files(shard_filenames):
+        for shard_stats, shard_metrics in \
+                run_chrom_workers(filter_reads_shard, shard_args, threads,
+                                  sizes=[x[2] for x in chroms]):
+            read_stats.add(shard_stats)
+            metrics.add(shard_metrics)
+
+        start_time = time.perf_counter()
+        merge_shards(files, tids)
+        metrics.add_time("merge_shards", time.perf_counter() - start_time)
+    
+    return read_stats
 
 
 def group_reads_by_snps(reads, snp_read_pos):
     """
-    group the reads by strings containing the combinations of ref/alt alleles
-    among the reads at the shared_snps. return a list of sets of reads - one
-    for each group
+    group the reads (rows of a 2D uint8 array) by the combinations of
+    ref/alt alleles among the reads at the shared_snps (0-based positions
+    in snp_read_pos). Returns a tuple of (keys, groups). keys is a list
+    with the (sorted) allele combination of each group, as bytes, and 
+    groups is an array giving the index of the group of each read
     """
-    # group the reads by the snp string and create a list to hold the groups
-    return [
-        set(reads) for hap, reads in
-        groupby(
-          # note that groupby needs the data to be sorted by the same key func
-          sorted(reads, key=lambda read: slice_read(read, snp_read_pos)),
-          key=lambda read: slice_read(read, snp_read_pos)
-        )
-    ]
+    if len(snp_read_pos) == 0:
+        # no shared SNPs so all reads are in the same group
+        return [b""], np.zeros(reads.shape[0], dtype=np.int64)
+
+    alleles = reads[:, snp_read_pos]
+    uniq, groups = np.unique(get_row_keys(alleles), return_inverse=True)
+    keys = [key.tobytes() for key in uniq]
+
+    return keys, groups.ravel()
 
 
 def read_pair_combos(old_reads, new_reads, max_seqs, snp_idx, snp_read_pos):
@@ -1399,62 +2883,88 @@ def read_pair_combos(old_reads, new_reads, max_seqs, snp_idx, snp_read_pos):
     when the original read pair has discordant alleles at shared SNPs.
     Input:
         old_reads - a tuple of length 2, containing the pair of original reads
-        new_reads - a list of two sets, each containing the reads generated
-                    from old_reads for remapping
+        new_reads - a list of two 2D uint8 arrays of unique reads 
+                    (one per row) generated from old_reads for remapping
         snp_index - a list of two lists of the indices of SNPs that overlap
                     with old_reads
         snp_read_pos - a list of two lists of the positions in old_reads where
                        SNPs are located
     Output:
-        unique_pairs - a set of tuples, each representing a unique pair of
-                       new_reads
+        unique_pairs - a tuple of two 2D uint8 arrays, with a row for
+                       each unique pair of new_reads
     """
     # get the indices of the shared SNPs in old_reads
+    shared_pos = []
     for i in range(len(snp_read_pos)):
         # get the indices of the SNP indices that are in both reads
-        idx_idxs = np.nonzero(np.in1d(snp_idx[i], snp_idx[(i+1) % 2]))[0]
+        idx_idxs = np.nonzero(np.isin(snp_idx[i], snp_idx[(i+1) % 2]))[0]
         # now, use the indices in idx_idxs to get the relevant snp positions
         # and convert positions to indices
-        snp_read_pos[i] = np.array(snp_read_pos[i], dtype=int)[idx_idxs] - 1
+        shared_pos.append(np.array(snp_read_pos[i], dtype=int)[idx_idxs] - 1)
     # check: are there discordant alleles at the shared SNPs?
     # if so, discard these reads
-    if (
-        slice_read(old_reads[0], snp_read_pos[0])
-        != slice_read(old_reads[1], snp_read_pos[1])
-    ):
+    old_alleles = [seq_to_array(old_reads[i])[shared_pos[i]]
+                   for i in range(len(old_reads))]
+    if not np.array_equal(old_alleles[0], old_alleles[1]):
         return None
     # group reads by the alleles they have at shared SNPs
-    for i in range(len(new_reads)):
-        new_reads[i] = group_reads_by_snps(
-            new_reads[i], snp_read_pos[i]
-        )
-    unique_pairs = set()
+    keys1, groups1 = group_reads_by_snps(new_reads[0], shared_pos[0])
+    keys2, groups2 = group_reads_by_snps(new_reads[1], shared_pos[1])
+    group2_by_key = dict((key, i) for i, key in enumerate(keys2))
+
+    idx1 = []
+    idx2 = []
+    n_pair = 0
     # calculate unique combinations of read pairs only among reads that
-    # have the same alleles at shared SNPs (ie if they're in the correct group)
-    for group in range(len(new_reads[0])):
-        for pair in product(new_reads[0][group], new_reads[1][group]):
-            if len(unique_pairs) <= max_seqs:
-                unique_pairs.add(pair)
-            else:
-                return False
-    return unique_pairs
+    # have the same alleles at shared SNPs (ie if they're in the same group)
+    for group1, key in enumerate(keys1):
+        group2 = group2_by_key.get(key)
+        if group2 is None:
+            continue
+        reads1 = np.nonzero(groups1 == group1)[0]
+        reads2 = np.nonzero(groups2 == group2)[0]
+        n_pair += len(reads1) * len(reads2)
+        if n_pair > max_seqs + 1:
+            return False
+        idx1.append(np.repeat(reads1, len(reads2)))
+        idx2.append(np.tile(reads2, len(reads1)))
+
+    if n_pair == 0:
+        return False
+
+    return (new_reads[0][np.concatenate(idx1)],
+            new_reads[1][np.concatenate(idx2)])
 
 
 def process_paired_read(read1, read2, read_stats, files,
-                        snp_tab, max_seqs, max_snps):
+                        snp_tab, max_seqs, max_snps,
+                        overlaps1=None, overlaps2=None, hap_cache=None,
+                        metrics=None):
     """Checks if either end of read pair overlaps SNPs or indels
     and writes read pair (or generated read pairs) to appropriate
-    output files"""
+    output files. overlaps1 and overlaps2 are the SNPs / indels 
+    overlapping each read, if they have already been looked up.
+    hap_cache is an optional HaplotypeCache. If metrics is provided,
+    the time spent generating and writing reads is recorded in
+    this Metrics object."""
 
     new_reads = []
     pair_snp_idx = []
     pair_snp_read_pos = []
 
-    for read in (read1, read2):
-        # check if either read overlaps SNPs or indels
-        # check if read overlaps SNPs or indels
-        snp_idx, snp_read_pos, \
-            indel_idx, indel_read_pos = snp_tab.get_overlapping_snps(read)
+    # check if either read overlaps SNPs or indels
+    if overlaps1 is None:
+        overlaps1 = snp_tab.get_overlapping_snps(read1)
+    if overlaps2 is None:
+        overlaps2 = snp_tab.get_overlapping_snps(read2)
+
+    # SNPs overlapped by both reads are only counted once
+    skip1, skip2 = get_mate_overlap_skips(read1, overlaps1[0], overlaps1[1],
+                                          read2, overlaps2[0], overlaps2[1])
+
+    for read, overlaps, skip_snps in ((read1, overlaps1, skip1),
+                                      (read2, overlaps2, skip2)):
+        snp_idx, snp_read_pos, indel_idx, indel_read_pos = overlaps
 
         if len(indel_idx) > 0:
             # for now discard this read pair, we want to improve this to handle
@@ -1468,7 +2978,7 @@ def process_paired_read(read1, read2, read_stats, files,
             alt_alleles = snp_tab.snp_allele2[snp_idx]
 
             count_ref_alt_matches(read, read_stats, snp_tab, snp_idx,
-                                  snp_read_pos)
+                                  snp_read_pos, skip_snps=skip_snps)
 
             # limit recursion here by discarding reads that
             # overlap too many SNPs
@@ -1476,6 +2986,7 @@ def process_paired_read(read1, read2, read_stats, files,
                 read_stats.discard_excess_snps += 1
                 return
 
+            start_time = time.perf_counter()
             if files.hap_h5:
                 # generate reads using observed set of haplotypes
                 read_seqs = generate_haplo_reads(read.query_sequence,
@@ -1483,18 +2994,23 @@ def process_paired_read(read1, read2, read_stats, files,
                                                  snp_read_pos,
                                                  ref_alleles, alt_alleles,
                                                  snp_tab.haplotypes,
-                                                 snp_tab.phase)
+                                                 snp_tab.phase,
+                                                 hap_cache=hap_cache)
             else:
                 # generate all possible allelic combinations of reads
                 read_seqs = generate_reads(read.query_sequence, snp_read_pos,
                                            ref_alleles, alt_alleles)
+            if metrics:
+                metrics.add_time("read_generation",
+                                 time.perf_counter() - start_time)
             
             new_reads.append(read_seqs)
             pair_snp_idx.append(snp_idx)
             pair_snp_read_pos.append(snp_read_pos)
         else:
             # no SNPs or indels overlap this read
-            new_reads.append(set())
+            new_reads.append(np.empty((0, len(read.query_sequence)),
+                                      dtype=np.uint8))
             pair_snp_idx.append([])
             pair_snp_read_pos.append([])
 
@@ -1505,8 +3021,8 @@ def process_paired_read(read1, read2, read_stats, files,
         read_stats.keep_pair += 1
     else:
         # add original version of both sides of pair
-        new_reads[0].add(read1.query_sequence)
-        new_reads[1].add(read2.query_sequence)
+        new_reads[0] = add_seq(new_reads[0], read1.query_sequence)
+        new_reads[1] = add_seq(new_reads[1], read2.query_sequence)
 
         if len(new_reads[0]) + len(new_reads[1]) > max_seqs:
             # quit now before generating a lot of read pairs
@@ -1514,24 +3030,35 @@ def process_paired_read(read1, read2, read_stats, files,
             return
 
         # get all unique combinations of read pairs
+        start_time = time.perf_counter()
         unique_pairs = read_pair_combos(
             (read1.query_sequence, read2.query_sequence), new_reads,
             max_seqs, pair_snp_idx, pair_snp_read_pos
         )
+        if metrics:
+            metrics.add_time("read_generation",
+                             time.perf_counter() - start_time)
         # if unique_pairs is None or False we should discard these reads
         if unique_pairs is None:
             read_stats.discard_discordant_shared_snp += 1
             return
-        elif not unique_pairs:
+        elif unique_pairs is False:
             read_stats.discard_excess_reads += 2
             return
 
         # remove original read pair, if present
-        unique_pairs.discard((read1.query_sequence, read2.query_sequence))
+        is_orig = (np.all(unique_pairs[0] == seq_to_array(read1.query_sequence),
+                          axis=1) &
+                   np.all(unique_pairs[1] == seq_to_array(read2.query_sequence),
+                          axis=1))
+        unique_pairs = (unique_pairs[0][~is_orig], unique_pairs[1][~is_orig])
             
         # write read pair to fastqs for remapping
+        start_time = time.perf_counter()
         write_pair_fastq(files.fastq1, files.fastq2, read1, read2,
                          unique_pairs)
+        if metrics:
+            metrics.add_time("fastq_write", time.perf_counter() - start_time)
 
         # Write read to 'remap' BAM for consistency with previous
         # implementation of script. Probably not needed and will result in
@@ -1547,13 +3074,19 @@ def process_paired_read(read1, read2, read_stats, files,
     
 
 def process_single_read(read, read_stats, files, snp_tab, max_seqs,
-                        max_snps):
+                        max_snps, overlaps=None, hap_cache=None,
+                        metrics=None):
     """Check if a single read overlaps SNPs or indels, and writes
-    this read (or generated read pairs) to appropriate output files"""
+    this read (or generated read pairs) to appropriate output files.
+    overlaps are the SNPs / indels overlapping the read, if they 
+    have already been looked up. hap_cache is an optional 
+    HaplotypeCache. If metrics is provided, the time spent generating
+    and writing reads is recorded in this Metrics object."""
                 
     # check if read overlaps SNPs or indels
-    snp_idx, snp_read_pos, \
-        indel_idx, indel_read_pos = snp_tab.get_overlapping_snps(read)
+    if overlaps is None:
+        overlaps = snp_tab.get_overlapping_snps(read)
+    snp_idx, snp_read_pos, indel_idx, indel_read_pos = overlaps
 
     
     if len(indel_idx) > 0:
@@ -1576,18 +3109,23 @@ def process_single_read(read, read_stats, files, snp_tab, max_seqs,
             read_stats.discard_excess_snps += 1
             return
 
+        start_time = time.perf_counter()
         if files.hap_h5:
             read_seqs = generate_haplo_reads(read.query_sequence, snp_idx,
                                              snp_read_pos,
                                              ref_alleles, alt_alleles,
                                              snp_tab.haplotypes,
-                                             snp_tab.phase)
+                                             snp_tab.phase,
+                                             hap_cache=hap_cache)
         else:
             read_seqs = generate_reads(read.query_sequence,  snp_read_pos,
                                        ref_alleles, alt_alleles)
 
         # we don't want the read that matches the original
-        read_seqs.discard(read.query_sequence)
+        read_seqs = discard_seq(read_seqs, read.query_sequence)
+        if metrics:
+            metrics.add_time("read_generation",
+                             time.perf_counter() - start_time)
         
         if len(read_seqs) == 0:
             # only read generated matches original read,
@@ -1596,7 +3134,11 @@ def process_single_read(read, read_stats, files, snp_tab, max_seqs,
             read_stats.keep_single += 1
         elif len(read_seqs) < max_seqs:
             # write read to fastq file for remapping
+            start_time = time.perf_counter()
             write_fastq(files.fastq_single, read, read_seqs)
+            if metrics:
+                metrics.add_time("fastq_write",
+                                 time.perf_counter() - start_time)
 
             # write read to 'to remap' BAM
             # this is probably not necessary with new implmentation
@@ -1663,19 +3205,59 @@ def main(bam_filenames, is_paired_end=False,
          max_snps=MAX_SNPS_DEFAULT, output_dir=None,
          snp_dir=None, snp_tab_filename=None,
          snp_index_filename=None,
-         haplotype_filename=None, samples=None):
+         haplotype_filename=None, samples=None, threads=1,
+         snp_index_type=SNP_INDEX_AUTO, snp_cache_dir=None,
+         snp_cache_checksum=False,
+         hap_cache_size=HAP_CACHE_SIZE_DEFAULT, compress_threads=1,
+         compress_level=GZIP_LEVEL_DEFAULT, metrics_filename=None,
+         progress_interval=0, sort_mem=SORT_MEM_DEFAULT):
 
+    metrics = Metrics(progress_interval)
+
+    # when multiple worker processes are used, they each open
+    # their own files
     files = DataFiles(bam_filenames,  is_sorted, is_paired_end,
                       output_dir=output_dir,
                       snp_dir=snp_dir,
                       snp_tab_filename=snp_tab_filename,
                       snp_index_filename=snp_index_filename,
-                      haplotype_filename=haplotype_filename)
-    
-    filter_reads(files, max_seqs=max_seqs, max_snps=max_snps,
-                 samples=samples)
+                      haplotype_filename=haplotype_filename,
+                      open_files=(threads == 1),
+                      compress_threads=compress_threads,
+                      compress_level=compress_level,
+                      sort_threads=threads,
+                      sort_mem=sort_mem)
+
+    if snp_cache_dir:
+        snp_cache = SNPCache(snp_cache_dir,
+                             checksum=snp_cache_checksum)
+    else:
+        snp_cache = None
+
+    if threads > 1:
+        read_stats = filter_reads_parallel(files, threads,
+                                           max_seqs=max_seqs,
+                                           max_snps=max_snps,
+                                           samples=samples,
+                                           snp_index_type=snp_index_type,
+                                           snp_cache=snp_cache,
+                                           hap_cache_size=hap_cache_size,
+                                           metrics=metrics)
+    else:
+        read_stats = filter_reads(files, max_seqs=max_seqs,
+                                  max_snps=max_snps, samples=samples,
+                                  snp_index_type=snp_index_type,
+                                  snp_cache=snp_cache,
+                                  hap_cache_size=hap_cache_size,
+                                  metrics=metrics)
+
+    read_stats.write(sys.stderr)
 
     files.close()
+
+    if metrics_filename:
+        metrics.finish()
+        metrics.write(metrics_filename)
     
     
 
@@ -1700,4 +3282,13 @@ if __name__ == '__main__':
          snp_tab_filename=options.snp_tab,
          snp_index_filename=options.snp_index,
          haplotype_filename=options.haplotype,
-         samples=samples)
+         samples=samples, threads=options.threads,
+         snp_index_type=options.snp_index_type,
+         snp_cache_dir=options.snp_cache_dir,
+         snp_cache_checksum=options.snp_cache_checksum,
+         hap_cache_size=options.hap_cache_size,
+         compress_threads=options.compress_threads,
+         compress_level=options.compress_level,
+         metrics_filename=options.metrics,
+         progress_interval=options.progress,
+         sort_mem=options.sort_mem)
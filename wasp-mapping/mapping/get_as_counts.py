@@ -1,4 +1,7 @@
 import sys
+import gzip
+import heapq
+import tempfile
 import argparse
 import numpy as np
 import pysam
@@ -10,9 +13,535 @@ import tables
 
 import os
 
-def write_results(out_f, chrom_name, snp_tab, ref_matches,
-                  alt_matches, oth_matches, geno_sample):
 
+# counts start as uint32 and are promoted to uint64 if they could
+# overflow
+UINT32_MAX = np.iinfo(np.uint32).max
+
+# output formats
+OUTPUT_TEXT = "text"
+OUTPUT_PARQUET = "parquet"
+OUTPUT_ACGT = "acgt"
+OUTPUT_FORMATS = [OUTPUT_TEXT, OUTPUT_PARQUET, OUTPUT_ACGT]
+
+# names of output columns
+OUTPUT_COLUMNS = ["CHROM", "SNP.POS", "REF.ALLELE", "ALT.ALLELE",
+                  "GENOTYPE", "REF.COUNT", "ALT.COUNT", "OTHER.COUNT"]
+
+# header of acgt output, which has the same layout as the output
+# of sequenza-utils pileup2acgt
+ACGT_COLUMNS = ["chr", "n.base", "base.ref", "depth",
+                "A", "C", "G", "T", "strand"]
+
+# index of each base in the counts of acgt output, other
+# bases (e.g. N) have index -1
+BASE_INDEX = np.full(256, -1, dtype=np.int8)
+for i, base in enumerate("ACGT"):
+    BASE_INDEX[ord(base)] = i
+    BASE_INDEX[ord(base.lower())] = i
+
+# SAM flag bits
+FLAG_PAIRED = 0x1
+FLAG_PROPER_PAIR = 0x2
+FLAG_UNMAPPED = 0x4
+FLAG_MATE_UNMAPPED = 0x8
+FLAG_REVERSE = 0x10
+FLAG_MATE_REVERSE = 0x20
+FLAG_READ1 = 0x40
+FLAG_READ2 = 0x80
+FLAG_SECONDARY = 0x100
+FLAG_QCFAIL = 0x200
+FLAG_DUP = 0x400
+FLAG_SUPPLEMENTARY = 0x800
+
+# flag names accepted by --exclude_flags (the same as samtools)
+FLAG_NAMES = {"PAIRED" : FLAG_PAIRED,
+              "PROPER_PAIR" : FLAG_PROPER_PAIR,
+              "UNMAP" : FLAG_UNMAPPED,
+              "MUNMAP" : FLAG_MATE_UNMAPPED,
+              "REVERSE" : FLAG_REVERSE,
+              "MREVERSE" : FLAG_MATE_REVERSE,
+              "READ1" : FLAG_READ1,
+              "READ2" : FLAG_READ2,
+              "SECONDARY" : FLAG_SECONDARY,
+              "QCFAIL" : FLAG_QCFAIL,
+              "DUP" : FLAG_DUP,
+              "SUPPLEMENTARY" : FLAG_SUPPLEMENTARY}
+
+# by default unmapped reads and secondary alignments are skipped
+EXCLUDE_FLAGS_DEFAULT = FLAG_UNMAPPED | FLAG_SECONDARY
+
+# number of rows that are formatted as text at once
+TEXT_BLOCK_SIZE = 100000
+
+
+
+def parse_flags(flags_str):
+    """Converts a string of SAM flags to an integer. The string may
+    be a number (e.g. 0x704 or 1796) or a comma-delimited list of
+    flag names such as UNMAP,SECONDARY,QCFAIL,DUP."""
+    try:
+        return int(flags_str, 0)
+    except ValueError:
+        pass
+
+    flags = 0
+    for name in flags_str.split(","):
+        name = name.strip().upper()
+        if name not in FLAG_NAMES:
+            raise ValueError("unknown flag name '%s', expected one of %s" %
+                             (name, ", ".join(sorted(FLAG_NAMES))))
+        flags |= FLAG_NAMES[name]
+
+    return flags
+
+
+
+def get_allele_codes(alleles):
+    """Returns a uint8 array with the ASCII code of each allele in
+    the provided array of bytes strings. Alleles that are not a single
+    base have code 0, and are never matched to read bases."""
+    codes = np.zeros(alleles.shape[0], dtype=np.uint8)
+    is_single = np.char.str_len(alleles) == 1
+    codes[is_single] = alleles[is_single].astype("S1").view(np.uint8)
+    return codes
+
+
+
+class MateOverlapCache(object):
+    """Holds the SNP bases of paired reads whose mate starts within
+    the read, until the mate is seen, so that a SNP covered by both
+    reads of a pair is only counted once. Reads are evicted from
+    the cache (and their bases counted) once the start of their
+    mate has been passed without it being seen (e.g. because it
+    was filtered), so only reads within about a fragment length of
+    the current position are held."""
+
+    def __init__(self):
+        # read name => (mate start, snp_idx, bases, quals, reverse)
+        self.cache = {}
+        # heap of (mate start, read name), used to evict reads
+        self.evict_heap = []
+
+        # largest number of reads held in the cache
+        self.max_size = 0
+        # number of pairs with reads that overlapped the same SNP
+        self.n_overlap_pair = 0
+        # number of bases not counted because mate overlapped SNP
+        self.n_discard_base = 0
+
+
+    def merge(self, obs1, obs2):
+        """Merges the SNP bases from two reads of a pair. Where both
+        reads overlap the same SNP, only the base with the higher
+        base quality is kept (or the base from the first read if the
+        qualities are equal)."""
+        snp_idx, bases, quals, reverse = \
+            [np.concatenate([x1, x2]) for x1, x2 in zip(obs1, obs2)]
+
+        # sort by SNP, then highest quality, then order of reads
+        n = snp_idx.shape[0]
+        order = np.lexsort((np.arange(n), 255 - quals, snp_idx))
+        sorted_idx = snp_idx[order]
+        keep = order[np.concatenate([[True],
+                                     sorted_idx[1:] != sorted_idx[:-1]])]
+
+        if keep.shape[0] < n:
+            self.n_overlap_pair += 1
+            self.n_discard_base += n - keep.shape[0]
+
+        return snp_idx[keep], bases[keep], reverse[keep]
+
+
+    def evict(self, cur_pos):
+        """Removes reads from the cache whose mate starts before
+        cur_pos, and returns a list of their (snp_idx, bases,
+        reverse) arrays"""
+        evicted = []
+        while self.evict_heap and self.evict_heap[0][0] < cur_pos:
+            mate_pos, name = heapq.heappop(self.evict_heap)
+            # reads are not removed from the heap when their mate is
+            # found, so check that this read is still in the cache
+            if name in self.cache and self.cache[name][0] == mate_pos:
+                snp_idx, bases, quals, reverse = self.cache.pop(name)[1:]
+                evicted.append((snp_idx, bases, reverse))
+        return evicted
+
+
+    def flush(self):
+        """Removes all reads from the cache (e.g. at the end of a
+        chromosome), and returns a list of their (snp_idx, bases,
+        reverse) arrays"""
+        evicted = [(snp_idx, bases, reverse) for mate_pos, snp_idx,
+                   bases, quals, reverse in self.cache.values()]
+        self.cache = {}
+        self.evict_heap = []
+        return evicted
+
+
+    def add_reads(self, reads, read_idx, snp_idx, bases, quals, reverse):
+        """Takes the SNP bases for a block of sorted reads, and returns
+        a list of (snp_idx, bases, reverse) arrays for the bases that
+        should now be counted. Bases from reads whose mate may
+        overlap the same SNPs are held in the cache until the mate
+        is seen."""
+        ready = []
+        if len(reads) == 0:
+            return ready
+
+        ready.extend(self.evict(reads[0].reference_start))
+
+        # reads whose mate is mapped to the same chromosome
+        exclude = FLAG_UNMAPPED | FLAG_MATE_UNMAPPED | \
+            FLAG_SECONDARY | FLAG_SUPPLEMENTARY
+        is_pair = np.array([(read.flag & exclude) == 0 and
+                            (read.flag & FLAG_PAIRED) != 0 and
+                            read.next_reference_id == read.reference_id
+                            for read in reads], dtype=bool)
+
+        # bases from other reads can be counted now
+        is_single = ~is_pair[read_idx]
+        ready.append((snp_idx[is_single], bases[is_single],
+                      reverse[is_single]))
+
+        offsets = np.searchsorted(read_idx, np.arange(len(reads) + 1))
+        for i in np.flatnonzero(is_pair & (np.diff(offsets) > 0)).tolist():
+            read = reads[i]
+            start, end = offsets[i], offsets[i+1]
+            obs = (snp_idx[start:end], bases[start:end],
+                   quals[start:end], reverse[start:end])
+
+            if read.query_name in self.cache:
+                # mate was already seen
+                mate_obs = self.cache.pop(read.query_name)[1:]
+                ready.append(self.merge(mate_obs, obs))
+            elif read.reference_start <= read.next_reference_start < \
+                 read.reference_end:
+                # mate may overlap same SNPs, wait for it
+                self.cache[read.query_name] = \
+                    (read.next_reference_start,) + obs
+                heapq.heappush(self.evict_heap, (read.next_reference_start,
+                                                 read.query_name))
+            else:
+                ready.append((obs[0], obs[1], obs[3]))
+
+        self.max_size = max(self.max_size, len(self.cache))
+
+        return ready
+
+
+    def write_stats(self, file_handle):
+        file_handle.write("read pairs with overlapping SNP bases: %d\n"
+                          "overlapping mate bases not counted: %d\n"
+                          "maximum size of read pair cache: %d\n" %
+                          (self.n_overlap_pair, self.n_discard_base,
+                           self.max_size))
+
+
+
+class AlleleCounter(object):
+    """Counts the reads that match the reference, alternate or
+    other alleles of each SNP in a SNPTable. Read bases with a base
+    quality below min_baseq are not counted. If count_bases is True,
+    the number of each of the bases A, C, G and T at each SNP is
+    also counted, in total and on the forward strand. If
+    dedup_overlap is True, SNPs that are overlapped by both reads of
+    a pair are only counted once, using the base with the higher
+    base quality; finish() must then be called after the last reads
+    from the chromosome are added."""
+
+    def __init__(self, snp_tab, min_baseq=0, count_bases=False,
+                 dedup_overlap=False):
+        self.snp_tab = snp_tab
+        self.min_baseq = min_baseq
+        self.count_bases = count_bases
+        if dedup_overlap:
+            self.mate_cache = MateOverlapCache()
+        else:
+            self.mate_cache = None
+        self.ref_codes = get_allele_codes(snp_tab.snp_allele1)
+        self.alt_codes = get_allele_codes(snp_tab.snp_allele2)
+
+        self.ref_matches = np.zeros(snp_tab.n_snp, dtype=np.uint32)
+        self.alt_matches = np.zeros(snp_tab.n_snp, dtype=np.uint32)
+        self.oth_matches = np.zeros(snp_tab.n_snp, dtype=np.uint32)
+
+        if count_bases:
+            # number of counted bases (including N) at each SNP
+            self.depth = np.zeros(snp_tab.n_snp, dtype=np.uint32)
+            # counts of A, C, G, T at each SNP
+            self.base_counts = np.zeros((snp_tab.n_snp, 4), dtype=np.uint32)
+            # counts of A, C, G, T from forward strand reads
+            self.fwd_counts = np.zeros((snp_tab.n_snp, 4), dtype=np.uint32)
+        else:
+            self.depth = None
+            self.base_counts = None
+            self.fwd_counts = None
+
+        # upper bound on the largest count
+        self.max_count = 0
+
+
+    def get_count_names(self):
+        """returns names of the attributes that hold count arrays"""
+        names = ["ref_matches", "alt_matches", "oth_matches"]
+        if self.count_bases:
+            names.extend(["depth", "base_counts", "fwd_counts"])
+        return names
+
+
+    def check_overflow(self, n_add):
+        """Promotes counts to uint64 if adding n_add to a count could
+        overflow uint32. The exact maximum count is only computed when
+        a cheap upper bound on it gets too large."""
+        if self.ref_matches.dtype == np.uint64:
+            return
+
+        self.max_count += n_add
+        if self.max_count <= UINT32_MAX:
+            return
+
+        # convert to python int so that the sum cannot overflow
+        names = self.get_count_names()
+        self.max_count = int(max(getattr(self, name).max(initial=0)
+                                 for name in names)) + n_add
+        if self.max_count > UINT32_MAX:
+            sys.stderr.write("promoting allele counts to uint64\n")
+            for name in names:
+                setattr(self, name, getattr(self, name).astype(np.uint64))
+
+
+    def add_reads(self, reads):
+        """Adds counts for a list of reads from the same chromosome.
+        The base of every read that overlaps a SNP is compared to the
+        SNP alleles at once, and the counts are updated with
+        np.add.at. Reads should already have been filtered (e.g. by
+        filter_block)."""
+        snp_offsets, snp_idx, snp_read_pos = \
+            self.snp_tab.get_overlapping_snps_batch(
+                *snptable.get_cigar_arrays(reads))[:3]
+
+        if snp_idx.shape[0] == 0:
+            return
+
+        # index of read for each overlapping SNP
+        n_overlap = np.diff(snp_offsets)
+        read_idx = np.repeat(np.arange(len(reads)), n_overlap)
+
+        # concatenate sequences of reads that overlap SNPs, and
+        # get offset of each read into the concatenated sequence
+        overlap_reads = np.flatnonzero(n_overlap)
+        seqs = [reads[i].query_sequence or ""
+                for i in overlap_reads.tolist()]
+        seq_len = np.zeros(len(reads), dtype=np.int64)
+        seq_len[overlap_reads] = [len(x) for x in seqs]
+        seq_start = np.cumsum(seq_len) - seq_len
+        seq_buf = np.frombuffer("".join(seqs).encode("ascii"),
+                                dtype=np.uint8)
+
+        # read positions are 1-based, reads without sequences
+        # do not match either allele
+        has_base = snp_read_pos <= seq_len[read_idx]
+        bases = np.zeros(snp_idx.shape[0], dtype=np.uint8)
+        buf_idx = seq_start[read_idx[has_base]] + snp_read_pos[has_base] - 1
+        bases[has_base] = seq_buf[buf_idx]
+
+        if self.min_baseq > 0 or self.mate_cache:
+            # bases without qualities are given the highest quality
+            # so that they are never filtered
+            qual_list = [reads[i].query_qualities
+                         for i in overlap_reads.tolist()]
+            qual_buf = np.frombuffer(b"".join(
+                [b"\xff" * len(seq) if qual is None else qual.tobytes()
+                 for seq, qual in zip(seqs, qual_list)]), dtype=np.uint8)
+            quals = np.full(snp_idx.shape[0], 255, dtype=np.uint8)
+            quals[has_base] = qual_buf[buf_idx]
+
+        if self.min_baseq > 0:
+            keep = quals >= self.min_baseq
+            snp_idx = snp_idx[keep]
+            read_idx = read_idx[keep]
+            bases = bases[keep]
+            quals = quals[keep]
+
+        if self.count_bases or self.mate_cache:
+            reverse = np.array([read.is_reverse for read in reads],
+                               dtype=bool)[read_idx]
+        else:
+            reverse = None
+
+        if self.mate_cache:
+            self.add_bases_list(self.mate_cache.add_reads(
+                reads, read_idx, snp_idx, bases, quals, reverse))
+        else:
+            self.add_bases(snp_idx, bases, reverse)
+
+
+    def finish(self):
+        """Counts the bases of any reads that are still waiting for
+        their mate"""
+        if self.mate_cache:
+            self.add_bases_list(self.mate_cache.flush())
+            self.mate_cache.write_stats(sys.stderr)
+
+
+    def add_bases_list(self, obs_list):
+        """Updates counts for a list of (snp_idx, bases, reverse)
+        arrays, which are concatenated so that counts are only
+        updated once"""
+        if obs_list:
+            self.add_bases(*[np.concatenate(x) for x in zip(*obs_list)])
+
+
+    def add_bases(self, snp_idx, bases, reverse):
+        """Updates counts for the read bases at SNPs with indices
+        snp_idx. reverse gives the strand of the read that each base
+        came from, and is only used if bases are being counted."""
+        if snp_idx.shape[0] == 0:
+            return
+
+        ref_codes = self.ref_codes[snp_idx]
+        alt_codes = self.alt_codes[snp_idx]
+        is_ref = (bases == ref_codes) & (ref_codes != 0)
+        is_alt = ~is_ref & (bases == alt_codes) & (alt_codes != 0)
+        is_oth = ~is_ref & ~is_alt
+
+        # no count can increase by more than the number of overlaps
+        self.check_overflow(snp_idx.shape[0])
+
+        np.add.at(self.ref_matches, snp_idx[is_ref], 1)
+        np.add.at(self.alt_matches, snp_idx[is_alt], 1)
+        np.add.at(self.oth_matches, snp_idx[is_oth], 1)
+
+        if self.count_bases:
+            np.add.at(self.depth, snp_idx, 1)
+
+            base_idx = BASE_INDEX[bases]
+            is_acgt = base_idx >= 0
+            np.add.at(self.base_counts,
+                      (snp_idx[is_acgt], base_idx[is_acgt]), 1)
+
+            is_fwd = is_acgt & ~reverse
+            np.add.at(self.fwd_counts,
+                      (snp_idx[is_fwd], base_idx[is_fwd]), 1)
+
+
+
+class TextWriter(object):
+    """Writes results as space-delimited text to stdout or to a file,
+    which is gzipped if its name ends with .gz"""
+
+    row_format = "%s %d %s %s %s %d %d %d\n"
+
+    def __init__(self, filename=None):
+        if filename is None:
+            self.f = sys.stdout
+        elif filename.endswith(".gz"):
+            self.f = util.open_gzip_writer(filename)
+        else:
+            self.f = open(filename, "w")
+
+
+    def write_table(self, columns):
+        """writes columns (in the order of OUTPUT_COLUMNS) a block
+        of rows at a time. Each column of a 2D array is written as a
+        separate field."""
+        chrom_name = columns[0]
+        n_row = columns[1].shape[0]
+
+        fields = []
+        for col in columns[1:]:
+            if col.ndim == 2:
+                fields.extend(col.T)
+            else:
+                fields.append(col)
+
+        for start in range(0, n_row, TEXT_BLOCK_SIZE):
+            end = min(start + TEXT_BLOCK_SIZE, n_row)
+            rows = zip([chrom_name] * (end - start),
+                       *[col[start:end].tolist() for col in fields])
+            self.f.write("".join(map(self.row_format.__mod__, rows)))
+
+
+    def close(self):
+        if self.f is not sys.stdout:
+            self.f.close()
+
+
+
+class AcgtWriter(TextWriter):
+    """Writes counts of A, C, G and T at each SNP as tab-delimited
+    text, with a header, in the same layout as sequenza-utils
+    pileup2acgt (the strand column gives the forward strand counts
+    of each base, separated by colons)"""
+
+    row_format = "%s\t%d\t%s\t%d\t%d\t%d\t%d\t%d\t%d:%d:%d:%d\n"
+
+    def __init__(self, filename=None):
+        TextWriter.__init__(self, filename)
+        self.f.write("\t".join(ACGT_COLUMNS) + "\n")
+
+
+
+class ParquetWriter(object):
+    """Writes results to a Parquet file, with one row group per
+    chromosome. Requires pyarrow."""
+
+    def __init__(self, filename):
+        import pyarrow
+        import pyarrow.parquet
+
+        self.pa = pyarrow
+        self.schema = pyarrow.schema(
+            [(OUTPUT_COLUMNS[0], pyarrow.string()),
+             (OUTPUT_COLUMNS[1], pyarrow.int64()),
+             (OUTPUT_COLUMNS[2], pyarrow.string()),
+             (OUTPUT_COLUMNS[3], pyarrow.string()),
+             (OUTPUT_COLUMNS[4], pyarrow.string()),
+             (OUTPUT_COLUMNS[5], pyarrow.uint64()),
+             (OUTPUT_COLUMNS[6], pyarrow.uint64()),
+             (OUTPUT_COLUMNS[7], pyarrow.uint64())])
+        self.writer = pyarrow.parquet.ParquetWriter(filename, self.schema)
+
+
+    def write_table(self, columns):
+        n_row = columns[1].shape[0]
+        arrays = [self.pa.array([columns[0]] * n_row,
+                                type=self.schema.field(0).type)]
+        for i, col in enumerate(columns[1:]):
+            arrays.append(self.pa.array(col,
+                                        type=self.schema.field(i+1).type))
+        self.writer.write_table(self.pa.Table.from_arrays(
+            arrays, schema=self.schema))
+
+
+    def close(self):
+        self.writer.close()
+
+
+
+def open_writer(output_filename=None, output_format=OUTPUT_TEXT):
+    if output_format == OUTPUT_PARQUET:
+        if output_filename is None:
+            raise ValueError("an output filename must be provided "
+                             "for %s output" % OUTPUT_PARQUET)
+        return ParquetWriter(output_filename)
+    elif output_format == OUTPUT_TEXT:
+        return TextWriter(output_filename)
+    elif output_format == OUTPUT_ACGT:
+        return AcgtWriter(output_filename)
+
+    raise ValueError("unknown output format '%s', expected one of %s" %
+                     (output_format, ", ".join(OUTPUT_FORMATS)))
+
+
+
+def get_result_columns(chrom_name, snp_tab, ref_matches,
+                       alt_matches, oth_matches, geno_sample):
+    """Returns a list of output columns for the SNPs on a chromosome,
+    in the order of OUTPUT_COLUMNS. The first column is the name of
+    the chromosome, and the rest are arrays with a value for each
+    SNP."""
     haps = None
     has_haps = False
     
@@ -33,21 +562,64 @@ def write_results(out_f, chrom_name, snp_tab, ref_matches,
             haps = None
             has_haps = False
 
-    for i in range(snp_tab.n_snp):
-        if has_haps:
-            geno_str = "{}|{}".format(haps[i, 0], haps[i, 1])
-        else:
-            geno_str = "NA"
-        out_f.write("%s %d %s %s %s %d %d %d\n" %
-                    (chrom_name, snp_tab.snp_pos[i],
-                     snp_tab.snp_allele1[i], snp_tab.snp_allele2[i],
-                     geno_str, ref_matches[i], alt_matches[i],
-                     oth_matches[i]))
+    if has_haps:
+        # there are only a few distinct genotypes, so only format
+        # each of them once
+        haps = haps.astype(np.int64)
+        geno_codes = (haps[:, 0] + 128) * 256 + (haps[:, 1] + 128)
+        uniq_codes, geno_idx = np.unique(geno_codes, return_inverse=True)
+        geno_strs = np.array(["%d|%d" % (x // 256 - 128, x % 256 - 128)
+                              for x in uniq_codes.tolist()])
+        geno = geno_strs[geno_idx]
+    else:
+        geno = np.full(snp_tab.n_snp, "NA")
+
+    # alleles are ASCII, and converting bytes to str with astype is
+    # much faster than np.char.decode
+    return [chrom_name, snp_tab.snp_pos.astype(np.int64),
+            snp_tab.snp_allele1.astype("U"), snp_tab.snp_allele2.astype("U"),
+            geno, ref_matches, alt_matches, oth_matches]
+
+
+
+def get_acgt_columns(chrom_name, snp_tab, depth, base_counts, fwd_counts):
+    """Returns a list of columns for acgt output. Only SNPs with a
+    single-base reference allele that are covered by at least one
+    counted read are included. The last two columns are 2D arrays
+    with the counts of A, C, G and T, in total and on the forward
+    strand."""
+    is_covered = (depth > 0) & (get_allele_codes(snp_tab.snp_allele1) != 0)
+
+    return [chrom_name, snp_tab.snp_pos[is_covered].astype(np.int64),
+            snp_tab.snp_allele1[is_covered].astype("U"),
+            depth[is_covered], base_counts[is_covered],
+            fwd_counts[is_covered]]
+
+
+
+def get_output_columns(output_format, chrom_name, snp_tab, counter,
+                       geno_sample):
+    """Returns the output columns for a chromosome, from the counts
+    in an AlleleCounter"""
+    if output_format == OUTPUT_ACGT:
+        return get_acgt_columns(chrom_name, snp_tab, counter.depth,
+                                counter.base_counts, counter.fwd_counts)
+
+    return get_result_columns(chrom_name, snp_tab, counter.ref_matches,
+                              counter.alt_matches, counter.oth_matches,
+                              geno_sample)
+
+
+
+def write_results(writer, chrom_name, snp_tab, ref_matches,
+                  alt_matches, oth_matches, geno_sample):
+    writer.write_table(get_result_columns(chrom_name, snp_tab, ref_matches,
+                                          alt_matches, oth_matches,
+                                          geno_sample))
 
 
 def write_header(out_f):
-    out_f.write("CHROM SNP.POS REF.ALLELE ALT.ALLELE GENOTYPE REF.COUNT "
-                "ALT.COUNT OTHER.COUNT\n")
+    out_f.write(" ".join(OUTPUT_COLUMNS) + "\n")
 
 
     
@@ -173,6 +745,87 @@ def parse_options():
                         "not provided or the GENO_SAMPLE does not match any "
                         "of the samples in haplotype file then NA is "
                         "output for genotype.", default=None)
+
+    parser.add_argument("--snp_index_type",
+                        default=snptable.SNP_INDEX_AUTO,
+                        choices=snptable.SNP_INDEX_TYPES,
+                        help="Type of index used to lookup SNPs by "
+                        "position (default=%s). A dense index has an "
+                        "entry for every base of a chromosome, while a "
+                        "sparse index only stores SNP positions and needs "
+                        "much less memory. With 'auto' a sparse index is "
+                        "used unless a chromosome has very dense SNPs."
+                        % snptable.SNP_INDEX_AUTO)
+
+    parser.add_argument("--snp_cache_dir", default=None,
+                        metavar="SNP_CACHE_DIR",
+                        help="Directory to cache SNP tables in. SNP "
+                        "tables for each chromosome are written to this "
+                        "directory after they are first read, and are "
+                        "read from it (much faster) in later runs with "
+                        "the same SNP files and --samples. The cache "
+                        "directory is created if it does not exist.")
+
+    parser.add_argument("--snp_cache_checksum", action="store_true",
+                        default=False,
+                        help="Identify SNP files in the --snp_cache_dir "
+                        "cache by an MD5 checksum of their contents, "
+                        "rather than by their path, size and "
+                        "modification time. This reads all of the SNP "
+                        "files on every run, but detects changes that "
+                        "keep the same size and modification time.")
+
+    parser.add_argument("--threads", type=int, default=1,
+                        help="Number of worker processes to use "
+                        "(default=1). If greater than 1, chromosomes "
+                        "are counted in parallel, using reads fetched "
+                        "from the indexed BAM file. If the BAM file "
+                        "does not have an index that is newer than it, "
+                        "it is indexed in a temporary directory. Output "
+                        "is the same as with one process.")
+
+    parser.add_argument("--min_mapq", type=int, default=0,
+                        help="Skip reads with a mapping quality less "
+                        "than MIN_MAPQ (default=0)")
+
+    parser.add_argument("--min_baseq", type=int, default=0,
+                        help="Do not count read bases with a base "
+                        "quality less than MIN_BASEQ (default=0)")
+
+    parser.add_argument("--exclude_flags", type=parse_flags,
+                        default=EXCLUDE_FLAGS_DEFAULT,
+                        help="Skip reads with any of these SAM flags set. "
+                        "Flags can be given as a number (e.g. 0x704) or "
+                        "as a comma-delimited list of names, like the "
+                        "samtools --ff option (e.g. "
+                        "UNMAP,SECONDARY,QCFAIL,DUP). Unmapped reads are "
+                        "always skipped. (default=UNMAP,SECONDARY)")
+
+    parser.add_argument("--dedup_overlap", action="store_true",
+                        default=False,
+                        help="Count SNPs that are overlapped by both "
+                        "reads of a pair only once, using the base from "
+                        "the read with the higher base quality (like "
+                        "the overlap detection of samtools mpileup). By "
+                        "default bases from both reads are counted.")
+
+    parser.add_argument("--output", default=None, metavar="OUTPUT_FILE",
+                        help="Write results to OUTPUT_FILE rather than "
+                        "stdout. Text output is gzipped if OUTPUT_FILE "
+                        "ends with .gz")
+
+    parser.add_argument("--output_format", default=OUTPUT_TEXT,
+                        choices=OUTPUT_FORMATS,
+                        help="Format of output (default=%s). Parquet "
+                        "output has a header with the column names %s, "
+                        "requires the pyarrow package and requires "
+                        "--output to be specified. With %s, the number "
+                        "of reads with each of the bases A, C, G and T is "
+                        "written for every covered SNP, as tab-delimited "
+                        "text with the header and columns of "
+                        "sequenza-utils pileup2acgt (%s)."
+                        % (OUTPUT_TEXT, ", ".join(OUTPUT_COLUMNS),
+                           OUTPUT_ACGT, " ".join(ACGT_COLUMNS)))
         
     parser.add_argument("bam_filename", action='store',
                         help="Coordinate-sorted input BAM file "
@@ -181,6 +834,25 @@ def parse_options():
 
     options = parser.parse_args()
     
+    if options.threads < 1:
+        parser.error("--threads must be at least 1")
+
+    if options.min_mapq < 0:
+        parser.error("--min_mapq must not be negative")
+
+    if options.min_baseq < 0:
+        parser.error("--min_baseq must not be negative")
+
+    if options.output_format == OUTPUT_PARQUET:
+        if options.output is None:
+            parser.error("--output must be specified with "
+                         "--output_format %s" % OUTPUT_PARQUET)
+        try:
+            import pyarrow
+        except ImportError:
+            parser.error("the pyarrow package is required for "
+                         "--output_format %s" % OUTPUT_PARQUET)
+
     if options.snp_dir:
         if(options.snp_tab or options.snp_index or options.haplotype):
             parser.error("expected --snp_dir OR (--snp_tab, --snp_index and "
@@ -195,28 +867,157 @@ def parse_options():
                         
     
 
+def read_snps(snp_tab, chrom_name, snp_dir=None, snp_tab_h5=None,
+              snp_index_h5=None, hap_h5=None, samples=None,
+              snp_cache=None):
+    """reads SNPs for a chromosome into snp_tab, from HDF5 files
+    if they are provided or otherwise from a text file in snp_dir"""
+    if snp_tab_h5:
+        # read SNPs from HDF5 files, reduce to set that are
+        # polymorphic in specified samples
+        snp_tab.read_h5(snp_tab_h5, snp_index_h5, hap_h5,
+                        chrom_name, samples=samples,
+                        cache=snp_cache)
+    elif snp_dir:
+        # read SNPs from text file
+        snp_filename = "%s/%s.snps.txt.gz" % (snp_dir, chrom_name)
+        snp_tab.read_file(snp_filename, cache=snp_cache)
+    else:
+        raise ValueError("--snp_dir OR (--snp_tab, --snp_index, "
+                         "and --hap_h5) must be defined")
+
+    sys.stderr.write("read %d SNPs\n" % snp_tab.n_snp)
+
+
+
+def filter_block(block, min_mapq=0, exclude_flags=EXCLUDE_FLAGS_DEFAULT):
+    """returns reads from block that should be counted. Unmapped
+    reads, reads with any of exclude_flags set and reads with a
+    mapping quality below min_mapq are skipped. By default secondary
+    alignments (i.e. read was aligned more than once and this has
+    align score that <= best score) are also skipped."""
+    exclude_flags |= FLAG_UNMAPPED
+    return [read for read in block
+            if not (read.flag & exclude_flags)
+            and read.mapping_quality >= min_mapq]
+
+
+
+def count_chrom_shard(args):
+    """Worker process function that counts alleles for the SNPs on a
+    single chromosome, using reads fetched from the indexed BAM file,
+    and saves the output columns to shard_filename (a .npz file)."""
+    bam_filename, index_filename, chrom_name, shard_filename, snp_dir, \
+        snp_tab_filename, snp_index_filename, haplotype_filename, \
+        samples, geno_sample, snp_index_type, snp_cache, \
+        output_format, min_mapq, min_baseq, exclude_flags, \
+        dedup_overlap = args
+
+    sys.stderr.write("starting chromosome %s\n" % chrom_name)
+
+    bam = pysam.Samfile(bam_filename, index_filename=index_filename)
+    snp_tab = snptable.SNPTable(index_type=snp_index_type)
+
+    if snp_tab_filename:
+        snp_tab_h5 = tables.open_file(snp_tab_filename, "r")
+        snp_index_h5 = tables.open_file(snp_index_filename, "r")
+        hap_h5 = tables.open_file(haplotype_filename, "r")
+    else:
+        snp_tab_h5 = snp_index_h5 = hap_h5 = None
+
+    read_snps(snp_tab, chrom_name, snp_dir=snp_dir, snp_tab_h5=snp_tab_h5,
+              snp_index_h5=snp_index_h5, hap_h5=hap_h5, samples=samples,
+              snp_cache=snp_cache)
+
+    counter = AlleleCounter(snp_tab, min_baseq=min_baseq,
+                            count_bases=(output_format == OUTPUT_ACGT),
+                            dedup_overlap=dedup_overlap)
+    for block in snptable.iter_read_blocks(bam.fetch(chrom_name)):
+        counter.add_reads(filter_block(block, min_mapq=min_mapq,
+                                       exclude_flags=exclude_flags))
+    counter.finish()
+
+    columns = get_output_columns(output_format, chrom_name, snp_tab,
+                                 counter, geno_sample)
+    np.savez(shard_filename, *columns)
+
+    for h5f in (snp_tab_h5, snp_index_h5, hap_h5):
+        if h5f:
+            h5f.close()
+    bam.close()
+
+    return shard_filename
+
+
+
+def count_parallel(writer, bam_filename, threads, snp_dir=None,
+                   snp_tab_filename=None, snp_index_filename=None,
+                   haplotype_filename=None, samples=None, geno_sample=None,
+                   snp_index_type=snptable.SNP_INDEX_AUTO, snp_cache=None,
+                   output_format=OUTPUT_TEXT, min_mapq=0, min_baseq=0,
+                   exclude_flags=EXCLUDE_FLAGS_DEFAULT, dedup_overlap=False):
+    """Counts alleles using a pool of worker processes, each of which
+    processes one chromosome at a time. Results for each chromosome
+    are saved to a shard file, and the shards are then written with
+    writer in the order that chromosomes appear in the BAM header,
+    so that the output is the same as when one process is used."""
+    shard_dir = tempfile.mkdtemp(prefix="get_as_counts.")
+
+    # shards and any new index are written to shard_dir, which is
+    # removed at the end
+    with util.removing_files([shard_dir]):
+        # a new index is written to shard_dir rather than next to the
+        # BAM file, which may be in a directory that is not writable
+        index_filename = util.get_bam_index(bam_filename,
+                                            "%s/input.bai" % shard_dir)
+        bam = pysam.Samfile(bam_filename, index_filename=index_filename)
+        chroms = util.get_indexed_chroms(bam)
+        bam.close()
+
+        if snp_cache and snp_tab_filename:
+            # get keys of HDF5 files once, rather than in every
+            # worker (which reads them if checksums are used)
+            snp_cache.get_key([snp_tab_filename, snp_index_filename,
+                               haplotype_filename], samples)
+
+        shard_args = [(bam_filename, index_filename, chrom,
+                       util.get_shard_filename("%s/counts" % shard_dir,
+                                               tid, ".npz"),
+                       snp_dir, snp_tab_filename, snp_index_filename,
+                       haplotype_filename, samples, geno_sample,
+                       snp_index_type, snp_cache, output_format,
+                       min_mapq, min_baseq, exclude_flags, dedup_overlap)
+                      for tid, chrom, n_read in chroms]
+
+        shard_filenames = util.run_chrom_workers(
+            count_chrom_shard, shard_args, threads,
+            sizes=[x[2] for x in chroms])
+
+        for shard_filename in shard_filenames:
+            with np.load(shard_filename) as shard:
+                columns = [shard["arr_%d" % i]
+                           for i in range(len(shard.files))]
+            columns[0] = str(columns[0])
+            writer.write_table(columns)
+
+
+
 def main(bam_filename, snp_dir=None, snp_tab_filename=None,
          snp_index_filename=None, haplotype_filename=None, samples=None,
-         geno_sample=None):
+         geno_sample=None, snp_index_type=snptable.SNP_INDEX_AUTO,
+         snp_cache_dir=None, snp_cache_checksum=False, threads=1,
+         output_filename=None, output_format=OUTPUT_TEXT, min_mapq=0,
+         min_baseq=0, exclude_flags=EXCLUDE_FLAGS_DEFAULT,
+         dedup_overlap=False):
 
-    out_f = sys.stdout
-    
-    bam = pysam.Samfile(bam_filename)
-        
-    cur_chrom = None
-    cur_tid = None
-    seen_chrom = set([])
-
-    snp_tab = snptable.SNPTable()
-    read_pair_cache = {}
+    writer = open_writer(output_filename, output_format)
 
-    # keep track of number of ref matches, non-ref matches, and other
-    # for each SNP
-    snp_ref_match = None
-    snp_alt_match = None
-    snp_other_match = None
+    if snp_cache_dir:
+        snp_cache = snptable.SNPCache(snp_cache_dir,
+                                      checksum=snp_cache_checksum)
+    else:
+        snp_cache = None
 
-    
     if geno_sample and not haplotype_filename:
         sys.stderr.write("WARNING: cannot obtain genotypes for sample "
                          "%s without --haplotype argument\n")
@@ -228,6 +1029,33 @@ def main(bam_filename, snp_dir=None, snp_tab_filename=None,
         if (not snp_index_filename) or (not haplotype_filename):
             raise ValueError("--snp_index and --haplotype must be provided "
                              "if --snp_tab is provided")
+    elif not snp_dir:
+        raise ValueError("--snp_dir OR (--snp_tab, --snp_index, "
+                         "and --hap_h5) must be defined")
+
+    if threads > 1:
+        count_parallel(writer, bam_filename, threads, snp_dir=snp_dir,
+                       snp_tab_filename=snp_tab_filename,
+                       snp_index_filename=snp_index_filename,
+                       haplotype_filename=haplotype_filename,
+                       samples=samples, geno_sample=geno_sample,
+                       snp_index_type=snp_index_type, snp_cache=snp_cache,
+                       output_format=output_format, min_mapq=min_mapq,
+                       min_baseq=min_baseq, exclude_flags=exclude_flags,
+                       dedup_overlap=dedup_overlap)
+        writer.close()
+        return
+
+    bam = pysam.Samfile(bam_filename)
+
+    cur_chrom = None
+    cur_tid = None
+    seen_chrom = set([])
+
+    snp_tab = snptable.SNPTable(index_type=snp_index_type)
+    counter = None
+
+    if snp_tab_filename:
         snp_tab_h5 = tables.open_file(snp_tab_filename, "r")
         snp_index_h5 = tables.open_file(snp_index_filename, "r")
         hap_h5 = tables.open_file(haplotype_filename, "r")
@@ -236,14 +1064,24 @@ def main(bam_filename, snp_dir=None, snp_tab_filename=None,
         snp_index_h5 = None
         hap_h5 = None
         
-    for read in bam:
+    # reads are processed in blocks from the same chromosome so that
+    # overlapping SNPs can be looked up for many reads at once
+    for block in snptable.iter_read_blocks(bam):
+        read = block[0]
+
+        if read.tid < 0:
+            # unmapped reads without a chromosome (at end of file)
+            continue
+        
         if (cur_tid is None) or (read.tid != cur_tid):
             # this is a new chromosome
 
             if cur_chrom:
                 # write out results from last chromosome
-                write_results(out_f, cur_chrom, snp_tab, snp_ref_match,
-                              snp_alt_match, snp_oth_match, geno_sample)
+                counter.finish()
+                writer.write_table(get_output_columns(
+                    output_format, cur_chrom, snp_tab, counter,
+                    geno_sample))
             
             cur_chrom = bam.getrname(read.tid)
             
@@ -255,56 +1093,26 @@ def main(bam_filename, snp_dir=None, snp_tab_filename=None,
             cur_tid = read.tid
             sys.stderr.write("starting chromosome %s\n" % cur_chrom)
 
-            # read SNPs for next chromomsome
-            if snp_tab_h5:
-                # read SNPs from HDF5 files, reduce to set that are
-                # polymorphic in specified samples
-                snp_tab.read_h5(snp_tab_h5, snp_index_h5, hap_h5,
-                                cur_chrom, samples=samples)
-            elif snp_dir:
-                # read SNPs from text file
-                snp_filename = "%s/%s.snps.txt.gz" % (snp_dir, cur_chrom)
-                snp_tab.read_file(snp_filename)
-            else:
-                raise ValueError("--snp_dir OR (--snp_tab, --snp_index, "
-                                 "and --hap_h5) must be defined")
-
-            sys.stderr.write("read %d SNPs\n" % snp_tab.n_snp)
-            
-            # clear SNP table and results             
-            snp_ref_match = np.zeros(snp_tab.n_snp, dtype=np.int16)
-            snp_alt_match = np.zeros(snp_tab.n_snp, dtype=np.int16)
-            snp_oth_match = np.zeros(snp_tab.n_snp, dtype=np.int16)
-                
-                 
-        if read.is_secondary:
-            # this is a secondary alignment (i.e. read was aligned more than
-            # once and this has align score that <= best score)
-            continue
-
-        # loop over all SNP that overlap this read
-        snp_idx, snp_read_pos, \
-            indel_idx, indel_read_pos = snp_tab.get_overlapping_snps(read)
+            # read SNPs for next chromosome, and clear counts
+            read_snps(snp_tab, cur_chrom, snp_dir=snp_dir,
+                      snp_tab_h5=snp_tab_h5, snp_index_h5=snp_index_h5,
+                      hap_h5=hap_h5, samples=samples, snp_cache=snp_cache)
+            counter = AlleleCounter(snp_tab, min_baseq=min_baseq,
+                                    count_bases=(output_format ==
+                                                 OUTPUT_ACGT),
+                                    dedup_overlap=dedup_overlap)
 
-        for snp_i, read_pos in zip(snp_idx, snp_read_pos):
-            snp_pos = snp_tab.snp_pos[snp_i]
-            ref_allele = snp_tab.snp_allele1[snp_i]
-            alt_allele = snp_tab.snp_allele2[snp_i]
-            
-            if ref_allele == read.query_sequence[read_pos-1]:
-                snp_ref_match[snp_i] += 1
-            elif alt_allele == read.query_sequence[read_pos-1]:
-                snp_alt_match[snp_i] += 1
-            else:
-                snp_oth_match[snp_i] += 1
+        counter.add_reads(filter_block(block, min_mapq=min_mapq,
+                                       exclude_flags=exclude_flags))
 
     if cur_chrom:
         # write results for final chromosome
-        write_results(out_f, cur_chrom, snp_tab, snp_ref_match,
-                      snp_alt_match, snp_oth_match, geno_sample)
+        counter.finish()
+        writer.write_table(get_output_columns(output_format, cur_chrom,
+                                              snp_tab, counter, geno_sample))
 
+    writer.close()
 
-    
 
 
 if __name__ == "__main__":
@@ -319,7 +1127,17 @@ if __name__ == "__main__":
          snp_tab_filename=options.snp_tab,
          snp_index_filename=options.snp_index,
          haplotype_filename=options.haplotype,
-         samples=samples, geno_sample=options.genotype_sample)
+         samples=samples, geno_sample=options.genotype_sample,
+         snp_index_type=options.snp_index_type,
+         snp_cache_dir=options.snp_cache_dir,
+         snp_cache_checksum=options.snp_cache_checksum,
+         threads=options.threads,
+         output_filename=options.output,
+         output_format=options.output_format,
+         min_mapq=options.min_mapq,
+         min_baseq=options.min_baseq,
+         exclude_flags=options.exclude_flags,
+         dedup_overlap=options.dedup_overlap)
     
 
     
@@ -1,48 +1,448 @@
-from random import choice
 import pysam
 import os
 import sys
 import argparse
+import time
 
-parser = argparse.ArgumentParser()
-parser.add_argument('input_bam', help="input BAM or SAM file (must be sorted!)")
-parser.add_argument("output_bam", help="output BAM or SAM file")
+import util
+import rmdup_pe
 
-options = parser.parse_args()
 
-if options.input_bam.endswith(".sam") or options.input_bam.endswith("sam.gz"):
-    infile = pysam.Samfile(options.input_bam, "r")
-else:
+# SAM flag bits
+FLAG_PAIRED = 0x1
+FLAG_UNMAPPED = 0x4
+FLAG_REVERSE = 0x10
+FLAG_SECONDARY = 0x100
+FLAG_QCFAIL = 0x200
+FLAG_SUPPLEMENTARY = 0x800
+
+
+class ReadStats(object):
+    """Counts of single-end reads that were kept and discarded"""
+
+    def __init__(self):
+        # number of reads discarded because not mapped
+        self.discard_unmapped = 0
+
+        # number of reads discarded because secondary match
+        self.discard_secondary = 0
+
+        # number of reads discarded because supplementary alignment
+        self.discard_supplementary = 0
+
+        # number of reads discarded because they failed QC
+        self.discard_qcfail = 0
+
+        # number of reads discarded because they are paired
+        # (these should be filtered with --paired_end)
+        self.discard_paired = 0
+
+        # reads discarded because duplicated
+        self.discard_dup = 0
+
+        # number of forward strand reads kept
+        self.keep_forward = 0
+
+        # number of reverse strand reads kept
+        self.keep_reverse = 0
+
+
+    def add(self, other):
+        """Adds counts from another ReadStats object to this one"""
+        for name, val in vars(other).items():
+            setattr(self, name, getattr(self, name) + val)
+
+
+    def write(self, file_handle):
+        file_handle.write("DISCARD reads:\n"
+                          "  unmapped: %d\n"
+                          "  secondary alignment: %d\n"
+                          "  supplementary alignment: %d\n"
+                          "  failed QC: %d\n"
+                          "  paired: %d\n"
+                          "  duplicate reads: %d\n"
+                          "KEEP reads:\n"
+                          "  forward strand: %d\n"
+                          "  reverse strand: %d\n" %
+                          (self.discard_unmapped,
+                           self.discard_secondary,
+                           self.discard_supplementary,
+                           self.discard_qcfail,
+                           self.discard_paired,
+                           self.discard_dup,
+                           self.keep_forward,
+                           self.keep_reverse))
+
+
+
+def open_input_bam(input_bam, index_filename=None):
+    if input_bam.endswith(".sam") or input_bam.endswith("sam.gz"):
+        return pysam.Samfile(input_bam, "r")
+
     # assume binary BAM file
-    infile = pysam.Samfile(options.input_bam, "rb")
-
-if options.output_bam.endswith(".sam"):
-    # output in text SAM format
-    outfile = pysam.Samfile(options.output_bam, "w", template=infile)
-elif options.output_bam.endswith(".bam"):
-    # output in binary compressed BAM format
-    outfile = pysam.Samfile(options.output_bam, "wb", template=infile)
-else:
+    return pysam.Samfile(input_bam, "rb", index_filename=index_filename)
+
+
+
+def open_output_bam(output_bam, template):
+    if output_bam.endswith(".sam"):
+        # output in text SAM format
+        return pysam.Samfile(output_bam, "w", template=template)
+    elif output_bam.endswith(".bam"):
+        # output in binary compressed BAM format
+        return pysam.Samfile(output_bam, "wb", template=template)
+
     raise ValueError("name of output file must end with .bam or .sam")
 
 
-chr=""
-pos=0
-linelistplus=[]
-linelistminus=[]
-for line in infile:
-    if line.rname!=chr or line.pos!=pos:
-        if(len(linelistplus)>0):
-            outfile.write(choice(linelistplus))
-        if(len(linelistminus)>0):
-            outfile.write(choice(linelistminus))
-        chr=line.rname
-        pos=line.pos
-        linelistplus=[]
-        linelistminus=[]
-    if(line.flag==0):
-        linelistplus.append(line)
-    if(line.flag==16):
-        linelistminus.append(line)
-infile.close()
-outfile.close()
+
+class DupGroup(object):
+    """
+    A group of duplicate reads, which start at the same position on
+    the same strand. Only the read to keep (the one with the lowest
+    hash of its name) is stored, so memory use does not depend on the
+    number of duplicates.
+    """
+
+    def __init__(self, seed=rmdup_pe.SEED_DEFAULT):
+        self.seed = seed
+        self.read = None
+        self.hash = None
+        self.n_read = 0
+
+
+    def add(self, read):
+        self.n_read += 1
+
+        if self.read is None:
+            # name hashes are only needed if there are duplicates
+            self.read = read
+            return
+
+        if self.hash is None:
+            self.hash = rmdup_pe.get_name_hash(self.read.qname, self.seed)
+
+        read_hash = rmdup_pe.get_name_hash(read.qname, self.seed)
+        if read_hash < self.hash:
+            # ties are resolved in favour of the first read
+            self.read = read
+            self.hash = read_hash
+
+
+    def write(self, outfile, read_stats):
+        """writes the kept read, and clears the group"""
+        if self.read is None:
+            return
+
+        if self.read.flag & FLAG_REVERSE:
+            read_stats.keep_reverse += 1
+        else:
+            read_stats.keep_forward += 1
+        read_stats.discard_dup += self.n_read - 1
+        outfile.write(self.read)
+
+        self.read = None
+        self.hash = None
+        self.n_read = 0
+
+
+
+def filter_reads(infile, outfile, seed=rmdup_pe.SEED_DEFAULT, chrom=None,
+                 metrics=None):
+    """
+    Removes duplicate single-end reads from the sorted reads in infile,
+    writing the kept reads to outfile. Of the reads that start at
+    the same position on the same strand, the one with the lowest
+    hash of its name is kept. Unmapped, secondary, supplementary,
+    QC-failed and paired reads are discarded. Duplicate flags set by
+    other tools are ignored. If chrom is specified, only the reads on
+    that chromosome are fetched from infile (which must be indexed).
+    If metrics is provided, timings and read counts are recorded in
+    this util.Metrics object. Returns a ReadStats object.
+    """
+    read_stats = ReadStats()
+
+    if metrics is None:
+        metrics = util.Metrics()
+
+    if chrom is None:
+        reads = infile
+    else:
+        reads = infile.fetch(chrom)
+
+    seen_tid = set([])
+    cur_tid = None
+    cur_pos = None
+    forward = DupGroup(seed)
+    reverse = DupGroup(seed)
+    read_count = 0
+
+    for read in reads:
+        if read_count >= util.METRICS_READ_INTERVAL:
+            metrics.count("reads", read_count)
+            metrics.progress()
+            read_count = 0
+        read_count += 1
+
+        flag = read.flag
+
+        if flag & FLAG_UNMAPPED:
+            if read.reference_id == -1 and cur_tid != -1:
+                # reads without coordinates are at end of sorted file
+                if read_count > 1:
+                    metrics.count("reads", read_count - 1)
+                    read_count = 1
+                metrics.start_chrom(util.METRICS_NO_CHROM)
+                cur_tid = -1
+            read_stats.discard_unmapped += 1
+            continue
+        if flag & FLAG_SECONDARY:
+            read_stats.discard_secondary += 1
+            continue
+        if flag & FLAG_SUPPLEMENTARY:
+            read_stats.discard_supplementary += 1
+            continue
+        if flag & FLAG_QCFAIL:
+            read_stats.discard_qcfail += 1
+            continue
+        if flag & FLAG_PAIRED:
+            read_stats.discard_paired += 1
+            continue
+
+        tid = read.reference_id
+        pos = read.reference_start
+
+        if tid != cur_tid or pos != cur_pos:
+            # reached a new position, write reads from last one
+            forward.write(outfile, read_stats)
+            reverse.write(outfile, read_stats)
+
+            if tid != cur_tid:
+                if tid in seen_tid:
+                    raise ValueError("expected input BAM file to be sorted "
+                                     "but chromosome %s is repeated\n" %
+                                     read.reference_name)
+                seen_tid.add(tid)
+
+                if read_count > 1:
+                    # reads before this one were on the last chromosome
+                    metrics.count("reads", read_count - 1)
+                    read_count = 1
+                metrics.start_chrom(read.reference_name)
+            elif pos < cur_pos:
+                raise ValueError("expected input BAM file to be sorted "
+                                 "but reads are out of order")
+            cur_tid = tid
+            cur_pos = pos
+
+        if flag & FLAG_REVERSE:
+            reverse.add(read)
+        else:
+            forward.add(read)
+
+    forward.write(outfile, read_stats)
+    reverse.write(outfile, read_stats)
+
+    if read_count > 0:
+        metrics.count("reads", read_count)
+    metrics.end_chrom()
+
+    return read_stats
+
+
+
+def filter_reads_shard(args):
+    """Worker process function that removes duplicates from the reads
+    on a single chromosome, writing the kept reads to a shard BAM
+    file. Returns a ReadStats object and a util.Metrics object."""
+    input_bam, index_filename, shard_filename, chrom, paired_end, seed, \
+        progress_interval = args
+
+    metrics = util.Metrics(progress_interval)
+    infile = open_input_bam(input_bam, index_filename)
+    outfile = pysam.Samfile(shard_filename, "wb", template=infile)
+
+    if paired_end:
+        read_stats = rmdup_pe.filter_reads(infile, outfile, seed=seed,
+                                           chrom=chrom, metrics=metrics)
+    else:
+        read_stats = filter_reads(infile, outfile, seed=seed, chrom=chrom,
+                                  metrics=metrics)
+
+    infile.close()
+    outfile.close()
+    metrics.finish()
+
+    return read_stats, metrics
+
+
+
+def merge_shards(output_bam, template, shard_filenames):
+    """Concatenates the shard BAM files into output_bam, in the order
+    given."""
+    if output_bam.endswith(".bam") and shard_filenames:
+        # shards all have the same header, so their compressed
+        # blocks can be concatenated without decompressing them
+        pysam.cat("-o", output_bam, *shard_filenames)
+    else:
+        outfile = open_output_bam(output_bam, template)
+        for shard_filename in shard_filenames:
+            shard = pysam.Samfile(shard_filename, "rb")
+            for read in shard:
+                outfile.write(read)
+            shard.close()
+        outfile.close()
+
+
+
+def filter_reads_parallel(input_bam, output_bam, threads, paired_end=False,
+                          seed=rmdup_pe.SEED_DEFAULT, metrics=None):
+    """Removes duplicates using a pool of worker processes, each of
+    which processes one chromosome at a time. Shard outputs are then
+    merged in the order that chromosomes appear in the BAM header, so
+    that the output is the same as when a single process is used.
+    Returns a ReadStats object. If metrics is provided, the metrics
+    recorded by the workers are added to this util.Metrics object."""
+    if not input_bam.endswith(".bam"):
+        raise ValueError("input must be a sorted BAM file to use "
+                         "more than one thread")
+
+    if paired_end:
+        read_stats = rmdup_pe.ReadStats()
+    else:
+        read_stats = ReadStats()
+
+    if metrics is None:
+        metrics = util.Metrics()
+
+    # a new index is written next to the output rather than the
+    # input, and is removed along with the shards at the end
+    tmp_filenames = ["%s.input.bai" % output_bam]
+    with util.removing_files(tmp_filenames):
+        index_filename = util.get_bam_index(input_bam, tmp_filenames[0])
+        infile = open_input_bam(input_bam, index_filename)
+
+        # check output filename before starting workers
+        open_output_bam(output_bam, infile).close()
+
+        # reads without coordinates are not returned by fetch()
+        read_stats.discard_unmapped += infile.nocoordinate
+        if infile.nocoordinate > 0:
+            metrics.count("reads", infile.nocoordinate)
+
+        chroms = util.get_indexed_chroms(infile)
+        shard_filenames = [util.get_shard_filename(output_bam, tid, ".bam")
+                           for tid, chrom, n_read in chroms]
+        tmp_filenames.extend(shard_filenames)
+        shard_args = [(input_bam, index_filename, shard_filename, chrom,
+                       paired_end, seed, metrics.progress_interval)
+                      for shard_filename, (tid, chrom, n_read)
+                      in zip(shard_filenames, chroms)]
+
+        for shard_stats, shard_metrics in \
+                util.run_chrom_workers(filter_reads_shard, shard_args,
+                                       threads,
+                                       sizes=[x[2] for x in chroms]):
+            read_stats.add(shard_stats)
+            metrics.add(shard_metrics)
+
+        start_time = time.perf_counter()
+        merge_shards(output_bam, infile, shard_filenames)
+        metrics.add_time("merge_shards", time.perf_counter() - start_time)
+        infile.close()
+
+    return read_stats
+
+
+
+def main(input_bam, output_bam, paired_end=False,
+         seed=rmdup_pe.SEED_DEFAULT, threads=1, metrics_filename=None,
+         progress_interval=0):
+    metrics = util.Metrics(progress_interval)
+
+    if threads > 1:
+        read_stats = filter_reads_parallel(input_bam, output_bam, threads,
+                                           paired_end=paired_end, seed=seed,
+                                           metrics=metrics)
+    else:
+        infile = open_input_bam(input_bam)
+        outfile = open_output_bam(output_bam, infile)
+
+        if paired_end:
+            read_stats = rmdup_pe.filter_reads(infile, outfile, seed=seed,
+                                               metrics=metrics)
+        else:
+            read_stats = filter_reads(infile, outfile, seed=seed,
+                                      metrics=metrics)
+
+        infile.close()
+        outfile.close()
+
+    read_stats.write(sys.stderr)
+
+    if metrics_filename:
+        metrics.finish()
+        metrics.write(metrics_filename)
+
+
+
+def parse_options():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_bam', help="input BAM or SAM file (must "
+                        "be sorted!)")
+    parser.add_argument("output_bam", help="output BAM or SAM file")
+    parser.add_argument("--paired_end", action="store_true",
+                        default=False,
+                        help="input reads are paired-end (the same as "
+                        "running rmdup_pe.py)")
+    parser.add_argument("--seed", type=int,
+                        default=rmdup_pe.SEED_DEFAULT,
+                        help="seed used to choose which of a set of "
+                        "duplicate reads to keep. The same input and "
+                        "seed always give the same output "
+                        "(default=%d)" % rmdup_pe.SEED_DEFAULT)
+    parser.add_argument("--threads", type=int, default=1,
+                        help="number of worker processes to use. If "
+                        "greater than 1, chromosomes are processed in "
+                        "parallel. This requires a coordinate-sorted BAM "
+                        "file. If it does not have an index that is newer "
+                        "than it, an index is written next to the output "
+                        "file and removed at the end (default=1)")
+    parser.add_argument("--metrics", default=None, metavar="METRICS_FILE",
+                        help="write metrics, including the time spent "
+                        "on each chromosome, reads per second, the "
+                        "largest cache sizes (with --paired_end) and peak "
+                        "memory use, to this file. The file is written "
+                        "in TSV format if its name ends with .tsv, and "
+                        "in JSON format otherwise")
+    parser.add_argument("--progress", type=float, default=0,
+                        metavar="SECONDS",
+                        help="write a progress line to stderr at most "
+                        "every SECONDS seconds (default=0, no progress "
+                        "lines)")
+
+    options = parser.parse_args()
+
+    if options.threads < 1:
+        parser.error("--threads must be at least 1")
+
+    if options.progress < 0:
+        parser.error("--progress must be at least 0")
+
+    return options
+
+
+
+if __name__ == "__main__":
+    sys.stderr.write("command line: %s\n" % " ".join(sys.argv))
+    sys.stderr.write("python version: %s\n" % sys.version)
+    sys.stderr.write("pysam version: %s\n" % pysam.__version__)
+
+    util.check_pysam_version()
+
+    options = parse_options()
+
+    main(options.input_bam, options.output_bam,
+         paired_end=options.paired_end, seed=options.seed,
+         threads=options.threads, metrics_filename=options.metrics,
+         progress_interval=options.progress)
@@ -1,4 +1,6 @@
-import random
+import heapq
+import hashlib
+import struct
 import pysam
 import os
 import sys
@@ -7,6 +9,10 @@ import argparse
 import util
 
 
+# default seed used to choose which duplicate read to keep
+SEED_DEFAULT = 0
+
+
 class ReadStats(object):
 
     def __init__(self):        
@@ -37,10 +43,30 @@ class ReadStats(object):
         
         # number of read pairs kept
         self.keep_pair = 0
+
+        # reads evicted from keep cache because mate was not seen
+        # by the position that it was expected at
+        self.evict_keep = 0
+
+        # reads evicted from discard cache because mate was not seen
+        # by the position that it was expected at
+        self.evict_discard = 0
+
+        # maximum number of reads held in keep and discard caches
+        self.max_cache = 0
+
+
+    def add(self, other):
+        """Adds counts from another ReadStats object to this one"""
+        for name, val in vars(other).items():
+            if name == "max_cache":
+                self.max_cache = max(self.max_cache, val)
+            else:
+                setattr(self, name, getattr(self, name) + val)
         
 
     def write(self, file_handle):
-        sys.stderr.write("DISCARD reads:\n"
+        file_handle.write("DISCARD reads:\n"
                          "  unmapped: %d\n"
                          "  mate unmapped: %d\n"
                          "  improper pair: %d\n"
@@ -50,22 +76,59 @@ class ReadStats(object):
                          "  not paired: %d\n"
                          "  duplicate pairs: %d\n"
                          "KEEP reads:\n"
-                         "  pairs: %d\n"  %
+                         "  pairs: %d\n"
+                         "CACHE reads:\n"
+                         "  evicted from keep cache (mate missing): %d\n"
+                         "  evicted from discard cache (mate missing): %d\n"
+                         "  max cached reads: %d\n" %
                          (self.discard_unmapped,
-                          self.discard_improper_pair,
+                          self.discard_mate_unmapped,
                           self.discard_improper_pair,
                           self.discard_different_chromosome,
                           self.discard_secondary,
                           self.discard_missing_pair,
                           self.discard_single,
                           self.discard_dup,
-                          self.keep_pair))
+                          self.keep_pair,
+                          self.evict_keep,
+                          self.evict_discard,
+                          self.max_cache))
         
 
                 
 
 
-def main(input_bam, output_bam):
+def get_name_hash(qname, seed=SEED_DEFAULT):
+    """
+    Returns a 64-bit integer hash of a read name, keyed on seed. Unlike
+    python's builtin hash() the value is the same in every process and
+    every run, so the duplicate read that is kept does not depend on
+    the order that reads are processed in.
+    """
+    h = hashlib.blake2b(qname.encode("utf-8"), digest_size=8,
+                        key=struct.pack("<q", seed))
+    return int.from_bytes(h.digest(), "little")
+
+
+
+def choose_read(read_list, seed=SEED_DEFAULT):
+    """
+    Removes and returns the read to keep from a list of duplicate
+    reads. This is the read with the lowest hash of its name, which is
+    independent of read scores and alleles, so the choice is unbiased.
+    """
+    if len(read_list) > 1:
+        # sort is stable, so reads from the same pair (which have
+        # the same hash) stay in input order
+        read_list.sort(key=lambda r: get_name_hash(r.qname, seed))
+    return read_list.pop(0)
+
+
+
+def main(input_bam, output_bam, seed=SEED_DEFAULT, metrics_filename=None,
+         progress_interval=0):
+    metrics = util.Metrics(progress_interval)
+
     if input_bam.endswith(".sam") or input_bam.endswith("sam.gz"):
         infile = pysam.Samfile(input_bam, "r")
     else:
@@ -81,25 +144,60 @@ def main(input_bam, output_bam):
     else:
         raise ValueError("name of output file must end with .bam or .sam")
 
-    filter_reads(infile, outfile)
+    read_stats = filter_reads(infile, outfile, seed=seed, metrics=metrics)
 
     infile.close()
     outfile.close()
 
+    read_stats.write(sys.stderr)
+
+    if metrics_filename:
+        metrics.finish()
+        metrics.write(metrics_filename)
+
+
+
+def evict_reads(cur_pos, evict_heap, keep_cache, discard_cache,
+                read_stats):
+    """
+    Removes reads from the keep and discard caches whose mates were
+    expected at a position before cur_pos (or anywhere, if cur_pos is
+    None). Input reads are sorted, so these mates will never be
+    seen. Returns the number of evicted reads.
+    """
+    n_evict = 0
+    while evict_heap and (cur_pos is None or evict_heap[0][0] < cur_pos):
+        mpos, qname = heapq.heappop(evict_heap)
+
+        # heap entries are not removed when pairs are completed, so
+        # check that the read is still cached (with the same mate
+        # position) before evicting it
+        if qname in keep_cache and \
+           keep_cache[qname].next_reference_start == mpos:
+            del keep_cache[qname]
+            read_stats.evict_keep += 1
+            n_evict += 1
+        elif discard_cache.get(qname) == mpos:
+            del discard_cache[qname]
+            read_stats.evict_discard += 1
+            n_evict += 1
+
+    read_stats.discard_missing_pair += n_evict
+    return n_evict
+
 
 
 def update_read_cache(cur_by_mpos, keep_cache, discard_cache,
-                      read_stats, outfile):
+                      evict_heap, read_stats, outfile, seed=SEED_DEFAULT,
+                      metrics=None):
     for mpos, read_list in list(cur_by_mpos.items()):
         # only keep one read from list with same pos,mate_pos pair
-        # shuffle order of reads in list and take first
-        # as 'keep' read
-        random.shuffle(read_list)
-        keep_read = read_list.pop()
+        keep_read = choose_read(read_list, seed)
         if keep_read.qname in keep_cache:
             raise ValueError("read %s is already "
                              "in keep cache" % keep_read.qname)
         keep_cache[keep_read.qname] = keep_read
+        heapq.heappush(evict_heap, (mpos, keep_read.qname))
 
         # rest of reads get discarded
         for discard_read in read_list:
@@ -116,20 +214,52 @@ def update_read_cache(cur_by_mpos, keep_cache, discard_cache,
                 outfile.write(discard_read)
                 del keep_cache[keep_read.qname]
             else:
-                discard_cache[discard_read.qname] = discard_read
+                # only the name and mate position of discarded reads
+                # are needed
+                discard_cache[discard_read.qname] = mpos
+                heapq.heappush(evict_heap, (mpos, discard_read.qname))
+
+    n_cache = len(keep_cache) + len(discard_cache)
+    if n_cache > read_stats.max_cache:
+        read_stats.max_cache = n_cache
+
+    if metrics:
+        metrics.set_max("keep_cache", len(keep_cache))
+        metrics.set_max("discard_cache", len(discard_cache))
 
     
-def filter_reads(infile, outfile):
+def filter_reads(infile, outfile, seed=SEED_DEFAULT, chrom=None,
+                 metrics=None):
+    """
+    Removes duplicate read pairs from the sorted reads in infile,
+    writing the kept pairs to outfile. If chrom is specified, only
+    the reads on that chromosome are fetched from infile (which
+    must be indexed). If metrics is provided, timings, read counts
+    and cache sizes are recorded in this util.Metrics object. Returns
+    a ReadStats object.
+    """
     read_stats = ReadStats()
+
+    if metrics is None:
+        metrics = util.Metrics()
+
+    if chrom is None:
+        reads = infile
+    else:
+        reads = infile.fetch(chrom)
     
     cur_tid = None
     seen_chrom = set([])
 
-    # name of reads to keep
+    # reads to keep, keyed on name
     keep_cache = {}
-    # name of reads to discard
+    # mate positions of reads to discard, keyed on name
     discard_cache = {}
-    cur_by_mpos = {}
+    # heap of (mate position, name) for cached reads, used to evict
+    # reads from the caches once their mates can no longer be seen
+    evict_heap = []
+    # number of reads evicted on current chromosome
+    n_evict = 0
 
     read_count = 0
 
@@ -139,10 +269,21 @@ def filter_reads(infile, outfile):
     # grouped by the mate pair position
     cur_by_mpos = {}
     
-    for read in infile:
+    for read in reads:
+        if read_count >= util.METRICS_READ_INTERVAL:
+            metrics.count("reads", read_count)
+            metrics.progress()
+            read_count = 0
         read_count += 1
 
         if read.is_unmapped:
+           if read.tid == -1 and cur_tid != -1:
+               # reads without coordinates are at end of sorted file
+               if read_count > 1:
+                   metrics.count("reads", read_count - 1)
+                   read_count = 1
+               metrics.start_chrom(util.METRICS_NO_CHROM)
+               cur_tid = -1
            read_stats.discard_unmapped += 1
            continue
         
@@ -150,29 +291,29 @@ def filter_reads(infile, outfile):
             # this is a new chromosome
             cur_chrom = infile.getrname(read.tid)
 
+            if read_count > 1:
+                # reads before this one were on the last chromosome
+                metrics.count("reads", read_count - 1)
+                read_count = 1
+
             if cur_pos:
                 update_read_cache(cur_by_mpos, keep_cache, discard_cache,
-                                  read_stats, outfile)
-            
-            if len(keep_cache) + len(discard_cache) != 0:
+                                  evict_heap, read_stats, outfile, seed,
+                                  metrics)
+
+            # evict all remaining reads from caches
+            n_evict += evict_reads(None, evict_heap, keep_cache,
+                                   discard_cache, read_stats)
+            if n_evict != 0:
                 sys.stderr.write("WARNING: failed to find pairs for %d "
-                                 "reads on this chromosome\n" %
-                                 (len(keep_cache) + len(discard_cache)))
-                read_stats.discard_missing_pair += len(keep_cache) + \
-                                                   len(discard_cache)
-                
-                sys.stderr.write("keep_cache:\n")
-                for r in list(keep_cache.values()):
-                    sys.stderr.write("  %s\n" % r.qname)
-                sys.stderr.write("discard_cache:\n")
-                for r in list(discard_cache.values()):
-                    sys.stderr.write("  %s\n" % r.qname)
+                                 "reads on this chromosome\n" % n_evict)
                                     
             keep_cache = {}
             discard_cache = {}
+            evict_heap = []
+            n_evict = 0
             cur_pos = None
             cur_by_mpos = {}
-            read_count = 0
             
             if cur_chrom in seen_chrom:
                 # sanity check that input bam file is sorted
@@ -182,6 +323,7 @@ def filter_reads(infile, outfile):
             cur_tid = read.tid
             sys.stderr.write("starting chromosome %s\n" % cur_chrom)
             sys.stderr.write("processing reads\n")
+            metrics.start_chrom(cur_chrom)
 
         if read.mate_is_unmapped:
             read_stats.discard_mate_unmapped += 1
@@ -215,7 +357,13 @@ def filter_reads(infile, outfile):
             # we have advanced to a new start position
             # decide which of reads at last position to keep or discard
             update_read_cache(cur_by_mpos, keep_cache, discard_cache,
-                              read_stats, outfile)
+                              evict_heap, read_stats, outfile, seed,
+                              metrics)
+
+            # mates of reads that are expected before the new position
+            # will never be seen, remove them from the caches
+            n_evict += evict_reads(read.pos, evict_heap, keep_cache,
+                                   discard_cache, read_stats)
 
             # create new list of reads at current position
             cur_pos = read.pos
@@ -254,16 +402,21 @@ def filter_reads(infile, outfile):
     # where final read pair on chromosome were overlapping (same start pos)
     if cur_pos:
         update_read_cache(cur_by_mpos, keep_cache, discard_cache,
-                          read_stats, outfile)
-                                 
-    if (len(keep_cache) + len(discard_cache)) != 0:
+                          evict_heap, read_stats, outfile, seed,
+                          metrics)
+
+    if read_count > 0:
+        metrics.count("reads", read_count)
+
+    n_evict += evict_reads(None, evict_heap, keep_cache, discard_cache,
+                           read_stats)
+    if n_evict != 0:
         sys.stderr.write("WARNING: failed to find pairs for %d "
-                         "keep reads and %d discard reads on this "
-                         "chromosome\n" % (len(keep_cache), len(discard_cache)))
-        
-        read_stats.discard_missing_pair += len(keep_cache) + len(discard_cache)
+                         "reads on this chromosome\n" % n_evict)
 
-    read_stats.write(sys.stderr)
+    metrics.end_chrom()
+
+    return read_stats
     
         
 
@@ -283,7 +436,29 @@ if __name__ == "__main__":
                         "be sorted!)")
     parser.add_argument("output_bam", help="output BAM or SAM file (not "
                         "sorted!)")
+    parser.add_argument("--seed", type=int, default=SEED_DEFAULT,
+                        help="seed used to choose which of a set of "
+                        "duplicate read pairs to keep. The same input and "
+                        "seed always give the same output "
+                        "(default=%d)" % SEED_DEFAULT)
+    parser.add_argument("--metrics", default=None, metavar="METRICS_FILE",
+                        help="write metrics, including the time spent "
+                        "on each chromosome, reads per second, the "
+                        "largest sizes of the keep and discard caches and "
+                        "peak memory use, to this file. The file is "
+                        "written in TSV format if its name ends with "
+                        ".tsv, and in JSON format otherwise")
+    parser.add_argument("--progress", type=float, default=0,
+                        metavar="SECONDS",
+                        help="write a progress line to stderr at most "
+                        "every SECONDS seconds (default=0, no progress "
+                        "lines)")
     
     options = parser.parse_args()
+
+    if options.progress < 0:
+        parser.error("--progress must be >= 0")
     
-    main(options.input_bam, options.output_bam)
+    main(options.input_bam, options.output_bam, seed=options.seed,
+         metrics_filename=options.metrics,
+         progress_interval=options.progress)
@@ -0,0 +1,214 @@
+
+
+import argparse
+import gzip
+import numpy as np
+import sys
+
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(
+        description="Compares allele-specific counts from "
+        "get_as_counts.py to the truth table written by "
+        "sim_pe_reads.py, and writes a summary of how many simulated "
+        "alleles were counted and how biased the counts are towards "
+        "the reference allele")
+
+    parser.add_argument("--dedup_overlap", action="store_true",
+                        default=False,
+                        help="count SNPs overlapped by both reads of a "
+                        "simulated pair once (use this when counts "
+                        "were made with get_as_counts.py --dedup_overlap)")
+
+    parser.add_argument("--output", default=None,
+                        help="write a tab-delimited table with the true "
+                        "and observed counts for every SNP to this file")
+
+    parser.add_argument("truth_file",
+                        help="truth table (.npz) written by "
+                        "sim_pe_reads.py --out_truth")
+
+    parser.add_argument("as_counts_file",
+                        help="text output of get_as_counts.py (may be "
+                        "gzipped)")
+
+    return parser.parse_args()
+
+
+
+def get_true_counts(truth, dedup_overlap=False):
+    """Returns arrays with the number of simulated reads that carry
+    the reference and alternate allele of each SNP in the truth
+    table. If dedup_overlap is True, a SNP overlapped by both reads
+    of a pair is only counted once."""
+    n_snp = truth["snp_pos"].shape[0]
+    snp_idx = truth["overlap_snp"]
+    allele = truth["overlap_allele"]
+
+    if dedup_overlap:
+        # both reads of a pair come from the same haplotype, so
+        # keep the first overlap of each SNP in each pair
+        n_overlap = np.diff(truth["pair_snp_offsets"])
+        pair_idx = np.repeat(np.arange(n_overlap.shape[0]), n_overlap)
+        keys = pair_idx * n_snp + snp_idx
+        uniq_idx = np.unique(keys, return_index=True)[1]
+        snp_idx = snp_idx[uniq_idx]
+        allele = allele[uniq_idx]
+
+    ref_counts = np.bincount(snp_idx[allele == 0], minlength=n_snp)
+    alt_counts = np.bincount(snp_idx[allele == 1], minlength=n_snp)
+
+    return ref_counts, alt_counts
+
+
+
+def read_as_counts(filename, truth):
+    """Reads the output of get_as_counts.py and returns arrays with the
+    reference, alternate and other counts of each SNP in the truth
+    table, and the number of counted alleles at SNPs that are not in
+    the truth table"""
+    chrom_names = truth["chrom_names"].tolist()
+    chrom_idx = dict((name, i) for i, name in enumerate(chrom_names))
+    snp_chrom = truth["snp_chrom"]
+    snp_pos = truth["snp_pos"]
+
+    # SNPs are sorted by position within each chromosome
+    chrom_start = np.searchsorted(snp_chrom, np.arange(len(chrom_names)),
+                                  side="left")
+    chrom_end = np.searchsorted(snp_chrom, np.arange(len(chrom_names)),
+                                side="right")
+
+    if filename.endswith(".gz"):
+        f = gzip.open(filename, "rt")
+    else:
+        f = open(filename, "rt")
+
+    chrom_list = []
+    pos_list = []
+    count_list = []
+    for line in f:
+        words = line.split()
+        if words[0] == "CHROM":
+            # header line
+            continue
+        chrom_list.append(chrom_idx.get(words[0], -1))
+        pos_list.append(int(words[1]))
+        count_list.append([int(x) for x in words[5:8]])
+
+    f.close()
+
+    line_chrom = np.array(chrom_list, dtype=np.int64)
+    line_pos = np.array(pos_list, dtype=np.int64)
+    line_counts = np.array(count_list, dtype=np.int64).reshape(-1, 3)
+
+    # find index of SNP in truth table for each line, or -1
+    line_snp = np.full(line_pos.shape[0], -1, dtype=np.int64)
+    for i in range(len(chrom_names)):
+        is_chrom = np.flatnonzero(line_chrom == i)
+        start, end = chrom_start[i], chrom_end[i]
+        idx = start + np.searchsorted(snp_pos[start:end], line_pos[is_chrom])
+        is_found = idx < end
+        is_found[is_found] = snp_pos[idx[is_found]] == line_pos[is_chrom][is_found]
+        line_snp[is_chrom[is_found]] = idx[is_found]
+
+    n_snp = snp_pos.shape[0]
+    is_known = line_snp >= 0
+    counts = np.zeros((n_snp, 3), dtype=np.int64)
+    np.add.at(counts, line_snp[is_known], line_counts[is_known])
+    n_unknown = int(np.sum(line_counts[~is_known]))
+
+    return counts[:, 0], counts[:, 1], counts[:, 2], n_unknown
+
+
+
+def get_ref_fraction(ref_counts, alt_counts):
+    total = np.sum(ref_counts) + np.sum(alt_counts)
+    if total == 0:
+        return float("nan")
+    return float(np.sum(ref_counts)) / total
+
+
+
+def write_summary(out_f, truth, true_ref, true_alt, ref_counts,
+                  alt_counts, oth_counts, n_unknown):
+    is_het = truth["snp_hap1"] != truth["snp_hap2"]
+    n_true = np.sum(true_ref) + np.sum(true_alt)
+    n_counted = np.sum(ref_counts) + np.sum(alt_counts)
+
+    true_frac = get_ref_fraction(true_ref[is_het], true_alt[is_het])
+    counted_frac = get_ref_fraction(ref_counts[is_het], alt_counts[is_het])
+
+    is_covered = (true_ref + true_alt) > 0
+    n_wrong = np.count_nonzero((ref_counts != true_ref) |
+                               (alt_counts != true_alt))
+
+    out_f.write("SNPs in truth table: %d\n"
+                "  heterozygous: %d\n"
+                "  overlapped by simulated reads: %d\n"
+                "  with counts that differ from truth: %d\n"
+                "simulated read pairs: %d\n"
+                "simulated alleles (ref / alt): %d / %d\n"
+                "counted alleles (ref / alt / other): %d / %d / %d\n"
+                "counted alleles at SNPs not in truth table: %d\n"
+                "fraction of simulated alleles counted: %.4f\n"
+                "reference fraction at het SNPs (truth): %.4f\n"
+                "reference fraction at het SNPs (counted): %.4f\n"
+                "reference bias at het SNPs: %.4f\n" %
+                (truth["snp_pos"].shape[0],
+                 np.count_nonzero(is_het),
+                 np.count_nonzero(is_covered),
+                 n_wrong,
+                 truth["pair_id"].shape[0],
+                 np.sum(true_ref), np.sum(true_alt),
+                 np.sum(ref_counts), np.sum(alt_counts), np.sum(oth_counts),
+                 n_unknown,
+                 float(n_counted) / n_true if n_true else float("nan"),
+                 true_frac, counted_frac, counted_frac - true_frac))
+
+
+
+def write_snp_table(filename, truth, true_ref, true_alt, ref_counts,
+                    alt_counts, oth_counts):
+    chrom_names = truth["chrom_names"]
+    columns = [chrom_names[truth["snp_chrom"]].tolist(),
+               truth["snp_pos"].tolist(),
+               truth["snp_ref"].view("S1").astype("U").tolist(),
+               truth["snp_alt"].view("S1").astype("U").tolist(),
+               truth["snp_hap1"].tolist(), truth["snp_hap2"].tolist(),
+               true_ref.tolist(), true_alt.tolist(), ref_counts.tolist(),
+               alt_counts.tolist(), oth_counts.tolist()]
+
+    f = open(filename, "w")
+    f.write("CHROM\tSNP.POS\tREF.ALLELE\tALT.ALLELE\tGENOTYPE\t"
+            "TRUE.REF.COUNT\tTRUE.ALT.COUNT\tREF.COUNT\tALT.COUNT\t"
+            "OTHER.COUNT\n")
+    f.write("".join(map("%s\t%d\t%s\t%s\t%d|%d\t%d\t%d\t%d\t%d\t%d\n".__mod__,
+                        zip(*columns))))
+    f.close()
+
+
+
+def main():
+    options = parse_options()
+
+    truth = np.load(options.truth_file)
+
+    true_ref, true_alt = get_true_counts(truth,
+                                         dedup_overlap=options.dedup_overlap)
+    ref_counts, alt_counts, oth_counts, n_unknown = \
+        read_as_counts(options.as_counts_file, truth)
+
+    write_summary(sys.stdout, truth, true_ref, true_alt, ref_counts,
+                  alt_counts, oth_counts, n_unknown)
+
+    if options.output:
+        write_snp_table(options.output, truth, true_ref, true_alt,
+                        ref_counts, alt_counts, oth_counts)
+
+    truth.close()
+
+
+
+if __name__ == "__main__":
+    main()
@@ -2,13 +2,34 @@
 
 import argparse
 import gzip
+import os
+import shutil
 import numpy as np
-import numpy.random
 import sys
-import string
 
 import tables
 
+# util.py is in the mapping directory, which is the parent directory
+MAPPING_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, MAPPING_DIR)
+
+import util
+
+
+# default seed for random number generator, so that the same
+# reads are simulated each time unless a seed is specified
+SEED_DEFAULT = 0
+
+# number of read pairs that are simulated and written at once
+BATCH_SIZE_DEFAULT = 100000
+
+# gzip compression level of output fastq files (the same as the
+# mapping scripts)
+GZIP_LEVEL_DEFAULT = 6
+
+# number of batches in a row in which no pair fits on the chromosome
+# before simulation of a chromosome is given up
+MAX_EMPTY_BATCHES = 100
 
 
 class Haplotypes(object):
@@ -22,14 +43,16 @@ class Haplotypes(object):
 
         
 
-class ReadCoord(object):
+class ReadCoords(object):
+    """Coordinates of a batch of read pairs (1-based, inclusive).
+    Each attribute is an array with a value for each pair."""
     def __init__(self, chrom_name, left_start, left_end, right_start, right_end):
 
-        if left_start > left_end:
+        if np.any(left_start > left_end):
             raise ValueError("left_start must be <= left_end")
-        if left_start > right_start:
+        if np.any(left_start > right_start):
             raise ValueError("left_start must be <= right_start")
-        if right_start > right_end:
+        if np.any(right_start > right_end):
             raise ValueError("right_start must be <= right_end")
 
         self.chrom_name = chrom_name
@@ -39,22 +62,29 @@ class ReadCoord(object):
         self.right_end = right_end
         
         
+    def __len__(self):
+        return self.left_start.shape[0]
+
+
+    def subset(self, idx):
+        """returns a ReadCoords object with the pairs selected by idx"""
+        return ReadCoords(self.chrom_name, self.left_start[idx],
+                          self.left_end[idx], self.right_start[idx],
+                          self.right_end[idx])
 
-dna_comp = None
 
-def comp(seq_str):
-    """complements the provided DNA sequence and returns it"""
-    global dna_comp
 
-    if dna_comp is None:
-        dna_comp = string.maketrans("ATCGMRWSYKNatcgmrwsykn",
-                                    "TAGCKYWSRMNtagckywsrmn")
-    return seq_str.translate(dna_comp)
+# lookup table used to complement sequences stored as arrays of
+# ASCII codes
+DNA_COMP = np.arange(256, dtype=np.uint8)
+for b1, b2 in zip("ATCGMRWSYKNatcgmrwsykn", "TAGCKYWSRMNtagckywsrmn"):
+    DNA_COMP[ord(b1)] = ord(b2)
 
 
-def revcomp(seq_str):
-    """returns reverse complement of provided DNA sequence"""
-    return comp(seq_str)[::-1]
+def revcomp_array(seqs):
+    """returns reverse complement of each row of a 2D array of
+    ASCII codes"""
+    return DNA_COMP[seqs[:, ::-1]]
 
     
 
@@ -93,17 +123,71 @@ def parse_options():
                         type=float)
 
     parser.add_argument("--chrom", default="chr22",
-                        help="for now just simulate from one chrom"
-                        "in future may simulate uniformly across entire genome...")
+                        help="chromosome to simulate reads from, or a "
+                        "comma-delimited list of chromosomes. Reads are "
+                        "divided between chromosomes in proportion to "
+                        "their number of heterozygous SNPs")
 
     parser.add_argument("--hap_file", required=True,
                         help="path to file containing haplotypes and alleles "
                         "The file should contain 5 columns:\n"
                         "  position RefAllele AltAllele hap1 hap2\n"
-                        "  example: 16050984 C G 1 0")
-
+                        "  example: 16050984 C G 1 0\n"
+                        "If more than one chromosome is simulated, the "
+                        "path must contain {chrom}, which is replaced by "
+                        "the name of each chromosome (e.g. "
+                        "{chrom}.hg19.haplotype.txt.gz)")
+
+    parser.add_argument("--out_truth", default=None,
+                        help="write a truth table, giving the haplotype "
+                        "that each read pair came from and the alleles of "
+                        "the SNPs it overlaps, to this .npz file. The "
+                        "truth table can be compared to the output of "
+                        "get_as_counts.py with score_sim_counts.py")
+
+    parser.add_argument("--threads", default=1, type=int,
+                        help="number of worker processes to use. If "
+                        "greater than 1, chromosomes are simulated in "
+                        "parallel. The output does not depend on the "
+                        "number of threads (default=1)")
+
+    parser.add_argument("--seed", default=SEED_DEFAULT, type=int,
+                        help="seed for random number generator. The "
+                        "same options and seed always give the same "
+                        "reads (default=%d)" % SEED_DEFAULT)
     
-    return parser.parse_args()
+    parser.add_argument("--batch_size", default=BATCH_SIZE_DEFAULT,
+                        type=int,
+                        help="number of read pairs to simulate and write "
+                        "at once (default=%d)" % BATCH_SIZE_DEFAULT)
+
+    parser.add_argument("--compress_level", default=GZIP_LEVEL_DEFAULT,
+                        type=int, choices=range(1, 10),
+                        metavar="{1-9}",
+                        help="gzip compression level used for output "
+                        "files that end with .gz (default=%d)"
+                        % GZIP_LEVEL_DEFAULT)
+
+    options = parser.parse_args()
+
+    if options.read_len < 1:
+        parser.error("--read_len must be at least 1")
+
+    if options.batch_size < 1:
+        parser.error("--batch_size must be at least 1")
+
+    if options.threads < 1:
+        parser.error("--threads must be at least 1")
+
+    options.chroms = options.chrom.split(",")
+    if len(options.chroms) > 1 and "{chrom}" not in options.hap_file:
+        parser.error("--hap_file must contain {chrom} when more than "
+                     "one chromosome is simulated")
+
+    if options.out_truth and not options.out_truth.endswith(".npz"):
+        parser.error("--out_truth must end with .npz")
+
+    return options
 
 
 
@@ -111,9 +195,9 @@ def parse_options():
 
 def read_haps(hap_file):
     if hap_file.endswith(".gz"):
-        f = gzip.open(hap_file)
+        f = gzip.open(hap_file, "rt")
     else:
-        f = open(hap_file)
+        f = open(hap_file, "rt")
 
     pos_list = []
     ref_allele_list = []
@@ -142,11 +226,14 @@ def read_haps(hap_file):
         hap1_list.append(int(words[3]))
         hap2_list.append(int(words[4]))
 
-    pos_array = np.array(pos_list, dtype=np.int32)
-    ref_allele_array = np.array(ref_allele_list, dtype=np.uint8)
-    alt_allele_array = np.array(alt_allele_list, dtype=np.uint8)
-    hap1_array = np.array(hap1_list, dtype=np.uint8)
-    hap2_array = np.array(hap2_list, dtype=np.uint8)
+    # SNPs are sorted by position so that the SNPs overlapping
+    # reads can be found with a binary search
+    order = np.argsort(np.array(pos_list, dtype=np.int32), kind="stable")
+    pos_array = np.array(pos_list, dtype=np.int32)[order]
+    ref_allele_array = np.array(ref_allele_list, dtype=np.uint8)[order]
+    alt_allele_array = np.array(alt_allele_list, dtype=np.uint8)[order]
+    hap1_array = np.array(hap1_list, dtype=np.uint8)[order]
+    hap2_array = np.array(hap2_list, dtype=np.uint8)[order]
 
     haplotypes = Haplotypes(pos_array, ref_allele_array, alt_allele_array,
                             hap1_array, hap2_array)
@@ -158,189 +245,429 @@ def read_haps(hap_file):
 
     
 
-def write_reads(file1, file2, read_coord, left_seq, right_seq):
-    """Outputs PE reads to two separate files in fastq format"""
+def get_hap_filename(hap_file, chrom_name):
+    return hap_file.replace("{chrom}", chrom_name)
+
+
+
+def write_reads(file1, file2, rng, read_coords, left_seqs, right_seqs,
+                pair_ids):
+    """Outputs a batch of PE reads to two separate files in fastq
+    format. left_seqs and right_seqs are 2D arrays of ASCII codes
+    with a row for each read. pair_ids are unique numbers for each
+    pair, which are used in the read names. Returns a boolean array
+    that is True for pairs where the left read is read1."""
 
-    if len(right_seq) != len(left_seq):
-        raise ValueError("length of right and left seqs does not match")
+    if left_seqs.shape != right_seqs.shape:
+        raise ValueError("shape of right and left seqs does not match")
     
-    read_len = len(left_seq)
+    n_pair, read_len = left_seqs.shape
         
     qual_str = "h" * read_len
 
-    tile = np.random.randint(32767)
-    
     # use chromosome number as lane number
-    # random identifier as tile
+    # number of pair as tile, so that read names are unique
     # start, end of fragment as x, y pixels
-    base_id = "PE%d:%s:%d:%d:%d#0" % (read_len, read_coord.chrom_name, 
-                                      tile, read_coord.left_start, 
-                                      read_coord.right_end)
+    id_fmt = "PE%d:%s:%%d:%%d:%%d#0" % (read_len, read_coords.chrom_name)
+    ids = list(map(id_fmt.__mod__,
+                   zip(pair_ids.tolist(), read_coords.left_start.tolist(),
+                       read_coords.right_end.tolist())))
+
+    # Make left read "read1" 50 % of time
+    left_is_read1 = rng.integers(2, size=n_pair) == 0
+    seqs1 = np.where(left_is_read1[:, None], left_seqs, right_seqs)
+    seqs2 = np.where(left_is_read1[:, None], right_seqs, left_seqs)
 
     # id1 = base_id + "/1"
     # id2 = base_id + "/2"
-    id1 = id2 = base_id
+    record_fmt = "@%s\n%s\n+\n" + qual_str + "\n"
+    for f, seqs in ((file1, seqs1), (file2, seqs2)):
+        seq_strs = np.ascontiguousarray(seqs).view("S%d" % read_len)
+        f.write("".join(map(record_fmt.__mod__,
+                            zip(ids, seq_strs[:, 0].astype("U").tolist()))))
 
-    # Make left read "read1" 50 % of time
-    if np.random.randint(2) == 0:
-        # make left read read1
-        file1.write("@%s\n%s\n+\n%s\n" % (id1, left_seq, qual_str))
-        file2.write("@%s\n%s\n+\n%s\n" % (id2, right_seq, qual_str))
-    else:
-        file1.write("@%s\n%s\n+\n%s\n" % (id1, right_seq, qual_str))
-        file2.write("@%s\n%s\n+\n%s\n" % (id2, left_seq, qual_str))
+    return left_is_read1
     
 
 
 
 
-def gen_read_coords(options, haps, het_only=True):
-    """generate coordinates for a read pair that overlaps a SNP"""
-    # to make this more efficient, could observer random
-    # vars for many reads at once, rather than single read at a time
-
+def gen_read_coords(rng, n_pair, options, haps, chrom_name, chrom_len,
+                    het_only=True):
+    """generate coordinates for a batch of read pairs that each
+    overlap a SNP. Pairs that would extend past the ends of the
+    chromosome are dropped, so fewer than n_pair pairs may be
+    returned."""
     if het_only:
         # select a heterozygous site to overlap
-        is_het = haps.hap1 != haps.hap2
-        i = numpy.random.randint(np.sum(is_het))
-        snp_pos = haps.pos[is_het][i]
-
-        
-        sys.stderr.write("selected SNP %d %s/%s\n" % 
-                         (snp_pos, chr(haps.ref_allele[i]), chr(haps.alt_allele[i])))
-
-        
+        snp_pos = haps.pos[haps.hap1 != haps.hap2]
     else:
         # select any SNP to overlap
-        i = numpy.random.randint(haps.pos.shape[0])
-        snp_pos = haps.pos[i]
+        snp_pos = haps.pos
 
+    if snp_pos.shape[0] == 0:
+        raise ValueError("there are no SNPs to simulate reads from")
 
-    # at what read position should het site be?
-    snp_read_pos = numpy.random.randint(options.read_len)
+    snp_pos = snp_pos[rng.integers(snp_pos.shape[0], size=n_pair)]
+    snp_pos = snp_pos.astype(np.int64)
+
+    # at what read position should het site be? (1-based, so that
+    # the read always overlaps the SNP)
+    snp_read_pos = rng.integers(1, options.read_len + 1, size=n_pair)
 
     # what should insert size be?
-    insert_size = numpy.random.normal(options.insert_size_mean,
-                                      options.insert_size_sd)
-    insert_size = int(np.rint(insert_size))
+    insert_size = rng.normal(options.insert_size_mean,
+                             options.insert_size_sd, size=n_pair)
+    insert_size = np.rint(insert_size).astype(np.int64)
 
     # insert size cannot be smaller than read size...
-    insert_size = max(options.read_len, insert_size)
+    insert_size = np.maximum(options.read_len, insert_size)
     
     # does left or right read overlap SNP?
-    if numpy.random.randint(2) == 0:
-        # left read overlaps SNP
-        left_start = snp_pos - snp_read_pos + 1
-        left_end = left_start + options.read_len - 1
-        right_end = left_start + insert_size - 1
-        right_start = right_end - options.read_len + 1
-    else:
-        # right read overlaps SNP
-        right_start = snp_pos - snp_read_pos + 1
-        right_end = right_start + options.read_len - 1
-        left_start = right_end - insert_size + 1
-        left_end = left_start + options.read_len - 1
+    left_overlaps = rng.integers(2, size=n_pair) == 0
+
+    # start of read that overlaps SNP
+    snp_read_start = snp_pos - snp_read_pos + 1
+    left_start = np.where(left_overlaps, snp_read_start,
+                          snp_read_start + options.read_len - insert_size)
+    left_end = left_start + options.read_len - 1
+    right_end = left_start + insert_size - 1
+    right_start = right_end - options.read_len + 1
 
-    read_coord = ReadCoord(options.chrom, left_start, left_end, right_start, right_end)
+    in_chrom = (left_start >= 1) & (right_end <= chrom_len)
 
-    return read_coord
+    read_coords = ReadCoords(chrom_name, left_start, left_end,
+                             right_start, right_end)
 
+    return read_coords.subset(in_chrom)
 
 
-def gen_seqs(read_coord, hap1_seq, hap2_seq):
-    """makes the sequence strings for each read, 
-    choosing 1 haplotype at random to obtain sequence from"""
+
+def gen_seqs(rng, read_coords, hap_seqs):
+    """makes the sequences for a batch of read pairs, choosing 1
+    haplotype at random for each pair to obtain sequence from.
+    hap_seqs is a 2D array with the sequence of each haplotype.
+    Returns 2D arrays with the left and right read sequences, and
+    the index of the haplotype used for each pair."""
     # randomly select haplotype
-    if np.random.randint(2) == 0:
-        chrom_seq = hap1_seq
-    else:
-        chrom_seq = hap2_seq
+    hap_idx = rng.integers(2, size=len(read_coords))[:, None]
 
-    # sys.stderr.write("%s-%s %s-%s\n" % (str(read_coord.left_start), 
-    #                                     str(read_coord.left_end),
-    #                                     str(read_coord.right_start),
-    #                                     str(read_coord.right_end)))
+    read_len = read_coords.left_end[0] - read_coords.left_start[0] + 1
+    offsets = np.arange(read_len)
     
-    s = read_coord.left_start - 1
-    e = read_coord.left_end
-    left_read_seq = chrom_seq[s:e]
-    # sys.stderr.write("%s\n%s\n" % (hap1_seq[s:e], hap2_seq[s:e]))
+    left_read_seqs = hap_seqs[hap_idx,
+                              read_coords.left_start[:, None] - 1 + offsets]
+    right_read_seqs = revcomp_array(
+        hap_seqs[hap_idx, read_coords.right_start[:, None] - 1 + offsets])
     
-    s = read_coord.right_start - 1
-    e = read_coord.right_end
-    right_read_seq = revcomp(chrom_seq[s:e])
-    # sys.stderr.write("%s\n%s\n\n" % (hap1_seq[s:e], hap2_seq[s:e]))
-
-    return right_read_seq, left_read_seq
+    return left_read_seqs, right_read_seqs, hap_idx[:, 0]
 
     
     
 
 
-def make_hap_seqs(haps, options):
-    """Makes a chromosome sequence for each haplotype"""
-    seq_h5 = tables.open_file(options.seq)
+def get_snp_overlaps(read_coords, haps, hap_idx, left_is_read1):
+    """Finds the SNPs overlapped by each read in a batch of read
+    pairs. Returns the number of SNP overlaps for each pair, and
+    arrays with the index of the SNP, the read (1 or 2) and the
+    allele (0 for ref, 1 for alt) of each overlap. Overlaps are
+    ordered by pair, and a SNP overlapped by both reads of a pair
+    has an overlap for each read."""
+    # start and end of the left and right read of each pair
+    starts = np.stack([read_coords.left_start, read_coords.right_start],
+                      axis=1).ravel()
+    ends = np.stack([read_coords.left_end, read_coords.right_end],
+                    axis=1).ravel()
+    first = np.searchsorted(haps.pos, starts, side="left")
+    n_overlap = np.searchsorted(haps.pos, ends, side="right") - first
+
+    # index of the SNP for every overlap
+    overlap_start = np.cumsum(n_overlap) - n_overlap
+    snp_idx = np.arange(np.sum(n_overlap)) + \
+        np.repeat(first - overlap_start, n_overlap)
+
+    is_read1 = np.stack([left_is_read1, ~left_is_read1], axis=1).ravel()
+    read_num = np.where(np.repeat(is_read1, n_overlap), 1, 2)
+
+    hap = np.repeat(np.repeat(hap_idx, 2), n_overlap)
+    allele = np.where(hap == 0, haps.hap1[snp_idx], haps.hap2[snp_idx])
+
+    return (n_overlap.reshape(-1, 2).sum(axis=1), snp_idx,
+            read_num.astype(np.uint8), allele.astype(np.uint8))
+
+
+
+def make_hap_seqs(haps, seq_filename, chrom_name):
+    """Makes a chromosome sequence for each haplotype. Returns a 2D
+    array of ASCII codes with a row for each haplotype"""
+    seq_h5 = tables.open_file(seq_filename)
     
-    node_name = "/%s" % options.chrom
+    node_name = "/%s" % chrom_name
     if node_name not in seq_h5:
-        raise ValueError("chromosome %s is not in sequence h5 file" % options.chrom)
+        raise ValueError("chromosome %s is not in sequence h5 file" % chrom_name)
         
-    seq_node = seq_h5.get_node("/%s" % options.chrom)
+    seq_node = seq_h5.get_node("/%s" % chrom_name)
 
-    seq_array1 = seq_node[:]
-    seq_array2 = np.array(seq_node[:])
+    seq_array = seq_node[:].astype(np.uint8)
+    hap_seqs = np.vstack([seq_array, seq_array])
 
     is_alt = (haps.hap1 == 1)
-    seq_array1[haps.pos[is_alt] - 1] = haps.alt_allele[is_alt]
+    hap_seqs[0, haps.pos[is_alt] - 1] = haps.alt_allele[is_alt]
 
     is_alt = (haps.hap2 == 1)    
-    seq_array2[haps.pos[is_alt] - 1] = haps.alt_allele[is_alt]
-    
-
-    seq1 = "".join([chr(x) for x in seq_array1])
-    seq2 = "".join([chr(x) for x in seq_array2])
+    hap_seqs[1, haps.pos[is_alt] - 1] = haps.alt_allele[is_alt]
 
     seq_h5.close()
 
-    return seq1, seq2
+    return hap_seqs
 
 
     
 
 
-def main():
-    options = parse_options()
+def open_fastq(filename, compress_level=GZIP_LEVEL_DEFAULT):
+    if filename.endswith(".gz"):
+        return gzip.open(filename, "wt", compresslevel=compress_level)
+    return open(filename, "w")
+
+
+
+def get_n_pairs(n_reads, weights):
+    """Divides n_reads read pairs between chromosomes in proportion
+    to weights, rounding so that the total is exactly n_reads"""
+    weights = np.asarray(weights, dtype=np.float64)
+    if np.sum(weights) == 0:
+        raise ValueError("there are no SNPs to simulate reads from")
+    expected = n_reads * weights / np.sum(weights)
+    n_pairs = np.floor(expected).astype(np.int64)
+
+    # give remaining pairs to the chromosomes with largest remainders
+    n_extra = n_reads - np.sum(n_pairs)
+    order = np.argsort(n_pairs - expected, kind="stable")
+    n_pairs[order[:n_extra]] += 1
+
+    return n_pairs.tolist()
+
+
+
+def simulate_chrom(options, chrom_name, n_reads, seed_seq,
+                   fastq1_file, fastq2_file):
+    """Simulates n_reads read pairs from a chromosome, writing them
+    to fastq1_file and fastq2_file. seed_seq is the
+    np.random.SeedSequence for this chromosome. Returns a dictionary
+    of truth table arrays for the simulated pairs, with SNP indices
+    relative to the SNPs on this chromosome."""
+    rng = np.random.default_rng(seed_seq)
+
+    sys.stderr.write("%s: reading haplotype information\n" % chrom_name)
+    haplotypes = read_haps(get_hap_filename(options.hap_file, chrom_name))
+
+    sys.stderr.write("%s: making haplotype sequences\n" % chrom_name)
+    hap_seqs = make_hap_seqs(haplotypes, options.seq, chrom_name)
+
+    truth = {"pair_id" : [],
+             "left_start" : [],
+             "right_end" : [],
+             "pair_hap" : [],
+             "left_is_read1" : [],
+             "pair_n_overlap" : [],
+             "overlap_snp" : [],
+             "overlap_read" : [],
+             "overlap_allele" : []}
+
+    chrom_len = hap_seqs.shape[1]
+    if n_reads > 0 and chrom_len < options.read_len:
+        raise ValueError("chromosome %s (%d bp) is shorter than the read "
+                         "length (%d)" % (chrom_name, chrom_len,
+                                          options.read_len))
+
+    sys.stderr.write("%s: simulating reads\n" % chrom_name)
+    n_done = 0
+    n_empty = 0
+    while n_done < n_reads:
+        n_pair = min(options.batch_size, n_reads - n_done)
+
+        # generate coords for read pairs, where one read of each
+        # pair overlaps a SNP
+        read_coords = gen_read_coords(rng, n_pair, options, haplotypes,
+                                      chrom_name, chrom_len)
+        if len(read_coords) == 0:
+            n_empty += 1
+            if n_empty >= MAX_EMPTY_BATCHES:
+                raise ValueError("no read pairs that overlap a SNP fit "
+                                 "on chromosome %s in %d batches: the "
+                                 "fragments may be longer than the "
+                                 "chromosome, or the SNPs may be too "
+                                 "close to its ends" %
+                                 (chrom_name, MAX_EMPTY_BATCHES))
+            continue
+        n_empty = 0
 
-    sys.stderr.write("reading haplotype information\n")
-    haplotypes = read_haps(options.hap_file)
-    
-    sys.stderr.write("making haplotype sequences\n")
-    hap1_seq, hap2_seq = make_hap_seqs(haplotypes, options)
+        # make read pair sequences 
+        left_seqs, right_seqs, hap_idx = gen_seqs(rng, read_coords,
+                                                  hap_seqs)
 
-    if options.out_fastq1.endswith(".gz"):
-        fastq1_file = gzip.open(options.out_fastq1, "w")
-    else:
-        fastq1_file = open(options.out_fastq1, "w")
+        pair_ids = np.arange(n_done, n_done + len(read_coords))
+        left_is_read1 = write_reads(fastq1_file, fastq2_file, rng,
+                                    read_coords, left_seqs, right_seqs,
+                                    pair_ids)
 
-    if options.out_fastq2.endswith(".gz"):
-        fastq2_file = gzip.open(options.out_fastq2, "w")
-    else:
-        fastq2_file = open(options.out_fastq2, "w")
-    
-    
-    sys.stderr.write("simulating reads\n")
-    for i in range(options.n_reads):
-        # generate coords for a read pair, where one read pair overlaps a SNP
-        read_coord = gen_read_coords(options, haplotypes)
+        if options.out_truth:
+            pair_n_overlap, overlap_snp, overlap_read, overlap_allele = \
+                get_snp_overlaps(read_coords, haplotypes, hap_idx,
+                                 left_is_read1)
+            truth["pair_id"].append(pair_ids)
+            truth["left_start"].append(read_coords.left_start)
+            truth["right_end"].append(read_coords.right_end)
+            truth["pair_hap"].append(hap_idx.astype(np.uint8))
+            truth["left_is_read1"].append(left_is_read1)
+            truth["pair_n_overlap"].append(pair_n_overlap)
+            truth["overlap_snp"].append(overlap_snp)
+            truth["overlap_read"].append(overlap_read)
+            truth["overlap_allele"].append(overlap_allele)
 
-        # make read pair sequences 
-        left_seq, right_seq = gen_seqs(read_coord, hap1_seq, hap2_seq)
+        n_done += len(read_coords)
+        sys.stderr.write("%s: %d read pairs\n" % (chrom_name, n_done))
+
+    return dict((name, np.concatenate(arrays) if arrays else np.zeros(0))
+                for name, arrays in truth.items())
+
+
+
+def simulate_chrom_shard(args):
+    """Worker process function that simulates the reads from one
+    chromosome, writing them to shard fastq files and the truth
+    table arrays to a shard .npz file"""
+    options, chrom_name, n_reads, seed_seq, shard_filenames = args
+    shard_fastq1, shard_fastq2, shard_truth = shard_filenames
 
-        write_reads(fastq1_file, fastq2_file, read_coord, left_seq, right_seq)
+    fastq1_file = open_fastq(shard_fastq1, options.compress_level)
+    fastq2_file = open_fastq(shard_fastq2, options.compress_level)
+
+    truth = simulate_chrom(options, chrom_name, n_reads, seed_seq,
+                           fastq1_file, fastq2_file)
 
     fastq1_file.close()
     fastq2_file.close()
 
+    np.savez(shard_truth, **truth)
+
+    return chrom_name
+
+
+
+def concat_files(out_filename, filenames):
+    """Concatenates files into out_filename. Gzipped files can be
+    concatenated because a gzip file may contain several compressed
+    members."""
+    with open(out_filename, "wb") as out_f:
+        for filename in filenames:
+            with open(filename, "rb") as f:
+                shutil.copyfileobj(f, out_f)
+
+
+
+def write_truth(filename, chrom_names, read_len, chrom_haps, chrom_truths):
+    """Writes the truth table to an .npz file. SNP indices are
+    converted to indices into the SNP arrays of all chromosomes,
+    which are also written to the file."""
+    snp_offsets = np.cumsum([0] + [h.pos.shape[0] for h in chrom_haps])
+    n_pairs = [t["pair_id"].shape[0] for t in chrom_truths]
+
+    pair_n_overlap = np.concatenate([t["pair_n_overlap"]
+                                     for t in chrom_truths])
+    pair_snp_offsets = np.zeros(pair_n_overlap.shape[0] + 1, dtype=np.int64)
+    pair_snp_offsets[1:] = np.cumsum(pair_n_overlap)
+
+    def concat(name):
+        return np.concatenate([t[name] for t in chrom_truths])
+
+    np.savez(filename,
+             chrom_names=np.array(chrom_names),
+             read_len=np.array(read_len),
+             snp_chrom=np.repeat(np.arange(len(chrom_names), dtype=np.int32),
+                                 np.diff(snp_offsets)),
+             snp_pos=np.concatenate([h.pos for h in chrom_haps]),
+             snp_ref=np.concatenate([h.ref_allele for h in chrom_haps]),
+             snp_alt=np.concatenate([h.alt_allele for h in chrom_haps]),
+             snp_hap1=np.concatenate([h.hap1 for h in chrom_haps]),
+             snp_hap2=np.concatenate([h.hap2 for h in chrom_haps]),
+             pair_chrom=np.repeat(np.arange(len(chrom_names), dtype=np.int32),
+                                  n_pairs),
+             pair_id=concat("pair_id").astype(np.int64),
+             left_start=concat("left_start").astype(np.int64),
+             right_end=concat("right_end").astype(np.int64),
+             pair_hap=concat("pair_hap").astype(np.uint8),
+             left_is_read1=concat("left_is_read1").astype(bool),
+             pair_snp_offsets=pair_snp_offsets,
+             overlap_snp=np.concatenate(
+                 [t["overlap_snp"].astype(np.int64) + offset
+                  for t, offset in zip(chrom_truths, snp_offsets)]),
+             overlap_read=concat("overlap_read").astype(np.uint8),
+             overlap_allele=concat("overlap_allele").astype(np.uint8))
+
+
+
+def main():
+    options = parse_options()
+
+    sys.stderr.write("reading haplotype information\n")
+    chrom_haps = [read_haps(get_hap_filename(options.hap_file, chrom_name))
+                  for chrom_name in options.chroms]
+
+    # divide reads between chromosomes by number of het SNPs, since
+    # every read pair overlaps a het SNP
+    n_het = [np.count_nonzero(h.hap1 != h.hap2) for h in chrom_haps]
+    n_pairs = get_n_pairs(options.n_reads, n_het)
+
+    # each chromosome has its own stream of random numbers, so that
+    # chromosomes can be simulated in any order
+    seed_seqs = np.random.SeedSequence(options.seed).spawn(len(options.chroms))
+
+    if options.threads > 1:
+        # shard files keep the extension of the output files, so that
+        # they are compressed in the same way
+        shard_filenames = [
+            (util.get_shard_filename(options.out_fastq1, i,
+                                     os.path.splitext(options.out_fastq1)[1]),
+             util.get_shard_filename(options.out_fastq2, i,
+                                     os.path.splitext(options.out_fastq2)[1]),
+             util.get_shard_filename(options.out_fastq1, i, ".npz"))
+            for i in range(len(options.chroms))]
+        shard_args = list(zip([options] * len(options.chroms),
+                              options.chroms, n_pairs, seed_seqs,
+                              shard_filenames))
+
+        with util.removing_files([x for shard in shard_filenames
+                                  for x in shard]):
+            util.run_chrom_workers(simulate_chrom_shard, shard_args,
+                                   options.threads, sizes=n_pairs)
+
+            # merge shards in the order chromosomes were given
+            concat_files(options.out_fastq1, [x[0] for x in shard_filenames])
+            concat_files(options.out_fastq2, [x[1] for x in shard_filenames])
+
+            chrom_truths = []
+            for x in shard_filenames:
+                with np.load(x[2]) as shard:
+                    chrom_truths.append(dict(shard.items()))
+    else:
+        fastq1_file = open_fastq(options.out_fastq1, options.compress_level)
+        fastq2_file = open_fastq(options.out_fastq2, options.compress_level)
+
+        chrom_truths = []
+        for chrom_name, n_pair, seed_seq in zip(options.chroms, n_pairs,
+                                                seed_seqs):
+            chrom_truths.append(simulate_chrom(options, chrom_name, n_pair,
+                                               seed_seq, fastq1_file,
+                                               fastq2_file))
+        fastq1_file.close()
+        fastq2_file.close()
+
+    if options.out_truth:
+        write_truth(options.out_truth, options.chroms, options.read_len,
+                    chrom_haps, chrom_truths)
+
 
     
 
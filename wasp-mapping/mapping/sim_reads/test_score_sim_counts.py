@@ -0,0 +1,64 @@
+import numpy as np
+
+import sim_pe_reads
+import score_sim_counts
+
+
+
+def get_truth():
+    """makes a truth table for two read pairs. The first pair has
+    reads that overlap each other, and both of its reads overlap the
+    SNP at position 25"""
+    pos = np.array([10, 25, 50, 80], dtype=np.int32)
+    haps = sim_pe_reads.Haplotypes(pos,
+                                   np.full(4, ord("A"), dtype=np.uint8),
+                                   np.full(4, ord("G"), dtype=np.uint8),
+                                   np.array([0, 1, 0, 1], dtype=np.uint8),
+                                   np.array([1, 1, 0, 0], dtype=np.uint8))
+
+    read_coords = sim_pe_reads.ReadCoords("chr1",
+                                          np.array([1, 60]),
+                                          np.array([36, 95]),
+                                          np.array([20, 70]),
+                                          np.array([55, 105]))
+    hap_idx = np.array([0, 1])
+    left_is_read1 = np.array([True, False])
+
+    pair_n_overlap, overlap_snp, overlap_read, overlap_allele = \
+        sim_pe_reads.get_snp_overlaps(read_coords, haps, hap_idx,
+                                      left_is_read1)
+
+    pair_snp_offsets = np.zeros(pair_n_overlap.shape[0] + 1, dtype=np.int64)
+    pair_snp_offsets[1:] = np.cumsum(pair_n_overlap)
+
+    return {"snp_pos" : pos,
+            "pair_snp_offsets" : pair_snp_offsets,
+            "overlap_snp" : overlap_snp,
+            "overlap_read" : overlap_read,
+            "overlap_allele" : overlap_allele}
+
+
+
+def test_snp_overlaps():
+    truth = get_truth()
+    assert list(truth["pair_snp_offsets"]) == [0, 4, 6]
+    assert list(truth["overlap_snp"]) == [0, 1, 1, 2, 3, 3]
+    # left read is read 2 of the second pair
+    assert list(truth["overlap_read"]) == [1, 1, 2, 2, 2, 1]
+    # first pair is from haplotype 1, second pair from haplotype 2
+    assert list(truth["overlap_allele"]) == [0, 1, 1, 0, 0, 0]
+
+
+
+def test_true_counts():
+    truth = get_truth()
+
+    ref_counts, alt_counts = score_sim_counts.get_true_counts(truth)
+    assert list(ref_counts) == [1, 0, 1, 2]
+    assert list(alt_counts) == [0, 2, 0, 0]
+
+    # SNPs overlapped by both reads of a pair are counted once
+    ref_counts, alt_counts = \
+        score_sim_counts.get_true_counts(truth, dedup_overlap=True)
+    assert list(ref_counts) == [1, 0, 1, 1]
+    assert list(alt_counts) == [0, 1, 0, 0]
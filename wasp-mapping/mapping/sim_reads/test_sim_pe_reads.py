@@ -0,0 +1,184 @@
+import argparse
+import gzip
+import sys
+
+import numpy as np
+import tables
+
+import sim_pe_reads
+
+
+
+def get_haps(pos, hap1, hap2):
+    n_snp = len(pos)
+    return sim_pe_reads.Haplotypes(np.array(pos, dtype=np.int32),
+                                   np.full(n_snp, ord("A"), dtype=np.uint8),
+                                   np.full(n_snp, ord("G"), dtype=np.uint8),
+                                   np.array(hap1, dtype=np.uint8),
+                                   np.array(hap2, dtype=np.uint8))
+
+
+
+class TestGenReadCoords:
+
+    def get_options(self):
+        return argparse.Namespace(read_len=36, insert_size_mean=100.0,
+                                  insert_size_sd=50.0)
+
+
+    def test_overlaps_snp(self):
+        """Test that every simulated pair overlaps the het SNP and
+        that the coordinates of the reads are consistent"""
+        options = self.get_options()
+        chrom_len = 1000
+        # only the SNP at 500 is heterozygous
+        haps = get_haps([100, 500, 900], [0, 0, 1], [0, 1, 1])
+
+        rng = np.random.default_rng(0)
+        coords = sim_pe_reads.gen_read_coords(rng, 2000, options, haps,
+                                              "chr1", chrom_len)
+        assert len(coords) == 2000
+
+        read_len = options.read_len
+        assert np.all(coords.left_end - coords.left_start + 1 == read_len)
+        assert np.all(coords.right_end - coords.right_start + 1 == read_len)
+        assert np.all(coords.left_start <= coords.right_start)
+        assert np.all(coords.left_start >= 1)
+        assert np.all(coords.right_end <= chrom_len)
+
+        left_overlaps = (coords.left_start <= 500) & (coords.left_end >= 500)
+        right_overlaps = (coords.right_start <= 500) & \
+            (coords.right_end >= 500)
+        assert np.all(left_overlaps | right_overlaps)
+
+        # SNP can be at the first or last position of a read
+        assert np.any(coords.left_start == 500)
+        assert np.any(coords.left_end == 500)
+        assert np.any(coords.right_start == 500)
+        assert np.any(coords.right_end == 500)
+
+
+    def test_chrom_ends(self):
+        """Test that pairs that would extend past the ends of the
+        chromosome are dropped"""
+        options = self.get_options()
+        chrom_len = 120
+        haps = get_haps([10, 110], [0, 1], [1, 0])
+
+        rng = np.random.default_rng(0)
+        coords = sim_pe_reads.gen_read_coords(rng, 1000, options, haps,
+                                              "chr1", chrom_len)
+        assert 0 < len(coords) < 1000
+        assert np.all(coords.left_start >= 1)
+        assert np.all(coords.right_end <= chrom_len)
+        assert np.all(coords.right_start >= coords.left_start)
+
+
+    def test_no_snps(self):
+        options = self.get_options()
+        haps = get_haps([100, 500], [0, 1], [0, 1])
+        rng = np.random.default_rng(0)
+        try:
+            sim_pe_reads.gen_read_coords(rng, 10, options, haps, "chr1", 1000)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("expected ValueError when there are no "
+                                 "het SNPs")
+
+
+
+class TestGetNPairs:
+
+    def test_totals(self):
+        """Test that pairs are divided in proportion to weights and
+        add up to the number of reads"""
+        assert sim_pe_reads.get_n_pairs(10, [5, 3, 2]) == [5, 3, 2]
+        assert sim_pe_reads.get_n_pairs(100, [1, 0, 3]) == [25, 0, 75]
+        for n_reads in range(20):
+            assert sum(sim_pe_reads.get_n_pairs(n_reads, [3, 1, 7])) == \
+                n_reads
+
+
+    def test_remainders(self):
+        """Test that extra pairs go to the largest remainders"""
+        # expected numbers are 1.25, 1.25, 2.5
+        assert sim_pe_reads.get_n_pairs(5, [1, 1, 2]) == [1, 1, 3]
+        # expected numbers are 0.7, 1.4, 2.9
+        assert sim_pe_reads.get_n_pairs(5, [7, 14, 29]) == [1, 1, 3]
+        # ties go to the first chromosome
+        assert sim_pe_reads.get_n_pairs(10, [1, 1, 1]) == [4, 3, 3]
+
+
+    def test_no_snps(self):
+        try:
+            sim_pe_reads.get_n_pairs(10, [0, 0])
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("expected ValueError when there are no "
+                                 "het SNPs")
+
+
+
+class TestThreads:
+
+    def write_inputs(self, tmp_path):
+        """writes a sequence h5 file and haplotype files for two 
+        chromosomes, and returns their paths"""
+        rng = np.random.default_rng(1)
+        seq_filename = str(tmp_path / "seq.h5")
+        seq_h5 = tables.open_file(seq_filename, "w")
+        for chrom_name, chrom_len in (("chr1", 3000), ("chr2", 2000)):
+            seq = np.frombuffer(b"ACGT", dtype=np.uint8)[
+                rng.integers(4, size=chrom_len)]
+            seq_h5.create_array("/", chrom_name, seq)
+
+            hap_filename = tmp_path / ("%s.haps.txt" % chrom_name)
+            with open(hap_filename, "w") as f:
+                for pos in range(100, chrom_len - 100, 150):
+                    f.write("%d %s T %d %d\n" % (pos, chr(seq[pos - 1]),
+                                                 (pos // 150) % 2,
+                                                 (pos // 300) % 2))
+        seq_h5.close()
+
+        return seq_filename, str(tmp_path / "{chrom}.haps.txt")
+
+
+    def run_sim(self, monkeypatch, tmp_path, seq_filename, hap_file,
+                prefix, threads):
+        out_files = [str(tmp_path / (prefix + x))
+                     for x in ("_1.fq.gz", "_2.fq.gz", ".truth.npz")]
+        monkeypatch.setattr(sys, "argv",
+                            ["sim_pe_reads.py", "--seq", seq_filename,
+                             "--n_reads", "500", "--hap_file", hap_file,
+                             "--chrom", "chr1,chr2",
+                             "--out_fastq1", out_files[0],
+                             "--out_fastq2", out_files[1],
+                             "--out_truth", out_files[2],
+                             "--batch_size", "100", "--seed", "7",
+                             "--threads", str(threads)])
+        sim_pe_reads.main()
+        return out_files
+
+
+    def test_threads(self, monkeypatch, tmp_path):
+        """Test that the same reads and truth table are simulated
+        with one and with several worker processes"""
+        seq_filename, hap_file = self.write_inputs(tmp_path)
+        out1 = self.run_sim(monkeypatch, tmp_path, seq_filename, hap_file,
+                            "threads1", 1)
+        out2 = self.run_sim(monkeypatch, tmp_path, seq_filename, hap_file,
+                            "threads2", 2)
+
+        for fastq1, fastq2 in zip(out1[:2], out2[:2]):
+            with gzip.open(fastq1, "rt") as f1, gzip.open(fastq2, "rt") as f2:
+                lines = f1.read()
+                assert lines.count("\n") == 500 * 4
+                assert lines == f2.read()
+
+        with np.load(out1[2]) as truth1, np.load(out2[2]) as truth2:
+            assert sorted(truth1.files) == sorted(truth2.files)
+            for name in truth1.files:
+                assert np.array_equal(truth1[name], truth2[name])
+            assert truth1["pair_id"].shape[0] == 500
@@ -1,15 +1,53 @@
 import sys
+import os
 import numpy as np
 import gzip
 import pysam
 import operator
+import hashlib
+import json
+import shutil
 
 import util
 
 
 NUCLEOTIDES = {b'A', b'C', b'T', b'G'}
+NUCLEOTIDE_ARRAY = np.array(sorted(NUCLEOTIDES), dtype="|S1")
 SNP_UNDEF = -1
 
+# kinds of variants in SNP table (see SNPTable.classify_variants)
+VARIANT_SNP = 0        # single-nucleotide polymorphism
+VARIANT_INDEL_1BP = 1  # 1bp insertion or deletion
+VARIANT_INDEL = 2      # longer indel (or other multi-base variant)
+VARIANT_MALFORMED = 3  # alleles with unexpected characters
+
+# types of index used to lookup SNPs by position (see SNPTable)
+SNP_INDEX_AUTO = "auto"
+SNP_INDEX_DENSE = "dense"
+SNP_INDEX_SPARSE = "sparse"
+SNP_INDEX_TYPES = [SNP_INDEX_AUTO, SNP_INDEX_DENSE, SNP_INDEX_SPARSE]
+
+# when index type is 'auto', a sparse index is used for chromosomes
+# with fewer SNPs than this per base. A sparse index uses 12 bytes per
+# SNP vs 4 bytes per base for a dense index, and lookups are faster
+# unless nearly every position has a SNP
+SPARSE_INDEX_MAX_DENSITY = 0.3
+
+# number of positions to read from HDF5 SNP index at once when
+# converting it to a sparse index
+SPARSE_INDEX_CHUNK_SIZE = 1000000
+
+# approximate number of bytes of haplotype matrix to read from HDF5
+# file at once when filtering SNPs by sample
+HAP_CHUNK_BYTES = 64*1024*1024
+
+# version of SNP cache format, this should be incremented whenever
+# the format changes or the way that SNP tables are built changes
+SNP_CACHE_VERSION = 1
+
+# number of reads to look up overlapping SNPs for at once
+READ_BLOCK_SIZE = 10000
+
 
 # codes for CIGAR string
 BAM_CMATCH     = 0   # M - match/mismatch to ref M
@@ -22,8 +60,80 @@ BAM_CPAD       = 6   # P - padding (silent deletion from padded reference)
 BAM_CEQUAL     = 7   # = - sequence match
 BAM_CDIFF      = 8   # X - sequence mismatch
 
+# lookup tables, indexed by CIGAR code, indicating whether an
+# operation consumes bases of the read / genome and whether it
+# aligns read bases to genome bases
+CIGAR_CONSUMES_READ = np.array([1, 1, 0, 0, 1, 0, 0, 1, 1], dtype=bool)
+CIGAR_CONSUMES_GENOME = np.array([1, 0, 1, 1, 0, 0, 0, 1, 1], dtype=bool)
+CIGAR_IS_MATCH = np.array([1, 0, 0, 0, 0, 0, 0, 1, 1], dtype=bool)
+
+
+def get_cigar_arrays(reads):
+    """Returns arrays describing the alignment of each of the provided
+    reads, in the form expected by SNPTable.get_overlapping_snps_batch():
+    [1] start position of each read in genome (0-based, like read.pos),
+    [2] CIGAR operation codes of all reads (concatenated),
+    [3] CIGAR operation lengths of all reads (concatenated),
+    [4] number of CIGAR operations for each read,
+    [5] query length of each read"""
+    n_read = len(reads)
+    read_starts = np.empty(n_read, dtype=np.int64)
+    n_cigar = np.empty(n_read, dtype=np.int64)
+    query_lens = np.empty(n_read, dtype=np.int64)
+    cigar_list = []
+
+    for i in range(n_read):
+        read = reads[i]
+        cigar = read.cigartuples
+        if cigar is None:
+            cigar = []
+        read_starts[i] = read.reference_start
+        n_cigar[i] = len(cigar)
+        query_lens[i] = read.query_length
+        cigar_list.extend(cigar)
+
+    if len(cigar_list) > 0:
+        cigar_array = np.array(cigar_list, dtype=np.int64)
+        cigar_ops = cigar_array[:, 0]
+        cigar_lens = cigar_array[:, 1]
+    else:
+        cigar_ops = np.array([], dtype=np.int64)
+        cigar_lens = np.array([], dtype=np.int64)
+
+    return read_starts, cigar_ops, cigar_lens, n_cigar, query_lens
+
+
+
+def iter_read_blocks(reads, block_size=READ_BLOCK_SIZE):
+    """Groups reads from an iterator into lists of up to block_size
+    consecutive reads that are all on the same chromosome, so that
+    overlapping SNPs can be looked up for a whole block at once"""
+    block = []
+    cur_tid = None
+    for read in reads:
+        if block and ((read.tid != cur_tid) or (len(block) >= block_size)):
+            yield block
+            block = []
+        cur_tid = read.tid
+        block.append(read)
+    if block:
+        yield block
+
+
+
 class SNPTable(object):
-    def __init__(self):
+    def __init__(self, index_type=SNP_INDEX_DENSE):
+        """index_type is one of SNP_INDEX_TYPES and specifies how SNPs
+        are looked up by position. A dense index uses an array with
+        an element for every position on the chromosome. A sparse index
+        only stores the positions of SNPs and uses much less memory.
+        With SNP_INDEX_AUTO the type of index is chosen for each
+        chromosome based on the density of SNPs."""
+        if index_type not in SNP_INDEX_TYPES:
+            raise ValueError("unknown SNP index type '%s', expected "
+                             "one of %s" % (index_type,
+                                            ", ".join(SNP_INDEX_TYPES)))
+        self.index_type = index_type
         self.clear()
 
     def clear(self):
@@ -35,9 +145,20 @@ class SNPTable(object):
         # snp_index array will be 0 and 1 (and can be used to lookup
         # info for the SNP in snp_pos, snp_allele1, snp_allele2 arrays)
         self.snp_index = np.array([], dtype=np.int32)
+        # when a sparse index is used, snp_index is empty and instead
+        # sparse_pos contains the sorted (0-based) positions of SNPs and
+        # sparse_idx contains the corresponding indices into
+        # snp_pos, snp_allele1, etc. For the example above sparse_pos
+        # would be [1233, 1454] and sparse_idx would be [0, 1]
+        self.is_sparse = False
+        self.index_len = 0
+        self.sparse_pos = np.array([], dtype=np.int64)
+        self.sparse_idx = np.array([], dtype=np.int32)
         self.snp_pos = np.array([], dtype=np.int32)
         self.snp_allele1 = np.array([], dtype="|S10")
         self.snp_allele2 = np.array([], dtype="|S10")
+        # kind of each variant (VARIANT_SNP, VARIANT_INDEL, etc.)
+        self.variant_kind = np.array([], dtype=np.uint8)
         self.haplotypes = None
         self.phase = None
         self.n_snp = 0
@@ -46,8 +167,15 @@ class SNPTable(object):
 
 
     def read_h5(self, snp_tab_h5, snp_index_h5, hap_h5, chrom_name,
-                samples=None):
-        """read in SNPs and indels from HDF5 input files"""
+                samples=None, cache=None):
+        """read in SNPs and indels from HDF5 input files. If an
+        SNPCache is provided, SNPs are read from the cache if they
+        are present in it, and are otherwise added to it"""
+        h5_filenames = [snp_tab_h5.filename, snp_index_h5.filename,
+                        hap_h5.filename]
+        if cache and cache.load(self, chrom_name, h5_filenames, samples,
+                                hap_h5=hap_h5):
+            return
 
         node_name = "/%s" % chrom_name
         phase_node_name = "/phase_%s" % chrom_name
@@ -69,9 +197,9 @@ class SNPTable(object):
                 self.clear()
                 return
 
-        # get numpy array of SNP idices
-        node = snp_index_h5.get_node(node_name)
-        self.snp_index = node[:]
+        # SNP index is read after SNPs, once we know how many
+        # there are
+        index_node = snp_index_h5.get_node(node_name)
 
         # get numpy array of SNP positions
         node = snp_tab_h5.get_node(node_name)
@@ -83,6 +211,8 @@ class SNPTable(object):
         self.haplotypes = hap_h5.get_node(node_name)
         if phase_node_name in hap_h5:
             self.phase = hap_h5.get_node(phase_node_name)
+        else:
+            self.phase = None
         
         if samples:
             # reduce set of SNPs and indels to ones that are
@@ -103,22 +233,15 @@ class SNPTable(object):
             hap_idx = np.empty(samp_idx.shape[0]*2, dtype=int)
             hap_idx[0::2] = samp_idx*2
             hap_idx[1::2] = samp_idx*2 + 1
-            haps = self.haplotypes[:, hap_idx]
-            if self.phase:
-                phase = self.phase[:, samp_idx]
 
-            # count number of ref and non-ref alleles,
-            # ignoring undefined (-1s)
-            nonref_count = np.apply_along_axis(np.sum, 1, haps == 1)
-            ref_count = np.apply_along_axis(np.sum, 1, haps == 0)
-            total_count = nonref_count + ref_count
-            is_polymorphic = (ref_count > 0) & (ref_count < total_count)
+            is_polymorphic, haps, phase = \
+                self.filter_polymorphic(samp_idx, hap_idx)
 
             # reduce to set of polymorphic positions
             sys.stderr.write("reducing %d SNPs on chromosome "
                              "%s to %d positions that are polymorphic in "
                              "sample of %d individuals\n" %
-                             (haps.shape[0], chrom_name, 
+                             (self.n_snp, chrom_name, 
                               np.sum(is_polymorphic), len(samples)))
 
             # make filtered and ordered samples for this chromosome
@@ -127,18 +250,29 @@ class SNPTable(object):
                                   key=operator.itemgetter(1))
             self.samples = [x[0] for x in sorted_samps]
             
-            self.haplotypes = haps[is_polymorphic,]
-            if self.phase:
-                self.phase = phase[is_polymorphic,]
+            self.haplotypes = haps
+            self.phase = phase
             self.snp_pos = self.snp_pos[is_polymorphic]
             self.snp_allele1 = self.snp_allele1[is_polymorphic]
             self.snp_allele2 = self.snp_allele2[is_polymorphic]
             self.n_snp = self.snp_pos.shape[0]
 
             # regenerate index to point to reduced set of polymorphic SNPs
-            self.snp_index[:] = -1                
-            self.snp_index[self.snp_pos-1] = np.arange(self.n_snp,
-                                                       dtype=np.int32)
+            self.make_index(index_node.shape[0])
+        elif self.use_sparse_index(index_node.shape[0]):
+            self.read_h5_sparse_index(index_node)
+        else:
+            # get numpy array of SNP idices
+            self.is_sparse = False
+            self.snp_index = index_node[:]
+            self.index_len = self.snp_index.shape[0]
+
+        self.variant_kind = self.classify_variants(chrom_name)
+
+        if cache:
+            cache.save(self, chrom_name, h5_filenames, samples,
+                       hap_node_name=node_name,
+                       phase_node_name=phase_node_name)
                 
 
     
@@ -213,6 +347,113 @@ class SNPTable(object):
 
         
 
+    def filter_polymorphic(self, samp_idx, hap_idx):
+        """Finds SNPs that are polymorphic in the samples with the
+        provided indices (samp_idx) and haplotype columns (hap_idx).
+        The haplotype (and phase) matrices are read from the HDF5
+        file in chunks of rows, so that the full matrix is never held
+        in memory. Returns a boolean array indicating which SNPs are
+        polymorphic and the haplotype and phase matrices for only
+        those SNPs and samples (phase is None if there is no phase
+        information)."""
+        n_row = self.haplotypes.shape[0]
+        n_col = max(self.haplotypes.shape[1], 1)
+        chunk_size = max(HAP_CHUNK_BYTES // n_col, 1)
+
+        is_polymorphic = np.zeros(n_row, dtype=bool)
+        hap_chunks = []
+        phase_chunks = []
+
+        for start in range(0, n_row, chunk_size):
+            end = min(start + chunk_size, n_row)
+            haps = self.haplotypes[start:end][:, hap_idx]
+
+            # count number of ref and non-ref alleles,
+            # ignoring undefined (-1s)
+            nonref_count = np.count_nonzero(haps == 1, axis=1)
+            ref_count = np.count_nonzero(haps == 0, axis=1)
+            total_count = nonref_count + ref_count
+            is_poly = (ref_count > 0) & (ref_count < total_count)
+            is_polymorphic[start:end] = is_poly
+
+            hap_chunks.append(haps[is_poly])
+            if self.phase is not None:
+                phase = self.phase[start:end][:, samp_idx]
+                phase_chunks.append(phase[is_poly])
+
+        if hap_chunks:
+            haps = np.concatenate(hap_chunks)
+        else:
+            haps = np.empty((0, hap_idx.shape[0]),
+                            dtype=self.haplotypes.dtype)
+
+        if self.phase is None:
+            phase = None
+        elif phase_chunks:
+            phase = np.concatenate(phase_chunks)
+        else:
+            phase = np.empty((0, samp_idx.shape[0]), dtype=self.phase.dtype)
+
+        return is_polymorphic, haps, phase
+
+    
+    def use_sparse_index(self, chrom_len):
+        """returns True if a sparse index should be used for the
+        current set of SNPs on a chromosome of length chrom_len"""
+        if self.index_type == SNP_INDEX_AUTO:
+            return self.n_snp < SPARSE_INDEX_MAX_DENSITY * chrom_len
+        return self.index_type == SNP_INDEX_SPARSE
+    
+    
+    def make_index(self, index_len):
+        """Makes index (dense or sparse) that is used to lookup SNPs 
+        by their position on the chromosome. index_len is the length 
+        of the dense index (i.e. the maximum SNP position). Where there
+        are multiple SNPs at the same position, the index points to 
+        the last one."""
+        self.index_len = index_len
+        if self.use_sparse_index(index_len):
+            self.is_sparse = True
+            self.snp_index = np.array([], dtype=np.int32)
+
+            order = np.argsort(self.snp_pos, kind="stable")
+            pos = self.snp_pos[order].astype(np.int64) - 1
+            is_last = np.ones(pos.shape[0], dtype=bool)
+            is_last[:-1] = pos[1:] != pos[:-1]
+            self.sparse_pos = pos[is_last]
+            self.sparse_idx = order[is_last].astype(np.int32)
+        else:
+            self.is_sparse = False
+            self.snp_index = np.empty(index_len, dtype=np.int32)
+            self.snp_index[:] = SNP_UNDEF
+            self.snp_index[self.snp_pos-1] = np.arange(self.n_snp,
+                                                       dtype=np.int32)
+
+            
+    def read_h5_sparse_index(self, index_node):
+        """Makes sparse index from dense SNP index stored in HDF5 file,
+        reading a chunk of positions at a time so that the whole dense
+        index is never held in memory"""
+        self.is_sparse = True
+        self.index_len = index_node.shape[0]
+        self.snp_index = np.array([], dtype=np.int32)
+        
+        pos_list = []
+        idx_list = []
+        for start in range(0, index_node.shape[0], SPARSE_INDEX_CHUNK_SIZE):
+            chunk = index_node[start:start+SPARSE_INDEX_CHUNK_SIZE]
+            offsets = np.where(chunk != SNP_UNDEF)[0]
+            pos_list.append(offsets.astype(np.int64) + start)
+            idx_list.append(chunk[offsets].astype(np.int32))
+
+        if pos_list:
+            self.sparse_pos = np.concatenate(pos_list)
+            self.sparse_idx = np.concatenate(idx_list)
+        else:
+            self.sparse_pos = np.array([], dtype=np.int64)
+            self.sparse_idx = np.array([], dtype=np.int32)
+            
+    
     def is_snp(self, allele1, allele2):
         """returns True if alleles appear to be 
         single-nucleotide polymorphism, returns false
@@ -235,10 +476,57 @@ class SNPTable(object):
         return False
         
 
+    def classify_variants(self, name):
+        """Classifies every variant in the table as a SNP, 1bp indel,
+        longer indel or malformed variant (with unexpected characters
+        in its alleles), like is_snp but for all variants at
+        once. Returns an array of VARIANT_* codes. A single warning is
+        written for malformed variants, which are treated like indels
+        when reads are checked for overlapping SNPs. name is the
+        chromosome or file that the variants were read from."""
+        len1 = np.char.str_len(self.snp_allele1)
+        len2 = np.char.str_len(self.snp_allele2)
+        is_single = (len1 == 1) & (len2 == 1)
+        is_nuc = (np.isin(self.snp_allele1, NUCLEOTIDE_ARRAY) &
+                  np.isin(self.snp_allele2, NUCLEOTIDE_ARRAY))
+        
+        # deleted allele may be represented with '-' character
+        is_del1 = (self.snp_allele1 == b"-")
+        is_del2 = (self.snp_allele2 == b"-")
+        len1[is_del1] = 0
+        len2[is_del2] = 0
+        
+        is_snp = is_single & is_nuc
+        is_malformed = (is_single & ~is_nuc & ~is_del1 & ~is_del2) | \
+                       ((len1 == 0) & (len2 == 0))
+        is_indel_1bp = ~is_snp & ~is_malformed & (np.abs(len1 - len2) == 1)
+        
+        variant_kind = np.full(self.snp_pos.shape[0], VARIANT_INDEL,
+                               dtype=np.uint8)
+        variant_kind[is_snp] = VARIANT_SNP
+        variant_kind[is_indel_1bp] = VARIANT_INDEL_1BP
+        variant_kind[is_malformed] = VARIANT_MALFORMED
+
+        n_malformed = np.sum(is_malformed)
+        if n_malformed > 0:
+            i = np.where(is_malformed)[0][0]
+            sys.stderr.write("WARNING: %d variants in %s have unexpected "
+                             "characters in alleles (e.g. %s/%s at "
+                             "position %d), treating them as indels\n" %
+                             (n_malformed, name, self.snp_allele1[i],
+                              self.snp_allele2[i], self.snp_pos[i]))
+        
+        return variant_kind
+
 
         
-    def read_file(self, filename):
-        """read in SNPs and indels from text input file"""
+    def read_file(self, filename, cache=None):
+        """read in SNPs and indels from text input file. If an
+        SNPCache is provided, SNPs are read from the cache if they
+        are present in it, and are otherwise added to it"""
+        if cache and cache.load(self, filename, [filename]):
+            return
+        
         try:
             if util.is_gzipped(filename):
                 f = gzip.open(filename, "rt")
@@ -290,18 +578,181 @@ class SNPTable(object):
         self.snp_allele2 = np.array(snp_allele2_list, dtype="|S10")
         del snp_allele2_list
 
+        self.n_snp = self.snp_pos.shape[0]
+
         # make another array that makes it easy to lookup SNPs by their position
         # on the chromosome
-        self.snp_index = np.empty(max_pos, dtype=np.int32)
-        self.snp_index[:] = SNP_UNDEF
-        self.snp_index[self.snp_pos-1] = np.arange(self.snp_pos.shape[0])
-
-        self.n_snp = self.snp_pos.shape[0]
+        self.make_index(max_pos)
+        self.variant_kind = self.classify_variants(filename)
 
         # currently haplotypes can only be read from HDF5 file
         self.haplotypes = None
 
+        if cache:
+            cache.save(self, filename, [filename])
+
     
+    def get_snps_in_intervals(self, starts, lengths):
+        """Finds SNPs and indels that overlap a set of genomic intervals.
+        starts are the (0-based) start positions of the intervals and
+        lengths are their lengths. Returns three arrays with an element
+        for each overlapping SNP / indel: [1] index of the interval
+        it overlaps, [2] offset of the SNP / indel from the start of the
+        interval, [3] index of the SNP / indel. Overlaps are ordered by
+        interval and then by offset."""
+
+        if self.is_sparse:
+            # find range of SNPs that falls within each interval
+            first = np.searchsorted(self.sparse_pos, starts, side="left")
+            last = np.searchsorted(self.sparse_pos, starts + lengths,
+                                   side="left")
+            n_hit = last - first
+
+            interval_idx = np.repeat(np.arange(starts.shape[0]), n_hit)
+            interval_first = np.cumsum(n_hit) - n_hit
+            k = (np.arange(interval_idx.shape[0]) -
+                 interval_first[interval_idx] + first[interval_idx])
+            offsets = self.sparse_pos[k] - starts[interval_idx]
+
+            return interval_idx, offsets, self.sparse_idx[k]
+        
+        # clip intervals to end of index, as there are no SNPs past the end
+        ends = np.minimum(starts + lengths, self.snp_index.shape[0])
+        n_pos = np.maximum(ends - starts, 0)
+
+        # expand intervals to get every genomic position that they cover
+        interval_idx = np.repeat(np.arange(starts.shape[0]), n_pos)
+        interval_first = np.cumsum(n_pos) - n_pos
+        offsets = (np.arange(interval_idx.shape[0]) -
+                   interval_first[interval_idx])
+        s_idx = self.snp_index[starts[interval_idx] + offsets]
+
+        is_hit = (s_idx != SNP_UNDEF)
+
+        return interval_idx[is_hit], offsets[is_hit], s_idx[is_hit]
+
+
+    def get_overlapping_snps_batch(self, read_starts, cigar_ops, cigar_lens,
+                                   n_cigar, query_lens):
+        """Finds the SNPs and indels that overlap a block of reads.
+        The reads are described by arrays (see get_cigar_arrays()):
+        read_starts - start positions of reads in genome (0-based)
+        cigar_ops - CIGAR operation codes for all reads, concatenated
+        cigar_lens - CIGAR operation lengths for all reads, concatenated
+        n_cigar - number of CIGAR operations for each read
+        query_lens - length of each read sequence
+
+        Returns six arrays:
+        [1] offsets into [2] and [3] for each read (of length n_read+1),
+        [2] indices of SNPs that reads overlap,
+        [3] positions in reads that overlap SNPs,
+        [4] offsets into [5] and [6] for each read (of length n_read+1),
+        [5] indices of indels that reads overlap,
+        [6] positions in reads that overlap indels.
+        The SNPs overlapping read i are snp_idx[snp_offsets[i]:snp_offsets[i+1]].
+        First base of read is position 1."""
+        read_starts = np.asarray(read_starts, dtype=np.int64)
+        cigar_ops = np.asarray(cigar_ops, dtype=np.int64)
+        cigar_lens = np.asarray(cigar_lens, dtype=np.int64)
+        n_cigar = np.asarray(n_cigar, dtype=np.int64)
+        query_lens = np.asarray(query_lens, dtype=np.int64)
+        n_read = read_starts.shape[0]
+
+        is_unknown = (cigar_ops < BAM_CMATCH) | (cigar_ops > BAM_CDIFF)
+        if np.any(is_unknown):
+            raise ValueError("unknown CIGAR code %d" %
+                             cigar_ops[is_unknown][0])
+
+        # index of read that each CIGAR operation belongs to, and
+        # index of first CIGAR operation for each read
+        op_read = np.repeat(np.arange(n_read), n_cigar)
+        read_first_op = (np.cumsum(n_cigar) - n_cigar)[op_read]
+
+        # number of bases of read and genome consumed by each operation
+        read_len = np.where(CIGAR_CONSUMES_READ[cigar_ops], cigar_lens, 0)
+        genome_len = np.where(CIGAR_CONSUMES_GENOME[cigar_ops], cigar_lens, 0)
+
+        # number of read / genome bases consumed before each operation
+        # (within its read)
+        read_cum = np.cumsum(read_len) - read_len
+        read_offset = read_cum - read_cum[read_first_op]
+        genome_cum = np.cumsum(genome_len) - genome_len
+        genome_offset = genome_cum - genome_cum[read_first_op]
+
+        total_read_len = np.bincount(op_read, weights=read_len,
+                                     minlength=n_read).astype(np.int64)
+        is_bad_len = total_read_len != query_lens
+        if np.any(is_bad_len):
+            i = np.where(is_bad_len)[0][0]
+            raise ValueError("length of read segments in CIGAR %d "
+                             "does not add up to query length (%d)" %
+                             (total_read_len[i], query_lens[i]))
+
+        # Look for SNPs and indels in match / mismatch segments and
+        # for indels in deleted segments. Read segments that are
+        # inserted or soft-clipped do not exist in the reference and
+        # skipped segments (e.g. introns) are ignored
+        is_del = (cigar_ops == BAM_CDEL)
+        is_lookup = CIGAR_IS_MATCH[cigar_ops] | is_del
+        seg_read = op_read[is_lookup]
+        seg_del = is_del[is_lookup]
+        seg_read_offset = read_offset[is_lookup]
+        seg_starts = read_starts[seg_read] + genome_offset[is_lookup]
+
+        seg_idx, offsets, s_idx = \
+            self.get_snps_in_intervals(seg_starts, cigar_lens[is_lookup])
+
+        hit_read = seg_read[seg_idx]
+        hit_del = seg_del[seg_idx]
+        # for deletions, position in read is where we last left off
+        # in read sequence
+        read_pos = np.where(hit_del, seg_read_offset[seg_idx],
+                            seg_read_offset[seg_idx] + offsets + 1)
+
+        is_snp = (self.variant_kind[s_idx] == VARIANT_SNP)
+        # SNPs in deleted segments are ignored
+        is_snp_hit = is_snp & ~hit_del
+        is_indel_hit = ~is_snp
+
+        snp_offsets = np.zeros(n_read+1, dtype=np.int64)
+        snp_offsets[1:] = np.cumsum(np.bincount(hit_read[is_snp_hit],
+                                                minlength=n_read))
+        indel_offsets = np.zeros(n_read+1, dtype=np.int64)
+        indel_offsets[1:] = np.cumsum(np.bincount(hit_read[is_indel_hit],
+                                                  minlength=n_read))
+
+        return (snp_offsets, s_idx[is_snp_hit], read_pos[is_snp_hit],
+                indel_offsets, s_idx[is_indel_hit], read_pos[is_indel_hit])
+
+
+    def get_overlapping_snps_reads(self, reads):
+        """Like get_overlapping_snps but looks up SNPs and indels
+        for a list of reads at once, which is much faster than
+        calling get_overlapping_snps for each read. Returns a list
+        containing a tuple of four lists for each read (in the form
+        returned by get_overlapping_snps)."""
+        snp_offsets, snp_idx, snp_read_pos, \
+            indel_offsets, indel_idx, indel_read_pos = \
+            self.get_overlapping_snps_batch(*get_cigar_arrays(reads))
+
+        snp_offsets = snp_offsets.tolist()
+        snp_idx = snp_idx.tolist()
+        snp_read_pos = snp_read_pos.tolist()
+        indel_offsets = indel_offsets.tolist()
+        indel_idx = indel_idx.tolist()
+        indel_read_pos = indel_read_pos.tolist()
+
+        overlaps = []
+        for i in range(len(reads)):
+            s_start, s_end = snp_offsets[i], snp_offsets[i+1]
+            i_start, i_end = indel_offsets[i], indel_offsets[i+1]
+            overlaps.append((snp_idx[s_start:s_end],
+                             snp_read_pos[s_start:s_end],
+                             indel_idx[i_start:i_end],
+                             indel_read_pos[i_start:i_end]))
+        return overlaps
+
+
     def get_overlapping_snps(self, read):
         """Returns several lists: 
         [1] indices of SNPs that this read overlaps,
@@ -309,151 +760,209 @@ class SNPTable(object):
         [3] indices for indels that read overlaps, 
         [4] positions in read sequence that overlap indels. 
         First base of read is position 1."""
+        snp_offsets, snp_idx, snp_read_pos, \
+            indel_offsets, indel_idx, indel_read_pos = \
+            self.get_overlapping_snps_batch(*get_cigar_arrays([read]))
         
-        # read.cigar is a list of tuples. Each tuple has two entries. The first
-        # entry specifies the character in the cigar and the second entry
-        # specifies the length of that character. The values are
-        # M       BAM_CMATCH      0
-        # I       BAM_CINS        1
-        # D       BAM_CDEL        2
-        # N       BAM_CREF_SKIP   3
-        # S       BAM_CSOFT_CLIP  4
-        # H       BAM_CHARD_CLIP  5
-        # P       BAM_CPAD        6
-        # =       BAM_CEQUAL      7
-        # X       BAM_CDIFF       8
-        # E.g. (0, 5) means 5 matches, and (4, 2) means a soft clip of 2bp
-        read_start = 0
-        read_end = 0
-        genome_start = read.pos
-        genome_end = read.pos
-
-        # index into combined SNP/indel table for overlapping SNPs
-        snp_idx = []
-        # positions in read of overlapping SNPs
-        snp_read_pos = []
-        # index into combined SNP/indel table for overlapping indels
-        indel_idx = []
-        # positions in read of overlapping SNPs
-        indel_read_pos = []
-        
-        for cigar in read.cigar:
-            op = cigar[0] # CIGAR 'operation'
-            op_len  = cigar[1] # length of operation
-            
-            if (op == BAM_CMATCH) or (op == BAM_CEQUAL) or (op == BAM_CDIFF):
-                # match or mismatch to reference
-                read_start = read_end + 1
-                read_end = read_start + op_len - 1
-                genome_start = genome_end + 1
-                genome_end = genome_start + op_len - 1
-
-                # check for SNP in this genome segment
-                s = genome_start - 1
-                e = min(genome_end, self.snp_index.shape[0])
-                s_idx = self.snp_index[s:e]
-                offsets = np.where(s_idx != SNP_UNDEF)[0]
-                
-                if offsets.shape[0] > 0:
-                    # there are overlapping SNPs and/or indels
-                    
-                    for offset in offsets:
-                        read_pos = offset + read_start
-                        
-                        allele1 = self.snp_allele1[s_idx[offset]]
-                        allele2 = self.snp_allele2[s_idx[offset]]
-                        if self.is_snp(allele1, allele2):
-                            snp_idx.append(s_idx[offset])
-                            snp_read_pos.append(read_pos)
-                        else:
-                            indel_idx.append(s_idx[offset])
-                            indel_read_pos.append(read_pos)
-
-            elif op == BAM_CINS:
-                # insert in read relative to reference
-                read_start = read_end + 1
-                read_end = read_start + op_len - 1
-
-                # Genome sequence does not advance, no possibility
-                # for read to overlap SNP, since these bases do
-                # not exist in reference.
-                # INDELs here should be picked up
-                # by one of flanking match segments
-
-            elif op == BAM_CDEL:
-                # deletion in read relative to reference
-                genome_start = genome_end + 1
-                genome_end   = genome_start + op_len - 1
-
-                # Read sequence does not advance, no possibility
-                # for read to overlap SNP, since these bases do
-                # not exist in read
-
-                # in most cases deletion should be picked up
-                # by flanking match segment, but there could be
-                # nested indels
-
-                s = genome_start - 1
-                e = min(genome_end, self.snp_index.shape[0])
-                
-                # check for INDEL in this genome segment
-                s_idx = self.snp_index[s:e]
-                offsets = np.where(s_idx != SNP_UNDEF)[0]
-                
-                if offsets.shape[0] > 0:
-                    # there are overlapping SNPs and/or indels
-                    for offset in offsets:
-                        read_pos = offset + read_start
-                        allele1 = self.snp_allele1[s_idx[offset]]
-                        allele2 = self.snp_allele2[s_idx[offset]]
-                        if self.is_snp(allele1, allele2):
-                            # ignore SNP
-                            pass
-                        else:
-                            indel_idx.append(s_idx[offset])
-                            # position in read is where we last left off
-                            # in read sequence
-                            indel_read_pos.append(read_end)
-            elif op == BAM_CREF_SKIP:
-                # section of skipped reference, such as intron
-                genome_end = genome_end + op_len
-                genome_start = genome_end
-
-                # do nothing with SNPs/indels in this region
-                # since they are skipped
-                
-            elif op == BAM_CSOFT_CLIP:
-                # this part of read skipped
-                read_start = read_end + 1
-                read_end = read_start + op_len - 1
-
-                # This is like insert, but at end of the read.
-                # Sequence was not considered in alignment.
-                # Usually this is because bases at end of read
-                # were low quality. One option would be to 
-                # pretend soft-clipped part of read was aligned
-                # like match/mismatch and to consider SNPs in this
-                # region. We have decided to not consider SNPs 
-                # because this part of read is not actually aligned.
-
-            elif op == BAM_CHARD_CLIP:
-                # these bases not included in read or genome
-                pass
+        return (snp_idx.tolist(), snp_read_pos.tolist(),
+                indel_idx.tolist(), indel_read_pos.tolist())
+
+
+
+class SNPCache(object):
+    """Stores per-chromosome SNP tables in a cache directory, so that
+    later runs with the same SNP files do not need to parse them
+    again. Each table is stored as a directory of .npy files, which
+    are memory-mapped when they are read back. Tables are keyed by
+    the real path, size and modification time of each input SNP file
+    and the list of samples used to filter the SNPs, so a cached table
+    is not used after an input file is replaced or modified. If
+    checksum is True, input files are identified by an MD5 checksum of
+    their contents instead, which reads every byte of the files but
+    also detects changes that keep the same size and modification
+    time."""
+
+    def __init__(self, cache_dir, checksum=False):
+        self.cache_dir = cache_dir
+        self.checksum = checksum
+        # keys of input files, by filename, so that each file
+        # is only checked once
+        self.file_keys = {}
+
+
+    def get_checksum(self, filename):
+        """returns MD5 checksum of contents of file"""
+        md5 = hashlib.md5()
+        f = open(filename, "rb")
+        while True:
+            block = f.read(1024*1024)
+            if not block:
+                break
+            md5.update(block)
+        f.close()
+        return md5.hexdigest()
 
-            elif op == BAM_CPAD:
-                # like an insert, likely only used in multiple-sequence
-                # alignment where inserts may be of different lengths
-                # in different seqs
-                read_start += read_end + 1
-                read_end = read_start + op_len - 1
 
+    def get_file_key(self, filename):
+        """returns string that identifies the version of an input 
+        file: its real path, size and modification time (in ns), or 
+        the checksum of its contents if self.checksum is True"""
+        if filename not in self.file_keys:
+            if self.checksum:
+                key = "md5:%s" % self.get_checksum(filename)
             else:
-                raise ValueError("unknown CIGAR code %d" % op)
+                st = os.stat(filename)
+                key = "stat:%s:%d:%d" % (os.path.realpath(filename),
+                                         st.st_size, st.st_mtime_ns)
+            self.file_keys[filename] = key
 
-        if read_end != len(read.seq):
-            raise ValueError("length of read segments in CIGAR %d "
-                             "does not add up to query length (%d)" %
-                             (read_end, len(read.seq)))
-        
+        return self.file_keys[filename]
+
+    
+    def get_key(self, filenames, samples=None):
+        """returns key for SNP table read from provided input files
+        and filtered using provided list of samples"""
+        md5 = hashlib.md5()
+        md5.update(("version:%d\n" % SNP_CACHE_VERSION).encode())
+        for filename in filenames:
+            md5.update(("file:%s\n" % self.get_file_key(filename)).encode())
+        if samples:
+            for samp in samples:
+                md5.update(("sample:%s\n" % samp).encode())
+        return md5.hexdigest()
+
+    
+    def get_path(self, chrom_name, filenames, samples=None):
+        """returns path to cache directory for SNP table, or None if
+        one of the input files cannot be read"""
+        try:
+            key = self.get_key(filenames, samples)
+        except IOError:
+            return None
+
+        # text SNP files are identified by filename rather than
+        # chromosome name
+        name = os.path.basename(chrom_name)
+        return os.path.join(self.cache_dir, "v%d" % SNP_CACHE_VERSION,
+                            key, name)
+    
+
+    def load(self, snp_tab, chrom_name, filenames, samples=None, hap_h5=None):
+        """Reads SNP table from cache into snp_tab. Returns True if
+        table was in the cache and False otherwise. hap_h5 is used
+        to get haplotypes that were not filtered by sample, which are
+        not stored in the cache."""
+        path = self.get_path(chrom_name, filenames, samples)
+        if path is None or not os.path.exists(path):
+            return False
+
+        f = open(os.path.join(path, "info.json"), "rt")
+        info = json.load(f)
+        f.close()
+
+        if info['version'] != SNP_CACHE_VERSION:
+            return False
+
+        sys.stderr.write("reading SNPs from cache '%s'\n" % path)
+
+        def load_array(name):
+            return np.load(os.path.join(path, name + ".npy"),
+                           mmap_mode='r')
+
+        snp_tab.clear()
+        snp_tab.snp_pos = load_array("snp_pos")
+        snp_tab.snp_allele1 = load_array("snp_allele1")
+        snp_tab.snp_allele2 = load_array("snp_allele2")
+        snp_tab.variant_kind = load_array("variant_kind")
+        snp_tab.n_snp = snp_tab.snp_pos.shape[0]
+        snp_tab.samples = info['samples']
+
+        # index is always stored in sparse form, but is converted to
+        # a dense index if that is what is wanted
+        snp_tab.index_len = info['index_len']
+        sparse_pos = load_array("sparse_pos")
+        sparse_idx = load_array("sparse_idx")
+        if snp_tab.use_sparse_index(snp_tab.index_len):
+            snp_tab.is_sparse = True
+            snp_tab.sparse_pos = sparse_pos
+            snp_tab.sparse_idx = sparse_idx
+        else:
+            snp_tab.is_sparse = False
+            snp_tab.snp_index = np.empty(snp_tab.index_len, dtype=np.int32)
+            snp_tab.snp_index[:] = SNP_UNDEF
+            snp_tab.snp_index[sparse_pos] = sparse_idx
+
+        if info['has_haplotypes']:
+            snp_tab.haplotypes = load_array("haplotypes")
+            if info['has_phase']:
+                snp_tab.phase = load_array("phase")
+        elif hap_h5 and info['hap_node_name']:
+            snp_tab.haplotypes = hap_h5.get_node(info['hap_node_name'])
+            if info['phase_node_name'] in hap_h5:
+                snp_tab.phase = hap_h5.get_node(info['phase_node_name'])
+
+        return True
+
+    
+    def save(self, snp_tab, chrom_name, filenames, samples=None,
+             hap_node_name=None, phase_node_name=None):
+        """Writes SNP table to the cache. Haplotypes are only stored if
+        they have been filtered by sample (and are therefore not an 
+        HDF5 node), otherwise the name of the HDF5 haplotype node is
+        stored so that they can be retrieved from the HDF5 file."""
+        path = self.get_path(chrom_name, filenames, samples)
+        if path is None or os.path.exists(path):
+            return
+
+        if snp_tab.is_sparse:
+            sparse_pos = snp_tab.sparse_pos
+            sparse_idx = snp_tab.sparse_idx
+        else:
+            sparse_pos = np.where(snp_tab.snp_index != SNP_UNDEF)[0]
+            sparse_idx = snp_tab.snp_index[sparse_pos].astype(np.int32)
+
+        has_haplotypes = isinstance(snp_tab.haplotypes, np.ndarray)
+        has_phase = has_haplotypes and isinstance(snp_tab.phase, np.ndarray)
         
-        return snp_idx, snp_read_pos, indel_idx, indel_read_pos
+        info = {'version' : SNP_CACHE_VERSION,
+                'chrom' : chrom_name,
+                'filenames' : filenames,
+                'samples' : list(snp_tab.samples),
+                'n_snp' : int(snp_tab.n_snp),
+                'index_len' : int(snp_tab.index_len),
+                'has_haplotypes' : has_haplotypes,
+                'has_phase' : has_phase,
+                'hap_node_name' : None if has_haplotypes else hap_node_name,
+                'phase_node_name' : None if has_haplotypes else phase_node_name}
+
+        # write to temporary directory first and then rename it, so
+        # that other processes never see an incomplete table
+        tmp_path = "%s.tmp%d" % (path, os.getpid())
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        arrays = [("snp_pos", snp_tab.snp_pos),
+                  ("snp_allele1", snp_tab.snp_allele1),
+                  ("snp_allele2", snp_tab.snp_allele2),
+                  ("variant_kind", snp_tab.variant_kind),
+                  ("sparse_pos", sparse_pos.astype(np.int64)),
+                  ("sparse_idx", sparse_idx)]
+        if has_haplotypes:
+            arrays.append(("haplotypes", snp_tab.haplotypes))
+        if has_phase:
+            arrays.append(("phase", snp_tab.phase))
+
+        for name, array in arrays:
+            np.save(os.path.join(tmp_path, name + ".npy"), array)
+
+        f = open(os.path.join(tmp_path, "info.json"), "wt")
+        json.dump(info, f, indent=2)
+        f.close()
+
+        try:
+            os.rename(tmp_path, path)
+            sys.stderr.write("wrote SNPs to cache '%s'\n" % path)
+        except OSError:
+            # another process wrote this table first
+            shutil.rmtree(tmp_path)
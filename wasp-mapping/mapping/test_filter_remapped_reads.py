@@ -1,6 +1,7 @@
 import sys
 import os
 import subprocess
+import numpy as np
 
 import filter_remapped_reads
 import util
@@ -107,6 +108,7 @@ remap_sam_lines_single = [
 def write_sam_header(f):
     f.write("@HD	VN:1.0	SO:coordinate\n")
     f.write("@SQ	SN:chr22	LN:51304566\n")
+    f.write("@SQ	SN:chr21	LN:48129895\n")
     f.write('@PG	ID:bowtie2	PN:bowtie2	VN:2.2.6	CL:"/iblm/netapp/home/gmcvicker/anaconda2/bin/bowtie2-align-s --wrapper basic-0 -x /iblm/netapp/data1/external/GRC37/combined/bowtie2_index/hg37 -1 /tmp/16686.inpipe1 -2 /tmp/16686.inpipe2\n')
 
 
@@ -545,3 +547,405 @@ def test_filter_different_CIGAR():
     # verify that filtered reads look correct
     # we expect a read pair with this identifier:
     assert "SRR1658224.34085432" in read_dict
+
+
+
+#
+# test that streaming merge join gives same reads as default mode
+#
+def test_filter_remapped_reads_merge_join():
+    test_dir = "test_data"
+
+    for to_remap_lines, remap_lines in \
+        ((to_remap_sam_lines, remap_sam_lines),
+         (to_remap_sam_lines_single, remap_sam_lines_single)):
+        to_remap_bam_filename = "test_data/test.to.remap.bam"
+        remap_bam_filename = "test_data/test.remap.bam"
+
+        write_to_remap_bam(
+            sam_lines=to_remap_lines,
+            data_dir=test_dir,
+            bam_filename=to_remap_bam_filename
+        )
+        write_remap_bam(
+            sam_lines=remap_lines,
+            data_dir=test_dir,
+            bam_filename=remap_bam_filename
+        )
+
+        filter_remapped_reads.main(
+            to_remap_bam_filename,
+            remap_bam_filename,
+            "test_data/keep.bam"
+        )
+        filter_remapped_reads.main(
+            to_remap_bam_filename,
+            remap_bam_filename,
+            "test_data/keep.merge_join.bam",
+            merge_join=True
+        )
+
+        lines = read_bam("test_data/keep.bam")
+        merge_join_lines = read_bam("test_data/keep.merge_join.bam")
+        assert len(lines) > 0
+        # merge join writes reads in order of read name (with '.'
+        # appended)
+        assert sorted(merge_join_lines) == sorted(lines)
+        assert merge_join_lines == sorted(merge_join_lines,
+                                          key=lambda x: x.split()[0] + ".")
+
+        # temporary sorted files are removed
+        assert not [x for x in os.listdir(test_dir) if ".tmp" in x]
+
+
+
+#
+# test that temporary files are removed when filtering fails
+#
+def test_filter_remapped_reads_merge_join_error():
+    test_dir = "test_data"
+    to_remap_bam_filename = "test_data/test.to.remap.bam"
+    remap_bam_filename = "test_data/test.remap.bam"
+
+    # remapped read name does not have coordinate and read numbers
+    remap_lines = [line.replace("single1.250.1.1", "single1")
+                   for line in remap_sam_lines_single]
+
+    write_to_remap_bam(
+        sam_lines=to_remap_sam_lines_single,
+        data_dir=test_dir,
+        bam_filename=to_remap_bam_filename
+    )
+    write_remap_bam(
+        sam_lines=remap_lines,
+        data_dir=test_dir,
+        bam_filename=remap_bam_filename
+    )
+
+    for keep_bam_filename, options in \
+        (("test_data/keep.merge_join.bam", {"merge_join" : True}),
+         ("test_data/keep.threads.bam", {"threads" : 2})):
+        try:
+            filter_remapped_reads.main(
+                to_remap_bam_filename,
+                remap_bam_filename,
+                keep_bam_filename,
+                **options
+            )
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("expected ValueError for bad read name")
+
+        assert not [x for x in os.listdir(test_dir) if ".tmp" in x]
+
+
+
+#
+# test merge join with read names that are the start of other read
+# names, followed by a character that sorts before '.' (r1-2.250.1.1 
+# sorts before r1.250.1.1, but r1 sorts before r1-2)
+#
+def test_filter_remapped_reads_merge_join_prefix_names():
+    test_dir = "test_data"
+    to_remap_bam_filename = "test_data/test.to.remap.bam"
+    remap_bam_filename = "test_data/test.remap.bam"
+
+    names = ["r1", "r1-2", "r1-3", "r1/x"]
+    to_remap_lines = [line.replace("single1", name)
+                      for name in names
+                      for line in to_remap_sam_lines_single]
+    remap_lines = [line.replace("single1", name)
+                   for name in names
+                   for line in remap_sam_lines_single]
+    # r1-3 does not remap to the correct location
+    remap_lines = [line.replace("r1-3.250.", "r1-3.300.")
+                   for line in remap_lines]
+
+    write_to_remap_bam(
+        sam_lines=to_remap_lines,
+        data_dir=test_dir,
+        bam_filename=to_remap_bam_filename
+    )
+    write_remap_bam(
+        sam_lines=remap_lines,
+        data_dir=test_dir,
+        bam_filename=remap_bam_filename
+    )
+
+    filter_remapped_reads.main(
+        to_remap_bam_filename,
+        remap_bam_filename,
+        "test_data/keep.bam"
+    )
+    filter_remapped_reads.main(
+        to_remap_bam_filename,
+        remap_bam_filename,
+        "test_data/keep.merge_join.bam",
+        merge_join=True
+    )
+
+    lines = read_bam("test_data/keep.bam")
+    merge_join_lines = read_bam("test_data/keep.merge_join.bam")
+    assert sorted(lines) == sorted(merge_join_lines)
+    assert [x.split()[0] for x in merge_join_lines] == ["r1-2", "r1", "r1/x"]
+
+
+
+def test_iter_read_groups():
+    class Read(object):
+        def __init__(self, qname):
+            self.qname = qname
+
+    names = ["r1", "r1-2", "r1-2-1", "r1-3", "r1.5", "r1/x", "r2", "r2-1"]
+    reads = [Read(name) for name in names for i in range(2)]
+    groups = list(filter_remapped_reads.iter_read_groups(reads))
+
+    # groups are in same order as groups of remapped reads
+    assert [name for name, group_reads in groups] == \
+        sorted(names, key=filter_remapped_reads.get_name_key)
+    assert all([len(group_reads) == 2 and
+                group_reads[0].qname == name
+                for name, group_reads in groups])
+
+    # error if reads are not sorted by name
+    try:
+        list(filter_remapped_reads.iter_read_groups(reads[::-1]))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("expected ValueError for unsorted reads")
+
+
+
+#
+# test interning of read names and bookkeeping arrays
+#
+def test_read_name_table():
+    table = filter_remapped_reads.ReadNameTable(capacity=4)
+
+    names = ["read%d" % i for i in range(100)]
+    ids = table.lookup(names[:60] + names[:10], add=True)
+    assert table.n_name == 60
+    assert sorted(set(ids)) == list(range(60))
+    # repeated names get the same ids
+    assert list(ids[60:]) == list(ids[:10])
+
+    # table grows as names are added
+    ids2 = table.lookup(names, add=True)
+    assert table.n_name == 100
+    assert list(ids2[:60]) == list(ids[:60])
+    assert table.keys.shape[0] >= 200
+
+    # missing names have id -1 if not added
+    ids3 = table.lookup(["read5", "missing"])
+    assert list(ids3) == [ids[5], -1]
+    assert table.n_name == 100
+
+
+
+class CollidingNameTable(filter_remapped_reads.ReadNameTable):
+    """name table in which names of the same length have the same hash"""
+    def hash_names(self, names):
+        return np.array([len(name) for name in names], dtype=np.uint64)
+
+
+    
+def test_read_name_table_collisions():
+    table = CollidingNameTable(capacity=4)
+
+    names = ["r%02d" % i for i in range(30)] + ["longer_name"]
+    ids = table.lookup(names[:20] + names[:5] + names[-1:], add=True)
+    assert table.n_name == 21
+    assert sorted(set(ids)) == list(range(21))
+    assert list(ids[20:25]) == list(ids[:5])
+
+    # names with the same hash are still told apart
+    ids2 = table.lookup(names, add=True)
+    assert table.n_name == 31
+    assert len(set(ids2)) == 31
+    assert list(ids2[:20]) == list(ids[:20])
+    assert ids2[-1] == ids[-1]
+
+    ids3 = table.lookup(["r05", "r99", "longer_nam"])
+    assert list(ids3) == [ids[5], -1, -1]
+
+    
+
+def test_remap_counts():
+    counts = filter_remapped_reads.RemapCounts()
+    m = counts.get_cigar_id("30M")
+    s = counts.get_cigar_id("5S25M")
+    i = counts.get_cigar_id("10M1I19M")
+    assert counts.get_cigar_id("30M") == m
+
+    CORRECT = filter_remapped_reads.REMAP_CORRECT
+    WRONG = filter_remapped_reads.REMAP_WRONG
+    SKIP = filter_remapped_reads.REMAP_SKIP
+    
+    counts.add_reads(["a", "a", "b", "c", "c", "d"],
+                     [CORRECT, SKIP, CORRECT, CORRECT, CORRECT, CORRECT],
+                     [2, 2, 1, 2, 2, 2],
+                     [m, s, m, m, s, m])
+    counts.add_reads(["a", "b", "d", "d"],
+                     [CORRECT, WRONG, CORRECT, SKIP],
+                     [2, 1, 2, 2],
+                     [m, -1, s, i])
+
+    ids = counts.names.lookup(["a", "b", "c", "d"])
+    is_keep = counts.get_keep()
+    assert list(is_keep[ids]) == [True, True, True, True]
+    assert list(counts.is_bad[ids]) == [False, True, False, False]
+    
+    assert counts.get_cigar_strings(ids[0]) == ("30M", "5S25M")
+    assert counts.get_cigar_strings(ids[1]) == ("30M",)
+    assert counts.get_cigar_strings(ids[2]) == ("30M", "5S25M")
+    # third CIGAR is counted but not stored
+    assert counts.get_cigar_strings(ids[3]) == ("30M", "5S25M", None)
+
+    # error if read maps correctly more times than expected
+    counts.add_reads(["c", "c"], [CORRECT, CORRECT], [2, 2], [m, m])
+    try:
+        counts.get_keep()
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("expected ValueError for extra reads")
+
+
+
+#
+# test that reads filtered by multiple worker processes are
+# the same as reads filtered by one process
+#
+def test_filter_remapped_reads_threads():
+    test_dir = "test_data"
+    to_remap_bam_filename = "test_data/test.to.remap.bam"
+    remap_bam_filename = "test_data/test.remap.bam"
+
+    write_to_remap_bam(
+        sam_lines=to_remap_sam_lines,
+        data_dir=test_dir,
+        bam_filename=to_remap_bam_filename
+    )
+    write_remap_bam(
+        sam_lines=remap_sam_lines,
+        data_dir=test_dir,
+        bam_filename=remap_bam_filename
+    )
+
+    filter_remapped_reads.main(
+        to_remap_bam_filename,
+        remap_bam_filename,
+        "test_data/keep.bam"
+    )
+    filter_remapped_reads.main(
+        to_remap_bam_filename,
+        remap_bam_filename,
+        "test_data/keep.threads.bam",
+        threads=3
+    )
+
+    lines = read_bam("test_data/keep.bam")
+    assert len(lines) > 0
+    # reads are written in order of chromosome and position, rather
+    # than in the order of the input file
+    assert sorted(read_bam("test_data/keep.threads.bam")) == sorted(lines)
+
+    # temporary files and shard files are removed
+    assert not [x for x in os.listdir(test_dir)
+                if x.startswith("keep.threads.bam.")]
+
+
+
+def move_read(line, chrom, offset=0, prefix=""):
+    """returns SAM line with read name prefixed by prefix, moved to
+    chrom and with its position and mate position shifted by offset"""
+    words = line.split("\t")
+    words[0] = prefix + words[0]
+    words[2] = chrom
+    words[3] = str(int(words[3]) + offset)
+    words[7] = str(int(words[7]) + offset)
+    return "\t".join(words)
+
+
+
+def unmap_read(line, flag):
+    """returns SAM line for an unmapped read with flag"""
+    words = line.split("\t")
+    words[1:9] = [str(flag), "*", "0", "0", "*", "*", "0", "0"]
+    return "\t".join(words)
+
+
+
+#
+# test multiple worker processes with reads on two chromosomes, and
+# reads that have remapped versions on another chromosome or that 
+# are unmapped
+#
+def test_filter_remapped_reads_threads_chroms():
+    test_dir = "test_data"
+    to_remap_bam_filename = "test_data/test.to.remap.bam"
+    remap_bam_filename = "test_data/test.remap.bam"
+
+    pair_lines = [x for x in to_remap_sam_lines
+                  if x.startswith("readpair1\t")]
+    remap_pair_lines = [x for x in remap_sam_lines
+                        if x.startswith("readpair1.")]
+
+    to_remap_lines = to_remap_sam_lines + \
+        [move_read(x, "chr21", prefix="c21_") for x in to_remap_sam_lines] + \
+        [move_read(x, "chr22", prefix=p)
+         for p in ("x_", "u_") for x in pair_lines]
+    remap_lines = remap_sam_lines + \
+        [move_read(x, "chr21", prefix="c21_") for x in remap_sam_lines] + \
+        [move_read(x, "chr22", prefix=p)
+         for p in ("x_", "u_") for x in remap_pair_lines[:2]]
+    # second version of x_readpair1 maps to another chromosome, 
+    # and second version of u_readpair1 does not map
+    remap_lines += [move_read(x, "chr21", offset=1000, prefix="x_")
+                    for x in remap_pair_lines[2:]]
+    remap_lines += [unmap_read("u_" + x, flag)
+                    for x, flag in zip(remap_pair_lines[2:], (77, 141))]
+
+    write_to_remap_bam(
+        sam_lines=to_remap_lines,
+        data_dir=test_dir,
+        bam_filename=to_remap_bam_filename
+    )
+    write_remap_bam(
+        sam_lines=remap_lines,
+        data_dir=test_dir,
+        bam_filename=remap_bam_filename
+    )
+
+    filter_remapped_reads.main(
+        to_remap_bam_filename,
+        remap_bam_filename,
+        "test_data/keep.bam"
+    )
+    filter_remapped_reads.main(
+        to_remap_bam_filename,
+        remap_bam_filename,
+        "test_data/keep.threads.bam",
+        threads=2
+    )
+
+    lines = read_bam("test_data/keep.bam")
+    threads_lines = read_bam("test_data/keep.threads.bam")
+    assert sorted(threads_lines) == sorted(lines)
+
+    names = set(x.split()[0] for x in threads_lines)
+    assert "readpair1" in names
+    assert "c21_readpair1" in names
+    assert "c21_SRR1658224.34085432" in names
+    assert "c21_SRR1658224.31153145" not in names
+    assert "x_readpair1" not in names
+    assert "u_readpair1" not in names
+
+    # chr22 comes first in header
+    chroms = [x.split()[2] for x in threads_lines]
+    assert chroms == sorted(chroms, reverse=True)
+
+    assert not [x for x in os.listdir(test_dir)
+                if x.startswith("keep.threads.bam.")]
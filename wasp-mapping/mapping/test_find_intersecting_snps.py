@@ -2,6 +2,7 @@ import glob
 import gzip
 import os
 import os.path
+import shutil
 import subprocess
 import sys
 import tables
@@ -115,6 +116,7 @@ class Data(object):
             self.fastq2_filename,
             self.sam_filename,
             self.bam_filename,
+            self.bam_filename + ".bai",
             self.bam_sort_filename,
             self.bam_keep_filename,
             self.bam_remap_filename,
@@ -246,6 +248,26 @@ class Data(object):
         
 
         
+    def write_sam(self, sam_lines):
+        """Writes SAM file containing the provided lines directly
+        (rather than creating it by mapping reads)"""
+        chrom_lengths = self.get_chrom_lengths()
+        
+        f = open(self.sam_filename, "w")
+        f.write("@HD\tVN:1.0\tSO:coordinate\n")
+        for chrom_name in self.chrom_names:
+            f.write("@SQ\tSN:%s\tLN:%d\n" %
+                    (chrom_name, chrom_lengths[chrom_name]))
+        for line in sam_lines:
+            f.write(line + "\n")
+        f.close()
+
+
+    def index_bam(self):
+        cmd = 'samtools index %s' % self.bam_filename
+        subprocess.check_call(cmd, shell=True)
+        
+        
     def sam2bam(self):
         cmd = 'samtools view -S -b %s > %s' % \
               (self.sam_filename, self.bam_filename)
@@ -390,9 +412,8 @@ class Data(object):
         
         snp_index_h5 = tables.open_file(self.snp_index_filename, "w")    
 
-        snp_index = 0
-
         chrom_arrays = {}
+        chrom_snp_index = {}
         chrom_lengths = self.get_chrom_lengths()
         
         for snp in self.snp_list:
@@ -406,10 +427,12 @@ class Data(object):
                                                    filters=zlib_filter)
                 carray[:] = -1
                 chrom_arrays[snp[0]] = carray
+                chrom_snp_index[snp[0]] = 0
 
+            # index is into the SNP table for this chromosome
             pos = snp[1]
-            carray[pos-1] = snp_index
-            snp_index += 1
+            carray[pos-1] = chrom_snp_index[snp[0]]
+            chrom_snp_index[snp[0]] += 1
             
         self.write_hap_samples(snp_index_h5)
 
@@ -1186,6 +1209,7 @@ class TestCLI:
             os.remove(out_file)
 
         os.remove("test_output_dir/test.sort.bam")
+        os.remove("test_output_dir/test.sort.bam.bai")
         os.rmdir(out_dir)
 
 
@@ -3924,3 +3948,524 @@ class TestUnphasedHaplotypes:
         
         test_data.cleanup()
 
+
+
+class TestThreads:
+    """tests for processing chromosomes with multiple worker processes"""
+
+    def test_threads_two_chrom(self):
+        """Test that output is the same as for a single process
+        when reads from two chromosomes are processed by separate
+        worker processes"""
+        test_data = Data(genome_seqs=["A" * 60, "T" * 60],
+                         chrom_names=["test_chrom1", "test_chrom2"],
+                         snp_list=[['test_chrom1', 1, "A", "C"],
+                                   ['test_chrom2', 10, "T", "G"]],
+                         haplotypes=[[0, 1, 0, 1],
+                                     [0, 1, 0, 1]])
+        test_data.setup()
+
+        qual = "B" * 30
+        test_data.write_sam(["read1\t0\ttest_chrom1\t1\t30\t30M\t*\t0\t0\t"
+                             + "A" * 30 + "\t" + qual,
+                             "read2\t0\ttest_chrom2\t1\t30\t30M\t*\t0\t0\t"
+                             + "T" * 30 + "\t" + qual,
+                             "read3\t0\ttest_chrom2\t20\t30\t30M\t*\t0\t0\t"
+                             + "T" * 30 + "\t" + qual])
+        test_data.sam2bam()
+        test_data.index_bam()
+
+        find_intersecting_snps.main(test_data.bam_filename,
+                                    is_paired_end=False,
+                                    is_sorted=True,
+                                    snp_tab_filename=test_data.snp_tab_filename,
+                                    snp_index_filename=test_data.snp_index_filename,
+                                    haplotype_filename=test_data.haplotype_filename,
+                                    threads=2)
+
+        #
+        # Verify that fastq contains reads from both chromosomes,
+        # in the order that chromosomes appear in the BAM
+        #
+        with gzip.open(test_data.fastq_remap_filename, "rt") as f:
+            lines = [x.strip() for x in f.readlines()]
+        assert len(lines) == 8
+        assert lines[0] == "@read1.1.1.1"
+        assert lines[1] == "C" + "A" * 29
+        assert lines[4] == "@read2.1.1.1"
+        assert lines[5] == "T" * 9 + "G" + "T" * 20
+
+        #
+        # Verify that to.remap bam contains first two reads and keep
+        # bam contains third read
+        #
+        old_lines = read_bam(test_data.bam_filename)
+        new_lines = read_bam(test_data.bam_remap_filename)
+        assert new_lines == old_lines[0:2]
+
+        new_lines = read_bam(test_data.bam_keep_filename)
+        assert new_lines == old_lines[2:]
+
+        #
+        # Verify that shard files were removed
+        #
+        assert len(glob.glob(test_data.output_prefix + ".shard*")) == 0
+
+        test_data.cleanup()
+
+
+
+class TestCompression:
+    """tests for compression of output files"""
+
+    def test_bam_fastq_compression(self):
+        """Test that keep / to.remap files are BAM and that fastqs 
+        compressed by multiple threads are the same as with one"""
+        test_data = Data(genome_seqs=["A" * 60],
+                         chrom_names=["test_chrom"],
+                         snp_list=[['test_chrom', 1, "A", "C"]],
+                         haplotypes=[[0, 1, 0, 1]])
+        test_data.setup()
+
+        qual = "B" * 30
+        test_data.write_sam(["read1\t0\ttest_chrom\t1\t30\t30M\t*\t0\t0\t"
+                             + "A" * 30 + "\t" + qual,
+                             "read2\t0\ttest_chrom\t20\t30\t30M\t*\t0\t0\t"
+                             + "A" * 30 + "\t" + qual])
+        test_data.sam2bam()
+
+        fastq_lines = []
+        for compress_threads in (1, 3):
+            find_intersecting_snps.main(test_data.bam_filename,
+                                        is_paired_end=False,
+                                        is_sorted=True,
+                                        snp_tab_filename=test_data.snp_tab_filename,
+                                        snp_index_filename=test_data.snp_index_filename,
+                                        haplotype_filename=test_data.haplotype_filename,
+                                        compress_threads=compress_threads,
+                                        compress_level=1)
+
+            with gzip.open(test_data.fastq_remap_filename, "rt") as f:
+                fastq_lines.append(f.readlines())
+
+            for bam_filename in (test_data.bam_keep_filename,
+                                 test_data.bam_remap_filename):
+                with pysam.AlignmentFile(bam_filename) as bam:
+                    assert bam.is_bam
+
+        assert len(fastq_lines[0]) == 4
+        assert fastq_lines[0] == fastq_lines[1]
+
+        old_lines = read_bam(test_data.bam_filename)
+        assert read_bam(test_data.bam_remap_filename) == old_lines[0:1]
+        assert read_bam(test_data.bam_keep_filename) == old_lines[1:]
+
+        test_data.cleanup()
+
+
+    def test_parallel_gzip_writer(self):
+        """Test that text written in many blocks can be read back"""
+        os.makedirs("test_data", exist_ok=True)
+        filename = "test_data/test_parallel.txt.gz"
+
+        lines = ["line %d\n" % i for i in range(1000)]
+        f = find_intersecting_snps.ParallelGzipWriter(filename, threads=3,
+                                                      block_size=100)
+        for line in lines:
+            f.write(line)
+        f.close()
+        with gzip.open(filename, "rt") as f:
+            assert f.readlines() == lines
+
+        # empty file should still be valid gzip
+        find_intersecting_snps.ParallelGzipWriter(filename, threads=2).close()
+        with gzip.open(filename, "rt") as f:
+            assert f.read() == ""
+
+        os.remove(filename)
+
+
+
+class TestSNPCache:
+    """tests for caching SNP tables between runs"""
+
+    def test_cache_haplotypes_samples(self):
+        """Test that output is the same when SNPs and haplotypes
+        filtered by sample are read from the cache"""
+        test_data = Data(genome_seqs=["A" * 60],
+                         chrom_names=["test_chrom"],
+                         snp_list=[['test_chrom', 1, "A", "C"],
+                                   ['test_chrom', 10, "A", "G"],
+                                   ['test_chrom', 20, "A", "T"]],
+                         hap_samples=["samp1", "samp2", "samp3"],
+                         haplotypes=[[0, 1, 0, 0, 0, 0],
+                                     [0, 0, 0, 0, 1, 1],
+                                     [1, 1, 0, 0, 0, 0]])
+        test_data.setup()
+
+        qual = "B" * 30
+        test_data.write_sam(["read1\t0\ttest_chrom\t1\t30\t30M\t*\t0\t0\t"
+                             + "A" * 30 + "\t" + qual])
+        test_data.sam2bam()
+
+        cache_dir = test_data.data_dir + "/snp_cache"
+        if os.path.exists(cache_dir):
+            shutil.rmtree(cache_dir)
+
+        fastqs = []
+        for i in range(2):
+            find_intersecting_snps.main(test_data.bam_filename,
+                                        is_paired_end=False,
+                                        is_sorted=True,
+                                        snp_tab_filename=test_data.snp_tab_filename,
+                                        snp_index_filename=test_data.snp_index_filename,
+                                        haplotype_filename=test_data.haplotype_filename,
+                                        samples=["samp1", "samp2"],
+                                        snp_cache_dir=cache_dir)
+            with gzip.open(test_data.fastq_remap_filename, "rt") as f:
+                fastqs.append([x.strip() for x in f.readlines()])
+
+        # only first and third SNPs are polymorphic in samp1 and samp2,
+        # and the haplotypes that differ from the read are 0/1 and 1/1
+        assert fastqs[0] == fastqs[1]
+        assert len(fastqs[0]) == 8
+        assert sorted([fastqs[0][1], fastqs[0][5]]) == \
+            ["A" * 19 + "T" + "A" * 10, "C" + "A" * 18 + "T" + "A" * 10]
+
+        # filtered haplotypes should be in cache
+        hap_files = glob.glob(cache_dir + "/v*/*/test_chrom/haplotypes.npy")
+        assert len(hap_files) == 1
+        haps = np.load(hap_files[0])
+        assert haps.tolist() == [[0, 1, 0, 0], [1, 1, 0, 0]]
+
+        shutil.rmtree(cache_dir)
+        test_data.cleanup()
+
+
+
+class TestFilterPolymorphic:
+    """tests for reducing SNPs to those polymorphic in samples"""
+
+    def test_read_h5_samples_chunks(self):
+        """Test that SNPs are correctly filtered by sample when
+        haplotypes are read in several chunks"""
+        test_data = Data(genome_seqs=["A" * 60],
+                         chrom_names=["test_chrom"],
+                         snp_list=[['test_chrom', 1, "A", "C"],
+                                   ['test_chrom', 10, "A", "G"],
+                                   ['test_chrom', 20, "A", "T"],
+                                   ['test_chrom', 30, "A", "C"],
+                                   ['test_chrom', 40, "A", "G"]],
+                         hap_samples=["samp1", "samp2", "samp3"],
+                         haplotypes=[[0, 1, 0, 0, 0, 0],
+                                     [0, 0, 0, 0, 1, 1],
+                                     [1, 1, -1, 0, 0, 0],
+                                     [-1, 1, 1, 1, 0, 0],
+                                     [0, -1, 0, 1, 1, 1]],
+                         haplotypes_phase=[[1, 0, 1],
+                                           [1, 1, 0],
+                                           [0, 1, 1],
+                                           [1, 1, 1],
+                                           [0, 0, 1]])
+        test_data.setup()
+
+        snp_tab_h5 = tables.open_file(test_data.snp_tab_filename, "r")
+        snp_index_h5 = tables.open_file(test_data.snp_index_filename, "r")
+        hap_h5 = tables.open_file(test_data.haplotype_filename, "r")
+
+        # read haplotypes 2 SNPs at a time
+        chunk_bytes = find_intersecting_snps.HAP_CHUNK_BYTES
+        find_intersecting_snps.HAP_CHUNK_BYTES = 12
+        try:
+            snp_tab = find_intersecting_snps.SNPTable()
+            snp_tab.read_h5(snp_tab_h5, snp_index_h5, hap_h5, "test_chrom",
+                            samples=["samp1", "samp2"])
+        finally:
+            find_intersecting_snps.HAP_CHUNK_BYTES = chunk_bytes
+            snp_tab_h5.close()
+            snp_index_h5.close()
+            hap_h5.close()
+
+        # second and fourth SNPs are not polymorphic in samp1 and
+        # samp2 (undefined genotypes are ignored)
+        assert snp_tab.n_snp == 3
+        assert snp_tab.samples == ["samp1", "samp2"]
+        assert list(snp_tab.snp_pos) == [1, 20, 40]
+        assert snp_tab.haplotypes.tolist() == [[0, 1, 0, 0],
+                                               [1, 1, -1, 0],
+                                               [0, -1, 0, 1]]
+        assert snp_tab.phase.tolist() == [[1, 0], [0, 1], [0, 0]]
+        assert snp_tab.snp_index[0] == 0
+        assert snp_tab.snp_index[19] == 1
+        assert snp_tab.snp_index[39] == 2
+        assert snp_tab.snp_index[9] == -1
+
+        test_data.cleanup()
+
+
+
+class TestHaplotypeCache:
+    """tests for caching unique haplotypes of sets of SNPs"""
+
+    def test_hap_cache(self):
+        haplotypes = np.array([[0, 1, 0, 0],
+                               [1, 1, 0, 1],
+                               [0, 0, 1, 1]], dtype=np.int8)
+        phase = np.array([[1, 1],
+                          [1, 0],
+                          [1, 1]], dtype=np.int8)
+
+        hap_cache = find_intersecting_snps.HaplotypeCache(max_size=2)
+
+        for snp_idx in ([0, 1], [1, 2], [0, 1], [0, 2], [1, 2], [1, 2]):
+            haps = hap_cache.get_unique_haplotypes(haplotypes, phase, snp_idx)
+            expect = find_intersecting_snps.get_unique_haplotypes(
+                haplotypes, phase, snp_idx)
+            assert haps.tolist() == expect.tolist()
+
+        # [0, 1] is reused once, then [1, 2] is evicted by [0, 2]
+        # and has to be recomputed, after which it is reused
+        assert hap_cache.hits == 2
+        assert hap_cache.misses == 4
+        assert list(hap_cache.cache.keys()) == [(0, 2), (1, 2)]
+
+        hap_cache.clear()
+        assert len(hap_cache.cache) == 0
+        hap_cache.get_unique_haplotypes(haplotypes, phase, [0, 1])
+        assert hap_cache.misses == 5
+
+
+    def test_hap_cache_disabled(self):
+        haplotypes = np.array([[0, 1, 0, 0]], dtype=np.int8)
+
+        hap_cache = find_intersecting_snps.HaplotypeCache(max_size=0)
+        hap_cache.get_unique_haplotypes(haplotypes, None, [0])
+        hap_cache.get_unique_haplotypes(haplotypes, None, [0])
+        assert hap_cache.hits == 0
+        assert hap_cache.misses == 2
+        assert len(hap_cache.cache) == 0
+
+
+
+class TestGenerateReads:
+    """tests for generating reads with alleles substituted at SNPs"""
+
+    def get_seqs(self, seq_array):
+        return [find_intersecting_snps.array_to_seq(s) for s in seq_array]
+
+    
+    def test_generate_reads(self):
+        ref_alleles = np.array([b"A", b"C"])
+        alt_alleles = np.array([b"G", b"T"])
+
+        seqs = find_intersecting_snps.generate_reads("AAACAA", [1, 4],
+                                                     ref_alleles, alt_alleles)
+        assert seqs.dtype == np.uint8
+        assert self.get_seqs(seqs) == ["AAACAA", "AAATAA",
+                                       "GAACAA", "GAATAA"]
+
+        # base in the original read that matches neither allele is kept
+        seqs = find_intersecting_snps.generate_reads("NAACAA", [1],
+                                                     ref_alleles[:1],
+                                                     alt_alleles[:1])
+        assert self.get_seqs(seqs) == ["AAACAA", "GAACAA", "NAACAA"]
+
+
+    def test_generate_haplo_reads(self):
+        haplotypes = np.array([[0, 1, 0, -1],
+                               [1, 1, 0, 0]], dtype=np.int8)
+        phase = np.array([[1, 1],
+                          [1, 1]], dtype=np.int8)
+        ref_alleles = np.array([b"A", b"C"])
+        alt_alleles = np.array([b"G", b"T"])
+
+        # haplotype with undefined genotype is skipped
+        seqs = find_intersecting_snps.generate_haplo_reads(
+            "AAACAA", [0, 1], [1, 4], ref_alleles, alt_alleles,
+            haplotypes, phase)
+        assert seqs.dtype == np.uint8
+        assert self.get_seqs(seqs) == ["AAACAA", "AAATAA", "GAATAA"]
+
+        seqs = find_intersecting_snps.discard_seq(seqs, "AAACAA")
+        assert self.get_seqs(seqs) == ["AAATAA", "GAATAA"]
+        seqs = find_intersecting_snps.add_seq(seqs, "AAACAA")
+        assert self.get_seqs(seqs) == ["AAACAA", "AAATAA", "GAATAA"]
+
+
+    def test_generate_reads_bad_allele(self):
+        try:
+            find_intersecting_snps.generate_reads("AAACAA", [1],
+                                                  np.array([b"AT"]),
+                                                  np.array([b"A"]))
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("expected ValueError for multi-base allele")
+
+
+
+class TestReadPairCombos:
+    """tests for combining generated reads into read pairs"""
+
+    def get_seqs(self, seqs):
+        return [find_intersecting_snps.array_to_seq(s) for s in seqs]
+
+    
+    def get_reads(self, seqs):
+        return np.array([find_intersecting_snps.seq_to_array(s)
+                         for s in seqs])
+
+    
+    def test_shared_snp(self):
+        # SNP 1 is shared by both reads: at position 4 of read1
+        # and position 2 of read2
+        new_reads = [self.get_reads(["AAACAA", "AAAGAA", "TAACAA", "TAAGAA"]),
+                     self.get_reads(["ACAAAA", "AGAAAA"])]
+        pairs = find_intersecting_snps.read_pair_combos(
+            ("AAACAA", "ACAAAA"), new_reads, 64, [[0, 1], [1]],
+            [[1, 4], [2]])
+
+        # only reads with the same allele at the shared SNP are paired
+        assert list(zip(self.get_seqs(pairs[0]), self.get_seqs(pairs[1]))) == \
+            [("AAACAA", "ACAAAA"), ("TAACAA", "ACAAAA"),
+             ("AAAGAA", "AGAAAA"), ("TAAGAA", "AGAAAA")]
+
+
+    def test_no_shared_snps(self):
+        new_reads = [self.get_reads(["AAAA", "TAAA"]),
+                     self.get_reads(["CCCC", "CCCG", "CCCT"])]
+        pairs = find_intersecting_snps.read_pair_combos(
+            ("AAAA", "CCCC"), new_reads, 64, [[0], [1]], [[1], [4]])
+        assert len(pairs[0]) == 6
+
+        # more than max_seqs (+ the original pair) pairs
+        pairs = find_intersecting_snps.read_pair_combos(
+            ("AAAA", "CCCC"), new_reads, 4, [[0], [1]], [[1], [4]])
+        assert pairs is False
+        
+
+    def test_discordant_shared_snp(self):
+        new_reads = [self.get_reads(["AAAA", "AAAT"]),
+                     self.get_reads(["CCCC", "CCCA"])]
+        pairs = find_intersecting_snps.read_pair_combos(
+            ("AAAA", "CCCC"), new_reads, 64, [[0], [0]], [[4], [4]])
+        assert pairs is None
+
+
+
+class TestMateOverlap:
+    """tests for counting SNPs overlapped by both reads of a pair once"""
+
+    def get_read(self, quals):
+        read = pysam.AlignedSegment()
+        read.query_sequence = "A" * len(quals)
+        read.query_qualities = pysam.qualitystring_to_array(quals)
+        return read
+
+
+    def test_mate_overlap_skips(self):
+        read1 = self.get_read("BBBBBB")
+        read2 = self.get_read("BBIBBB")
+
+        # SNP 1 is shared, with a higher quality base in read2.
+        # SNP 2 is shared, with equal qualities
+        skip1, skip2 = find_intersecting_snps.get_mate_overlap_skips(
+            read1, [0, 1, 2], [1, 4, 6], read2, [1, 2, 3], [3, 5, 6])
+        assert skip1 == set([1])
+        assert skip2 == set([2])
+
+
+
+class TestSortBam:
+    """tests for sorting and indexing the input BAM file"""
+
+    def write_bam(self, filename, sort_order, read_pos):
+        header = {"HD": {"VN": "1.0", "SO": sort_order},
+                  "SQ": [{"SN": "test_chrom", "LN": 100}]}
+        if not os.path.exists("test_data"):
+            os.makedirs("test_data")
+        bam = pysam.AlignmentFile(filename, "wb", header=header)
+        for i, pos in enumerate(read_pos):
+            read = pysam.AlignedSegment(bam.header)
+            read.query_name = "read%d" % (i + 1)
+            read.reference_id = 0
+            read.reference_start = pos
+            read.mapping_quality = 30
+            read.cigarstring = "10M"
+            read.query_sequence = "A" * 10
+            read.query_qualities = pysam.qualitystring_to_array("B" * 10)
+            bam.write(read)
+        bam.close()
+
+
+    def test_sort_unsorted_bam(self):
+        """Test that a BAM file whose header does not say it is sorted
+        by coordinate is sorted and indexed, even with is_sorted"""
+        self.write_bam("test_data/unsorted.bam", "unsorted", [50, 10, 30])
+
+        for is_sorted in (False, True):
+            sorted_bam, index_filename = \
+                find_intersecting_snps.get_sorted_bam(
+                    "test_data/unsorted.bam", "test_data/unsorted",
+                    is_sorted=is_sorted, threads=2)
+            assert sorted_bam == "test_data/unsorted.sort.bam"
+            assert index_filename == "test_data/unsorted.sort.bam.bai"
+
+            bam = pysam.AlignmentFile(sorted_bam,
+                                      index_filename=index_filename)
+            assert bam.header.to_dict()["HD"]["SO"] == "coordinate"
+            assert [read.reference_start for read in
+                    bam.fetch("test_chrom")] == [10, 30, 50]
+            bam.close()
+
+            os.remove(sorted_bam)
+            os.remove(index_filename)
+
+        os.remove("test_data/unsorted.bam")
+
+
+    def test_sorted_bam_indexed(self):
+        """Test that a BAM file whose header says it is sorted by
+        coordinate is not sorted again, and is indexed in the
+        output directory"""
+        self.write_bam("test_data/sorted.bam", "coordinate", [10, 30, 50])
+
+        sorted_bam, index_filename = find_intersecting_snps.get_sorted_bam(
+            "test_data/sorted.bam", "test_data/sorted_out")
+        assert sorted_bam == "test_data/sorted.bam"
+        assert index_filename == "test_data/sorted_out.input.bai"
+        assert not os.path.exists("test_data/sorted.sort.bam")
+        assert not os.path.exists("test_data/sorted.bam.bai")
+
+        # an up-to-date index next to the BAM file is used
+        pysam.index("test_data/sorted.bam")
+        assert find_intersecting_snps.get_sorted_bam(
+            "test_data/sorted.bam", "test_data/sorted_out")[1] == \
+            "test_data/sorted.bam.bai"
+
+        os.remove("test_data/sorted.bam")
+        os.remove("test_data/sorted.bam.bai")
+        os.remove(index_filename)
+
+
+    def test_stale_index(self):
+        """Test that an index that is older than the BAM file is not
+        used, so that the reads fetched are the ones in the BAM file"""
+        self.write_bam("test_data/stale.bam", "coordinate", [10, 30, 50])
+        pysam.index("test_data/stale.bam")
+        # rewrite BAM file with different reads, after the index
+        os.utime("test_data/stale.bam.bai", (0, 0))
+        self.write_bam("test_data/stale.bam", "coordinate", [5, 20, 40, 60])
+
+        sorted_bam, index_filename = find_intersecting_snps.get_sorted_bam(
+            "test_data/stale.bam", "test_data/stale_out")
+        assert index_filename == "test_data/stale_out.input.bai"
+
+        bam = pysam.AlignmentFile(sorted_bam, index_filename=index_filename)
+        assert [read.reference_start for read in
+                bam.fetch("test_chrom")] == [5, 20, 40, 60]
+        bam.close()
+
+        for filename in ("test_data/stale.bam", "test_data/stale.bam.bai",
+                         index_filename):
+            os.remove(filename)
@@ -0,0 +1,375 @@
+import snptable
+import get_as_counts
+
+import gzip
+
+import numpy as np
+
+import pysam
+import pytest
+
+from test_snptable import Data
+
+
+
+class TestAlleleCounter:
+
+    def test_add_reads(self):
+        """Test that read bases are compared to SNP alleles correctly
+        and that reads which do not match either allele are counted
+        as other"""
+        data = Data()
+        data.snp_list = [(10, "A", "C"),
+                         (12, "A", "-"),
+                         (20, "T", "G"),
+                         (25, "AT", "A"),
+                         (40, "C", "G")]
+        data.setup()
+
+        #          0        1         2         3
+        #          123456789012345678901234567890
+        seqs = ["AAAAAAAAAAAAAAAAAAATAAAAAAAAAA",
+                "AAAAAAAAACAAAAAAAAAGAAAAAAAAAA",
+                "AAAAAAAAAGAAAAAAAAAAAAAAAAAAAA",
+                # overlaps SNP at 40 at read position 10
+                "AAAAAAAAACAAAAAAAAAAAAAAAAAAAA",
+                # secondary alignment, should be skipped
+                "AAAAAAAAACAAAAAAAAAGAAAAAAAAAA"]
+        positions = [1, 1, 1, 31, 1]
+        flags = [0, 0, 16, 0, 256]
+
+        sam_file = open(data.sam_filename, "w")
+        data.write_sam_header(sam_file)
+        for i in range(len(seqs)):
+            data.write_sam_read(sam_file, read_name="read%d" % i,
+                                seq=seqs[i], pos=positions[i],
+                                flag=flags[i])
+        sam_file.close()
+
+        sam_file = pysam.Samfile(data.sam_filename)
+        reads = [read for read in sam_file]
+        sam_file.close()
+
+        snp_tab = snptable.SNPTable()
+        snp_tab.read_file(data.snp_filename)
+
+        counter = get_as_counts.AlleleCounter(snp_tab)
+        counter.add_reads(get_as_counts.filter_block(reads))
+
+        # indels at positions 12 and 25 are not counted
+        assert list(snp_tab.snp_pos) == [10, 12, 20, 25, 40]
+        assert list(counter.ref_matches) == [1, 0, 1, 0, 1]
+        assert list(counter.alt_matches) == [1, 0, 1, 0, 0]
+        assert list(counter.oth_matches) == [1, 0, 1, 0, 0]
+        assert counter.ref_matches.dtype == np.uint32
+
+
+    def test_promote_counts(self):
+        """Test that counts are promoted to uint64 rather than
+        overflowing"""
+        data = Data()
+        data.setup()
+
+        sam_file = open(data.sam_filename, "w")
+        data.write_sam_header(sam_file)
+        data.write_sam_read(sam_file, read_name="read1")
+        data.write_sam_read(sam_file, read_name="read2")
+        sam_file.close()
+
+        sam_file = pysam.Samfile(data.sam_filename)
+        reads = [read for read in sam_file]
+        sam_file.close()
+
+        snp_tab = snptable.SNPTable()
+        snp_tab.read_file(data.snp_filename)
+
+        counter = get_as_counts.AlleleCounter(snp_tab)
+        max_count = get_as_counts.UINT32_MAX
+        counter.ref_matches[0] = max_count - 1
+        counter.max_count = max_count - 1
+
+        # both reads match reference allele of first SNP
+        counter.add_reads(reads)
+        assert counter.ref_matches.dtype == np.uint64
+        assert counter.ref_matches[0] == max_count + 1
+        assert counter.alt_matches.dtype == np.uint64
+
+
+    def test_allele_codes(self):
+        alleles = np.array([b"A", b"T", b"AT", b""], dtype="|S10")
+        codes = get_as_counts.get_allele_codes(alleles)
+        assert list(codes) == [ord("A"), ord("T"), 0, 0]
+
+
+    def test_filters(self):
+        """Test that reads are filtered by mapping quality and flags
+        and that bases are filtered by base quality"""
+        data = Data()
+        data.snp_list = [(10, "A", "C"),
+                         (20, "T", "G")]
+        data.setup()
+
+        # first base of read3 and second base of read4 have low
+        # base quality (# is 2)
+        quals = ["B" * 30,
+                 "B" * 30,
+                 "B" * 9 + "#" + "B" * 20,
+                 "B" * 19 + "#" + "B" * 10,
+                 "B" * 30]
+        mapqs = [30, 5, 30, 30, 30]
+        # last read is a duplicate
+        flags = [0, 0, 16, 16, 1024]
+
+        sam_file = open(data.sam_filename, "w")
+        data.write_sam_header(sam_file)
+        for i in range(len(quals)):
+            data.write_sam_read(sam_file, read_name="read%d" % i,
+                                mapq=mapqs[i], flag=flags[i],
+                                qual=quals[i])
+        sam_file.close()
+
+        sam_file = pysam.Samfile(data.sam_filename)
+        reads = [read for read in sam_file]
+        sam_file.close()
+
+        snp_tab = snptable.SNPTable()
+        snp_tab.read_file(data.snp_filename)
+
+        # by default only unmapped and secondary reads are skipped
+        counter = get_as_counts.AlleleCounter(snp_tab)
+        counter.add_reads(get_as_counts.filter_block(reads))
+        assert list(counter.ref_matches) == [5, 0]
+        assert list(counter.oth_matches) == [0, 5]
+
+        exclude_flags = get_as_counts.parse_flags("UNMAP,SECONDARY,DUP")
+        counter = get_as_counts.AlleleCounter(snp_tab, min_baseq=10)
+        counter.add_reads(get_as_counts.filter_block(
+            reads, min_mapq=10, exclude_flags=exclude_flags))
+        assert list(counter.ref_matches) == [2, 0]
+        assert list(counter.oth_matches) == [0, 2]
+
+
+    def test_dedup_overlap(self):
+        """Test that SNPs overlapped by both reads of a pair are only
+        counted once, using the base with the higher quality"""
+        data = Data()
+        data.snp_list = [(10, "A", "C"),
+                         (20, "T", "G")]
+        data.setup()
+
+        #          0        1         2         3
+        #          123456789012345678901234567890
+        seqs = ["AAAAAAAAACAAAAAAAAAAAAAAAAAAAA",
+                # mate is missing
+                "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAA",
+                # mate of first read, overlaps SNPs at positions
+                # 6 and 16, first with higher quality
+                "AAAAAAAAAAAAAAAGAAAAAAAAAAAAAA"]
+        quals = ["B" * 30,
+                 "B" * 30,
+                 "B" * 5 + "I" + "B" * 24]
+        read_names = ["pair1", "pair2", "pair1"]
+        positions = [1, 3, 5]
+        mate_positions = [5, 8, 1]
+        flags = [99, 99, 147]
+
+        sam_file = open(data.sam_filename, "w")
+        data.write_sam_header(sam_file)
+        for i in range(len(seqs)):
+            data.write_sam_read(sam_file, read_name=read_names[i],
+                                seq=seqs[i], qual=quals[i],
+                                pos=positions[i], flag=flags[i],
+                                rnext="=", pnext=mate_positions[i])
+        sam_file.close()
+
+        sam_file = pysam.Samfile(data.sam_filename)
+        reads = [read for read in sam_file]
+        sam_file.close()
+
+        snp_tab = snptable.SNPTable()
+        snp_tab.read_file(data.snp_filename)
+
+        counter = get_as_counts.AlleleCounter(snp_tab)
+        counter.add_reads(reads)
+        assert list(counter.ref_matches) == [2, 0]
+        assert list(counter.alt_matches) == [1, 1]
+        assert list(counter.oth_matches) == [0, 2]
+
+        # add reads one at a time, so that mates are in different
+        # blocks
+        counter = get_as_counts.AlleleCounter(snp_tab, dedup_overlap=True)
+        for read in reads:
+            counter.add_reads([read])
+        counter.finish()
+        assert list(counter.ref_matches) == [2, 0]
+        assert list(counter.alt_matches) == [0, 0]
+        assert list(counter.oth_matches) == [0, 2]
+        assert counter.mate_cache.n_discard_base == 2
+        assert counter.mate_cache.max_size == 2
+        assert len(counter.mate_cache.cache) == 0
+
+
+    def test_parse_flags(self):
+        assert get_as_counts.parse_flags("0x704") == 0x704
+        assert get_as_counts.parse_flags("1796") == 0x704
+        assert get_as_counts.parse_flags("UNMAP,SECONDARY,QCFAIL,DUP") == \
+            0x704
+        try:
+            get_as_counts.parse_flags("UNMAP,NOTAFLAG")
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("expected ValueError for unknown flag")
+
+
+    def test_count_bases(self):
+        """Test counting of A, C, G, T at each SNP for acgt output"""
+        data = Data()
+        data.snp_list = [(10, "A", "C"),
+                         (20, "T", "G"),
+                         (25, "A", "G")]
+        data.setup()
+
+        #          0        1         2         3
+        #          123456789012345678901234567890
+        seqs = ["AAAAAAAAACAAAAAAAAATAAAAAAAAAA",
+                "AAAAAAAAAAAAAAAAAAAGAAAAAAAAAA",
+                "AAAAAAAAANAAAAAAAAAGAAAAAAAAAA"]
+        flags = [0, 16, 0]
+
+        sam_file = open(data.sam_filename, "w")
+        data.write_sam_header(sam_file)
+        for i in range(len(seqs)):
+            data.write_sam_read(sam_file, read_name="read%d" % i,
+                                seq=seqs[i], flag=flags[i])
+        sam_file.close()
+
+        sam_file = pysam.Samfile(data.sam_filename)
+        reads = [read for read in sam_file]
+        sam_file.close()
+
+        snp_tab = snptable.SNPTable()
+        snp_tab.read_file(data.snp_filename)
+
+        counter = get_as_counts.AlleleCounter(snp_tab, count_bases=True)
+        counter.add_reads(reads)
+
+        # N is included in depth but not in base counts
+        assert list(counter.depth) == [3, 3, 3]
+        assert counter.base_counts.tolist() == [[1, 1, 0, 0],
+                                                [0, 0, 2, 1],
+                                                [3, 0, 0, 0]]
+        assert counter.fwd_counts.tolist() == [[0, 1, 0, 0],
+                                               [0, 0, 1, 1],
+                                               [2, 0, 0, 0]]
+
+
+
+class TestWriteResults:
+
+    def get_snp_table(self):
+        data = Data()
+        data.snp_list = [(10, "A", "C"),
+                         (20, "T", "G"),
+                         (25, "AT", "A")]
+        data.setup()
+        snp_tab = snptable.SNPTable()
+        snp_tab.read_file(data.snp_filename)
+        return snp_tab
+
+
+    def test_write_text(self):
+        snp_tab = self.get_snp_table()
+        counts = np.array([1, 70000, 0], dtype=np.uint32)
+
+        for filename, open_f in [("test_data/as_counts.txt", open),
+                                 ("test_data/as_counts.txt.gz", gzip.open)]:
+            writer = get_as_counts.open_writer(filename)
+            get_as_counts.write_results(writer, "chr1", snp_tab, counts,
+                                        counts * 2, counts * 3, None)
+            writer.close()
+
+            f = open_f(filename, "rt")
+            lines = f.readlines()
+            f.close()
+            assert lines == ["chr1 10 A C NA 1 2 3\n",
+                             "chr1 20 T G NA 70000 140000 210000\n",
+                             "chr1 25 AT A NA 0 0 0\n"]
+
+
+    def test_write_parquet(self):
+        pyarrow = pytest.importorskip("pyarrow")
+        import pyarrow.parquet
+
+        snp_tab = self.get_snp_table()
+        counts = np.array([1, 70000, 0], dtype=np.uint32)
+
+        filename = "test_data/as_counts.parquet"
+        writer = get_as_counts.open_writer(filename,
+                                           get_as_counts.OUTPUT_PARQUET)
+        get_as_counts.write_results(writer, "chr1", snp_tab, counts,
+                                    counts * 2, counts * 3, None)
+        get_as_counts.write_results(writer, "chr2", snp_tab, counts,
+                                    counts, counts, None)
+        writer.close()
+
+        parquet_file = pyarrow.parquet.ParquetFile(filename)
+        # one row group for each chromosome
+        assert parquet_file.metadata.num_row_groups == 2
+
+        table = parquet_file.read()
+        assert table.schema.names == get_as_counts.OUTPUT_COLUMNS
+        assert [str(field.type) for field in table.schema] == \
+            ["string", "int64", "string", "string", "string",
+             "uint64", "uint64", "uint64"]
+
+        rows = table.to_pydict()
+        assert rows["CHROM"] == ["chr1"] * 3 + ["chr2"] * 3
+        assert rows["SNP.POS"] == [10, 20, 25] * 2
+        assert rows["REF.ALLELE"] == ["A", "T", "AT"] * 2
+        assert rows["ALT.ALLELE"] == ["C", "G", "A"] * 2
+        assert rows["GENOTYPE"] == ["NA"] * 6
+        assert rows["REF.COUNT"] == [1, 70000, 0] * 2
+        assert rows["ALT.COUNT"] == [2, 140000, 0, 1, 70000, 0]
+        assert rows["OTHER.COUNT"] == [3, 210000, 0, 1, 70000, 0]
+
+
+    def test_genotype_columns(self):
+        snp_tab = self.get_snp_table()
+        snp_tab.samples = ["samp1", "samp2"]
+        snp_tab.haplotypes = np.array([[0, 1, 1, 0],
+                                       [1, 1, 0, -1],
+                                       [0, 0, -1, 1]], dtype=np.int8)
+        counts = np.zeros(3, dtype=np.uint32)
+
+        columns = get_as_counts.get_result_columns("chr1", snp_tab, counts,
+                                                   counts, counts, "samp2")
+        assert len(columns) == len(get_as_counts.OUTPUT_COLUMNS)
+        assert list(columns[4]) == ["1|0", "0|-1", "-1|1"]
+
+
+    def test_write_acgt(self):
+        snp_tab = self.get_snp_table()
+        depth = np.array([4, 0, 2], dtype=np.uint32)
+        base_counts = np.array([[2, 1, 0, 0],
+                                [0, 0, 0, 0],
+                                [2, 0, 0, 0]], dtype=np.uint32)
+        fwd_counts = np.array([[1, 1, 0, 0],
+                               [0, 0, 0, 0],
+                               [0, 0, 0, 0]], dtype=np.uint32)
+
+        filename = "test_data/as_counts.acgt.txt"
+        writer = get_as_counts.open_writer(filename,
+                                           get_as_counts.OUTPUT_ACGT)
+        writer.write_table(get_as_counts.get_acgt_columns(
+            "chr1", snp_tab, depth, base_counts, fwd_counts))
+        writer.close()
+
+        f = open(filename, "rt")
+        lines = f.readlines()
+        f.close()
+
+        # uncovered SNPs and indels are not written
+        assert lines == ["chr\tn.base\tbase.ref\tdepth\tA\tC\tG\tT\t"
+                         "strand\n",
+                         "chr1\t10\tA\t4\t2\t1\t0\t0\t1:1:0:0\n"]
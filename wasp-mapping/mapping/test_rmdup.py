@@ -1,9 +1,13 @@
 import sys
 import os
 import subprocess
+import json
+
+import pysam
 
 import filter_remapped_reads
 import util
+import rmdup
 import rmdup_pe
 
 #
@@ -169,3 +173,217 @@ def test_rmdup_pe():
 
     
     
+
+
+def test_rmdup_pe_evict():
+    test_dir = "test_data"
+    sam_filename = test_dir + "/rmdup_evict.sam"
+    rmdup_output_bam = test_dir + "/rmdup_evict_output.bam"
+
+    seq = "A" * 50
+    qual = "I" * 50
+    sam_lines = [
+        # mate of readpair1 is missing
+        "readpair1	163	chr22	100	12	50M	=	200	150	%s	%s" % (seq, qual),
+        "readpair2	163	chr22	150	12	50M	=	250	150	%s	%s" % (seq, qual),
+        # duplicate of readpair2, but mate is missing
+        "dup_readpair2	163	chr22	150	12	50M	=	250	150	%s	%s" % (seq, qual),
+        "readpair2	83	chr22	250	12	50M	=	150	-150	%s	%s" % (seq, qual),
+        "readpair3	163	chr22	300	12	50M	=	400	150	%s	%s" % (seq, qual),
+        "readpair3	83	chr22	400	12	50M	=	300	-150	%s	%s" % (seq, qual)]
+
+    if not os.path.exists(test_dir):
+        os.makedirs(test_dir)
+    f = open(sam_filename, "w")
+    write_sam_header(f)
+    for line in sam_lines:
+        f.write(line + "\n")
+    f.close()
+
+    infile = pysam.AlignmentFile(sam_filename, "r")
+    outfile = pysam.AlignmentFile(rmdup_output_bam, "wb", template=infile)
+
+    read_stats = rmdup_pe.filter_reads(infile, outfile)
+    infile.close()
+    outfile.close()
+
+    # reads with missing mates are evicted from the caches once
+    # the position of the mate has been passed
+    assert read_stats.evict_keep + read_stats.evict_discard == 2
+    assert read_stats.discard_missing_pair == 2
+    assert read_stats.max_cache <= 3
+    # readpair2 is either kept, or discarded as a duplicate if
+    # dup_readpair2 was chosen as the read to keep
+    assert read_stats.keep_pair + read_stats.discard_dup == 2
+
+    lines = read_bam(rmdup_output_bam)
+    names = set([line.split()[0] for line in lines])
+    assert "readpair1" not in names
+    assert "readpair3" in names
+    assert "dup_readpair2" not in names
+
+
+def test_rmdup_pe_threads():
+    test_dir = "test_data"
+    rmdup_input_bam = "test_data/rmdup_input.bam"
+
+    write_bam_pe(data_dir=test_dir, bam_filename=rmdup_input_bam)
+
+    # same seed should always give the same output, whether
+    # or not chromosomes are processed in parallel
+    rmdup.main(rmdup_input_bam, "test_data/rmdup_output.1.bam",
+               paired_end=True, seed=3)
+    rmdup.main(rmdup_input_bam, "test_data/rmdup_output.2.bam",
+               paired_end=True, seed=3)
+    rmdup.main(rmdup_input_bam, "test_data/rmdup_output.threads.bam",
+               paired_end=True, seed=3, threads=2)
+
+    lines = read_bam("test_data/rmdup_output.1.bam")
+    assert len(lines) == 8
+    assert read_bam("test_data/rmdup_output.2.bam") == lines
+    assert read_bam("test_data/rmdup_output.threads.bam") == lines
+
+    # shard files are removed
+    assert not [x for x in os.listdir(test_dir) if ".shard" in x]
+
+
+
+def test_rmdup_pe_metrics():
+    test_dir = "test_data"
+    rmdup_input_bam = "test_data/rmdup_input.bam"
+
+    write_bam_pe(data_dir=test_dir, bam_filename=rmdup_input_bam)
+    lines = read_bam(rmdup_input_bam)
+    n_read = len(lines)
+    n_unplaced = len([x for x in lines if x.split()[2] == "*"])
+
+    for threads in (1, 2):
+        metrics_filename = "test_data/rmdup_metrics.%d.json" % threads
+        rmdup.main(rmdup_input_bam, "test_data/rmdup_output.metrics.bam",
+                   paired_end=True, threads=threads,
+                   metrics_filename=metrics_filename)
+
+        f = open(metrics_filename)
+        metrics = json.load(f)
+        f.close()
+
+        # reads without coordinates are counted separately
+        chrom_metrics = dict((x["chrom"], x) for x in metrics["chromosomes"])
+        assert set(chrom_metrics.keys()) == set(["chr22", "*"])
+        assert chrom_metrics["chr22"]["counts"]["reads"] == \
+            n_read - n_unplaced
+        assert chrom_metrics["*"]["counts"]["reads"] == n_unplaced
+        assert chrom_metrics["chr22"]["max"]["keep_cache"] > 0
+        assert metrics["total"]["counts"]["reads"] == n_read
+        assert metrics["peak_rss_mb"] > 0
+
+    # metrics are written in long format to files ending with .tsv
+    rmdup.main(rmdup_input_bam, "test_data/rmdup_output.metrics.bam",
+               paired_end=True, metrics_filename="test_data/rmdup_metrics.tsv")
+    f = open("test_data/rmdup_metrics.tsv")
+    lines = f.read().splitlines()
+    f.close()
+    assert lines[0] == "CHROM\tMETRIC\tVALUE"
+    assert "chr22\tcounts.reads\t%d" % (n_read - n_unplaced) in lines
+    assert "total\tcounts.reads\t%d" % n_read in lines
+
+
+
+def test_rmdup_se():
+    test_dir = "test_data"
+    sam_filename = test_dir + "/rmdup_se_input.sam"
+    rmdup_input_bam = test_dir + "/rmdup_se_input.bam"
+
+    seq = "A" * 50
+    qual = "I" * 50
+    sam_lines = [
+        "read1	0	chr22	100	12	50M	*	0	0	%s	%s" % (seq, qual),
+        "read2	0	chr22	100	12	50M	*	0	0	%s	%s" % (seq, qual),
+        "read3	16	chr22	100	12	50M	*	0	0	%s	%s" % (seq, qual),
+        "read4	0	chr22	100	12	50M	*	0	0	%s	%s" % (seq, qual),
+        "read5	0	chr22	200	12	50M	*	0	0	%s	%s" % (seq, qual),
+        "read6	16	chr22	200	12	50M	*	0	0	%s	%s" % (seq, qual),
+        "read7	16	chr22	200	12	50M	*	0	0	%s	%s" % (seq, qual)]
+
+    if not os.path.exists(test_dir):
+        os.makedirs(test_dir)
+    f = open(sam_filename, "w")
+    write_sam_header(f)
+    for line in sam_lines:
+        f.write(line + "\n")
+    f.close()
+    pysam.view("-b", "-o", rmdup_input_bam, sam_filename,
+               catch_stdout=False)
+
+    outputs = []
+    for seed in range(5):
+        rmdup.main(rmdup_input_bam, "test_data/rmdup_se_output.bam",
+                   seed=seed)
+        lines = read_bam("test_data/rmdup_se_output.bam")
+
+        # expect one read per position and strand
+        assert len(lines) == 4
+        assert len(set((x.split()[1], x.split()[3]) for x in lines)) == 4
+        assert "read3" in [x.split()[0] for x in lines]
+        assert "read5" in [x.split()[0] for x in lines]
+
+        # same seed gives same output
+        rmdup.main(rmdup_input_bam, "test_data/rmdup_se_output.2.bam",
+                   seed=seed, threads=2)
+        assert read_bam("test_data/rmdup_se_output.2.bam") == lines
+        outputs.append(lines)
+
+    # different seeds choose different reads
+    assert len(set(tuple(x) for x in outputs)) > 1
+
+
+
+def test_rmdup_se_flags():
+    test_dir = "test_data"
+    sam_filename = test_dir + "/rmdup_se_flags.sam"
+    rmdup_output_bam = test_dir + "/rmdup_se_flags_output.bam"
+
+    seq = "A" * 50
+    qual = "I" * 50
+    sam_lines = [
+        "fwd1	0	chr22	100	12	50M	*	0	0	%s	%s" % (seq, qual),
+        # reads marked as duplicates by other tools are not discarded
+        # because of the mark, but are treated like other reads
+        "fwd2	1024	chr22	100	12	50M	*	0	0	%s	%s" % (seq, qual),
+        "rev1	1040	chr22	100	12	50M	*	0	0	%s	%s" % (seq, qual),
+        "secondary	256	chr22	100	12	50M	*	0	0	%s	%s" % (seq, qual),
+        "supplementary	2048	chr22	100	12	50M	*	0	0	%s	%s" %
+        (seq, qual),
+        "qcfail	512	chr22	150	12	50M	*	0	0	%s	%s" % (seq, qual),
+        "paired	99	chr22	150	12	50M	=	300	200	%s	%s" % (seq, qual),
+        "rev2	16	chr22	150	12	50M	*	0	0	%s	%s" % (seq, qual),
+        "unmapped	4	*	0	0	*	*	0	0	%s	%s" % (seq, qual)]
+
+    if not os.path.exists(test_dir):
+        os.makedirs(test_dir)
+    f = open(sam_filename, "w")
+    write_sam_header(f)
+    for line in sam_lines:
+        f.write(line + "\n")
+    f.close()
+
+    infile = pysam.AlignmentFile(sam_filename, "r")
+    outfile = pysam.AlignmentFile(rmdup_output_bam, "wb", template=infile)
+    read_stats = rmdup.filter_reads(infile, outfile)
+    infile.close()
+    outfile.close()
+
+    assert read_stats.discard_unmapped == 1
+    assert read_stats.discard_secondary == 1
+    assert read_stats.discard_supplementary == 1
+    assert read_stats.discard_qcfail == 1
+    assert read_stats.discard_paired == 1
+    assert read_stats.discard_dup == 1
+    assert read_stats.keep_forward == 1
+    assert read_stats.keep_reverse == 2
+
+    names = [line.split()[0] for line in read_bam(rmdup_output_bam)]
+    assert len(names) == 3
+    assert len(set(names) & set(["fwd1", "fwd2"])) == 1
+    assert "rev1" in names
+    assert "rev2" in names
@@ -3,6 +3,7 @@
 import snptable
 import gzip
 import os
+import shutil
 
 import numpy as np
 
@@ -128,6 +129,35 @@ class TestReadFile(object):
         assert snp_tab.snp_pos[3] == 3
 
 
+    def test_variant_kind(self):
+        data = Data()
+        data.snp_list = [(10, "A", "-"), # 1bp deletion
+                         (20, "A", "ATTG"), # 3bp insertion
+                         (21, "A", "T"), # SNP
+                         (3, "AAA", "A"), # 2bp deletion
+                         (30, "AT", "A"), # 1bp deletion
+                         (40, "A", "N"), # unexpected character
+                         (50, "AT", "GC")] # not a SNP
+        data.setup()
+
+        snp_tab = snptable.SNPTable()
+        snp_tab.read_file(data.snp_filename)
+
+        assert list(snp_tab.variant_kind) == [snptable.VARIANT_INDEL_1BP,
+                                              snptable.VARIANT_INDEL,
+                                              snptable.VARIANT_SNP,
+                                              snptable.VARIANT_INDEL,
+                                              snptable.VARIANT_INDEL_1BP,
+                                              snptable.VARIANT_MALFORMED,
+                                              snptable.VARIANT_INDEL]
+
+        # variant kinds should agree with is_snp
+        for i in range(snp_tab.n_snp):
+            assert snp_tab.is_snp(snp_tab.snp_allele1[i],
+                                  snp_tab.snp_allele2[i]) == \
+                (snp_tab.variant_kind[i] == snptable.VARIANT_SNP)
+
+
 class TestGetOverlappingSNPs:
         
     def test_get_overlapping_snps_simple(self):
@@ -251,3 +281,317 @@ class TestGetOverlappingSNPs:
 
     
 
+
+
+    def test_get_overlapping_indel_deletion(self):
+        """Test that indels in deleted part of read are reported at
+        the last read position before the deletion, and that SNPs in 
+        deleted part of read are ignored"""
+        data = Data()
+        data.snp_list = [(10, "A", "C"),
+                         (12, "A", "-"),
+                         (20, "T", "G")]
+        data.setup()
+
+        # write a single read with a deletion spanning two variants
+        sam_file = open(data.sam_filename, "w")
+        data.write_sam_header(sam_file)
+        data.write_sam_read(sam_file, cigar="8M15D22M")
+        sam_file.close()
+        
+        sam_file = pysam.Samfile(data.sam_filename)
+        read = next(sam_file)
+
+        snp_tab = snptable.SNPTable()
+        snp_tab.read_file(data.snp_filename)
+        snp_idx, snp_read_pos, \
+            indel_idx, indel_read_pos = snp_tab.get_overlapping_snps(read)
+
+        assert len(snp_idx) == 0
+        assert len(indel_idx) == 1
+        assert indel_idx[0] == 1
+        assert indel_read_pos[0] == 8
+
+
+    def test_get_overlapping_snps_bad_cigar(self):
+        """Test that error is raised if CIGAR does not match 
+        length of read"""
+        data = Data()
+        data.setup()
+
+        sam_file = open(data.sam_filename, "w")
+        data.write_sam_header(sam_file)
+        data.write_sam_read(sam_file, cigar="30M")
+        sam_file.close()
+
+        # pysam refuses to read a SAM with inconsistent CIGAR, so
+        # change CIGAR after reading instead
+        sam_file = pysam.Samfile(data.sam_filename)
+        read = next(sam_file)
+        read.cigartuples = [(snptable.BAM_CMATCH, 25)]
+
+        snp_tab = snptable.SNPTable()
+        snp_tab.read_file(data.snp_filename)
+
+        try:
+            snp_tab.get_overlapping_snps(read)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("expected ValueError")
+        
+
+
+class TestGetOverlappingSNPsBatch:
+
+    def test_get_overlapping_snps_reads(self):
+        """Test that looking up SNPs for a block of reads gives 
+        same result as looking up SNPs one read at a time"""
+        data = Data()
+        data.snp_list = [(10, "A", "C"),
+                         (12, "A", "-"),
+                         (20, "T", "G"),
+                         (25, "AT", "A"),
+                         (40, "C", "G")]
+        data.setup()
+
+        cigars = ["30M", "10M85N20M", "10S20M", "8M15D22M",
+                  "5M2I23M", "3H15=1X14=", "30M"]
+        positions = [1, 1, 11, 1, 3, 1, 50]
+        
+        sam_file = open(data.sam_filename, "w")
+        data.write_sam_header(sam_file)
+        for i in range(len(cigars)):
+            data.write_sam_read(sam_file, read_name="read%d" % i,
+                                cigar=cigars[i], pos=positions[i])
+        sam_file.close()
+
+        sam_file = pysam.Samfile(data.sam_filename)
+        reads = [read for read in sam_file]
+        sam_file.close()
+        
+        snp_tab = snptable.SNPTable()
+        snp_tab.read_file(data.snp_filename)
+
+        block_overlaps = snp_tab.get_overlapping_snps_reads(reads)
+        assert len(block_overlaps) == len(reads)
+        for read, overlaps in zip(reads, block_overlaps):
+            assert overlaps == snp_tab.get_overlapping_snps(read)
+
+        # check some of the values directly
+        snp_offsets, snp_idx, snp_read_pos, \
+            indel_offsets, indel_idx, indel_read_pos = \
+            snp_tab.get_overlapping_snps_batch(
+                *snptable.get_cigar_arrays(reads))
+        
+        # first read overlaps 2 SNPs and 2 indels
+        assert list(snp_offsets[:2]) == [0, 2]
+        assert list(snp_idx[0:2]) == [0, 2]
+        assert list(snp_read_pos[0:2]) == [10, 20]
+        assert list(indel_offsets[:2]) == [0, 2]
+        assert list(indel_idx[0:2]) == [1, 3]
+        assert list(indel_read_pos[0:2]) == [12, 25]
+
+        # last read does not overlap anything
+        assert snp_offsets[-2] == snp_offsets[-1]
+        assert indel_offsets[-2] == indel_offsets[-1]
+        assert snp_offsets[-1] == snp_idx.shape[0]
+        assert indel_offsets[-1] == indel_idx.shape[0]
+
+
+    def test_get_overlapping_snps_reads_empty(self):
+        """Test looking up SNPs for an empty block of reads"""
+        data = Data()
+        data.setup()
+
+        snp_tab = snptable.SNPTable()
+        snp_tab.read_file(data.snp_filename)
+
+        assert snp_tab.get_overlapping_snps_reads([]) == []
+
+
+
+class TestSparseIndex:
+
+    def write_reads(self, data):
+        cigars = ["30M", "10M85N20M", "10S20M", "8M15D22M",
+                  "5M2I23M", "3H15=1X14=", "30M"]
+        positions = [1, 1, 11, 1, 3, 1, 50]
+        
+        sam_file = open(data.sam_filename, "w")
+        data.write_sam_header(sam_file)
+        for i in range(len(cigars)):
+            data.write_sam_read(sam_file, read_name="read%d" % i,
+                                cigar=cigars[i], pos=positions[i])
+        sam_file.close()
+
+        sam_file = pysam.Samfile(data.sam_filename)
+        reads = [read for read in sam_file]
+        sam_file.close()
+        return reads
+    
+    
+    def test_sparse_read_file(self):
+        """Test that dense and sparse index give same results
+        when SNPs are read from text file"""
+        data = Data()
+        # SNPs are unsorted and two are at the same position
+        data.snp_list = [(40, "C", "G"),
+                         (10, "A", "C"),
+                         (12, "A", "-"),
+                         (25, "AT", "A"),
+                         (20, "T", "G"),
+                         (12, "A", "G"),
+                         (100, "A", "T")]
+        data.setup()
+        reads = self.write_reads(data)
+
+        dense_tab = snptable.SNPTable(index_type=snptable.SNP_INDEX_DENSE)
+        dense_tab.read_file(data.snp_filename)
+        sparse_tab = snptable.SNPTable(index_type=snptable.SNP_INDEX_SPARSE)
+        sparse_tab.read_file(data.snp_filename)
+
+        assert not dense_tab.is_sparse
+        assert sparse_tab.is_sparse
+        assert sparse_tab.snp_index.shape[0] == 0
+        assert list(sparse_tab.sparse_pos) == [9, 11, 19, 24, 39, 99]
+        assert list(sparse_tab.sparse_idx) == [1, 5, 4, 3, 0, 6]
+
+        for read in reads:
+            assert dense_tab.get_overlapping_snps(read) == \
+                sparse_tab.get_overlapping_snps(read)
+
+
+    def test_auto_index(self):
+        """Test that sparse index is chosen automatically 
+        when SNPs are not dense"""
+        data = Data()
+        data.setup()
+
+        snp_tab = snptable.SNPTable(index_type=snptable.SNP_INDEX_AUTO)
+        snp_tab.read_file(data.snp_filename)
+        assert snp_tab.is_sparse
+
+        data.snp_list = [(i, "A", "C") for i in range(1, 11)]
+        data.setup()
+        snp_tab.read_file(data.snp_filename)
+        assert not snp_tab.is_sparse
+        assert snp_tab.snp_index.shape[0] == 10
+        
+
+    def test_sparse_h5_index(self):
+        """Test conversion of dense HDF5 index to sparse index, 
+        reading index in several chunks"""
+        dense_index = np.full(25, snptable.SNP_UNDEF, dtype=np.int32)
+        dense_index[[3, 9, 10, 24]] = [0, 1, 2, 3]
+
+        snp_tab = snptable.SNPTable(index_type=snptable.SNP_INDEX_SPARSE)
+        chunk_size = snptable.SPARSE_INDEX_CHUNK_SIZE
+        snptable.SPARSE_INDEX_CHUNK_SIZE = 10
+        try:
+            snp_tab.read_h5_sparse_index(dense_index)
+        finally:
+            snptable.SPARSE_INDEX_CHUNK_SIZE = chunk_size
+
+        assert snp_tab.is_sparse
+        assert list(snp_tab.sparse_pos) == [3, 9, 10, 24]
+        assert list(snp_tab.sparse_idx) == [0, 1, 2, 3]
+
+
+    def test_bad_index_type(self):
+        try:
+            snptable.SNPTable(index_type="bad")
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("expected ValueError")
+
+
+
+class TestSNPCache:
+
+    def test_cache_read_file(self):
+        """Test that SNP table read from cache is same as
+        one read from text file"""
+        data = Data()
+        data.snp_list = [(10, "A", "C"),
+                         (12, "A", "-"),
+                         (20, "T", "G"),
+                         (100, "A", "T")]
+        data.setup()
+        cache_dir = data.data_dir + "/snp_cache"
+        if os.path.exists(cache_dir):
+            shutil.rmtree(cache_dir)
+            
+        snp_cache = snptable.SNPCache(cache_dir)
+        snp_tab = snptable.SNPTable()
+        snp_tab.read_file(data.snp_filename, cache=snp_cache)
+
+        # table should have been written to cache
+        cache_path = snp_cache.get_path(data.snp_filename,
+                                        [data.snp_filename])
+        assert os.path.exists(cache_path + "/snp_pos.npy")
+        
+        # read table from cache with a new cache object, using
+        # sparse index
+        snp_cache = snptable.SNPCache(cache_dir)
+        cached_tab = snptable.SNPTable(index_type=snptable.SNP_INDEX_SPARSE)
+        assert snp_cache.load(cached_tab, data.snp_filename,
+                              [data.snp_filename])
+        assert cached_tab.is_sparse
+        assert isinstance(cached_tab.snp_pos, np.memmap)
+        assert cached_tab.n_snp == 4
+        assert list(cached_tab.snp_pos) == list(snp_tab.snp_pos)
+        assert list(cached_tab.snp_allele1) == list(snp_tab.snp_allele1)
+        assert list(cached_tab.snp_allele2) == list(snp_tab.snp_allele2)
+        assert list(cached_tab.variant_kind) == list(snp_tab.variant_kind)
+
+        # dense index should be rebuilt from cache
+        cached_tab = snptable.SNPTable(index_type=snptable.SNP_INDEX_DENSE)
+        cached_tab.read_file(data.snp_filename, cache=snp_cache)
+        assert not cached_tab.is_sparse
+        assert list(cached_tab.snp_index) == list(snp_tab.snp_index)
+
+        # changing SNP file should give a different key, so that
+        # cached table is not used
+        data.snp_list = [(10, "A", "G")]
+        data.setup()
+        snp_cache = snptable.SNPCache(cache_dir)
+        assert not snp_cache.load(cached_tab, data.snp_filename,
+                                  [data.snp_filename])
+        cached_tab.read_file(data.snp_filename, cache=snp_cache)
+        assert cached_tab.n_snp == 1
+        assert cached_tab.snp_allele2[0] == b"G"
+
+        shutil.rmtree(cache_dir)
+
+
+    def test_cache_key(self):
+        """Test that cache keys change when an input file's
+        modification time changes, unless checksums of file contents 
+        are used"""
+        data = Data()
+        data.setup()
+        cache_dir = data.data_dir + "/snp_cache"
+        filenames = [data.snp_filename]
+
+        key = snptable.SNPCache(cache_dir).get_key(filenames)
+        checksum_key = snptable.SNPCache(cache_dir,
+                                         checksum=True).get_key(filenames)
+        assert key != checksum_key
+
+        # same file given by a different path has the same key
+        abs_filenames = [os.path.abspath(data.snp_filename)]
+        assert snptable.SNPCache(cache_dir).get_key(abs_filenames) == key
+
+        # keys are remembered by each cache object
+        snp_cache = snptable.SNPCache(cache_dir)
+        assert snp_cache.get_key(filenames) == key
+        
+        st = os.stat(data.snp_filename)
+        os.utime(data.snp_filename,
+                 ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+        assert snp_cache.get_key(filenames) == key
+        assert snptable.SNPCache(cache_dir).get_key(filenames) != key
+        assert snptable.SNPCache(cache_dir, checksum=True).get_key(
+            filenames) == checksum_key
@@ -1,10 +1,31 @@
 import sys
-import subprocess
 import os
+import gzip
+import zlib
+import collections
+import contextlib
+import concurrent.futures
+import json
+import resource
+import time
 
 
 DNA_COMP = None
 
+# size of blocks of text that are compressed in parallel
+GZIP_BLOCK_SIZE = 4 * 1024 * 1024
+GZIP_LEVEL_DEFAULT = 6
+
+# number of reads between updates of Metrics by loops that process
+# one read at a time
+METRICS_READ_INTERVAL = 10000
+
+# name that Metrics uses for work that is not on a chromosome
+METRICS_NO_CHROM = "*"
+
+# default maximum memory used per thread when sorting BAM files
+SORT_MEM_DEFAULT = "768M"
+
 def comp(seq_str):
     """complements the provided DNA sequence and returns it"""
     global DNA_COMP
@@ -20,45 +41,168 @@ def revcomp(seq_str):
     return comp(seq_str)[::-1]
 
         
-def sort_bam(input_bam, output_prefix):
-    """Calls samtools sort on input_bam filename and writes to
-    output_bam. Takes into account that the command line arguments 
-    for samtools sort have changed between versions."""
+def sort_bam(input_bam, output_prefix, threads=1, sort_mem=SORT_MEM_DEFAULT):
+    """Sorts input_bam by coordinate and writes it to output_prefix +
+    '.sort.bam', returning the name of the sorted file. Sorting is done
+    by pysam.sort, which is a merge sort that uses the given number of
+    threads, and writes temporary files (next to the output file) when
+    it uses more than sort_mem memory per thread."""
+    import pysam
 
     output_bam = output_prefix + ".sort.bam"
-    
-    # first try new way of using samtools sort
-    failed = False
-    cmd = "samtools sort -o " + output_bam + " " + input_bam
-    sys.stderr.write("running command: %s\n" % cmd)
-    try:
-        subprocess.check_call(cmd, shell=True)
-    except Exception as e:
-        sys.stderr.write("samtools sort command failed:\n%s\n" %
-                         str(e))
-        failed = True
+
+    sys.stderr.write("sorting %s with %d threads\n" % (input_bam, threads))
+    pysam.sort("-@", str(threads - 1), "-m", sort_mem,
+               "-T", output_prefix + ".sort.tmp",
+               "-o", output_bam, input_bam)
+
     if not os.path.exists(output_bam):
-        sys.stderr.write("output file %s does not exist\n" % output_bam)
-        failed = True
-        
-    if failed:
-        # OLD way of calling samtools (changed in newer versions)
-        sys.stderr.write("samtools sort command failed, trying old samtools "
-                         "syntax\n")
-        
-        cmd = "samtools sort " + input_bam + " " + output_prefix
-        sys.stderr.write("running command: %s\n" % cmd)
-
-        try:
-            subprocess.check_call(cmd, shell=True)
-        except Exception as e:
-            sys.stderr.write("samtools sort command failed:\n%s\n" %
-                             str(e))
-            exit(1)
-        
-        if not os.path.exists(paths.sorted_output_bam):
-            raise IOError("Failed to create sorted BAM file '%s'" %
-                          paths.sorted_output_bam)
+        raise IOError("Failed to create sorted BAM file '%s'" % output_bam)
+
+    return output_bam
+
+
+
+def get_bam_index(bam_filename, index_filename, threads=1):
+    """Returns the name of an up-to-date index of bam_filename. An
+    existing index next to bam_filename (.bai or .csi) is only used if
+    it is newer than bam_filename, because a stale index makes fetch()
+    silently return the wrong reads. Otherwise bam_filename is indexed
+    and the index is written to index_filename, rather than next to
+    bam_filename, which may be in a directory that is not writable.
+    The BAM file should be opened with pysam.AlignmentFile(bam_filename,
+    index_filename=...) to use the returned index."""
+    import pysam
+
+    bam_mtime = os.path.getmtime(bam_filename)
+    bam_root = os.path.splitext(bam_filename)[0]
+    for filename in (bam_filename + ".bai", bam_root + ".bai",
+                     bam_filename + ".csi", bam_root + ".csi"):
+        if os.path.exists(filename):
+            if os.path.getmtime(filename) >= bam_mtime:
+                return filename
+            sys.stderr.write("WARNING: index %s is older than %s, "
+                             "not using it\n" % (filename, bam_filename))
+
+    sys.stderr.write("indexing %s\n" % bam_filename)
+    pysam.index("-@", str(threads - 1), bam_filename, index_filename)
+
+    return index_filename
+
+
+
+def get_sorted_bam(input_bam, output_prefix, is_sorted=False, threads=1,
+                   sort_mem=SORT_MEM_DEFAULT):
+    """Returns the names of a coordinate-sorted BAM file with the reads
+    from input_bam and of its index. If input_bam is a BAM file whose
+    header (@HD SO field) says that it is sorted by coordinate, it is
+    used as it is. Otherwise it is sorted with sort_bam. If is_sorted
+    is True, input_bam is assumed to be sorted unless its header gives
+    a different sort order. The index is found or created by
+    get_bam_index, and a new index of input_bam is written to
+    output_prefix + '.input.bai'."""
+    import pysam
+
+    bam = pysam.AlignmentFile(input_bam)
+    sort_order = bam.header.to_dict().get("HD", {}).get("SO")
+    is_bam = bam.is_bam
+    bam.close()
+
+    if is_bam and (sort_order == "coordinate" or
+                   (is_sorted and sort_order in (None, "unknown"))):
+        sorted_bam = input_bam
+    else:
+        if is_sorted:
+            sys.stderr.write("WARNING: header of %s gives sort order '%s', "
+                             "sorting it by coordinate\n" %
+                             (input_bam, sort_order))
+        sorted_bam = sort_bam(input_bam, output_prefix, threads=threads,
+                              sort_mem=sort_mem)
+
+    if sorted_bam == input_bam:
+        index_filename = output_prefix + ".input.bai"
+    else:
+        index_filename = sorted_bam + ".bai"
+    index_filename = get_bam_index(sorted_bam, index_filename,
+                                   threads=threads)
+
+    return sorted_bam, index_filename
+
+
+
+def get_indexed_chroms(bam):
+    """returns a list of (tid, name, n_read) tuples for the chromosomes
+    of the indexed pysam AlignmentFile bam that have reads, in the
+    order of the BAM header"""
+    return sorted((bam.get_tid(x.contig), x.contig, x.total)
+                  for x in bam.get_index_statistics() if x.total > 0)
+
+
+
+def get_shard_filename(filename, index, suffix=""):
+    """returns the name of a 'shard' file that a worker process writes
+    output to, which is later merged into filename"""
+    return "%s.shard%d%s" % (filename, index, suffix)
+
+
+
+def remove_files(filenames):
+    """removes the files and directories in filenames that exist"""
+    import shutil
+
+    for filename in filenames:
+        if os.path.isdir(filename):
+            shutil.rmtree(filename)
+        elif os.path.exists(filename):
+            os.remove(filename)
+
+
+
+@contextlib.contextmanager
+def removing_files(filenames):
+    """Context manager that removes the files (and directories) in the
+    list filenames when the block is left, including when an exception
+    is raised, so that shards and temporary files are not left behind
+    by a failed run. Names can be added to the list inside the block."""
+    try:
+        yield filenames
+    finally:
+        remove_files(filenames)
+
+
+
+def run_chrom_job(args):
+    """runs a job in a worker process, returning its index and result"""
+    func, i, job_args = args
+    return i, func(job_args)
+
+
+
+def run_chrom_workers(func, job_args, threads, sizes=None):
+    """Calls func on each of job_args (typically one per chromosome) in
+    a pool of threads worker processes, and returns the results in the
+    order of job_args. If sizes are given, the largest jobs are started
+    first so that big chromosomes do not hold up the end of the run.
+    Workers are started with spawn rather than fork, so that they do
+    not inherit HDF5 library state or open files from this process."""
+    import multiprocessing
+
+    order = list(range(len(job_args)))
+    if sizes is not None:
+        order.sort(key=lambda i: sizes[i], reverse=True)
+
+    sys.stderr.write("processing %d chromosomes with %d worker "
+                     "processes\n" % (len(job_args), threads))
+
+    results = [None] * len(job_args)
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(threads) as pool:
+        for i, result in pool.imap_unordered(
+                run_chrom_job, [(func, i, job_args[i]) for i in order],
+                chunksize=1):
+            results[i] = result
+
+    return results
 
 
 
@@ -78,6 +222,332 @@ def is_gzipped(filename):
     return (byte1 == b'\x1f') and (byte2== b'\x8b')
 
 
+class ParallelGzipWriter(object):
+    """File-like object that writes text to a gzip file, compressing
+    blocks of text in parallel using a pool of threads (zlib releases
+    the GIL while it compresses). Each block is written as a separate
+    gzip member, which is still a valid gzip file that can be read by 
+    gzip / zcat. Blocks are written in the order they were filled, so 
+    the output does not depend on the number of threads."""
+
+    def __init__(self, filename, threads=2, level=GZIP_LEVEL_DEFAULT,
+                 block_size=GZIP_BLOCK_SIZE):
+        self.f = open(filename, "wb")
+        self.level = level
+        self.block_size = block_size
+        self.buf = []
+        self.buf_len = 0
+        self.pool = concurrent.futures.ThreadPoolExecutor(threads)
+        # compressed blocks that have not been written yet; the
+        # number is limited to bound memory usage
+        self.pending = collections.deque()
+        self.max_pending = threads * 2
+        self.n_block = 0
+
+
+    def compress_block(self, data):
+        """returns data compressed as a single gzip member"""
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+
+        
+    def write_pending(self, max_pending):
+        """writes compressed blocks until at most max_pending 
+        are left"""
+        while len(self.pending) > max_pending:
+            self.f.write(self.pending.popleft().result())
+
+            
+    def flush_block(self):
+        """submits the buffered text to be compressed"""
+        if self.buf_len == 0:
+            return
+        data = "".join(self.buf).encode("utf-8")
+        self.buf = []
+        self.buf_len = 0
+        self.pending.append(self.pool.submit(self.compress_block, data))
+        self.n_block += 1
+        self.write_pending(self.max_pending)
+        
+
+    def write(self, text):
+        self.buf.append(text)
+        self.buf_len += len(text)
+        if self.buf_len >= self.block_size:
+            self.flush_block()
+
+
+    def close(self):
+        self.flush_block()
+        self.write_pending(0)
+        if self.n_block == 0:
+            # write an empty gzip member, so that file is valid gzip
+            self.f.write(self.compress_block(b""))
+        self.pool.shutdown()
+        self.f.close()
+
+        
+
+def open_gzip_writer(filename, threads=1, level=GZIP_LEVEL_DEFAULT):
+    """Opens filename for writing gzipped text. If threads > 1,
+    blocks of text are compressed in parallel by a ParallelGzipWriter"""
+    if threads > 1:
+        return ParallelGzipWriter(filename, threads=threads, level=level)
+    return gzip.open(filename, "wt", compresslevel=level)
+
+
+
+def get_peak_rss_mb(children=False):
+    """returns the peak resident set size of this process in MB. If
+    children is True, returns the peak resident set size of the
+    largest single child process that has finished (not the sum over
+    child processes) instead."""
+    if children:
+        who = resource.RUSAGE_CHILDREN
+    else:
+        who = resource.RUSAGE_SELF
+    rss = resource.getrusage(who).ru_maxrss
+    if sys.platform == "darwin":
+        # ru_maxrss is in bytes on macOS, and in kB elsewhere
+        return rss / (1024.0 * 1024.0)
+    return rss / 1024.0
+
+
+
+class Metrics(object):
+    """Records the wall time spent on each chromosome (or other unit
+    of work) and in each phase of processing, counts of reads and other
+    items, the largest sizes of caches, and peak memory use, so that
+    they can be written to a JSON or TSV metrics file. If
+    progress_interval is greater than 0, progress() writes a line to
+    stderr at most once every progress_interval seconds."""
+
+    def __init__(self, progress_interval=0):
+        self.progress_interval = progress_interval
+        self.start_time = time.perf_counter()
+        self.last_progress = self.start_time
+        self.wall_seconds = 0.0
+        self.peak_rss_mb = 0.0
+
+        # current chromosome, and time that it was started
+        self.chrom = METRICS_NO_CHROM
+        self.chrom_start = None
+
+        # chromosomes in the order they were started
+        self.chroms = []
+
+        # seconds spent on each chromosome
+        self.chrom_seconds = {}
+
+        # seconds spent in each phase, counts, and maximum values,
+        # as dictionaries keyed on chromosome
+        self.phase_seconds = {}
+        self.counts = {}
+        self.max_values = {}
+
+        # last running totals given to update_count
+        self.totals = {}
+
+
+    def start_chrom(self, chrom_name):
+        """ends the current chromosome and starts timing chrom_name"""
+        self.end_chrom()
+        self.chrom = chrom_name
+        if chrom_name not in self.chrom_seconds:
+            self.chroms.append(chrom_name)
+            self.chrom_seconds[chrom_name] = 0.0
+        self.chrom_start = time.perf_counter()
+
+
+    def end_chrom(self):
+        """stops timing the current chromosome"""
+        if self.chrom_start is not None:
+            self.chrom_seconds[self.chrom] += time.perf_counter() - \
+                self.chrom_start
+            self.chrom_start = None
+        self.chrom = METRICS_NO_CHROM
+        self.peak_rss_mb = max(self.peak_rss_mb, get_peak_rss_mb())
+
+
+    def add_time(self, phase, seconds):
+        """adds seconds to the time spent in phase on the current
+        chromosome"""
+        phases = self.phase_seconds.setdefault(self.chrom, {})
+        phases[phase] = phases.get(phase, 0.0) + seconds
+
+
+    def count(self, name, n=1):
+        """adds n to a count for the current chromosome"""
+        counts = self.counts.setdefault(self.chrom, {})
+        counts[name] = counts.get(name, 0) + n
+
+
+    def update_count(self, name, total):
+        """updates a count from a running total that is kept elsewhere
+        (e.g. by a cache), adding the increase since the last update
+        to the current chromosome"""
+        n = total - self.totals.get(name, 0)
+        self.totals[name] = total
+        if n:
+            self.count(name, n)
+
+
+    def set_max(self, name, value):
+        """records value if it is the largest seen for name on the
+        current chromosome"""
+        if value > self.max_values.get(self.chrom, {}).get(name, 0):
+            self.max_values.setdefault(self.chrom, {})[name] = value
+
+
+    def progress(self):
+        """writes a progress line if progress_interval seconds have
+        passed since the last one"""
+        if self.progress_interval <= 0:
+            return
+        now = time.perf_counter()
+        if now - self.last_progress < self.progress_interval:
+            return
+        self.last_progress = now
+
+        n_read = self.counts.get(self.chrom, {}).get("reads", 0)
+        if self.chrom_start is not None and now > self.chrom_start:
+            read_rate = n_read / (now - self.chrom_start)
+        else:
+            read_rate = 0.0
+        sys.stderr.write("progress: %s: %d reads (%.0f reads/sec), "
+                         "%.1f seconds elapsed, peak RSS %.1f MB\n" %
+                         (self.chrom, n_read, read_rate,
+                          now - self.start_time, get_peak_rss_mb()))
+
+
+    def add(self, other):
+        """adds the metrics from another Metrics object to this one
+        (e.g. to combine metrics from separate worker processes)"""
+        for chrom_name in other.chroms:
+            if chrom_name not in self.chrom_seconds:
+                self.chroms.append(chrom_name)
+                self.chrom_seconds[chrom_name] = 0.0
+            self.chrom_seconds[chrom_name] += other.chrom_seconds[chrom_name]
+
+        for chrom_name, phases in other.phase_seconds.items():
+            self_phases = self.phase_seconds.setdefault(chrom_name, {})
+            for phase, seconds in phases.items():
+                self_phases[phase] = self_phases.get(phase, 0.0) + seconds
+
+        for chrom_name, counts in other.counts.items():
+            self_counts = self.counts.setdefault(chrom_name, {})
+            for name, n in counts.items():
+                self_counts[name] = self_counts.get(name, 0) + n
+
+        for chrom_name, max_values in other.max_values.items():
+            self_max_values = self.max_values.setdefault(chrom_name, {})
+            for name, value in max_values.items():
+                self_max_values[name] = max(self_max_values.get(name, 0),
+                                            value)
+
+        self.peak_rss_mb = max(self.peak_rss_mb, other.peak_rss_mb)
+
+
+    def finish(self):
+        """stops timing, and records total wall time and peak memory"""
+        self.end_chrom()
+        self.wall_seconds = time.perf_counter() - self.start_time
+
+
+    def get_summary(self, seconds, phases, counts, max_values):
+        if seconds > 0 and "reads" in counts:
+            read_rate = counts["reads"] / seconds
+        else:
+            read_rate = None
+
+        # fraction of cache lookups that were hits, from counts
+        # named <cache>_hits and <cache>_misses
+        hit_rates = {}
+        for name in counts:
+            if name.endswith("_hits") or name.endswith("_misses"):
+                cache_name = name.rsplit("_", 1)[0]
+                n_hit = counts.get(cache_name + "_hits", 0)
+                n_miss = counts.get(cache_name + "_misses", 0)
+                hit_rates[cache_name] = float(n_hit) / (n_hit + n_miss)
+
+        return {"seconds" : seconds,
+                "reads_per_second" : read_rate,
+                "phases" : dict(phases),
+                "counts" : dict(counts),
+                "max" : dict(max_values),
+                "hit_rates" : hit_rates}
+
+
+    def to_dict(self):
+        """returns the metrics as a dictionary, with a summary for
+        each chromosome and a summary of all chromosomes"""
+        chroms = list(self.chroms)
+        for chrom_name in list(self.phase_seconds) + list(self.counts) + \
+                list(self.max_values):
+            # work that was not on a chromosome
+            if chrom_name not in chroms:
+                chroms.append(chrom_name)
+
+        chrom_summaries = []
+        total_phases = {}
+        total_counts = {}
+        total_max_values = {}
+        for chrom_name in chroms:
+            summary = self.get_summary(self.chrom_seconds.get(chrom_name, 0.0),
+                                       self.phase_seconds.get(chrom_name, {}),
+                                       self.counts.get(chrom_name, {}),
+                                       self.max_values.get(chrom_name, {}))
+            summary["chrom"] = chrom_name
+            chrom_summaries.append(summary)
+
+            # combine metrics for all chromosomes
+            for phase, seconds in summary["phases"].items():
+                total_phases[phase] = total_phases.get(phase, 0.0) + seconds
+            for name, n in summary["counts"].items():
+                total_counts[name] = total_counts.get(name, 0) + n
+            for name, value in summary["max"].items():
+                total_max_values[name] = max(total_max_values.get(name, 0),
+                                             value)
+
+        total_summary = self.get_summary(self.wall_seconds, total_phases,
+                                         total_counts, total_max_values)
+
+        return {"command" : " ".join(sys.argv),
+                "wall_seconds" : self.wall_seconds,
+                "peak_rss_mb" : self.peak_rss_mb,
+                "total" : total_summary,
+                "chromosomes" : chrom_summaries}
+
+
+    def write(self, filename):
+        """writes the metrics to filename, in TSV format if the name
+        ends with .tsv and in JSON format otherwise"""
+        metrics = self.to_dict()
+
+        f = open(filename, "w")
+        if not filename.endswith(".tsv"):
+            json.dump(metrics, f, indent=2, sort_keys=True)
+            f.write("\n")
+            f.close()
+            return
+
+        # write one metric per line, in long format
+        f.write("CHROM\tMETRIC\tVALUE\n")
+        f.write("total\twall_seconds\t%g\n" % metrics["wall_seconds"])
+        f.write("total\tpeak_rss_mb\t%g\n" % metrics["peak_rss_mb"])
+        metrics["total"]["chrom"] = "total"
+        for summary in metrics["chromosomes"] + [metrics["total"]]:
+            rows = [("seconds", summary["seconds"])]
+            if summary["reads_per_second"] is not None:
+                rows.append(("reads_per_second", summary["reads_per_second"]))
+            for key in ("phases", "counts", "max", "hit_rates"):
+                rows.extend(("%s.%s" % (key, name), value) for name, value
+                            in sorted(summary[key].items()))
+            for name, value in rows:
+                f.write("%s\t%s\t%g\n" % (summary["chrom"], name, value))
+        f.close()
+
+
 
 def check_pysam_version(min_pysam_ver="0.8.4"):
     """Checks that the imported version of pysam is greater than